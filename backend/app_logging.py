@@ -0,0 +1,275 @@
+"""
+app_logging.py
+
+This module provides non-blocking logging for the device. Loggers only put
+records on a bounded queue; a background thread formats them, keeps the
+most recent ones in an in-memory ring buffer (served by GET /debug/logs) and
+writes them to the output in batches, one write and flush per batch.
+
+Output is rate-limited so a burst of per-command logs cannot flood the SD
+card: records over the limit are kept in the ring buffer but not written,
+and a summary of how many were suppressed is written before the next
+written record, once the limit allows again, or when logging stops. When the
+queue is full, records are dropped rather than blocking the API or the
+WebSocket loop.
+"""
+
+import collections
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, TextIO
+
+from memory import approximate_size, memory_monitor
+from metrics import registry
+
+LOG_RECORDS = registry.counter("log_records_total", "Log records by level.", labels=("level",))
+LOG_DROPPED = registry.counter("log_records_dropped_total",
+                               "Log records not written, because the queue was full or by rate limit.",
+                               labels=("reason",))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def record_to_dict(record: logging.LogRecord) -> Dict[str, Any]:
+    """Convert a log record to a JSON-serializable dictionary."""
+    entry = {
+        "timestamp": record.created,
+        "level": record.levelname,
+        "logger": record.name,
+        "message": record.getMessage(),
+        "thread": record.threadName,
+    }
+    if record.exc_info:
+        entry["exception"] = logging.Formatter().formatException(record.exc_info)
+    for key, value in vars(record).items():
+        if key not in _RECORD_ATTRIBUTES:
+            entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+    return entry
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record_to_dict(record), separators=(",", ":"))
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records when the queue is full instead of blocking."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the writer thread. The message arguments are
+        # resolved now, since mutable arguments may change before it runs.
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.labels("queue_full").inc()
+
+class LogPipeline:
+    """The background writer: drains the queue, fills the ring buffer and writes batches."""
+
+    def __init__(self, stream: Optional[TextIO] = None, json_output: bool = False,
+                 queue_size: int = 10000, ring_size: int = 1000, batch_size: int = 100,
+                 flush_interval: float = 0.5, rate_limit: float = 50, burst: int = 200):
+        """
+        Args:
+            stream: Where records are written (defaults to stderr, i.e. the journal)
+            json_output: Write one JSON object per line instead of text
+            queue_size: Records buffered before new ones are dropped
+            ring_size: Recent records kept in memory for /debug/logs
+            batch_size: Maximum records per write
+            flush_interval: Seconds to wait for more records before writing a batch
+            rate_limit: Records per second written on average (0 for no limit)
+            burst: Records that may be written at once after a quiet period
+        """
+        self.stream = stream if stream is not None else sys.stderr
+        self.formatter = JsonFormatter() if json_output else logging.Formatter(TEXT_FORMAT)
+        self.queue: "queue.Queue[Optional[logging.LogRecord]]" = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.ring = collections.deque(maxlen=ring_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._suppressed = 0
+        self._ring_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the writer thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        """Write everything queued so far and stop the writer thread."""
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def records(self, limit: int = 100, level: Optional[str] = None,
+                logger_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Get the most recent records, newest last, optionally filtered."""
+        minimum = logging.getLevelName(level.upper()) if level else 0
+        if not isinstance(minimum, int):
+            raise ValueError(f"Unknown log level: {level}")
+        with self._ring_lock:
+            entries = list(self.ring)
+        entries = [
+            entry for entry in entries
+            if logging.getLevelName(entry["level"]) >= minimum
+            and (logger_name is None or entry["logger"] == logger_name
+                 or entry["logger"].startswith(logger_name + "."))
+        ]
+        return entries[-limit:]
+
+    def ring_size(self) -> int:
+        """Estimate the memory held by the ring buffer in bytes."""
+        with self._ring_lock:
+            entries = list(self.ring)
+        return approximate_size(entries)
+
+    def clear_ring(self):
+        """Drop the records kept in memory."""
+        with self._ring_lock:
+            self.ring.clear()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch: List[logging.LogRecord] = []
+            try:
+                # While records are suppressed, wake up to report them once the limit allows
+                record = self.queue.get(timeout=self.flush_interval if self._suppressed else None)
+            except queue.Empty:
+                self._write(batch)
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            self._write(batch, final=stopping)
+
+    def _refill(self) -> float:
+        """Add the tokens earned since the last refill. Returns the tokens available."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate_limit)
+        self._refilled_at = now
+        return self._tokens
+
+    def _allow(self) -> bool:
+        """Take a token from the rate limiter."""
+        if not self.rate_limit:
+            return True
+        if self._refill() >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _summary(self) -> str:
+        line = f"... {self._suppressed} log records suppressed by rate limit"
+        self._suppressed = 0
+        return line
+
+    def _write(self, batch: List[logging.LogRecord], final: bool = False):
+        """Write a batch; final writes the summary of suppressed records even if the limit is still hit."""
+        lines = []
+        with self._ring_lock:
+            for record in batch:
+                self.ring.append(record_to_dict(record))
+        for record in batch:
+            LOG_RECORDS.labels(record.levelname).inc()
+            # Warnings and errors are always written
+            if record.levelno >= logging.WARNING or self._allow():
+                if self._suppressed:
+                    lines.append(self._summary())
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:
+                    lines.append(f"Unformattable log record from {record.name}: {record.msg!r}")
+            else:
+                self._suppressed += 1
+                LOG_DROPPED.labels("rate_limit").inc()
+        if self._suppressed and (final or self._refill() >= 1):
+            lines.append(self._summary())
+        if not lines:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            pass  # Nowhere left to report it
+
+# The pipeline installed by setup_logging
+pipeline: Optional[LogPipeline] = None
+
+def setup_logging(level: str = "INFO", json_output: bool = False, log_file: Optional[str] = None,
+                  rate_limit: float = 50, ring_size: int = 1000) -> LogPipeline:
+    """
+    Route all logging through a queued, batched, rate-limited writer.
+
+    Replaces the handlers of the root logger, so it should be called once,
+    early in main().
+
+    Args:
+        level: Minimum level of records handled
+        json_output: Write one JSON object per line
+        log_file: Append to this file instead of writing to stderr
+        rate_limit: Records per second written on average (0 for no limit)
+        ring_size: Recent records kept in memory for /debug/logs
+    """
+    global pipeline
+    if pipeline is not None:
+        shutdown_logging()
+
+    stream = open(log_file, "a", encoding="utf-8") if log_file else None
+    pipeline = LogPipeline(stream, json_output, rate_limit=rate_limit, ring_size=ring_size)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(pipeline.handler)
+    root.setLevel(level.upper())
+    pipeline.start()
+    memory_monitor.register("logs", pipeline.ring_size, pipeline.clear_ring, priority=10)
+    return pipeline
+
+def shutdown_logging():
+    """Flush and stop the writer installed by setup_logging."""
+    global pipeline
+    if pipeline is None:
+        return
+    logging.getLogger().removeHandler(pipeline.handler)
+    memory_monitor.unregister("logs")
+    pipeline.stop()
+    if pipeline.stream not in (sys.stderr, sys.stdout):
+        pipeline.stream.close()
+    pipeline = None
+
+def recent_records(limit: int = 100, level: Optional[str] = None,
+                   logger_name: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Get recent records from the installed pipeline (empty if logging was not set up)."""
+    if pipeline is None:
+        return []
+    return pipeline.records(limit, level, logger_name)
@@ -0,0 +1,504 @@
+"""
+asset_sync.py
+
+This module keeps the device's sounds and icons in sync with the hub.
+
+The hub publishes a manifest of the asset files, by content hash (see
+hub.assets):
+
+    GET /assets/manifest
+    {"revision": "<sha256 of the file list>",
+     "files": {"sounds/book.mp3": {"digest": "<sha256>", "size": 48213}, ...}}
+
+The first path level names an asset root ("sounds", "icons"), which the
+device maps to a local directory. The device fetches the manifest
+(conditionally, with the last revision as ETag), downloads the blobs it
+does not have yet from GET /assets/blobs/<digest> and installs them:
+
+- Blobs are stored once per digest in a BlobStore, however many files
+  share the content, and kept across syncs; renaming or reverting a file
+  downloads nothing.
+- Downloads fetch Range chunks into a partial file that survives failed
+  attempts and restarts, so an interrupted transfer resumes where it
+  stopped. A few blobs download at the same time, and failed chunks are
+  retried with decorrelated jitter backoff (see backoff). The partial
+  downloads of blobs a newer manifest no longer lists are deleted with the
+  unused blobs, so a blob dropped and listed again starts over.
+- Nothing is installed until every blob is downloaded and its digest
+  verified. Each file is then replaced with os.replace, so readers see the
+  old or the new file, never a partial one, and files dropped from the
+  manifest are removed. The installed revision is recorded last.
+
+Files the device has that the hub never listed are left alone.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import httpx
+
+from backoff import DecorrelatedJitterBackoff
+from clock import Clock, system_clock
+from metrics import registry
+from sound_library import sound_library
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024  # Bytes per Range request
+HASH_BLOCK_SIZE = 1024 * 1024
+INSTALLED_FILE = "installed.json"
+
+ASSET_SYNCS = registry.counter("asset_syncs_total", "Asset syncs, by result.", labels=("result",))
+ASSET_SYNC = registry.histogram("asset_sync_seconds", "Time taken by asset syncs that changed files.")
+ASSET_BYTES = registry.counter("asset_downloaded_bytes_total", "Asset bytes downloaded from the hub.")
+ASSET_RETRIES = registry.counter("asset_download_retries_total", "Asset chunk downloads retried.")
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+def valid_digest(digest: str) -> bool:
+    """Check that a string is a lowercase hex SHA-256 digest."""
+    return bool(_DIGEST.fullmatch(digest))
+
+def file_digest(path: str) -> str:
+    """Get the SHA-256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def manifest_revision(files: Dict[str, Dict[str, Any]]) -> str:
+    """Get the revision of a manifest file list: a digest of its paths and digests."""
+    listing = json.dumps({path: entry["digest"] for path, entry in sorted(files.items())},
+                         separators=(",", ":"))
+    return hashlib.sha256(listing.encode()).hexdigest()
+
+def build_manifest(roots: Dict[str, str]) -> Dict[str, Any]:
+    """
+    List the files of asset directories with their digests.
+
+    Args:
+        roots: Asset root name -> directory; hidden files and directories are skipped
+
+    Returns:
+        The manifest, with paths "<root>/<path in the directory>"
+    """
+    files = {}
+    for root, directory in roots.items():
+        for parent, dirnames, filenames in os.walk(directory):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+            for name in sorted(filenames):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(parent, name)
+                relative = os.path.relpath(path, directory).replace(os.sep, "/")
+                files[f"{root}/{relative}"] = {"digest": file_digest(path), "size": os.path.getsize(path)}
+    return {"revision": manifest_revision(files), "files": files}
+
+class AssetSyncError(Exception):
+    """An asset sync failed; the installed files were left unchanged."""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable  # A blob request that may succeed when retried
+
+class BlobStore:
+    """Files stored once per content digest, under <directory>/<digest[:2]>/<digest>."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.partial_directory = os.path.join(directory, "partial")
+        os.makedirs(self.partial_directory, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def partial_path(self, digest: str) -> str:
+        """Where the download of a blob is kept until it is complete."""
+        return os.path.join(self.partial_directory, digest)
+
+    def __contains__(self, digest: str) -> bool:
+        return os.path.isfile(self.path(digest))
+
+    def digests(self) -> Set[str]:
+        """Get the digests of the stored blobs."""
+        return {name for parent, _, names in os.walk(self.directory) if parent != self.partial_directory
+                for name in names if valid_digest(name)}
+
+    def commit(self, digest: str):
+        """
+        Move a completed download into the store, after verifying its digest.
+
+        Raises:
+            AssetSyncError: If the content does not match the digest (the download is discarded)
+        """
+        partial = self.partial_path(digest)
+        actual = file_digest(partial)
+        if actual != digest:
+            os.unlink(partial)
+            raise AssetSyncError(f"Blob {digest} has digest {actual}")
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        os.replace(partial, self.path(digest))
+
+    def remove_unused(self, keep: Iterable[str]) -> int:
+        """
+        Delete the blobs and partial downloads not in keep.
+
+        Returns:
+            The number of blobs deleted
+        """
+        keep = set(keep)
+        removed = 0
+        for digest in self.digests() - keep:
+            os.unlink(self.path(digest))
+            removed += 1
+        for name in os.listdir(self.partial_directory):
+            if name not in keep:
+                os.unlink(os.path.join(self.partial_directory, name))
+        return removed
+
+class AssetSync:
+    """Downloads the assets listed by the hub and installs them into local directories."""
+
+    def __init__(self, base_url: str, roots: Dict[str, str], store_dir: str, concurrency: int = 4,
+                 chunk_size: int = CHUNK_SIZE, max_attempts: int = 5, retry_base: float = 0.5,
+                 retry_cap: float = 30.0, timeout: float = 30.0,
+                 transport: Optional[httpx.AsyncBaseTransport] = None, clock: Optional[Clock] = None):
+        """
+        Args:
+            base_url: URL of the hub's REST API
+            roots: Asset root name -> local directory (e.g. {"sounds": "sounds"});
+                manifest files under other roots are skipped
+            store_dir: Directory of the blob store and the installed revision
+            concurrency: Blobs downloaded at the same time
+            chunk_size: Bytes per Range request
+            max_attempts: Failed requests in a row after which a blob download gives up
+            retry_base: Minimum delay before retrying a request, in seconds
+            retry_cap: Maximum delay before retrying a request, in seconds
+            timeout: Seconds a request may take
+            transport: httpx transport (for tests)
+            clock: Clock for the retry delays (defaults to the system clock)
+        """
+        self.base_url = base_url.rstrip("/")
+        self.roots = roots
+        self.store = BlobStore(os.path.join(store_dir, "blobs"))
+        self.installed_path = os.path.join(store_dir, INSTALLED_FILE)
+        self.lock_path = os.path.join(store_dir, "sync.lock")
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.timeout = timeout
+        self.transport = transport
+        self.clock = clock or system_clock
+        self.installed = self._load_installed()
+        self._sync_lock = asyncio.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    @property
+    def revision(self) -> Optional[str]:
+        """The revision of the installed manifest."""
+        return self.installed.get("revision")
+
+    async def sync(self) -> Dict[str, Any]:
+        """
+        Bring the local asset directories to the hub's current manifest.
+
+        Returns:
+            Counts of the sync: downloaded (blobs), bytes, installed and removed (files)
+
+        Raises:
+            AssetSyncError: If the manifest or a blob could not be fetched
+        """
+        async with self._sync_lock:
+            # Processes overlap during a handover (see handoff), only one may sync
+            with open(self.lock_path, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise AssetSyncError("Another process is syncing the assets")
+                # The other process may have installed a newer revision
+                self.installed = self._load_installed()
+                return await self._sync()
+
+    async def _sync(self) -> Dict[str, Any]:
+        started_at = time.perf_counter()
+        limits = httpx.Limits(max_connections=self.concurrency)
+        try:
+            async with httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=limits,
+                                         transport=self.transport) as client:
+                manifest = await self._fetch_manifest(client)
+                if manifest is None:
+                    ASSET_SYNCS.labels("unchanged").inc()
+                    return {"revision": self.revision, "downloaded": 0, "bytes": 0, "installed": 0,
+                            "removed": 0}
+                files = self._accepted_files(manifest["files"])
+                missing = {entry["digest"]: entry["size"] for entry in files.values()
+                           if entry["digest"] not in self.store}
+                downloaded = await self._download_all(client, missing)
+        except AssetSyncError:
+            ASSET_SYNCS.labels("failed").inc()
+            raise
+        except httpx.HTTPError as e:
+            ASSET_SYNCS.labels("failed").inc()
+            raise AssetSyncError(f"{type(e).__name__}: {e}") from e
+
+        installed, removed = self._install(manifest["revision"], files)
+        self.store.remove_unused(entry["digest"] for entry in files.values())
+        ASSET_SYNCS.labels("changed").inc()
+        ASSET_SYNC.observe(time.perf_counter() - started_at)
+        logger.info(f"Synced assets to revision {manifest['revision'][:12]}: {len(missing)} blobs "
+                    f"downloaded, {installed} files installed, {removed} removed")
+        return {"revision": manifest["revision"], "downloaded": len(missing), "bytes": sum(downloaded),
+                "installed": installed, "removed": removed}
+
+    async def _fetch_manifest(self, client: httpx.AsyncClient) -> Optional[Dict[str, Any]]:
+        """Get the hub's manifest, or None if it is the installed revision."""
+        headers = {"If-None-Match": f'"{self.revision}"'} if self.revision else {}
+        response = await client.get("/assets/manifest", headers=headers)
+        if response.status_code == 304:
+            return None
+        if response.status_code != 200:
+            raise AssetSyncError(f"Manifest request failed: HTTP {response.status_code}")
+        manifest = response.json()
+        if manifest.get("revision") == self.revision:
+            return None
+        return manifest
+
+    def _accepted_files(self, files: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Get the manifest files that map into a local root, skipping malformed entries."""
+        accepted = {}
+        for path, entry in files.items():
+            if (self._destination(path) is None or not valid_digest(str(entry.get("digest")))
+                    or not isinstance(entry.get("size"), int)):
+                logger.warning(f"Skipping asset {path!r}")
+                continue
+            accepted[path] = entry
+        return accepted
+
+    def _destination(self, path: str) -> Optional[str]:
+        """Get the local path of a manifest path, or None if it has no root here or leaves its root."""
+        root, _, relative = path.partition("/")
+        directory = self.roots.get(root)
+        parts = relative.split("/")
+        if directory is None or not relative or any(part in ("", ".", "..") or part.startswith(".")
+                                                    or "\\" in part for part in parts):
+            return None
+        return os.path.join(directory, *parts)
+
+    async def _download_all(self, client: httpx.AsyncClient, blobs: Dict[str, int]) -> List[int]:
+        """Download blobs, a few at a time. When one fails the others stop too, keeping what they fetched."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.ensure_future(self._download(client, digest, size, semaphore))
+                 for digest, size in blobs.items()]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _download(self, client: httpx.AsyncClient, digest: str, size: int,
+                        semaphore: asyncio.Semaphore) -> int:
+        """Download a blob into the store, resuming a partial download. Returns the bytes fetched."""
+        async with semaphore:
+            partial = self.store.partial_path(digest)
+            backoff = DecorrelatedJitterBackoff(self.retry_base, self.retry_cap)
+            fetched = 0
+            failures = 0
+            with open(partial, "ab") as f:
+                if f.tell() > size:
+                    f.truncate(0)
+                    f.seek(0)
+                while f.tell() < size:
+                    offset = f.tell()
+                    try:
+                        fetched += await self._fetch_chunk(client, digest, size, f)
+                    except (httpx.HTTPError, AssetSyncError) as e:
+                        if isinstance(e, AssetSyncError) and not e.retryable:
+                            raise
+                        failures += 1
+                        if failures >= self.max_attempts:
+                            raise AssetSyncError(f"Blob {digest} failed at byte {offset}: {e}") from e
+                        ASSET_RETRIES.inc()
+                        await self.clock.sleep(backoff.next_delay())
+                        continue
+                    # Only failures in a row count, progress resets them
+                    failures = 0
+                    backoff.reset()
+            self.store.commit(digest)
+            return fetched
+
+    async def _fetch_chunk(self, client: httpx.AsyncClient, digest: str, size: int, f) -> int:
+        """Append the next chunk of a blob to its partial file. Returns the bytes fetched."""
+        offset = f.tell()
+        end = min(offset + self.chunk_size, size) - 1
+        response = await client.get(f"/assets/blobs/{digest}", headers={"Range": f"bytes={offset}-{end}"})
+        if response.status_code == 200:
+            # The server ignored the range and sent the whole blob
+            f.seek(0)
+            f.truncate()
+        elif response.status_code >= 400:
+            # Client errors other than rate limiting will not go away by retrying
+            retryable = response.status_code >= 500 or response.status_code in (408, 429)
+            raise AssetSyncError(f"Blob {digest} request failed: HTTP {response.status_code}", retryable)
+        elif response.status_code != 206 or not response.headers.get("content-range", "").startswith(
+                f"bytes {offset}-"):
+            # E.g. a proxy mangling the range
+            raise AssetSyncError(f"Blob {digest} request got HTTP {response.status_code} with range "
+                                 f"{response.headers.get('content-range')!r}", retryable=True)
+        content = response.content
+        if not content:
+            raise AssetSyncError(f"Blob {digest} request returned no content", retryable=True)
+        if f.tell() + len(content) > size:
+            # Start over
+            f.truncate(0)
+            f.seek(0)
+            raise AssetSyncError(f"Blob {digest} is larger than {size} bytes", retryable=True)
+        f.write(content)
+        f.flush()
+        ASSET_BYTES.inc(len(content))
+        return len(content)
+
+    def _install(self, revision: str, files: Dict[str, Dict[str, Any]]) -> Tuple[int, int]:
+        """Replace the local files with the stored blobs and remove dropped files. Returns both counts."""
+        previous = self.installed.get("files", {})
+        installed = 0
+        for path, entry in files.items():
+            destination = self._destination(path)
+            if previous.get(path) == entry["digest"] and os.path.exists(destination):
+                continue
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            temporary = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.sync")
+            if os.path.lexists(temporary):
+                os.unlink(temporary)
+            try:
+                # A hard link costs no space; copy where the store is on another file system
+                os.link(self.store.path(entry["digest"]), temporary)
+            except OSError:
+                shutil.copyfile(self.store.path(entry["digest"]), temporary)
+            os.replace(temporary, destination)
+            installed += 1
+
+        removed = 0
+        for path in set(previous) - set(files):
+            destination = self._destination(path)
+            if destination is not None and os.path.isfile(destination):
+                os.unlink(destination)
+                removed += 1
+
+        self.installed = {"revision": revision, "files": {path: entry["digest"] for path, entry in files.items()}}
+        temporary = f"{self.installed_path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.installed, f)
+        os.replace(temporary, self.installed_path)
+        if installed or removed:
+            sound_library.refresh()
+        return installed, removed
+
+    def _load_installed(self) -> Dict[str, Any]:
+        try:
+            with open(self.installed_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable {self.installed_path}: {e}")
+            return {}
+
+    def start(self, interval: float = 3600.0):
+        """
+        Sync in a thread of its own: now, every interval seconds and whenever
+        request_sync() is called.
+        """
+        if self._thread is not None:
+            return
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval, started), name="asset-sync",
+                                        daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def request_sync(self):
+        """Sync as soon as possible (e.g. when the hub announces new assets). Thread-safe."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop syncing; a download in progress is resumed by the next sync."""
+        if self._thread is None:
+            return
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self, interval: float, started: threading.Event):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._sync_periodically(interval, started))
+        finally:
+            self._loop = None
+            loop.close()
+
+    async def _sync_periodically(self, interval: float, started: threading.Event):
+        self._wake = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._sync_lock = asyncio.Lock()  # Bound to this loop
+        self._loop = asyncio.get_running_loop()
+        started.set()
+        backoff = DecorrelatedJitterBackoff(self.retry_base * 10, interval)
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        while True:
+            self._wake.clear()
+            sync = asyncio.ensure_future(self.sync())
+            await asyncio.wait([sync, stopping], return_when=asyncio.FIRST_COMPLETED)
+            if stopping.done():
+                # The partial downloads are kept for the next process
+                sync.cancel()
+                await asyncio.gather(sync, return_exceptions=True)
+                return
+            delay = interval
+            if sync.exception() is not None:
+                logger.warning(f"Asset sync failed: {sync.exception()}")
+                delay = backoff.next_delay()
+            else:
+                backoff.reset()
+            wake = asyncio.ensure_future(self._wake.wait())
+            await asyncio.wait([wake, stopping], timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            wake.cancel()
+            if stopping.done():
+                return
+
+def start_asset_sync(base_url: str, roots: Dict[str, str], store_dir: str, interval: float = 3600.0) -> AssetSync:
+    """
+    Start syncing assets from the hub in a background thread.
+
+    Args:
+        base_url: URL of the hub's REST API
+        roots: Asset root name -> local directory
+        store_dir: Directory of the blob store
+        interval: Seconds between syncs
+
+    Returns:
+        The syncer; stop it with stop()
+    """
+    syncer = AssetSync(base_url, roots, store_dir)
+    syncer.start(interval)
+    logger.info(f"Syncing {', '.join(roots)} from {base_url} every {interval:.0f}s")
+    return syncer
@@ -0,0 +1,43 @@
+"""
+backoff.py
+
+This module provides retry delays using exponential backoff with
+"decorrelated jitter": each delay is drawn uniformly between the base delay
+and three times the previous delay, capped at a maximum. Clients that lost
+their connection at the same moment therefore spread out their retries
+instead of reconnecting in lockstep.
+"""
+
+import random
+from typing import Optional
+
+class DecorrelatedJitterBackoff:
+    """
+    Generator of retry delays with decorrelated jitter.
+    """
+
+    def __init__(self, base: float = 1.0, cap: float = 60.0, rng: Optional[random.Random] = None):
+        """
+        Initialize the backoff.
+
+        Args:
+            base: Minimum delay in seconds
+            cap: Maximum delay in seconds
+            rng: Random number generator (for deterministic tests)
+        """
+        self.base = base
+        self.cap = cap
+        self.rng = rng or random.Random()
+        self.attempts = 0
+        self._previous = base
+
+    def next_delay(self) -> float:
+        """Get the delay in seconds before the next attempt."""
+        self.attempts += 1
+        self._previous = min(self.cap, self.rng.uniform(self.base, self._previous * 3))
+        return self._previous
+
+    def reset(self):
+        """Start over after a successful attempt."""
+        self.attempts = 0
+        self._previous = self.base
@@ -0,0 +1,231 @@
+"""
+clock.py
+
+This module provides the clocks the device reads time from.
+
+Code that waits or timestamps (RoutineState transitions, the WebSocket
+heartbeat, reconnect backoff and status coalescing, the display clock)
+takes a Clock instead of calling time and asyncio directly:
+
+- SystemClock reads the real clocks; system_clock is the default everywhere.
+- VirtualClock only moves when told to. Its run() drives an event loop by
+  jumping straight to the next timer whenever every task is waiting, so a
+  15-minute routine takes as long as the code it runs, and the same inputs
+  always produce the same sequence of events (see tools.simulate).
+
+Durations measured to report overhead (metrics histograms, trace spans)
+keep using time.perf_counter(), since they measure the host, not the
+routine.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, List, Optional
+
+class Clock(ABC):
+    """Source of time for the routine, timers and network loops."""
+
+    @abstractmethod
+    def time(self) -> float:
+        """Get the wall clock time in seconds since the epoch."""
+
+    @abstractmethod
+    def monotonic(self) -> float:
+        """Get a clock reading for measuring intervals, in seconds."""
+
+    def strftime(self, format: str) -> str:
+        """Format the current local time, like time.strftime."""
+        return time.strftime(format, time.localtime(self.time()))
+
+    @abstractmethod
+    def call_later(self, delay: float, callback: Callable[[], Any]):
+        """Run a callback on the running event loop after delay seconds. Returns a handle with cancel()."""
+
+    @abstractmethod
+    async def sleep(self, delay: float):
+        """Wait for delay seconds, like asyncio.sleep."""
+
+    @abstractmethod
+    async def wait_for(self, awaitable: Awaitable, timeout: float) -> Any:
+        """Await with a timeout, raising asyncio.TimeoutError like asyncio.wait_for."""
+
+class SystemClock(Clock):
+    """The real clocks."""
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> asyncio.TimerHandle:
+        return asyncio.get_running_loop().call_later(delay, callback)
+
+    async def sleep(self, delay: float):
+        await asyncio.sleep(delay)
+
+    async def wait_for(self, awaitable: Awaitable, timeout: float) -> Any:
+        return await asyncio.wait_for(awaitable, timeout)
+
+class VirtualTimer:
+    """A callback scheduled on a VirtualClock."""
+
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline: float, callback: Callable[[], Any]):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock(Clock):
+    """
+    A clock that moves only through advance() and run().
+
+    Timers fire in deadline order (ties in scheduling order). It must be
+    used from a single event loop.
+    """
+
+    def __init__(self, start: float = 0.0, epoch: float = 1767290400.0, settle_steps: int = 1000):
+        """
+        Args:
+            start: Initial monotonic reading
+            epoch: Wall clock time at the start (default: 2026-01-01 18:00 UTC)
+            settle_steps: Maximum event loop iterations given to tasks
+                after each timer before virtual time moves on
+        """
+        self._now = start
+        self._wall_offset = epoch - start
+        self.settle_steps = settle_steps
+        self.timers_fired = 0
+        self._timers: List[Any] = []  # Heap of (deadline, sequence, VirtualTimer)
+        self._sequence = itertools.count()
+
+    def time(self) -> float:
+        return self._now + self._wall_offset
+
+    def monotonic(self) -> float:
+        return self._now
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> VirtualTimer:
+        timer = VirtualTimer(self._now + max(0.0, delay), callback)
+        heapq.heappush(self._timers, (timer.deadline, next(self._sequence), timer))
+        return timer
+
+    async def sleep(self, delay: float):
+        if delay <= 0:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        timer = self.call_later(delay, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            timer.cancel()
+
+    async def wait_for(self, awaitable: Awaitable, timeout: float) -> Any:
+        task = asyncio.ensure_future(awaitable)  # Futures (e.g. pong waiters) are used as they are
+        if task.done():
+            return task.result()
+        waiter = asyncio.get_running_loop().create_future()
+
+        def wake(_=None):
+            if not waiter.done():
+                waiter.set_result(None)
+
+        task.add_done_callback(wake)
+        timer = self.call_later(timeout, wake)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            timer.cancel()
+            task.remove_done_callback(wake)
+        if task.done():
+            return task.result()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise asyncio.TimeoutError()
+
+    def pending(self) -> int:
+        """Get the number of scheduled timers that were not cancelled."""
+        return sum(1 for _, _, timer in self._timers if not timer.cancelled)
+
+    async def _settle(self):
+        """Let the tasks woken so far run until they all wait again."""
+        # CPython's loops expose their queue of ready callbacks; with it,
+        # settling stops as soon as nothing but this task is left to run
+        ready = getattr(asyncio.get_running_loop(), "_ready", None)
+        for _ in range(self.settle_steps):
+            await asyncio.sleep(0)
+            if ready is not None and not ready:
+                break
+
+    def _pop_due(self, until: Optional[float]) -> Optional[VirtualTimer]:
+        while self._timers:
+            deadline, _, timer = self._timers[0]
+            if until is not None and deadline > until:
+                return None
+            heapq.heappop(self._timers)
+            if not timer.cancelled:
+                return timer
+        return None
+
+    def _fire(self, timer: VirtualTimer):
+        self._now = max(self._now, timer.deadline)
+        self.timers_fired += 1
+        timer.callback()
+
+    async def advance(self, seconds: float):
+        """Move time forward by seconds, firing the timers that fall due on the way."""
+        target = self._now + seconds
+        await self._settle()
+        while True:
+            timer = self._pop_due(target)
+            if timer is None:
+                break
+            self._fire(timer)
+            await self._settle()
+        self._now = target
+
+    async def run(self, awaitable: Awaitable, timeout: Optional[float] = None) -> Any:
+        """
+        Run a coroutine to completion in virtual time: whenever all tasks
+        wait, jump to the next timer.
+
+        Args:
+            awaitable: The coroutine to run
+            timeout: Virtual seconds after which asyncio.TimeoutError is raised
+
+        Raises:
+            RuntimeError: If the coroutine waits but no timer is scheduled
+                (it would never finish)
+        """
+        task = asyncio.ensure_future(awaitable)
+        deadline = None if timeout is None else self._now + timeout
+        try:
+            while True:
+                await self._settle()
+                if task.done():
+                    return task.result()
+                timer = self._pop_due(None)
+                if timer is None:
+                    raise RuntimeError("Deadlock: tasks are waiting but no timer is scheduled")
+                if deadline is not None and timer.deadline > deadline:
+                    self._now = deadline
+                    raise asyncio.TimeoutError()
+                self._fire(timer)
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+# The clock used unless another one is passed in
+system_clock = SystemClock()
@@ -0,0 +1,170 @@
+"""
+definition_sync.py
+
+This module applies the routine definitions feed from the cloud (see
+ws_protocol) to the local database.
+
+The device records the last revision it applied in sync_revisions and asks
+for the changes since then after connecting. A definitions message is
+applied in one database transaction together with its revision, so a
+failure or power cut leaves the previous definitions and revision in
+place. The commit is reported by entity.events like any other change,
+which refreshes the cached routine of RoutineState and the routine
+runtimes.
+
+A message whose base is not the applied revision means a revision was
+missed: it is ignored, and the device asks for the changes since the
+revision it has. Only the hub decides on a full download, when it no
+longer has those changes.
+
+Definitions synced from the cloud keep the cloud's row ids.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+import ws_protocol
+from entity import Routine, RoutineTask, SyncRevision, Task
+from entity.base import SessionLocal
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+FEED = "definitions"
+
+# Deleted in this order and inserted in the reverse one, so references stay valid
+MODELS = {"routine_tasks": RoutineTask, "routines": Routine, "tasks": Task}
+
+DEFINITION_SYNCS = registry.counter("definition_syncs_total",
+                                    "Definitions messages from the cloud, by outcome.", labels=("result",))
+DEFINITION_CHANGES = registry.counter("definition_changes_applied_total", "Definition rows changed by the cloud.")
+
+class DefinitionSyncError(Exception):
+    """A definitions message could not be applied; nothing was changed."""
+
+class DefinitionSync:
+    """Applies definitions messages to the database and tracks the applied revision."""
+
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal):
+        """
+        Args:
+            session_factory: Creates the sessions changes are applied in
+        """
+        self.session_factory = session_factory
+        self._revision: Optional[int] = None
+        self._lock = threading.Lock()  # Messages are applied one at a time, in order
+
+    @property
+    def revision(self) -> int:
+        """The last applied revision (0 before the first sync)."""
+        if self._revision is None:
+            session = self.session_factory()
+            try:
+                row = session.get(SyncRevision, FEED)
+                self._revision = row.revision if row is not None else 0
+            finally:
+                session.close()
+        return self._revision
+
+    def request(self) -> Dict[str, Any]:
+        """Get the message asking the hub for the changes since the applied revision."""
+        return {"type": ws_protocol.DEFINITIONS_SYNC, "revision": self.revision}
+
+    def apply(self, message: Dict[str, Any]) -> bool:
+        """
+        Apply a definitions message.
+
+        Returns:
+            False if a revision was missed and the changes since the applied
+            revision must be requested, True otherwise
+
+        Raises:
+            DefinitionSyncError: If the message holds invalid changes
+        """
+        with self._lock:
+            revision = message.get("revision")
+            full = bool(message.get("full"))
+            if not isinstance(revision, int):
+                raise DefinitionSyncError(f"Definitions message without revision: {message!r}")
+            if not full and message.get("base") != self.revision:
+                if revision <= self.revision:
+                    DEFINITION_SYNCS.labels("duplicate").inc()
+                    return True  # Already applied
+                logger.info(f"Missed definition revisions between {self.revision} and {message.get('base')}")
+                DEFINITION_SYNCS.labels("gap").inc()
+                return False
+
+            changes = message.get("changes") or []
+            session = self.session_factory()
+            try:
+                with session.begin():
+                    self._apply_changes(session, changes, full)
+                    state = session.get(SyncRevision, FEED)
+                    if state is None:
+                        state = SyncRevision(feed=FEED)
+                        session.add(state)
+                    state.revision = revision
+                    state.updated_at = time.time()
+            except DefinitionSyncError:
+                DEFINITION_SYNCS.labels("failed").inc()
+                raise
+            except Exception as e:
+                DEFINITION_SYNCS.labels("failed").inc()
+                raise DefinitionSyncError(f"Could not apply definitions revision {revision}: {e}") from e
+            finally:
+                session.close()
+
+            self._revision = revision
+            DEFINITION_SYNCS.labels("full" if full else "delta").inc()
+            DEFINITION_CHANGES.inc(len(changes))
+            logger.info(f"Applied definitions revision {revision} ({'full, ' if full else ''}{len(changes)} rows)")
+            return True
+
+    def _apply_changes(self, session: Session, changes: List[Dict[str, Any]], full: bool):
+        """Delete and write the rows of the changes (replacing all rows if full), without committing."""
+        upserts: Dict[str, Dict[int, Dict[str, Any]]] = {table: {} for table in MODELS}
+        deletes: Dict[str, List[int]] = {table: [] for table in MODELS}
+        for change in changes:
+            table, row_id = change.get("table"), change.get("id")
+            if table not in MODELS or not isinstance(row_id, int):
+                raise DefinitionSyncError(f"Invalid change: {change!r}")
+            if change.get("deleted"):
+                deletes[table].append(row_id)
+            elif isinstance(change.get("row"), dict):
+                upserts[table][row_id] = change["row"]
+            else:
+                raise DefinitionSyncError(f"Change without a row: {change!r}")
+        if full:
+            for table, model in MODELS.items():
+                deletes[table] = [row_id for (row_id,) in session.query(model.id) if row_id not in upserts[table]]
+
+        for table, model in MODELS.items():
+            for row_id in deletes[table]:
+                row = session.get(model, row_id)
+                if row is not None:
+                    session.delete(row)
+        session.flush()
+
+        # Move rewritten routine tasks out of the way first, so a new order
+        # never collides with the old one in the (routine_id, position) index
+        moved = [session.get(RoutineTask, row_id) for row_id in upserts["routine_tasks"]]
+        for routine_task in moved:
+            if routine_task is not None:
+                routine_task.position = -routine_task.id
+        session.flush()
+
+        for table, model in reversed(list(MODELS.items())):
+            for row_id, values in upserts[table].items():
+                row = session.get(model, row_id)
+                if row is None:
+                    row = model(id=row_id)
+                    session.add(row)
+                for field in ws_protocol.DEFINITION_FIELDS[table]:
+                    if field not in values:
+                        raise DefinitionSyncError(f"Row {table}/{row_id} lacks {field}")
+                    setattr(row, field, values[field])
+            session.flush()
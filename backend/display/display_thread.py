@@ -14,11 +14,13 @@ import os
 
 from PySide6.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout, QHBoxLayout, QGridLayout
 from PySide6.QtGui import QFont, QColor, QPalette
-from PySide6.QtCore import Qt, QTimer
+from PySide6.QtCore import Qt, QTimer, Signal
 
-from backend import routine_state
+from clock import system_clock
+from routine_state import routine_state
 from display.current_task_display import CurrentTaskDisplay
 from display.next_tasks_display import NextTasksDisplay
+from display.telemetry import DISPLAY_FRAME, DISPLAY_UPDATE
 from display.time_widget import TimeDisplay
 
 
@@ -31,8 +33,20 @@ def qcolor_from_tuple(rgb_tuple):
     return QColor(*rgb_tuple)
 
 class DisplayWindow(QWidget):
-    def __init__(self, screen_size=(1024, 600)):
+    # Carries a routine state Transition and the perf_counter() time it was emitted
+    transition_received = Signal(object, float)
+
+    def __init__(self, screen_size=(1024, 600), state_source=None, clock=None):
+        """
+        Args:
+            screen_size: Size of the window
+            state_source: Returns the routine state snapshot to show. None
+                follows the routine_state of this process; the display
+                process passes a shared_state reader instead.
+            clock: Clock shown on the display (defaults to the system clock)
+        """
         super().__init__()
+        self.clock = clock or system_clock
         self.setWindowTitle("Bedtime Routine")
         self.resize(*screen_size)
 
@@ -43,8 +57,11 @@ class DisplayWindow(QWidget):
         self.setAutoFillBackground(True)
 
         layout = QVBoxLayout()
-        layout.addWidget(TimeDisplay(["🛏️", "🦷", "🛁"]))
+        layout.addWidget(TimeDisplay(["🛏️", "🦷", "🛁"], clock=self.clock))
         layout.addWidget(CurrentTaskDisplay())
+        self.task_label = QLabel("No Active Routine")
+        self.task_label.setStyleSheet("font-size: 24px; color: white;")
+        layout.addWidget(self.task_label)
         layout.addWidget(NextTasksDisplay(["👕 Pajamas", "📖 Story", "💡 Lights Out"]))
 
         self.setLayout(layout)
@@ -54,18 +71,40 @@ class DisplayWindow(QWidget):
 
         self.is_fullscreen = False
 
+        self.state_source = state_source
+        if state_source is None:
+            self.state_source = routine_state.snapshot
+            # State changes happen on other threads, Qt delivers them on the GUI thread
+            self.transition_received.connect(self.on_transition)
+            routine_state.add_listener(self._on_state_change)
+
     def get_current_time(self):
-        return time.strftime("%H:%M")
+        return self.clock.strftime("%H:%M")
 
     def update_display(self):
-        # Get state as needed
-        is_active = routine_state.is_routine_active
-        current_task = routine_state.current_task
-
-        if is_active and current_task:
-            self.task_label.setText(f"Current Task: {current_task['name']}")
-        else:
-            self.task_label.setText("No Active Routine")
+        with DISPLAY_UPDATE.labels("window").time():
+            # One snapshot, so the flag and the task belong to the same state
+            snapshot = self.state_source()
+            current_task = snapshot["current_task"] if snapshot else None
+
+            if snapshot and snapshot["is_active"] and current_task:
+                self.task_label.setText(f"Current Task: {current_task['name']}")
+            else:
+                self.task_label.setText("No Active Routine")
+
+    def _on_state_change(self, transition):
+        self.transition_received.emit(transition, time.perf_counter())
+
+    def on_transition(self, transition, emitted_at):
+        started_at = time.perf_counter()
+        self.update_display()
+        if transition.trace is not None:
+            transition.trace.add_span("display.queue", emitted_at, started_at)
+            transition.trace.add_span("display.update", started_at)
+
+    def paintEvent(self, event):
+        with DISPLAY_FRAME.time():
+            super().paintEvent(event)
 
     def keyPressEvent(self, event):
         # Toggle fullscreen on F10
@@ -0,0 +1,91 @@
+"""
+telemetry.py
+
+Display metrics, and the reports that carry them from the display process
+to the main process.
+
+In process mode (see display_supervisor) the display records its update
+times and cache sizes in its own process, where /metrics, /debug/traces
+and /debug/memory never see them. The display therefore sends reports over
+a pipe: after every update the shared-state sequence number it showed and
+when the update ran, and with every report the histogram observations
+since the previous one. Periodic reports also carry the size of its
+caches. The supervisor adds them to the metrics, traces and memory
+breakdown of the main process.
+
+Report times are time.perf_counter() values; on Linux that clock is
+CLOCK_MONOTONIC, which all processes share.
+"""
+
+import logging
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from memory import memory_monitor
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_UPDATE = registry.histogram("display_update_seconds",
+                                    "Time spent updating display widgets.", labels=("widget",))
+DISPLAY_FRAME = registry.histogram("display_frame_seconds", "Time spent painting the display window.")
+
+# Histograms the display process records and the main process exposes
+FORWARDED = (DISPLAY_UPDATE, DISPLAY_FRAME)
+
+class TelemetrySender:
+    """Sends the display's reports to the main process (used in the display process)."""
+
+    def __init__(self, connection, caches: Optional[Callable[[], Dict[str, Any]]] = None):
+        """
+        Args:
+            connection: Sending end of the report pipe
+            caches: Returns the size of the display's caches in bytes, by
+                name (defaults to the subsystems of the memory monitor)
+        """
+        self.connection = connection
+        self.caches = caches or self._subsystem_sizes
+        self._sent: Dict[Tuple[str, Tuple[str, ...]], Tuple[list, float, int]] = {}
+
+    def update(self, update: Callable[[], Any], sequence: Callable[[], int]):
+        """Run a display update and report it, with the sequence number it showed."""
+        started_at = time.perf_counter()
+        update()
+        self.send({"sequence": sequence(), "started_at": started_at, "ended_at": time.perf_counter()})
+
+    def send(self, update: Optional[Dict[str, Any]] = None, include_caches: bool = False):
+        """Send a report with the histogram observations since the previous one."""
+        report = {"update": update, "histograms": self._histogram_deltas()}
+        if include_caches:
+            report["caches"] = self.caches()
+        try:
+            self.connection.send(report)
+        except OSError as e:
+            # The supervisor is gone; the display quits on its next wakeup
+            logger.debug(f"Could not send a display report: {e}")
+
+    def _histogram_deltas(self):
+        deltas = []
+        for family in FORWARDED:
+            for values, histogram in family.children():
+                state = histogram.state()
+                counts, total, count = state
+                sent_counts, sent_total, sent_count = self._sent.get((family.name, values), (None, 0.0, 0))
+                if count == sent_count:
+                    continue
+                if sent_counts is not None:
+                    counts = [now - before for now, before in zip(counts, sent_counts)]
+                deltas.append((family.name, values, counts, total - sent_total, count - sent_count))
+                self._sent[(family.name, values)] = state
+        return deltas
+
+    @staticmethod
+    def _subsystem_sizes() -> Dict[str, Any]:
+        subsystems = memory_monitor.breakdown()["subsystems"]
+        return {name: subsystem["bytes"] for name, subsystem in subsystems.items()}
+
+def apply_histograms(deltas):
+    """Add the histogram observations of a report to the histograms of this process."""
+    families = {family.name: family for family in FORWARDED}
+    for name, values, counts, total, count in deltas:
+        families[name].labels(*values).merge(counts, total, count)
@@ -1,11 +1,14 @@
 from PySide6.QtWidgets import QWidget, QLabel, QHBoxLayout
 from PySide6.QtCore import QTimer, Qt
-import time
+from clock import system_clock
+from display.telemetry import DISPLAY_UPDATE
 
 class TimeDisplay(QWidget):
-    def __init__(self, completed_icons=None):
+    def __init__(self, completed_icons=None, clock=None):
         super().__init__()
 
+        self.clock = clock or system_clock
+
         if completed_icons is None:
             completed_icons = []
 
@@ -33,13 +36,20 @@ class TimeDisplay(QWidget):
         self.layout.setStretch(1, 1)
         self.layout.setStretch(2, 4)
 
-        # Update every second
+        # Update when the minute changes, instead of every second
         self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.update_time)
-        self.timer.start(1000)
+        self.schedule_tick()
 
     def get_current_time(self):
-        return time.strftime("%H:%M")
+        return self.clock.strftime("%H:%M")
+
+    def schedule_tick(self):
+        seconds = self.clock.time() % 60
+        self.timer.start(int((60 - seconds) * 1000) + 1)
 
     def update_time(self):
-        self.time_label.setText(self.get_current_time())
\ No newline at end of file
+        with DISPLAY_UPDATE.labels("time").time():
+            self.time_label.setText(self.get_current_time())
+        self.schedule_tick()
\ No newline at end of file
@@ -1,10 +1,14 @@
+import collections
 import io
 import os
+import threading
 
 import cairosvg
 import yaml
 from PySide6.QtGui import QFont
 
+from memory import approximate_size, memory_monitor
+
 
 def get_fa_path(name, version="free-6.7.2-desktop"):
     return f"assets/icons/fontawesome-{version}/svgs/{name}.svg"
@@ -35,14 +39,36 @@ class AwesomeFontProvider:
         self.font_size = font_size
         self.default_type = "regular"
 
-        with open(self.categories_path, "r", encoding="utf-8") as f:
-            self.categories = yaml.safe_load(f)
-
-        with open(self.icons_path, "r", encoding="utf-8") as f:
-            self.icons = yaml.safe_load(f)
+        # The metadata is large, so it is loaded on first use and can be
+        # dropped by the memory monitor (see release_metadata)
+        self._categories = None
+        self._icons = None
 
         self._initialized = True  # Prevent re-init
 
+    @property
+    def categories(self) -> dict:
+        if self._categories is None:
+            with open(self.categories_path, "r", encoding="utf-8") as f:
+                self._categories = yaml.safe_load(f)
+        return self._categories
+
+    @property
+    def icons(self) -> dict:
+        if self._icons is None:
+            with open(self.icons_path, "r", encoding="utf-8") as f:
+                self._icons = yaml.safe_load(f)
+        return self._icons
+
+    def metadata_size(self) -> int:
+        """Estimate the memory held by the loaded metadata in bytes."""
+        return approximate_size([self._categories, self._icons])
+
+    def release_metadata(self):
+        """Drop the loaded metadata; it is reloaded when next needed."""
+        self._categories = None
+        self._icons = None
+
     def get_font(self, type: str = None, font_size: int = None) -> QFont:
         type = type or self.default_type
         if type not in self.font_paths:
@@ -65,7 +91,42 @@ class AwesomeFontProvider:
             raise ValueError(f"Category '{category_name}' not found.")
         return category.get("icons", [])
 
+class IconCache:
+    """Least recently used cache of icon SVG files, so widgets do not re-read the SD card."""
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> bytes:
+        """Get the SVG data of a Font Awesome icon."""
+        with self._lock:
+            data = self._entries.get(name)
+            if data is not None:
+                self._entries.move_to_end(name)
+                return data
+        with open(get_fa_path(name), "rb") as f:
+            data = f.read()
+        with self._lock:
+            self._entries[name] = data
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return data
+
+    def size(self) -> int:
+        with self._lock:
+            return sum(len(name) + len(data) for name, data in self._entries.items())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 fa_provider = AwesomeFontProvider()
+icon_cache = IconCache()
+
+memory_monitor.register("icon_svgs", icon_cache.size, icon_cache.clear, priority=20)
+memory_monitor.register("icon_metadata", fa_provider.metadata_size, fa_provider.release_metadata, priority=30)
 
 if __name__ == "__main__":
 
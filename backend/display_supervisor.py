@@ -0,0 +1,259 @@
+"""
+display_supervisor.py
+
+This module runs the Qt display in a separate process and keeps it running.
+
+Qt requires the QApplication to live on the main thread of its process, and
+running it in the main process also makes every repaint compete for the GIL
+with the API server and the WebSocket client. The supervisor therefore
+starts the display as its own process (with the "spawn" start method, so it
+does not inherit threads or locks from this one). The display reads the
+routine state from a shared-memory segment (shared_state) that the
+supervisor updates on every RoutineState transition, and sleeps on a wakeup
+pipe between changes.
+
+When the display process exits unexpectedly it is restarted, with backoff
+if it keeps crashing; the rest of the application is unaffected.
+
+The display sends its update times, histograms and cache sizes back over a
+report pipe (see display.telemetry), so they show up in /metrics,
+/debug/traces and /debug/memory of this process.
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from backoff import DecorrelatedJitterBackoff
+from display.telemetry import TelemetrySender, apply_histograms
+from memory import memory_monitor
+from metrics import registry
+from routine_state import RoutineState, routine_state
+from shared_state import SharedStateReader, SharedStateWriter
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_RESTARTS = registry.counter("display_process_restarts_total",
+                                    "Restarts of the display process after it exited unexpectedly.")
+DISPLAY_UP = registry.gauge("display_process_up", "Whether the display process is running.")
+
+# A display process that ran this long is considered healthy again
+STABLE_AFTER = 60.0
+
+# Seconds between the display's reports of its caches and widget timings
+REPORT_INTERVAL = 10.0
+
+# Traced transitions waiting for the display to show them
+MAX_PENDING_TRACES = 64
+
+def run_display(shm_name: str, wakeup, reports, screen_size: Tuple[int, int], log_level: str = "INFO"):
+    """
+    Entry point of the display process: show the window on this process's
+    main thread and follow the shared routine state until the supervisor
+    closes the wakeup pipe. Every update is reported on the reports pipe.
+    """
+    from app_logging import setup_logging
+    setup_logging(log_level)
+
+    from PySide6.QtCore import QSocketNotifier, QTimer
+    from PySide6.QtWidgets import QApplication
+
+    from display.display_thread import DisplayWindow
+
+    reader = SharedStateReader(shm_name)
+    telemetry = TelemetrySender(reports)
+    app = QApplication([])
+    window = DisplayWindow(screen_size=screen_size, state_source=reader.read)
+    window.show()
+    telemetry.update(window.update_display, lambda: reader.sequence)
+
+    timer = QTimer()
+    timer.timeout.connect(lambda: telemetry.send(include_caches=True))
+    timer.start(int(REPORT_INTERVAL * 1000))
+
+    fd = wakeup.fileno()
+    notifier = QSocketNotifier(fd, QSocketNotifier.Read)
+
+    def on_wakeup():
+        # Drain all pending wakeups, they are answered by one update
+        if not os.read(fd, 4096):
+            # The supervisor is gone
+            notifier.setEnabled(False)
+            app.quit()
+            return
+        telemetry.update(window.update_display, lambda: reader.sequence)
+
+    notifier.activated.connect(on_wakeup)
+    try:
+        return app.exec()
+    finally:
+        reader.close()
+
+class DisplaySupervisor:
+    """Starts the display process, feeds it state changes and restarts it when it dies."""
+
+    def __init__(self, screen_size: Tuple[int, int] = (1024, 600), state: Optional[RoutineState] = None,
+                 log_level: str = "INFO", target: Callable[..., Any] = run_display,
+                 backoff: Optional[DecorrelatedJitterBackoff] = None):
+        """
+        Args:
+            screen_size: Size of the display window
+            state: Routine state to mirror (the singleton by default)
+            log_level: Minimum level of log records in the display process
+            target: Entry point of the display process (importable by name)
+            backoff: Delays between restarts of a crashing display
+        """
+        self.screen_size = screen_size
+        self.state = state or routine_state
+        self.log_level = log_level
+        self.target = target
+        self.backoff = backoff or DecorrelatedJitterBackoff(base=0.5, cap=30.0)
+        self.restarts = 0
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self._context = multiprocessing.get_context("spawn")
+        self._writer: Optional[SharedStateWriter] = None
+        self._wakeup_reader = None
+        self._wakeup_writer = None
+        self._reports_reader = None
+        self._reports_writer = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._reports_thread: Optional[threading.Thread] = None
+        # Sequence number -> (trace, publish time) of traced transitions not shown yet
+        self._pending_traces = collections.OrderedDict()
+        self._pending_lock = threading.Lock()
+        self.cache_sizes: Dict[str, Any] = {}  # Last reported by the display, by cache
+
+    def start(self):
+        """Create the shared state, start the display process and watch it."""
+        if self._thread is not None:
+            return
+        self._writer = SharedStateWriter()
+        self._wakeup_reader, self._wakeup_writer = self._context.Pipe(duplex=False)
+        self._writer.set_wakeup_fd(self._wakeup_writer.fileno())
+        self._reports_reader, self._reports_writer = self._context.Pipe(duplex=False)
+
+        # Listeners run under the state lock, so the first snapshot cannot
+        # miss a transition that happens while subscribing
+        with self.state._state_lock:
+            self.state.add_listener(self._on_transition)
+            self._publish()
+
+        self._stop.clear()
+        self._spawn()
+        self._thread = threading.Thread(target=self._watch, name="display-supervisor", daemon=True)
+        self._thread.start()
+        self._reports_thread = threading.Thread(target=self._receive_reports, name="display-reports", daemon=True)
+        self._reports_thread.start()
+
+    def stop(self, timeout: float = 5):
+        """Stop the display process and remove the shared state."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self.state.remove_listener(self._on_transition)
+        # Closing the pipe makes the display quit its event loop
+        self._wakeup_writer.close()
+        process = self.process
+        process.join(timeout)
+        if process.is_alive():
+            logger.warning("Display process did not quit, terminating it")
+            process.terminate()
+            process.join(timeout)
+        self._thread.join()
+        self._thread = None
+        self._reports_thread.join()
+        self._reports_thread = None
+        self._wakeup_reader.close()
+        self._reports_reader.close()
+        self._reports_writer.close()
+        self._writer.close()
+        self._writer = None
+        for name in self.cache_sizes:
+            memory_monitor.unregister(f"display.{name}")
+        self.cache_sizes = {}
+        with self._pending_lock:
+            self._pending_traces.clear()
+        DISPLAY_UP.set(0)
+
+    def _publish(self) -> int:
+        return self._writer.publish(self.state.snapshot())
+
+    def _on_transition(self, transition):
+        published_at = time.perf_counter()
+        try:
+            sequence = self._publish()
+        except Exception as e:
+            logger.error(f"Could not publish the routine state to the display: {e}")
+            return
+        if transition.trace is not None:
+            with self._pending_lock:
+                self._pending_traces[sequence] = (transition.trace, published_at)
+                while len(self._pending_traces) > MAX_PENDING_TRACES:
+                    self._pending_traces.popitem(last=False)
+
+    def _receive_reports(self):
+        while not self._stop.is_set():
+            try:
+                if not self._reports_reader.poll(0.2):
+                    continue
+                report = self._reports_reader.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                self._apply_report(report)
+            except Exception as e:
+                logger.error(f"Could not apply a display report: {e}")
+
+    def _apply_report(self, report: Dict[str, Any]):
+        """Add a display report to the metrics, traces and memory breakdown of this process."""
+        apply_histograms(report["histograms"])
+
+        update = report["update"]
+        if update is not None:
+            with self._pending_lock:
+                shown = [sequence for sequence in self._pending_traces if sequence <= update["sequence"]]
+                traces = [self._pending_traces.pop(sequence) for sequence in shown]
+            for trace, published_at in traces:
+                trace.add_span("display.queue", published_at, update["started_at"])
+                trace.add_span("display.update", update["started_at"], update["ended_at"])
+
+        for name, size in report.get("caches", {}).items():
+            if name not in self.cache_sizes:
+                # Sized only: the caches live in the display process
+                memory_monitor.register(f"display.{name}", lambda name=name: self.cache_sizes.get(name) or 0)
+            self.cache_sizes[name] = size
+
+    def _spawn(self):
+        self.process = self._context.Process(
+            target=self.target,
+            args=(self._writer.name, self._wakeup_reader, self._reports_writer, self.screen_size, self.log_level),
+            name="display",
+            daemon=True,
+        )
+        self.process.start()
+        DISPLAY_UP.set(1)
+        logger.info(f"Display process started (pid {self.process.pid})")
+
+    def _watch(self):
+        while not self._stop.is_set():
+            started_at = time.monotonic()
+            self.process.join()
+            DISPLAY_UP.set(0)
+            if self._stop.is_set():
+                break
+
+            logger.error(f"Display process exited with code {self.process.exitcode}, restarting")
+            if time.monotonic() - started_at >= STABLE_AFTER:
+                self.backoff.reset()
+            if self._stop.wait(self.backoff.next_delay()):
+                break
+            self.restarts += 1
+            DISPLAY_RESTARTS.inc()
+            self._spawn()
+            # The new process reads the latest snapshot on startup; a wakeup
+            # left in the pipe by the old one is harmless
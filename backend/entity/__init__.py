@@ -5,10 +5,16 @@ Entity package for SQLAlchemy models.
 from .base import Base, db_session, init_db, get_db
 from .task import Task
 from .routine import Routine
+from .routine_task import RoutineTask
+from .run_event import RunEvent
+from .task_stats import TaskStats
+from .sync_revision import SyncRevision
 from .db_init import init_database, create_default_routine
+from .events import DefinitionChange, add_change_listener, remove_change_listener
 
 __all__ = [
     'Base', 'db_session', 'init_db', 'get_db',
-    'Task', 'Routine',
-    'init_database', 'create_default_routine'
+    'Task', 'Routine', 'RoutineTask', 'RunEvent', 'TaskStats', 'SyncRevision',
+    'init_database', 'create_default_routine',
+    'DefinitionChange', 'add_change_listener', 'remove_change_listener'
 ]
@@ -5,35 +5,87 @@ This module provides the base class for all SQLAlchemy models and sets up the
 SQLAlchemy engine and session.
 """
 
-from sqlalchemy import create_engine
+import os
+import sys
+import weakref
+
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
 
 # Create SQLAlchemy engine
 # Using SQLite for simplicity, can be changed to other databases as needed
-SQLALCHEMY_DATABASE_URL = "sqlite:///./routinecloud.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("ROUTINECLOUD_DATABASE_URL", "sqlite:///./routinecloud.db")
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 
+# Location of the Alembic configuration and migration scripts
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALEMBIC_INI_PATH = os.path.join(BACKEND_DIR, "alembic.ini")
+MIGRATIONS_PATH = os.path.join(BACKEND_DIR, "migrations")
+
+# Revision matching the schema that Base.metadata.create_all used to produce
+LEGACY_SCHEMA_REVISION = "0001"
+
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Create scoped session for thread safety
 db_session = scoped_session(SessionLocal)
 
+# Sessions that have begun a transaction, for identity_map_size
+_live_sessions = weakref.WeakSet()
+
+@event.listens_for(Session, "after_begin")
+def _track_session(session, transaction, connection):
+    _live_sessions.add(session)
+
+def identity_map_size() -> int:
+    """Estimate the memory held by ORM objects in the identity maps of open sessions, in bytes."""
+    total = 0
+    for session in list(_live_sessions):
+        for obj in list(session.identity_map.values()):
+            attributes = vars(obj)
+            total += sys.getsizeof(obj) + sys.getsizeof(attributes)
+            total += sum(sys.getsizeof(value) for key, value in attributes.items()
+                         if not key.startswith("_sa_"))
+    return total
+
 # Create base class for all models
 Base = declarative_base()
 Base.query = db_session.query_property()
 
-def init_db():
-    """Initialize the database by creating all tables."""
-    # Import all models here to ensure they are registered with Base
-    from .task import Task
-    from .routine import Routine
-    from .routine_task import RoutineTask
+def get_alembic_config():
+    """Get the Alembic configuration for the backend migrations."""
+    from alembic.config import Config
+
+    config = Config(ALEMBIC_INI_PATH)
+    config.set_main_option("script_location", MIGRATIONS_PATH)
+    return config
+
+def init_db(bind=None):
+    """
+    Initialize the database by migrating it to the latest schema revision.
+
+    Databases created by the former ``Base.metadata.create_all`` call have
+    no revision table; they are stamped with the initial revision first so
+    that only the newer migrations run.
+
+    Args:
+        bind: Engine to migrate (defaults to the application engine)
+    """
+    from alembic import command
+
+    bind = bind if bind is not None else engine
+    config = get_alembic_config()
 
-    Base.metadata.create_all(bind=engine)
+    with bind.begin() as connection:
+        config.attributes["connection"] = connection
+        table_names = inspect(connection).get_table_names()
+        if "routines" in table_names and "alembic_version" not in table_names:
+            command.stamp(config, LEGACY_SCHEMA_REVISION)
+        command.upgrade(config, "head")
 
 def get_db():
     """Get a database session."""
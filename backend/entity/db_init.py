@@ -12,35 +12,40 @@ from .routine_task import RoutineTask
 def create_default_routine():
     """Create the default bedtime routine with tasks."""
     # Check if the routine already exists
-    routine = Routine.query.filter_by(name="Bedtime Routine").first()
+    routine = Routine.get_by_name("Bedtime Routine")
     if routine:
         return routine
 
-    # Create the routine
+    # Create the routine, making it the active one if there is none yet
     routine = Routine(
         name="Bedtime Routine",
-        description="A routine to help children get ready for bed"
+        description="A routine to help children get ready for bed",
+        is_active=Routine.get_active() is None
     )
 
     # Create tasks
     tasks = [
         Task(
             name="Brush Teeth",
+            icon_name="tooth",
             sound="brush_teeth.mp3",
             duration=120
         ),
         Task(
             name="Put on Pajamas",
+            icon_name="shirt",
             sound="pajamas.mp3",
             duration=180
         ),
         Task(
             name="Read a Book",
+            icon_name="book-open",
             sound="book.mp3",
             duration=300
         ),
         Task(
             name="Go to Sleep",
+            icon_name="bed",
             sound="sleep.mp3",
             duration=60
         )
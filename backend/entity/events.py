@@ -0,0 +1,97 @@
+"""
+Change notification module.
+
+This module notifies listeners after a transaction that changed routine
+definitions (Routine, Task or RoutineTask rows) has been committed. It lets
+in-memory caches such as RoutineState stay in sync with the database without
+re-querying on every read.
+"""
+
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, List, Set
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .routine import Routine
+from .routine_task import RoutineTask
+from .task import Task
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class DefinitionChange:
+    """Routine definition rows touched by one committed transaction."""
+    routine_ids: Set[int] = field(default_factory=set)
+    task_ids: Set[int] = field(default_factory=set)
+    # True if any routine was inserted, deleted or had its is_active flag changed
+    active_changed: bool = False
+
+    def __bool__(self):
+        return bool(self.routine_ids or self.task_ids or self.active_changed)
+
+_listeners: List[Callable[[DefinitionChange], None]] = []
+_listeners_lock = threading.Lock()
+
+def add_change_listener(callback: Callable[[DefinitionChange], None]) -> None:
+    """Register a callback invoked with a DefinitionChange after each relevant commit."""
+    with _listeners_lock:
+        if callback not in _listeners:
+            _listeners.append(callback)
+
+def remove_change_listener(callback: Callable[[DefinitionChange], None]) -> None:
+    """Unregister a callback added with add_change_listener."""
+    with _listeners_lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+def _pending(session: Session) -> DefinitionChange:
+    """Get the change collected so far in the session's current transaction."""
+    change = session.info.get("definition_change")
+    if change is None:
+        change = session.info["definition_change"] = DefinitionChange()
+    return change
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session, flush_context):
+    """Record which routine definition rows were written by this flush."""
+    change = _pending(session)
+    for state, objects in (("new", session.new), ("dirty", session.dirty), ("deleted", session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Routine):
+                change.routine_ids.add(obj.id)
+                if state != "dirty" or "is_active" in _modified_attributes(obj):
+                    change.active_changed = True
+            elif isinstance(obj, RoutineTask):
+                change.routine_ids.add(obj.routine_id)
+            elif isinstance(obj, Task):
+                change.task_ids.add(obj.id)
+
+def _modified_attributes(obj) -> Set[str]:
+    """Get the names of the attributes of obj with pending changes."""
+    from sqlalchemy import inspect
+
+    return {attr.key for attr in inspect(obj).attrs if attr.history.has_changes()}
+
+@event.listens_for(Session, "after_commit")
+def _notify_listeners(session):
+    """Call the registered listeners once the changes are durable."""
+    change = session.info.pop("definition_change", None)
+    if not change:
+        return
+
+    with _listeners_lock:
+        listeners = list(_listeners)
+
+    for callback in listeners:
+        try:
+            callback(change)
+        except Exception as e:
+            logger.error(f"Definition change listener failed: {e}")
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session):
+    """Forget changes from a transaction that was rolled back."""
+    session.info.pop("definition_change", None)
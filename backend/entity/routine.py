@@ -16,11 +16,11 @@ class Routine(Base):
     __tablename__ = "routines"
 
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, index=True)
     description = Column(String, nullable=True)
 
     # Whether this routine is active
-    is_active = Column(Boolean, default=False)
+    is_active = Column(Boolean, default=False, index=True)
 
     # Timestamps
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -42,6 +42,18 @@ class Routine(Base):
             "tasks": [rt.task.to_dict() for rt in self.routine_tasks]
         }
 
+    @classmethod
+    def get_active(cls, session=None):
+        """Get the currently active routine (uses ix_routines_is_active)."""
+        query = session.query(cls) if session is not None else cls.query
+        return query.filter(cls.is_active.is_(True)).first()
+
+    @classmethod
+    def get_by_name(cls, name, session=None):
+        """Get the first routine with the given name (uses ix_routines_name)."""
+        query = session.query(cls) if session is not None else cls.query
+        return query.filter(cls.name == name).first()
+
     def start(self):
         """Start the routine."""
         self.is_active = True
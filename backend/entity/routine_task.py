@@ -5,7 +5,7 @@ This module defines the RoutineTask entity for SQLAlchemy, which represents
 a single task instance within a specific routine (many RoutineTasks per Routine, but each RoutineTask belongs to only one Routine).
 """
 
-from sqlalchemy import Column, Integer, ForeignKey
+from sqlalchemy import Column, Integer, ForeignKey, Index
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -17,10 +17,14 @@ class RoutineTask(Base):
     """
 
     __tablename__ = "routine_tasks"
+    __table_args__ = (
+        # Ordered tasks of a routine; also enforces one task per position
+        Index("ix_routine_tasks_routine_id_position", "routine_id", "position", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     routine_id = Column(Integer, ForeignKey("routines.id"), nullable=False)
-    task_id = Column(Integer, ForeignKey("tasks.id"), nullable=False)
+    task_id = Column(Integer, ForeignKey("tasks.id"), nullable=False, index=True)
     position = Column(Integer, nullable=False)  # Position of this task in the routine (order)
 
     # Relationships
@@ -28,4 +32,22 @@ class RoutineTask(Base):
     task = relationship("Task", back_populates="routine_tasks")        # Each RoutineTask has one Task
 
     def __repr__(self):
-        return f"<RoutineTask(routine_id={self.routine_id}, task_id={self.task_id}, position={self.position})>"
\ No newline at end of file
+        return f"<RoutineTask(routine_id={self.routine_id}, task_id={self.task_id}, position={self.position})>"
+
+    @classmethod
+    def ordered_tasks_query(cls, routine_id, session=None):
+        """
+        Query the tasks of a routine in position order.
+
+        Served by ix_routine_tasks_routine_id_position, so SQLite neither scans
+        routine_tasks nor sorts the result.
+        """
+        from .task import Task
+
+        query = session.query(Task) if session is not None else Task.query
+        return (
+            query
+            .join(cls, cls.task_id == Task.id)
+            .filter(cls.routine_id == routine_id)
+            .order_by(cls.position)
+        )
@@ -0,0 +1,31 @@
+"""
+RunEvent entity module.
+
+This module defines the RunEvent entity for SQLAlchemy, a time series of
+routine run and task start/end events recorded by run_history.
+"""
+
+from sqlalchemy import Column, Integer, String, Float, Boolean, Index
+
+from .base import Base
+
+class RunEvent(Base):
+    """A single start or end event of a routine run or of a task within a run."""
+
+    __tablename__ = "run_events"
+    __table_args__ = (
+        Index("ix_run_events_run_id", "run_id"),
+        Index("ix_run_events_timestamp", "timestamp"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, nullable=False)
+    routine_id = Column(Integer, nullable=True)  # None while the built-in default tasks are used
+    task_id = Column(Integer, nullable=True)  # None for run_start/run_end events
+    kind = Column(String, nullable=False)  # "run_start", "run_end", "task_start" or "task_end"
+    timestamp = Column(Float, nullable=False)  # Seconds since the epoch
+    duration = Column(Float, nullable=True)  # Seconds, set on end events
+    completed = Column(Boolean, nullable=True)  # End events: finished normally (False if stopped)
+
+    def __repr__(self):
+        return f"<RunEvent(run_id={self.run_id}, kind='{self.kind}', task_id={self.task_id})>"
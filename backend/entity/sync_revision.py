@@ -0,0 +1,24 @@
+"""
+SyncRevision entity module.
+
+This module defines the SyncRevision entity for SQLAlchemy, the last
+revision of a cloud change feed applied to the local database (see
+definition_sync). It also keeps local counters that must never go back,
+like the last issued run id (see run_history).
+"""
+
+from sqlalchemy import Column, Float, Integer, String
+
+from .base import Base
+
+class SyncRevision(Base):
+    """Last applied revision of one change feed."""
+
+    __tablename__ = "sync_revisions"
+
+    feed = Column(String, primary_key=True)  # e.g. "definitions", or "run_ids" for a counter
+    revision = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Float, nullable=True)  # Seconds since the epoch
+
+    def __repr__(self):
+        return f"<SyncRevision(feed='{self.feed}', revision={self.revision})>"
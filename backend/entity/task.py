@@ -3,11 +3,9 @@ Task entity module.
 
 This module defines the Task entity for SQLAlchemy.
 """
-from PySide6.QtSvgWidgets import QSvgWidget
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.orm import relationship
 
-from display.utils import get_fa_path
 from .base import Base
 
 class Task(Base):
@@ -16,7 +14,7 @@ class Task(Base):
     __tablename__ = "tasks"
 
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, index=True)
     icon_name = Column(String, nullable=False)
     sound = Column(String, nullable=False)
     duration = Column(Integer, nullable=False)  # Duration in seconds
@@ -32,11 +30,24 @@ class Task(Base):
         return {
             "id": self.id,
             "name": self.name,
+            "icon_name": self.icon_name,
             "sound": self.sound,
             "duration": self.duration
         }
 
+    @classmethod
+    def get_by_name(cls, name, session=None):
+        """Get the first task with the given name (uses ix_tasks_name)."""
+        query = session.query(cls) if session is not None else cls.query
+        return query.filter(cls.name == name).first()
+
     def get_item_as_widget(self):
-        return QSvgWidget(
-            get_fa_path(self.icon_name)
-        )
\ No newline at end of file
+        # Qt is only imported when a widget is needed, so the entity layer
+        # can be used by migrations and headless services without PySide6.
+        from PySide6.QtCore import QByteArray
+        from PySide6.QtSvgWidgets import QSvgWidget
+        from display.utils import icon_cache
+
+        widget = QSvgWidget()
+        widget.load(QByteArray(icon_cache.get(self.icon_name)))
+        return widget
\ No newline at end of file
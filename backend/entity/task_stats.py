@@ -0,0 +1,45 @@
+"""
+TaskStats entity module.
+
+This module defines the TaskStats entity for SQLAlchemy, the incrementally
+maintained duration rollup of a task (or of a whole run) within a routine.
+"""
+
+import json
+
+from sqlalchemy import Column, Integer, String, Float, Text, Index
+
+from .base import Base
+
+class TaskStats(Base):
+    """
+    Duration rollup for one task of a routine, or for complete runs of the
+    routine when task_id is None.
+    """
+
+    __tablename__ = "task_stats"
+    __table_args__ = (
+        Index("ix_task_stats_routine_id_task_id", "routine_id", "task_id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    routine_id = Column(Integer, nullable=True)
+    task_id = Column(Integer, nullable=True)
+    name = Column(String, nullable=True)  # Last seen task or routine name
+    count = Column(Integer, nullable=False, default=0)
+    total_duration = Column(Float, nullable=False, default=0.0)
+    min_duration = Column(Float, nullable=True)
+    max_duration = Column(Float, nullable=True)
+    # Sparse duration histogram as JSON: {"bucket index": count}
+    histogram = Column(Text, nullable=False, default="{}")
+
+    def __repr__(self):
+        return f"<TaskStats(routine_id={self.routine_id}, task_id={self.task_id}, count={self.count})>"
+
+    def get_histogram(self):
+        """Get the histogram as a dict mapping bucket index to count."""
+        return {int(k): v for k, v in json.loads(self.histogram or "{}").items()}
+
+    def set_histogram(self, histogram):
+        """Store a dict mapping bucket index to count."""
+        self.histogram = json.dumps(histogram, sort_keys=True)
@@ -0,0 +1,420 @@
+"""
+event_dispatcher.py
+
+This module sends routine transitions to outside systems: HTTP webhooks and
+MQTT-style topics on a local bus that home-automation integrations
+subscribe to (e.g. dim the lights when "Go to Sleep" starts).
+
+Delivery never runs on the thread changing the routine. The RoutineState
+listener only turns the transition into an event and hands it to the
+dispatcher's event loop, which runs in its own thread. There, each sink has
+a bounded queue of pending events, one per routine runtime (target): an
+event for a target that still has one pending replaces it, so a slow or
+unreachable sink receives the latest state instead of a backlog. A pool of
+worker tasks delivers the queues, one event at a time per sink, and failed
+deliveries are retried with decorrelated jitter backoff (see backoff).
+
+Events are JSON objects:
+
+    {"event": "next_task", "target_id": null, "routine_id": 1,
+     "task": {...}, "previous_task": {...}, "is_active": true,
+     "timestamp": 1767290400.0, "coalesced": 0}
+
+"task" is the task active after the change. "previous_task" is the task
+active before the first of the coalesced changes, and "coalesced" counts
+the changes replaced by this one.
+
+Topics are "<prefix>/<target>/state" (retained: integrations starting later
+read the latest state with topic_bus.retained()) and
+"<prefix>/<target>/<event>", with "default"
+as the target of the device's own routine. Subscriptions may use the MQTT
+wildcards "+" (one level) and "#" (the remaining levels).
+"""
+
+import asyncio
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import httpx
+
+from backoff import DecorrelatedJitterBackoff
+from clock import Clock, system_clock
+from metrics import registry
+from routine_registry import DEFAULT_TARGET
+from routine_state import Transition
+
+logger = logging.getLogger(__name__)
+
+EVENTS_DELIVERED = registry.counter("events_delivered_total", "Events delivered, by sink.", labels=("sink",))
+EVENT_FAILURES = registry.counter("event_delivery_failures_total", "Failed event deliveries, by sink.",
+                                  labels=("sink",))
+EVENTS_COALESCED = registry.counter("events_coalesced_total",
+                                    "Events replaced by a newer event for the same target before delivery.",
+                                    labels=("sink",))
+EVENTS_DROPPED = registry.counter("events_dropped_total", "Events given up on, by sink and reason.",
+                                  labels=("sink", "reason"))
+EVENT_DELIVERY = registry.histogram("event_delivery_seconds", "Time taken by event deliveries.", labels=("sink",))
+EVENT_QUEUE_DEPTH = registry.gauge("event_queue_depth", "Events waiting for delivery, by sink.", labels=("sink",))
+
+def event_from_transition(transition: Transition) -> Dict[str, Any]:
+    """Get the event sent for a routine transition."""
+    return {
+        "event": transition.event,
+        "target_id": transition.target_id,
+        "routine_id": transition.routine_id,
+        "task": transition.current_task,
+        "previous_task": transition.previous_task,
+        "is_active": transition.current_task is not None,
+        "timestamp": transition.timestamp,
+        "coalesced": 0,
+    }
+
+class DeliveryError(Exception):
+    """An event could not be delivered; retryable unless the sink rejected it for good."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+Subscriber = Callable[[str, Dict[str, Any]], Union[None, Awaitable[None]]]
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """Check whether a topic matches a subscription pattern with MQTT wildcards."""
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+class TopicBus:
+    """
+    In-process publish/subscribe with MQTT-style topics and retained messages.
+
+    Subscribers are called on the dispatcher's event loop and may be
+    coroutine functions; they must not block.
+    """
+
+    def __init__(self):
+        self._subscribers: List[Tuple[str, Subscriber]] = []
+        self._retained: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, pattern: str, callback: Subscriber) -> Callable[[], None]:
+        """
+        Call callback(topic, payload) for every message on a matching topic
+        published from now on (see retained() for earlier ones).
+
+        Returns:
+            A function that cancels the subscription
+        """
+        entry = (pattern, callback)
+        with self._lock:
+            self._subscribers.append(entry)
+
+        def unsubscribe():
+            with self._lock:
+                if entry in self._subscribers:
+                    self._subscribers.remove(entry)
+        return unsubscribe
+
+    def retained(self, pattern: str = "#") -> Dict[str, Dict[str, Any]]:
+        """Get the retained messages of the topics matching a pattern."""
+        with self._lock:
+            return {topic: payload for topic, payload in self._retained.items() if topic_matches(pattern, topic)}
+
+    async def publish(self, topic: str, payload: Dict[str, Any], retain: bool = False):
+        """Call the subscribers of a topic. A failing subscriber is logged and does not affect the others."""
+        with self._lock:
+            if retain:
+                self._retained[topic] = payload
+            subscribers = [callback for pattern, callback in self._subscribers if topic_matches(pattern, topic)]
+        for callback in subscribers:
+            try:
+                result = callback(topic, payload)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Subscriber of {topic} failed: {e}")
+
+# Local bus used unless another one is passed in
+topic_bus = TopicBus()
+
+class TopicSink:
+    """Publishes events on a TopicBus."""
+
+    def __init__(self, bus: Optional[TopicBus] = None, prefix: str = "bedtime"):
+        self.bus = bus if bus is not None else topic_bus
+        self.prefix = prefix
+        self.name = f"topics:{prefix}"
+
+    async def deliver(self, event: Dict[str, Any]):
+        base = f"{self.prefix}/{event['target_id'] or DEFAULT_TARGET}"
+        await self.bus.publish(f"{base}/state", event, retain=True)
+        await self.bus.publish(f"{base}/{event['event']}", event)
+
+    async def close(self):
+        pass
+
+class WebhookSink:
+    """POSTs events as JSON to a URL."""
+
+    def __init__(self, url: str, timeout: float = 5.0, headers: Optional[Dict[str, str]] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        """
+        Args:
+            url: Webhook URL
+            timeout: Seconds a delivery may take
+            headers: Extra request headers (e.g. an authorization token)
+            transport: httpx transport (for tests)
+        """
+        self.url = url
+        self.name = f"webhook:{urlsplit(url).netloc}"
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def deliver(self, event: Dict[str, Any]):
+        if self._client is None:
+            # Created on the dispatcher's loop, and reused for keep-alive
+            self._client = httpx.AsyncClient(timeout=self.timeout, headers=self.headers, transport=self.transport)
+        try:
+            response = await self._client.post(self.url, json=event)
+        except httpx.HTTPError as e:
+            raise DeliveryError(f"{type(e).__name__}: {e}") from e
+        if response.status_code >= 400:
+            # Client errors other than rate limiting will not go away by retrying
+            retryable = response.status_code >= 500 or response.status_code in (408, 429)
+            raise DeliveryError(f"HTTP {response.status_code}", retryable)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class _SinkQueue:
+    """Pending events of one sink, at most one per target."""
+
+    __slots__ = ("sink", "pending", "attempts", "backoff", "active")
+
+    def __init__(self, sink, backoff: DecorrelatedJitterBackoff):
+        self.sink = sink
+        self.pending: "OrderedDict[Optional[str], Dict[str, Any]]" = OrderedDict()
+        self.attempts = 0  # Failed attempts of the event at the front
+        self.backoff = backoff
+        self.active = False  # Queued for a worker, being delivered or waiting to retry
+
+class EventDispatcher:
+    """Delivers routine events to sinks from its own thread and event loop."""
+
+    def __init__(self, sinks: List[Any], workers: int = 4, max_pending: int = 64, max_attempts: int = 8,
+                 retry_base: float = 1.0, retry_cap: float = 300.0, clock: Optional[Clock] = None):
+        """
+        Args:
+            sinks: Objects with a name, async deliver(event) raising
+                DeliveryError, and async close()
+            workers: Deliveries running at the same time (over all sinks)
+            max_pending: Targets with a pending event per sink; the oldest
+                event is dropped when a new target does not fit
+            max_attempts: Attempts per event before it is dropped
+            retry_base: Minimum delay before retrying, in seconds
+            retry_cap: Maximum delay before retrying, in seconds
+            clock: Clock for the retry delays (defaults to the system clock)
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.clock = clock or system_clock
+        self._queues = [_SinkQueue(sink, DecorrelatedJitterBackoff(retry_base, retry_cap)) for sink in sinks]
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ready: Optional[asyncio.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+        self._stopping: Optional[asyncio.Event] = None
+        self._stop_timeout = 5.0
+        for queue in self._queues:
+            EVENT_QUEUE_DEPTH.labels(queue.sink.name).set_function(lambda queue=queue: len(queue.pending))
+
+    @property
+    def sinks(self) -> List[Any]:
+        return [queue.sink for queue in self._queues]
+
+    def start(self):
+        """Start the dispatcher thread."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="event-dispatcher", daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the dispatcher, giving pending deliveries up to timeout seconds."""
+        if self._thread is None:
+            return
+        self._stop_timeout = timeout
+        self._loop.call_soon_threadsafe(self._stopping.set)
+        self._thread.join(timeout + 5)
+        self._thread = None
+
+    def on_transition(self, transition: Transition):
+        """RoutineState listener (see RoutineRegistry.add_listener)."""
+        self.publish(event_from_transition(transition))
+
+    def publish(self, event: Dict[str, Any]):
+        """Queue an event for all sinks (from any thread, never blocks)."""
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._enqueue, event)
+        except RuntimeError:
+            pass  # The loop was closed by stop()
+
+    def pending(self) -> Dict[str, int]:
+        """Get the number of pending events per sink."""
+        return {queue.sink.name: len(queue.pending) for queue in self._queues}
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._main())
+        finally:
+            self._loop = None
+            loop.close()
+
+    async def _main(self):
+        self._ready = asyncio.Queue()
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._started.set()
+        try:
+            await self._stopping.wait()
+            # Deliver what is pending unless a sink keeps failing
+            deadline = time.monotonic() + self._stop_timeout
+            while (any(queue.active for queue in self._queues) and time.monotonic() < deadline
+                   and not any(queue.attempts for queue in self._queues)):
+                await asyncio.sleep(0.01)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for queue in self._queues:
+                if queue.pending:
+                    logger.warning(f"Dropping {len(queue.pending)} undelivered events for {queue.sink.name}")
+                try:
+                    await queue.sink.close()
+                except Exception as e:
+                    logger.error(f"Could not close {queue.sink.name}: {e}")
+
+    def _enqueue(self, event: Dict[str, Any]):
+        key = event["target_id"]
+        for queue in self._queues:
+            previous = queue.pending.get(key)
+            if previous is not None:
+                # Keep the first change's previous task, and the queue position
+                queue.pending[key] = dict(event, previous_task=previous["previous_task"],
+                                          coalesced=previous["coalesced"] + event["coalesced"] + 1)
+                EVENTS_COALESCED.labels(queue.sink.name).inc()
+            else:
+                if len(queue.pending) >= self.max_pending:
+                    queue.pending.popitem(last=False)
+                    queue.attempts = 0  # Counted for the dropped event, if it had failed
+                    EVENTS_DROPPED.labels(queue.sink.name, "queue_full").inc()
+                queue.pending[key] = event
+            if not queue.active:
+                queue.active = True
+                self._ready.put_nowait(queue)
+
+    async def _worker(self):
+        while True:
+            queue = await self._ready.get()
+            if not queue.pending:
+                queue.active = False
+                continue
+            key, event = queue.pending.popitem(last=False)
+            name = queue.sink.name
+            started_at = time.perf_counter()
+            try:
+                await queue.sink.deliver(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                EVENT_FAILURES.labels(name).inc()
+                retryable = not isinstance(e, DeliveryError) or e.retryable
+                self._retry(queue, key, event, retryable, e)
+                continue
+            finally:
+                EVENT_DELIVERY.labels(name).observe(time.perf_counter() - started_at)
+
+            EVENTS_DELIVERED.labels(name).inc()
+            queue.attempts = 0
+            queue.backoff.reset()
+            if queue.pending:
+                self._ready.put_nowait(queue)
+            else:
+                queue.active = False
+
+    def _retry(self, queue: _SinkQueue, key: Optional[str], event: Dict[str, Any], retryable: bool,
+               error: Exception):
+        """Put a failed event back at the front, unless it was superseded meanwhile, and retry later."""
+        name = queue.sink.name
+        queue.attempts += 1
+        if not retryable or queue.attempts >= self.max_attempts:
+            reason = "rejected" if not retryable else "attempts"
+            logger.warning(f"Dropping {event['event']} event for {name} after {queue.attempts} attempts: {error}")
+            EVENTS_DROPPED.labels(name, reason).inc()
+            queue.attempts = 0
+        elif key in queue.pending:
+            # A newer event for the target replaces the failed one; it keeps
+            # the failed event's previous task
+            newer = queue.pending[key]
+            queue.pending[key] = dict(newer, previous_task=event["previous_task"],
+                                      coalesced=event["coalesced"] + newer["coalesced"] + 1)
+            queue.pending.move_to_end(key, last=False)
+            EVENTS_COALESCED.labels(name).inc()
+        else:
+            queue.pending[key] = event
+            queue.pending.move_to_end(key, last=False)
+
+        if not queue.pending:
+            queue.active = False
+            queue.backoff.reset()
+            return
+        if not retryable or queue.attempts == 0:
+            self._ready.put_nowait(queue)
+            return
+        delay = queue.backoff.next_delay()
+        logger.info(f"Delivery to {name} failed ({error}), retrying in {delay:.1f}s")
+        self.clock.call_later(delay, lambda: self._ready.put_nowait(queue))
+
+def start_event_dispatcher(webhooks: List[str], topic_prefix: str = "bedtime", source=None) -> EventDispatcher:
+    """
+    Start delivering routine events to webhooks and the local topic_bus.
+
+    Args:
+        webhooks: Webhook URLs
+        topic_prefix: First level of the local topics
+        source: RoutineRegistry or RoutineState to follow (defaults to the routine_registry)
+
+    Returns:
+        The dispatcher; stop it with dispatcher.stop() and source.remove_listener(dispatcher.on_transition)
+    """
+    if source is None:
+        from routine_registry import routine_registry
+        source = routine_registry
+    sinks = [TopicSink(topic_bus, topic_prefix)] + [WebhookSink(url) for url in webhooks]
+    dispatcher = EventDispatcher(sinks)
+    dispatcher.start()
+    source.add_listener(dispatcher.on_transition)
+    logger.info(f"Sending routine events to {', '.join(sink.name for sink in sinks)}")
+    return dispatcher
@@ -4,12 +4,27 @@ fastapi_server.py
 This module provides a FastAPI server with REST endpoints to control the bedtime routine.
 """
 
-from fastapi import FastAPI, HTTPException
+import asyncio
+import logging
+import time
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
+from starlette.routing import Match
 from typing import List, Dict, Optional, Any
 
-from routine_state import routine_state
+from app_logging import recent_records
+from memory import memory_monitor
+from metrics import registry
+from routine_registry import routine_registry
+from routine_state import RoutineState
+from run_history import run_history
+from tracing import activate, tracer
+
+logger = logging.getLogger(__name__)
 
 # Create FastAPI app
 app = FastAPI(title="Bedtime Routine API", 
@@ -24,6 +39,44 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+REQUEST_LATENCY = registry.histogram("http_request_duration_seconds",
+                                     "Time spent handling HTTP requests.", labels=("method", "route"))
+REQUESTS = registry.counter("http_requests_total", "HTTP responses by status code.",
+                            labels=("method", "route", "status"))
+
+def route_template(request: Request) -> str:
+    """Get the path template of the matched route, e.g. /sound/play/{sound_name}."""
+    route = request.scope.get("route")
+    if route is None:  # Older Starlette versions do not record the matched route
+        for candidate in request.app.router.routes:
+            if candidate.matches(request.scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", "unmatched")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """
+    Record the latency and status of every request, and trace commands.
+    
+    Requests other than GET are traced like WebSocket commands; a caller
+    can pass its own trace id in the X-Trace-Id header.
+    """
+    started_at = time.perf_counter()
+    trace = None
+    if request.method != "GET":
+        trace = tracer.start_trace(request.url.path, "rest", request.headers.get("x-trace-id"), started_at)
+    with activate(trace):
+        response = await call_next(request)
+    route = route_template(request)
+    REQUEST_LATENCY.labels(request.method, route).observe(time.perf_counter() - started_at)
+    REQUESTS.labels(request.method, route, str(response.status_code)).inc()
+    if trace is not None:
+        trace.name = f"{request.method} {route}"
+        trace.add_span("rest.handler", started_at, status=response.status_code)
+        response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
 # Response models
 class Task(BaseModel):
     id: int
@@ -36,6 +89,27 @@ class RoutineStatus(BaseModel):
     current_task: Optional[Task] = None
     current_sound: Optional[str] = None
 
+class DurationStatistics(BaseModel):
+    routine_id: Optional[int] = None
+    task_id: Optional[int] = None  # None for whole-run statistics
+    name: Optional[str] = None
+    count: int
+    mean: Optional[float] = None
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+# Optional on the routine endpoints: the child or screen whose routine is meant
+TARGET = Query(None, description="Target id of a routine runtime (default: the device's own routine)")
+
+def target_state(target: Optional[str]) -> RoutineState:
+    """Get the routine runtime of a target, or fail with 404."""
+    state = routine_registry.get(target)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Unknown target: {target}")
+    return state
+
 # API endpoints
 @app.get("/", response_model=Dict[str, str])
 async def root():
@@ -43,60 +117,193 @@ async def root():
     return {"message": "Welcome to the Bedtime Routine API"}
 
 @app.get("/tasks", response_model=List[Task])
-async def get_tasks():
+async def get_tasks(target: Optional[str] = TARGET):
     """Get all tasks in the routine."""
-    return routine_state.tasks
+    return target_state(target).tasks
 
 @app.get("/status", response_model=RoutineStatus)
-async def get_status():
+async def get_status(target: Optional[str] = TARGET):
     """Get the current status of the routine."""
-    current_task = routine_state.current_task
-    
+    return target_state(target).snapshot()
+
+@app.get("/stats", response_model=List[DurationStatistics])
+async def get_stats():
+    """Get duration statistics per task and per routine (served from memory)."""
+    return run_history.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Get runtime metrics in the Prometheus text format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/traces")
+async def get_traces(limit: int = Query(20, ge=1)):
+    """Get per-stage latency and the spans of the last commands."""
     return {
-        "is_active": routine_state.is_routine_active,
-        "current_task": current_task,
-        "current_sound": routine_state.current_sound
+        "sample_rate": tracer.sample_rate,
+        "stages": tracer.stage_latencies(limit),
+        "traces": tracer.export(limit)
     }
 
+@app.get("/debug/logs")
+async def get_logs(limit: int = Query(100, ge=1), level: Optional[str] = None,
+                   logger: Optional[str] = None):
+    """Get recent log records from memory, optionally filtered by minimum level and logger."""
+    try:
+        return recent_records(limit, level, logger)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/debug/memory")
+def get_memory():
+    """Get the resident memory, the budget and the estimated size of each subsystem's caches."""
+    return memory_monitor.breakdown()
+
+@app.get("/debug/memory/snapshot")
+def get_memory_snapshot(limit: int = Query(20, ge=1), key_type: str = "lineno", frames: int = Query(1, ge=1)):
+    """
+    Get the top allocation sites from a tracemalloc snapshot, grouped by
+    lineno, filename or traceback.
+    
+    The first call starts tracing; later calls also show the growth since the previous snapshot.
+    """
+    if key_type not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail=f"Invalid key_type: {key_type}")
+    return memory_monitor.snapshot(limit, key_type, frames)
+
+@app.post("/debug/memory/evict")
+def evict_memory():
+    """Evict all evictable caches now."""
+    return memory_monitor.evict()
+
 @app.post("/routine/start", response_model=Task)
-async def start_routine():
+async def start_routine(target: Optional[str] = TARGET):
     """Start the routine from the beginning."""
+    state = target_state(target)
     try:
-        task = routine_state.start_routine()
+        task = state.start_routine()
         return task
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/routine/next", response_model=Optional[Task])
-async def next_task():
+async def next_task(target: Optional[str] = TARGET):
     """Move to the next task in the routine."""
-    if not routine_state.is_routine_active:
+    state = target_state(target)
+    if not state.is_routine_active:
         raise HTTPException(status_code=400, detail="No active routine")
     
-    task = routine_state.next_task()
+    task = state.next_task()
     if task is None:
         return None  # Routine is complete
     return task
 
 @app.post("/routine/stop")
-async def stop_routine():
+async def stop_routine(target: Optional[str] = TARGET):
     """Stop the current routine."""
-    routine_state.stop_routine()
+    target_state(target).stop_routine()
     return {"message": "Routine stopped"}
 
+@app.post("/routine/select/{routine_id}", response_model=List[Task])
+def select_routine(routine_id: int, target: Optional[str] = TARGET):
+    """Make a stored routine the active one and load its tasks."""
+    state = target_state(target)
+    if not state.select_routine(routine_id):
+        raise HTTPException(status_code=404, detail=f"Routine not found: {routine_id}")
+    return state.tasks
+
 @app.post("/sound/play/{sound_name}")
-async def play_sound(sound_name: str):
+async def play_sound(sound_name: str, target: Optional[str] = TARGET):
     """Play a specific sound."""
-    success = routine_state.play_sound(sound_name)
+    success = target_state(target).play_sound(sound_name)
     if not success:
         raise HTTPException(status_code=400, detail=f"Could not play sound: {sound_name}")
     return {"message": f"Playing sound: {sound_name}"}
 
+@app.get("/targets", response_model=Dict[str, RoutineStatus])
+async def get_targets():
+    """Get the status of the routine runtime of every target besides the default one."""
+    return routine_registry.snapshots()
+
+@app.put("/targets/{target_id}", response_model=RoutineStatus)
+def create_target(target_id: str, routine_id: Optional[int] = None):
+    """Create the routine runtime of a target (running the active routine unless routine_id is given)."""
+    try:
+        return routine_registry.create(target_id, routine_id).snapshot()
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Routine not found: {routine_id}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/targets/{target_id}")
+async def delete_target(target_id: str):
+    """Discard the routine runtime of a target."""
+    if not routine_registry.remove(target_id):
+        raise HTTPException(status_code=404, detail=f"Unknown target: {target_id}")
+    return {"message": f"Removed target: {target_id}"}
+
+# Read-only routes requested by warm_up
+WARM_UP_PATHS = ("/", "/status", "/tasks", "/stats", "/metrics")
+
+def warm_up():
+    """
+    Serve the read-only routes once in-process, so the first real requests
+    do not pay for lazy imports, route and model setup or the first
+    database connection (e.g. right after a handoff).
+    """
+    import httpx
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://warm-up") as client:
+            for path in WARM_UP_PATHS:
+                await client.get(path)
+
+    asyncio.run(run())
+
+class DrainingServer(uvicorn.Server):
+    """
+    A uvicorn server that, when stopping, lets the connections it already
+    accepted send their request before closing the idle ones.
+
+    uvicorn closes a connection without a request in progress right away,
+    and a client that connected just before the listener was handed to
+    another process would see its request fail. Connections not accepted
+    yet stay in the shared listen backlog.
+
+    The wait relies on uvicorn internals (Server.servers, the connections
+    of its server_state and their request cycle); with a uvicorn that does
+    not have them the server shuts down the plain uvicorn way.
+    """
+
+    request_grace = 0.5  # Seconds to wait for the request of a new connection
+
+    async def shutdown(self, sockets=None):
+        servers = getattr(self, "servers", None)
+        connections = getattr(getattr(self, "server_state", None), "connections", None)
+        if servers is None or connections is None:
+            logger.warning(f"uvicorn {uvicorn.__version__} does not expose its connections, "
+                           "closing new connections without waiting for their request")
+        else:
+            for server in servers:
+                server.close()
+            deadline = time.monotonic() + self.request_grace
+            # A connection's cycle is set once its first request arrived
+            while (any(hasattr(connection, "cycle") and connection.cycle is None for connection in connections)
+                   and time.monotonic() < deadline):
+                await asyncio.sleep(0.005)
+        await super().shutdown(sockets)
+
+def create_server(host: str = "0.0.0.0", port: int = 8000) -> DrainingServer:
+    """Create the uvicorn server of the app (run it with server.run(sockets=[...]) to use a given socket)."""
+    from uvicorn.config import LOGGING_CONFIG
+    # Once logging is set up (see app_logging), uvicorn's loggers go through it too
+    log_config = None if logging.getLogger().handlers else LOGGING_CONFIG
+    return DrainingServer(uvicorn.Config(app, host=host, port=port, log_config=log_config))
+
 # Function to start the server
 def start_server(host: str = "0.0.0.0", port: int = 8000):
     """Start the FastAPI server."""
-    import uvicorn
-    uvicorn.run(app, host=host, port=port)
+    create_server(host, port).run()
 
 if __name__ == "__main__":
     start_server()
\ No newline at end of file
@@ -0,0 +1,286 @@
+"""
+handoff.py
+
+This module provides zero-downtime restarts of the device process.
+
+The HTTP listener is opened once and outlives the process: it comes from
+systemd socket activation (bedtime_routine.socket, LISTEN_FDS), from the
+process being replaced, or, when started by hand, is bound here. New
+connections that arrive while no process is accepting wait in the listen
+backlog instead of being refused.
+
+Replacing the process (systemctl reload, i.e. SIGHUP):
+1. The old process starts the new one with the same command line, passing
+   it the listening socket and one end of a socket pair, and sends it the
+   current state so its display comes up showing the right task.
+2. The new process loads the routine, warms its caches and starts its
+   display, then reports "ready". The old process keeps serving meanwhile.
+3. The old process stops serving HTTP and WebSocket commands, flushes the
+   run history and sends the final state.
+4. The new process restores it, accepts on the inherited socket, connects
+   to the hub (which replaces the old connection), tells systemd it is the
+   main process now and acknowledges. The old process exits.
+Only steps 3 and 4 are visible to users; if the new process fails before
+step 4, the old one resumes serving.
+
+When the service is stopped or restarted instead, the state is written to
+a file in the runtime directory and restored by the next process if it is
+recent enough.
+
+Messages on the socket pair are JSON objects, one per line.
+"""
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+SD_LISTEN_FDS_START = 3  # First file descriptor passed by systemd
+HANDOFF_FD_ENV = "BEDTIME_HANDOFF_FD"  # Socket pair end of a process being replaced
+LISTEN_FD_ENV = "BEDTIME_LISTEN_FD"  # Listening socket inherited from it
+
+class HandoffError(RuntimeError):
+    """The other process failed, exited or did not answer in time."""
+
+def listen_fds(unset_environment: bool = True) -> List[int]:
+    """
+    Get the file descriptors passed by systemd socket activation (sd_listen_fds).
+
+    Returns an empty list when the process was not socket-activated.
+    """
+    try:
+        if int(os.environ.get("LISTEN_PID", "")) != os.getpid():
+            return []
+        count = int(os.environ.get("LISTEN_FDS", ""))
+    except ValueError:
+        return []
+    finally:
+        if unset_environment:
+            for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+                os.environ.pop(name, None)
+    fds = list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count))
+    for fd in fds:
+        os.set_inheritable(fd, False)
+    return fds
+
+def notify(state: str) -> bool:
+    """
+    Send a status to systemd (sd_notify), e.g. "READY=1" or "MAINPID=1234".
+
+    Returns False when not running under a notify-type service.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        address = "\0" + address[1:]  # Abstract namespace
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+        return True
+    except OSError as e:
+        logger.warning(f"Could not notify systemd: {e}")
+        return False
+
+def open_listener(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """
+    Get the listening socket of the HTTP server: inherited from a process
+    being replaced, passed by systemd, or bound to host and port.
+    """
+    inherited = os.environ.pop(LISTEN_FD_ENV, None)
+    if inherited is not None:
+        logger.info("Using the listening socket of the previous process")
+        return socket.socket(fileno=int(inherited))
+
+    fds = listen_fds()
+    if fds:
+        if len(fds) > 1:
+            logger.warning(f"Got {len(fds)} sockets from systemd, using the first")
+        logger.info("Using the listening socket passed by systemd")
+        return socket.socket(fileno=fds[0])
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+class _Channel:
+    """One end of the socket pair between the old and the new process."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._reader = sock.makefile("r", encoding="utf-8")
+
+    def send(self, message: Dict[str, Any]):
+        self.sock.sendall((json.dumps(message, separators=(",", ":")) + "\n").encode())
+
+    def receive(self, expected: str, timeout: Optional[float]) -> Dict[str, Any]:
+        self.sock.settimeout(timeout)
+        try:
+            line = self._reader.readline()
+        except (socket.timeout, OSError) as e:
+            raise HandoffError(f"No {expected} message: {e}") from e
+        if not line:
+            raise HandoffError(f"Connection closed while waiting for a {expected} message")
+        message = json.loads(line)
+        if message.get("type") != expected:
+            raise HandoffError(f"Expected a {expected} message, got {message.get('type')}")
+        return message
+
+    def close(self):
+        self._reader.close()
+        self.sock.close()
+
+class Successor:
+    """The new process, as seen from the one it replaces."""
+
+    def __init__(self, process: subprocess.Popen, channel: _Channel):
+        self.process = process
+        self.channel = channel
+
+    @classmethod
+    def spawn(cls, listener: socket.socket, argv: Optional[Sequence[str]] = None) -> "Successor":
+        """Start a new process with the same command line (by default), inheriting the listener."""
+        ours, theirs = socket.socketpair()
+        env = dict(os.environ, **{HANDOFF_FD_ENV: str(theirs.fileno()), LISTEN_FD_ENV: str(listener.fileno())})
+        command = list(argv) if argv is not None else [sys.executable] + sys.argv
+        try:
+            process = subprocess.Popen(command, env=env, pass_fds=(theirs.fileno(), listener.fileno()))
+        finally:
+            theirs.close()
+        logger.info(f"Started replacement process {process.pid}")
+        return cls(process, _Channel(ours))
+
+    def send_state(self, state: Dict[str, Any], final: bool = False):
+        self.channel.send({"type": "state", "final": final, "state": state})
+
+    def wait_ready(self, timeout: float):
+        self.channel.receive("ready", timeout)
+
+    def wait_serving(self, timeout: float):
+        self.channel.receive("serving", timeout)
+
+    def abort(self):
+        """Stop a new process that failed to take over."""
+        self.channel.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        logger.error(f"Replacement process {self.process.pid} exited with code {self.process.returncode}")
+
+class Predecessor:
+    """The old process, as seen from the one replacing it."""
+
+    def __init__(self, channel: _Channel):
+        self.channel = channel
+
+    @classmethod
+    def from_environment(cls) -> Optional["Predecessor"]:
+        """Get the process being replaced, or None if this process was started normally."""
+        fd = os.environ.pop(HANDOFF_FD_ENV, None)
+        if fd is None:
+            return None
+        return cls(_Channel(socket.socket(fileno=int(fd))))
+
+    def initial_state(self, timeout: float = 10) -> Dict[str, Any]:
+        """Get the state sent when this process was started."""
+        return self.channel.receive("state", timeout)["state"]
+
+    def ready(self, timeout: float = 30) -> Dict[str, Any]:
+        """Report that this process is warmed up, and get the final state."""
+        self.channel.send({"type": "ready", "pid": os.getpid()})
+        return self.channel.receive("state", timeout)["state"]
+
+    def serving(self):
+        """Report that this process accepts connections now; the old one may exit."""
+        self.channel.send({"type": "serving", "pid": os.getpid()})
+        self.channel.close()
+
+def replace_process(listener: socket.socket, export_state: Callable[[], Dict[str, Any]],
+                    quiesce: Callable[[], None], resume: Callable[[], None],
+                    argv: Optional[Sequence[str]] = None, ready_timeout: float = 60,
+                    serving_timeout: float = 10) -> bool:
+    """
+    Hand the service over to a new process (run in the old one).
+
+    Args:
+        listener: Listening socket passed to the new process
+        export_state: Returns the state to carry over
+        quiesce: Stops serving HTTP and WebSocket commands
+        resume: Serves again after a failed handover
+        argv: Command line of the new process (defaults to this one's)
+        ready_timeout: Seconds the new process may take to start and warm up
+        serving_timeout: Seconds the new process may take to accept connections
+
+    Returns:
+        True if the new process took over and this one should exit
+    """
+    successor = Successor.spawn(listener, argv)
+    try:
+        successor.send_state(export_state())
+        successor.wait_ready(ready_timeout)
+    except (HandoffError, OSError) as e:
+        logger.error(f"Replacement process did not get ready: {e}")
+        successor.abort()
+        return False
+
+    held_from = time.perf_counter()
+    quiesce()
+    try:
+        successor.send_state(export_state(), final=True)
+        successor.wait_serving(serving_timeout)
+    except (HandoffError, OSError) as e:
+        logger.error(f"Replacement process did not take over: {e}")
+        successor.abort()
+        resume()
+        return False
+    successor.channel.close()
+    logger.info(f"Handed over to process {successor.process.pid}, "
+                f"requests were held for {(time.perf_counter() - held_from) * 1000:.0f} ms")
+    return True
+
+def save_state(path: str, state: Dict[str, Any]):
+    """Write the state for the next process, atomically."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump({"saved_at": time.time(), "state": state}, f)
+    os.replace(temporary, path)
+
+def load_state(path: str, max_age: float = 60) -> Optional[Dict[str, Any]]:
+    """
+    Get the state written by save_state and remove the file.
+
+    Returns None if there is none, or if it is older than max_age seconds
+    (e.g. the device was off overnight).
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable state file {path}: {e}")
+        saved = None
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    if saved is None:
+        return None
+    age = time.time() - saved["saved_at"]
+    if age > max_age:
+        logger.info(f"Ignoring state saved {age:.0f} s ago")
+        return None
+    return saved["state"]
@@ -0,0 +1,17 @@
+"""
+Reference hub (cloud side) for the device WebSocket protocol.
+
+The hub accepts device connections, keeps the latest status of every device,
+fans commands out to devices and device groups, syncs routine definitions
+and assets to devices and exposes a small REST facade. It is a local
+stand-in for integration tests and a baseline for the real cloud server.
+
+Run it with: python -m hub --ws-port 3000 --http-port 8080
+"""
+
+from .server import Hub, DeviceConnection
+from .assets import AssetCatalog
+from .definitions import DefinitionStore
+from .rest import create_app
+
+__all__ = ['Hub', 'DeviceConnection', 'AssetCatalog', 'DefinitionStore', 'create_app']
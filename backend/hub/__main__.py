@@ -0,0 +1,62 @@
+"""
+Run the reference hub: the device WebSocket server and the REST facade in
+one asyncio process.
+"""
+
+import argparse
+import asyncio
+import logging
+import resource
+import sys
+
+import uvicorn
+
+from .assets import AssetCatalog
+from .rest import create_app
+from .server import Hub
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_WS_PORT = 3000
+DEFAULT_HTTP_PORT = 8080
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="RoutineCloud reference hub")
+    parser.add_argument("--host", default=DEFAULT_HOST,
+                        help=f"Host to bind both servers (default: {DEFAULT_HOST})")
+    parser.add_argument("--ws-port", type=int, default=DEFAULT_WS_PORT,
+                        help=f"Port for device WebSocket connections (default: {DEFAULT_WS_PORT})")
+    parser.add_argument("--http-port", type=int, default=DEFAULT_HTTP_PORT,
+                        help=f"Port for the REST API (default: {DEFAULT_HTTP_PORT})")
+    parser.add_argument("--assets", action="append", default=[], metavar="ROOT=DIR",
+                        help="Publish the files of DIR to devices as asset root ROOT, "
+                             "e.g. sounds=sounds (may be given several times)")
+    return parser.parse_args()
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit permits."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+async def run(args):
+    hub = Hub(args.host, args.ws_port)
+    await hub.start()
+    assets = AssetCatalog(dict(root.split("=", 1) for root in args.assets)) if args.assets else None
+    config = uvicorn.Config(create_app(hub, assets), host=args.host, port=args.http_port, log_level="warning")
+    try:
+        await uvicorn.Server(config).serve()
+    finally:
+        await hub.stop()
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    print(f"Open file limit: {raise_file_limit()}")
+    print(f"Devices: ws://{args.host}:{args.ws_port}/ws?device_id=<id>, REST API: http://{args.host}:{args.http_port}")
+    asyncio.run(run(args))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Hub asset catalog module.
+
+This module provides the asset files the hub publishes to devices: a
+manifest of content hashes and the blobs by digest (see asset_sync for the
+device side and the wire format).
+"""
+
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from asset_sync import build_manifest
+
+logger = logging.getLogger(__name__)
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Get the first and last byte of a single HTTP Range header.
+
+    Returns:
+        The inclusive byte range, or None if the header is not satisfiable
+    """
+    match = _RANGE.fullmatch(header.strip())
+    if match is None or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # A suffix range: the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+class AssetCatalog:
+    """The asset files of some directories, listed by content digest."""
+
+    def __init__(self, roots: Dict[str, str]):
+        """
+        Args:
+            roots: Asset root name -> directory (e.g. {"sounds": "sounds"})
+        """
+        self.roots = roots
+        self._manifest: Dict[str, Any] = {"revision": None, "files": {}}
+        self._paths: Dict[str, str] = {}  # Digest -> a file with that content
+        self._lock = threading.Lock()
+        self.rescan()
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        return self._manifest
+
+    def rescan(self) -> bool:
+        """
+        List and hash the files again, after they changed.
+
+        Returns:
+            True if the manifest revision changed
+        """
+        manifest = build_manifest(self.roots)
+        paths = {}
+        for path, entry in manifest["files"].items():
+            root, _, relative = path.partition("/")
+            paths.setdefault(entry["digest"], os.path.join(self.roots[root], *relative.split("/")))
+        with self._lock:
+            changed = manifest["revision"] != self._manifest["revision"]
+            self._manifest = manifest
+            self._paths = paths
+        if changed:
+            logger.info(f"Asset revision {manifest['revision'][:12]}: {len(manifest['files'])} files, "
+                        f"{len(paths)} blobs")
+        return changed
+
+    def blob_path(self, digest: str) -> Optional[str]:
+        """Get a file holding a blob, or None if no listed file has that digest."""
+        return self._paths.get(digest)
@@ -0,0 +1,100 @@
+"""
+Hub definition store module.
+
+This module keeps the routine definitions edited in the cloud and the log
+of their changes, from which devices get the changes since the revision
+they last applied (see ws_protocol and definition_sync).
+"""
+
+import logging
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+import ws_protocol
+
+logger = logging.getLogger(__name__)
+
+class DefinitionStore:
+    """Routine definition rows by table and id, with a bounded log of their changes."""
+
+    def __init__(self, max_log: int = 10000):
+        """
+        Args:
+            max_log: Row changes kept in the log; devices further behind get
+                a full download
+        """
+        self.max_log = max_log
+        self.revision = 0
+        self.rows: Dict[str, Dict[int, Dict[str, Any]]] = {table: {} for table in ws_protocol.DEFINITION_FIELDS}
+        self._log: deque = deque()  # (revision, table, id), oldest first
+        self._oldest_delta = 0  # Lowest revision changes can be sent from
+        self.full_downloads = 0
+
+    def apply(self, changes: List[Dict[str, Any]]) -> int:
+        """
+        Commit changes as one new revision.
+
+        Args:
+            changes: {"table", "id", "row"} to insert or replace a row,
+                {"table", "id", "deleted": True} to delete one
+
+        Returns:
+            The new revision
+
+        Raises:
+            ValueError: If a change names an unknown table or lacks a row (nothing is applied)
+        """
+        for change in changes:
+            fields = ws_protocol.DEFINITION_FIELDS.get(change.get("table"))
+            if fields is None or not isinstance(change.get("id"), int):
+                raise ValueError(f"Invalid change: {change!r}")
+            if not change.get("deleted") and not (isinstance(change.get("row"), dict)
+                                                  and set(fields) <= set(change["row"])):
+                raise ValueError(f"Change without a complete row: {change!r}")
+
+        self.revision += 1
+        for change in changes:
+            table, row_id = change["table"], change["id"]
+            if change.get("deleted"):
+                self.rows[table].pop(row_id, None)
+            else:
+                fields = ws_protocol.DEFINITION_FIELDS[table]
+                self.rows[table][row_id] = {field: change["row"][field] for field in fields}
+            self._log.append((self.revision, table, row_id))
+        while len(self._log) > self.max_log:
+            revision, _, _ = self._log.popleft()
+            self._oldest_delta = max(self._oldest_delta, revision)
+        return self.revision
+
+    def changes_since(self, revision: Optional[int]) -> Dict[str, Any]:
+        """
+        Get the definitions message bringing a device from a revision to the current one.
+
+        The changes are sent when the log still holds them all; a device that
+        never synced (revision 0 or None), is behind the log or ahead of the
+        hub (whose store was reset) gets every row instead.
+        """
+        revision = revision or 0
+        if revision == self.revision:
+            return self._message(revision, [], False)
+        if revision == 0 or revision < self._oldest_delta or revision > self.revision:
+            self.full_downloads += 1
+            changes = [{"table": table, "id": row_id, "row": row}
+                       for table, rows in self.rows.items() for row_id, row in rows.items()]
+            return self._message(revision, changes, True)
+
+        touched: Dict[Tuple[str, int], None] = {}
+        for logged, table, row_id in reversed(self._log):
+            if logged <= revision:
+                break
+            touched[(table, row_id)] = None
+        changes = []
+        for table, row_id in reversed(list(touched)):
+            row = self.rows[table].get(row_id)
+            changes.append({"table": table, "id": row_id, "row": row} if row is not None
+                           else {"table": table, "id": row_id, "deleted": True})
+        return self._message(revision, changes, False)
+
+    def _message(self, base: int, changes: List[Dict[str, Any]], full: bool) -> Dict[str, Any]:
+        return {"type": ws_protocol.DEFINITIONS, "base": base, "revision": self.revision, "full": full,
+                "changes": changes}
@@ -0,0 +1,150 @@
+"""
+Hub REST facade module.
+
+This module provides a FastAPI app to inspect devices and send commands to
+devices and groups through a Hub, to edit the routine definitions synced to
+devices and to serve the assets devices sync.
+"""
+
+import time
+from typing import Any, Dict, List, Optional
+
+from fastapi import Body, FastAPI, Header, HTTPException, Response
+
+from asset_sync import valid_digest
+from .assets import AssetCatalog, parse_range
+from .server import Hub
+
+def _execute_at(execute_at: Optional[float], execute_in: Optional[float]) -> Optional[float]:
+    """Get the hub time a command runs at, given as a time or as seconds from now."""
+    if execute_at is not None and execute_in is not None:
+        raise HTTPException(status_code=400, detail="Pass execute_at or execute_in, not both")
+    return time.time() + execute_in if execute_in is not None else execute_at
+
+def create_app(hub: Hub, assets: Optional[AssetCatalog] = None) -> FastAPI:
+    """Create the REST facade for a hub, serving the assets of a catalog if given."""
+    app = FastAPI(title="RoutineCloud Hub API",
+                  description="Reference hub for RoutineCloud devices")
+
+    @app.get("/stats")
+    async def get_stats():
+        """Get connection and message counters."""
+        return hub.stats()
+
+    @app.get("/devices", response_model=List[Dict[str, Any]])
+    async def get_devices(connected: bool = False):
+        """List known devices (only connected ones if requested)."""
+        device_ids = hub.connections if connected else set(hub.last_seen) | set(hub.connections)
+        return [hub.device_info(device_id) for device_id in sorted(device_ids)]
+
+    @app.get("/devices/{device_id}")
+    async def get_device(device_id: str):
+        """Get the latest status of a device."""
+        info = hub.device_info(device_id)
+        if info is None:
+            raise HTTPException(status_code=404, detail=f"Unknown device: {device_id}")
+        return info
+
+    @app.post("/devices/{device_id}/commands/{command}")
+    async def send_device_command(device_id: str, command: str,
+                                  data: Optional[Dict[str, Any]] = Body(default=None),
+                                  trace_id: Optional[str] = None, execute_at: Optional[float] = None,
+                                  execute_in: Optional[float] = None):
+        """
+        Send a command to a device, optionally tagged with a trace id and
+        run at a hub time (execute_at) or that many seconds from now (execute_in).
+        """
+        execute_at = _execute_at(execute_at, execute_in)
+        if not await hub.send_command(device_id, command, data, trace_id, execute_at):
+            raise HTTPException(status_code=404, detail=f"Device not connected: {device_id}")
+        return {"message": f"Sent {command} to {device_id}", "execute_at": execute_at}
+
+    @app.get("/groups", response_model=Dict[str, List[str]])
+    async def get_groups():
+        """List groups and their members."""
+        return {group: sorted(members) for group, members in hub.groups.items()}
+
+    @app.put("/groups/{group}/devices/{device_id}")
+    async def add_group_member(group: str, device_id: str):
+        """Add a device to a group."""
+        hub.add_to_group(group, device_id)
+        return {"message": f"Added {device_id} to {group}"}
+
+    @app.delete("/groups/{group}/devices/{device_id}")
+    async def remove_group_member(group: str, device_id: str):
+        """Remove a device from a group."""
+        hub.remove_from_group(group, device_id)
+        return {"message": f"Removed {device_id} from {group}"}
+
+    @app.post("/groups/{group}/commands/{command}")
+    async def send_group_command(group: str, command: str,
+                                 data: Optional[Dict[str, Any]] = Body(default=None),
+                                 execute_at: Optional[float] = None, execute_in: Optional[float] = None):
+        """
+        Send a command to all connected members of a group, run by all of
+        them at the same hub time (execute_at) or seconds from now (execute_in) if given.
+        """
+        if group not in hub.groups:
+            raise HTTPException(status_code=404, detail=f"Unknown group: {group}")
+        execute_at = _execute_at(execute_at, execute_in)
+        sent = hub.send_group_command(group, command, data, execute_at)
+        return {"message": f"Sent {command} to {sent} devices", "sent": sent, "execute_at": execute_at}
+
+    @app.get("/definitions")
+    async def get_definitions(since: int = 0):
+        """Get the definition changes since a revision (every row if it is 0 or too old)."""
+        return hub.definitions.changes_since(since)
+
+    @app.post("/definitions")
+    async def post_definitions(changes: List[Dict[str, Any]] = Body(..., embed=True)):
+        """Commit definition changes as one revision and push them to the connected devices."""
+        try:
+            revision = hub.publish_definitions(changes)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"revision": revision}
+
+    @app.get("/assets/manifest")
+    async def get_asset_manifest(response: Response, if_none_match: Optional[str] = Header(default=None)):
+        """Get the manifest of the assets, or 304 if the device has its revision."""
+        if assets is None:
+            raise HTTPException(status_code=404, detail="No assets published")
+        manifest = assets.manifest
+        etag = f'"{manifest["revision"]}"'
+        if if_none_match == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        return manifest
+
+    @app.get("/assets/blobs/{digest}")
+    def get_asset_blob(digest: str, range_header: Optional[str] = Header(default=None, alias="Range")):
+        """Get an asset by digest, or the part of it given by a Range header."""
+        path = assets.blob_path(digest) if assets is not None and valid_digest(digest) else None
+        if path is None:
+            raise HTTPException(status_code=404, detail=f"Unknown blob: {digest}")
+        with open(path, "rb") as f:
+            size = f.seek(0, 2)
+            if range_header is None:
+                f.seek(0)
+                return Response(f.read(), media_type="application/octet-stream",
+                                headers={"Accept-Ranges": "bytes"})
+            byte_range = parse_range(range_header, size)
+            if byte_range is None:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            start, end = byte_range
+            f.seek(start)
+            return Response(f.read(end - start + 1), status_code=206, media_type="application/octet-stream",
+                            headers={"Content-Range": f"bytes {start}-{end}/{size}", "Accept-Ranges": "bytes"})
+
+    @app.post("/assets/rescan")
+    async def rescan_assets(notify: bool = True):
+        """List the asset files again and ask connected devices to sync if they changed."""
+        if assets is None:
+            raise HTTPException(status_code=404, detail="No assets published")
+        changed = assets.rescan()
+        notified = 0
+        if changed and notify:
+            notified = hub.broadcast_command(list(hub.connections), "sync_assets")
+        return {"revision": assets.manifest["revision"], "changed": changed, "notified": notified}
+
+    return app
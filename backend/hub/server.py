@@ -0,0 +1,329 @@
+"""
+Hub server module.
+
+This module implements the device side of the hub: one asyncio task per
+device connection, a latest-status table, command fan-out, the routine
+definitions feed and the clock devices schedule commands against.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+import websockets
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+import ws_protocol
+from time_sync import TimeSync
+from .definitions import DefinitionStore
+
+logger = logging.getLogger(__name__)
+
+class DeviceConnection:
+    """A connected device."""
+
+    __slots__ = ("device_id", "websocket", "codec", "tracker", "connected_at")
+
+    def __init__(self, device_id: str, websocket, codec, last_id: int = 0):
+        self.device_id = device_id
+        self.websocket = websocket
+        self.codec = codec
+        self.tracker = ws_protocol.StatusTracker(last_id=last_id)
+        self.connected_at = time.time()
+
+    async def send(self, message: Dict[str, Any]):
+        await self.websocket.send(self.codec.encode(message))
+
+class Hub:
+    """
+    Asyncio WebSocket hub speaking the device protocol (see ws_protocol).
+
+    Devices connect to ws://host:port/ws?device_id=<id>. Connections without
+    a device id are identified by their remote address.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 3000, ping_interval: Optional[float] = 30,
+                 ping_timeout: Optional[float] = 20, definitions: Optional[DefinitionStore] = None):
+        """
+        Initialize the hub.
+
+        Args:
+            host: Interface to listen on
+            port: Port to listen on
+            ping_interval: Seconds between server pings that reap dead
+                connections (devices also run their own heartbeat)
+            ping_timeout: Seconds to wait for a pong before closing
+            definitions: Routine definitions synced to devices (empty by default)
+        """
+        self.host = host
+        self.port = port
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+        self.connections: Dict[str, DeviceConnection] = {}
+        # Latest known status and last message time of every device ever seen
+        self.statuses: Dict[str, Dict[str, Any]] = {}
+        self.last_seen: Dict[str, float] = {}
+        # Highest outbox id processed per device, kept across connections:
+        # sequence numbers restart with the device, outbox ids do not
+        self.last_ids: Dict[str, int] = {}
+        self.groups: Dict[str, Set[str]] = {}
+        self.definitions = definitions if definitions is not None else DefinitionStore()
+
+        # Counters
+        self.messages_received = 0
+        self.resyncs_requested = 0
+        self.nacks_received = 0
+
+        self._server = None
+
+    async def start(self):
+        """Start listening for device connections."""
+        self._server = await websockets.serve(
+            self._handle_connection,
+            self.host,
+            self.port,
+            subprotocols=ws_protocol.supported_subprotocols() or None,
+            compression=None,
+            extensions=[ServerPerMessageDeflateFactory(
+                server_max_window_bits=11,
+                client_max_window_bits=11,
+                compress_settings={"memLevel": 4}
+            )],
+            ping_interval=self.ping_interval,
+            ping_timeout=self.ping_timeout,
+            max_queue=4
+        )
+        if self.port == 0:
+            self.port = next(iter(self._server.sockets)).getsockname()[1]
+        logger.info(f"Hub listening on ws://{self.host}:{self.port}/ws")
+
+    async def stop(self):
+        """Close all connections and stop listening."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            await self.stop()
+
+    @property
+    def url(self) -> str:
+        """Get the URL devices connect to."""
+        host = "127.0.0.1" if self.host in ("0.0.0.0", "") else self.host
+        return f"ws://{host}:{self.port}/ws"
+
+    # Device connections
+
+    @staticmethod
+    def _device_id(websocket) -> str:
+        request = getattr(websocket, "request", None)
+        path = request.path if request is not None else getattr(websocket, "path", "")
+        device_ids = parse_qs(urlsplit(path).query).get("device_id")
+        if device_ids:
+            return device_ids[0]
+        host, port = websocket.remote_address[:2]
+        return f"{host}:{port}"
+
+    async def _handle_connection(self, websocket):
+        device_id = self._device_id(websocket)
+        codec = ws_protocol.codec_for_subprotocol(websocket.subprotocol)
+        previous = self.connections.get(device_id)
+        last_id = self.last_ids.get(device_id, 0)
+        if previous is not None:
+            last_id = max(last_id, previous.tracker.last_id)
+        connection = DeviceConnection(device_id, websocket, codec, last_id)
+
+        if previous is not None:
+            # The device reconnected before the old (half-open) socket was reaped
+            asyncio.ensure_future(previous.websocket.close())
+        self.connections[device_id] = connection
+        logger.debug(f"Device {device_id} connected ({websocket.subprotocol or 'json'})")
+
+        try:
+            async for frame in websocket:
+                try:
+                    message = codec.decode(frame)
+                except ValueError:
+                    logger.warning(f"Undecodable frame from {device_id}")
+                    continue
+                await self._handle_message(connection, message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.last_ids[device_id] = max(self.last_ids.get(device_id, 0), connection.tracker.last_id)
+            if self.connections.get(device_id) is connection:
+                del self.connections[device_id]
+            logger.debug(f"Device {device_id} disconnected")
+
+    async def _handle_message(self, connection: DeviceConnection, message: Dict[str, Any]):
+        """Update the device's status from a message and acknowledge it."""
+        received_at = time.time()
+        self.messages_received += 1
+        device_id = connection.device_id
+        tracker = connection.tracker
+        self.last_seen[device_id] = time.time()
+        message_type = message.get("type")
+
+        if message_type == ws_protocol.BATCH:
+            in_sync = True
+            tracker.apply_batch(message)
+        elif message_type in (ws_protocol.STATUS, ws_protocol.STATUS_DELTA):
+            if tracker.is_duplicate(message):
+                # Already applied: only its sequence number moves on
+                in_sync = tracker.observe(message.get("seq"))
+            else:
+                in_sync = tracker.apply(message)
+        else:
+            if message_type == ws_protocol.DEFINITIONS_SYNC:
+                await connection.send(self.definitions.changes_since(message.get("revision")))
+            elif message_type == ws_protocol.TIME_SYNC:
+                await connection.send(TimeSync.answer(message, received_at, time.time()))
+            elif message_type == ws_protocol.NACK:
+                self.nacks_received += 1
+                logger.warning(f"Device {device_id} rejected {message.get('command')}: {message.get('reason')}")
+            in_sync = tracker.observe(message.get("seq"))
+
+        if tracker.status is not None:
+            self.statuses[device_id] = tracker.status
+
+        if in_sync:
+            await connection.send({"type": ws_protocol.ACK, "seq": message.get("seq")})
+        else:
+            self.resyncs_requested += 1
+            await connection.send({"type": ws_protocol.RESYNC})
+
+    # Commands
+
+    @staticmethod
+    def command_message(command: str, data: Optional[Dict[str, Any]] = None,
+                        trace_id: Optional[str] = None, execute_at: Optional[float] = None) -> Dict[str, Any]:
+        message = {"type": ws_protocol.COMMAND, "command": command, "data": data or {}}
+        if trace_id is not None:
+            message["trace_id"] = trace_id
+        if execute_at is not None:
+            message["execute_at"] = execute_at
+        return message
+
+    async def send_command(self, device_id: str, command: str, data: Optional[Dict[str, Any]] = None,
+                           trace_id: Optional[str] = None, execute_at: Optional[float] = None) -> bool:
+        """
+        Send a command to one device.
+
+        A trace_id, if given, is recorded by the device's command trace. An
+        execute_at time (hub clock, seconds since the epoch) makes the
+        device run the command at that time instead of on receipt.
+
+        Returns:
+            True if the device is connected and the command was sent
+        """
+        connection = self.connections.get(device_id)
+        if connection is None:
+            return False
+        try:
+            await connection.send(self.command_message(command, data, trace_id, execute_at))
+            return True
+        except websockets.ConnectionClosed:
+            return False
+
+    def broadcast_command(self, device_ids: Iterable[str], command: str,
+                          data: Optional[Dict[str, Any]] = None, execute_at: Optional[float] = None) -> int:
+        """
+        Send a command to many devices without waiting for slow ones.
+
+        The message is encoded once per codec and written with
+        websockets.broadcast, which skips connections whose write buffer is
+        full instead of blocking the fan-out. With an execute_at time (hub
+        clock) the devices run the command at the same moment.
+
+        Returns:
+            The number of connected devices the command was sent to
+        """
+        return self._broadcast(device_ids, self.command_message(command, data, execute_at=execute_at))
+
+    def _broadcast(self, device_ids: Iterable[str], message: Dict[str, Any]) -> int:
+        by_codec: Dict[Optional[str], List[Any]] = {}
+        codecs = {}
+        for device_id in device_ids:
+            connection = self.connections.get(device_id)
+            if connection is not None:
+                key = connection.codec.subprotocol
+                codecs[key] = connection.codec
+                by_codec.setdefault(key, []).append(connection.websocket)
+
+        for key, websockets_ in by_codec.items():
+            websockets.broadcast(websockets_, codecs[key].encode(message))
+        return sum(len(w) for w in by_codec.values())
+
+    # Routine definitions
+
+    def publish_definitions(self, changes: List[Dict[str, Any]]) -> int:
+        """
+        Commit definition changes as a new revision and push them to the connected devices.
+
+        Devices that missed earlier revisions notice the gap and ask for the
+        changes since the revision they have.
+
+        Returns:
+            The new revision
+
+        Raises:
+            ValueError: If a change is invalid
+        """
+        base = self.definitions.revision
+        revision = self.definitions.apply(changes)
+        if self.connections:
+            self._broadcast(list(self.connections), self.definitions.changes_since(base))
+        return revision
+
+    # Groups
+
+    def add_to_group(self, group: str, device_id: str):
+        self.groups.setdefault(group, set()).add(device_id)
+
+    def remove_from_group(self, group: str, device_id: str):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(device_id)
+            if not members:
+                del self.groups[group]
+
+    def send_group_command(self, group: str, command: str, data: Optional[Dict[str, Any]] = None,
+                           execute_at: Optional[float] = None) -> int:
+        """Send a command to every connected member of a group."""
+        return self.broadcast_command(self.groups.get(group, ()), command, data, execute_at)
+
+    # Queries
+
+    def device_info(self, device_id: str) -> Optional[Dict[str, Any]]:
+        """Get what the hub knows about a device, or None if it was never seen."""
+        if device_id not in self.last_seen and device_id not in self.connections:
+            return None
+        connection = self.connections.get(device_id)
+        return {
+            "device_id": device_id,
+            "connected": connection is not None,
+            "protocol": (connection.codec.subprotocol or "json") if connection else None,
+            "status": self.statuses.get(device_id),
+            "last_seen": self.last_seen.get(device_id),
+            "groups": sorted(g for g, members in self.groups.items() if device_id in members)
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connected_devices": len(self.connections),
+            "known_devices": len(self.statuses),
+            "groups": len(self.groups),
+            "messages_received": self.messages_received,
+            "resyncs_requested": self.resyncs_requested,
+            "nacks_received": self.nacks_received,
+            "definitions_revision": self.definitions.revision,
+            "definitions_full_downloads": self.definitions.full_downloads
+        }
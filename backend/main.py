@@ -2,30 +2,60 @@
 main.py
 
 This is the main entry point for the Raspberry Pi bedtime routine application.
-It initializes and starts all components: FastAPI server, display thread, and WebSocket client.
+It initializes and starts all components: FastAPI server, display process, and WebSocket client.
 """
 
 import argparse
+import logging
 import os
 import signal
+import socket
 import sys
 import threading
 import time
 from typing import Optional
 
 # Import our modules
-from fastapi_server import start_server
-from display_thread import start_display_thread
+from app_logging import setup_logging, shutdown_logging
+from asset_sync import start_asset_sync
+from fastapi_server import create_server, warm_up
 from ws_client import start_ws_client
+from routine_registry import routine_registry
 from routine_state import routine_state
+from entity import init_database
+from entity.base import identity_map_size
+from definition_sync import DefinitionSync
+from display_supervisor import DisplaySupervisor
+from event_dispatcher import start_event_dispatcher
+from handoff import HandoffError, Predecessor, load_state, notify, open_listener, replace_process, save_state
+from memory import memory_monitor
+from run_history import run_history
+from sound_library import sound_library
+from tracing import tracer
 
 # Default configuration
 DEFAULT_HOST = "0.0.0.0"
 DEFAULT_PORT = 8000
 DEFAULT_WS_URL = "ws://localhost:3000/ws"
 DEFAULT_SOUND_DIR = "sounds"
+DEFAULT_ICON_DIR = "assets/icons"  # Where the display looks for the Font Awesome icons
+DEFAULT_ASSET_STORE = "asset_store"
+DEFAULT_ASSET_SYNC_INTERVAL = 3600
 DEFAULT_SCREEN_SIZE = (800, 480)
 DEFAULT_FPS = 30
+DEFAULT_DISPLAY_MODE = "process"
+DEFAULT_HISTORY_MAX_EVENTS = 20000
+DEFAULT_OUTBOX_PATH = "outbox.db"
+DEFAULT_TRACE_SAMPLE_RATE = 1.0
+DEFAULT_LOG_LEVEL = "INFO"
+DEFAULT_LOG_RATE_LIMIT = 50
+DEFAULT_MEMORY_BUDGET_MB = 300  # Of the 512 MB on the device
+# Carries the routine progress over a restart; systemd sets RUNTIME_DIRECTORY
+DEFAULT_STATE_FILE = os.path.join(os.environ.get("RUNTIME_DIRECTORY", "."), "handoff_state.json")
+DEFAULT_STATE_MAX_AGE = 60
+DEFAULT_EVENT_TOPIC_PREFIX = "bedtime"
+
+logger = logging.getLogger(__name__)
 
 def parse_args():
     """Parse command line arguments."""
@@ -39,6 +69,12 @@ def parse_args():
                         help=f"WebSocket server URL (default: {DEFAULT_WS_URL})")
     parser.add_argument("--sound-dir", default=DEFAULT_SOUND_DIR,
                         help=f"Directory containing sound files (default: {DEFAULT_SOUND_DIR})")
+    parser.add_argument("--asset-url",
+                        help="REST API of the hub to sync sounds and icons from (default: no sync)")
+    parser.add_argument("--asset-store", default=DEFAULT_ASSET_STORE,
+                        help=f"Directory keeping the synced assets by content hash (default: {DEFAULT_ASSET_STORE})")
+    parser.add_argument("--asset-sync-interval", type=float, default=DEFAULT_ASSET_SYNC_INTERVAL,
+                        help=f"Seconds between asset syncs (default: {DEFAULT_ASSET_SYNC_INTERVAL})")
     parser.add_argument("--width", type=int, default=DEFAULT_SCREEN_SIZE[0],
                         help=f"Screen width (default: {DEFAULT_SCREEN_SIZE[0]})")
     parser.add_argument("--height", type=int, default=DEFAULT_SCREEN_SIZE[1],
@@ -47,8 +83,37 @@ def parse_args():
                         help=f"Display frames per second (default: {DEFAULT_FPS})")
     parser.add_argument("--no-display", action="store_true",
                         help="Disable pygame display (for headless operation)")
+    parser.add_argument("--display-mode", choices=("process", "thread"), default=DEFAULT_DISPLAY_MODE,
+                        help="Run the display in its own supervised process, or in a thread of this one "
+                             f"(default: {DEFAULT_DISPLAY_MODE})")
     parser.add_argument("--no-ws", action="store_true",
                         help="Disable WebSocket client")
+    parser.add_argument("--device-id", default=socket.gethostname(),
+                        help="Device id reported to the hub (default: host name)")
+    parser.add_argument("--outbox-path", default=DEFAULT_OUTBOX_PATH,
+                        help=f"File storing messages not yet delivered to the cloud (default: {DEFAULT_OUTBOX_PATH})")
+    parser.add_argument("--history-max-events", type=int, default=DEFAULT_HISTORY_MAX_EVENTS,
+                        help=f"Raw run history events to keep (default: {DEFAULT_HISTORY_MAX_EVENTS})")
+    parser.add_argument("--trace-sample-rate", type=float, default=DEFAULT_TRACE_SAMPLE_RATE,
+                        help=f"Fraction of commands traced end to end (default: {DEFAULT_TRACE_SAMPLE_RATE})")
+    parser.add_argument("--log-level", default=DEFAULT_LOG_LEVEL,
+                        help=f"Minimum level of log records (default: {DEFAULT_LOG_LEVEL})")
+    parser.add_argument("--log-json", action="store_true",
+                        help="Write log records as JSON lines")
+    parser.add_argument("--log-file",
+                        help="Append log records to this file instead of writing them to stderr")
+    parser.add_argument("--log-rate-limit", type=float, default=DEFAULT_LOG_RATE_LIMIT,
+                        help=f"Log records per second written below WARNING, 0 for no limit (default: {DEFAULT_LOG_RATE_LIMIT})")
+    parser.add_argument("--memory-budget-mb", type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help=f"Resident memory that triggers cache eviction, 0 to disable (default: {DEFAULT_MEMORY_BUDGET_MB})")
+    parser.add_argument("--state-file", default=DEFAULT_STATE_FILE,
+                        help=f"File carrying the routine progress over a restart (default: {DEFAULT_STATE_FILE})")
+    parser.add_argument("--state-max-age", type=float, default=DEFAULT_STATE_MAX_AGE,
+                        help=f"Seconds after which a saved routine progress is discarded (default: {DEFAULT_STATE_MAX_AGE})")
+    parser.add_argument("--webhook", action="append", default=[], metavar="URL",
+                        help="POST routine events to this URL (may be given several times)")
+    parser.add_argument("--event-topic-prefix", default=DEFAULT_EVENT_TOPIC_PREFIX,
+                        help=f"First level of the local event topics (default: {DEFAULT_EVENT_TOPIC_PREFIX})")
     
     return parser.parse_args()
 
@@ -57,49 +122,167 @@ def main():
     # Parse command line arguments
     args = parse_args()
     
+    # Log through a background writer, so logging never blocks the API or WebSocket loop
+    setup_logging(args.log_level, args.log_json, args.log_file, args.log_rate_limit)
+    
+    # The HTTP listener outlives this process: it comes from systemd or from
+    # the process being replaced, and connections wait in its backlog (see handoff)
+    listener = open_listener(args.host, args.port)
+    predecessor = Predecessor.from_environment()
+    
     # Create the sounds directory if it doesn't exist
     os.makedirs(args.sound_dir, exist_ok=True)
+    sound_library.directory = args.sound_dir
+    
+    # Migrate the database and load the active routine into memory
+    init_database()
+    if not routine_state.load_from_db():
+        logger.warning("No active routine in the database, using the default tasks")
+    
+    # Continue the routine where the previous process left off
+    def restore(carried_over):
+        if carried_over is None:
+            return False
+        routine_registry.restore_state(carried_over.get("targets", {}))
+        return routine_state.restore_state(carried_over["routine"])
     
-    # Start the display thread if enabled
-    display_thread = None
-    if not args.no_display:
-        print(f"Starting display thread (size: {args.width}x{args.height}, fps: {args.fps})")
-        display_thread = start_display_thread(
-            sound_dir=args.sound_dir,
-            screen_size=(args.width, args.height),
-            fps=args.fps
-        )
-    
-    # Start the WebSocket client if enabled
-    ws_thread = None
-    if not args.no_ws:
-        print(f"Starting WebSocket client (server: {args.ws_url})")
-        ws_thread = start_ws_client(server_url=args.ws_url)
-    
-    # Start the FastAPI server in a separate thread
-    print(f"Starting FastAPI server on {args.host}:{args.port}")
-    server_thread = threading.Thread(
-        target=start_server,
-        args=(args.host, args.port),
-        daemon=True
-    )
-    server_thread.start()
-    
-    # Set up signal handling for graceful shutdown
-    def signal_handler(sig, frame):
-        print("Shutting down...")
-        # The threads are daemon threads, so they will be terminated when the main thread exits
-        sys.exit(0)
-    
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
-    # Keep the main thread alive
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("Shutting down...")
+        carried_over = predecessor.initial_state() if predecessor else load_state(args.state_file, args.state_max_age)
+    except HandoffError as e:
+        logger.error(f"Could not take over from the previous process: {e}")
+        shutdown_logging()
+        return 1
+    restored = restore(carried_over)
+    
+    tracer.sample_rate = args.trace_sample_rate
+    
+    # Evict caches before the process gets near the OOM killer
+    memory_monitor.register("orm_identity_map", identity_map_size)
+    memory_monitor.budget = args.memory_budget_mb * 2**20
+    memory_monitor.start()
+    
+    # Start the display if enabled
+    display_supervisor = None
+    display_thread = None
+    if not args.no_display and args.display_mode == "process":
+        logger.info(f"Starting display process (size: {args.width}x{args.height})")
+        display_supervisor = DisplaySupervisor(screen_size=(args.width, args.height), log_level=args.log_level)
+        display_supervisor.start()
+    elif not args.no_display:
+        # Qt in a non-main thread is unsupported; kept for development on desktops
+        from display.display_thread import start_display_thread
+        logger.info(f"Starting display thread (size: {args.width}x{args.height})")
+        display_thread = start_display_thread(screen_size=(args.width, args.height))
+    
+    # Serve the first requests from warm caches
+    warm_up()
+    
+    # Take over from the process being replaced: it stops serving and sends
+    # its final state only now, which keeps the gap short
+    if predecessor is not None:
+        try:
+            carried_over = predecessor.ready()
+        except HandoffError as e:
+            # The previous process keeps serving
+            logger.error(f"Could not take over from the previous process: {e}")
+            if display_supervisor is not None:
+                display_supervisor.stop()
+            shutdown_logging()
+            return 1
+        restored = restore(carried_over)
+    
+    # Record run history
+    run_history.max_events = args.history_max_events
+    run_history.start()
+    if restored:
+        run_history.restore_run(carried_over["run"])
+    
+    # Send routine events to webhooks and local topics, off the routine's thread
+    event_dispatcher = start_event_dispatcher(args.webhook, args.event_topic_prefix, routine_registry)
+    
+    # Fetch new and changed sounds and icons from the hub
+    asset_sync = None
+    if args.asset_url:
+        asset_sync = start_asset_sync(args.asset_url, {"sounds": args.sound_dir, "icons": DEFAULT_ICON_DIR},
+                                      args.asset_store, args.asset_sync_interval)
+    
+    server = None
+    server_thread = None
+    ws_client = None
+    
+    def start_serving():
+        nonlocal server, server_thread, ws_client
+        # Start the FastAPI server in a separate thread, on a copy of the
+        # listener (uvicorn closes its sockets when it stops)
+        logger.info(f"Starting FastAPI server on {args.host}:{args.port}")
+        server = create_server(args.host, args.port)
+        server_thread = threading.Thread(target=server.run, kwargs={"sockets": [listener.dup()]}, daemon=True)
+        server_thread.start()
+        
+        # Start the WebSocket client if enabled
+        if not args.no_ws:
+            logger.info(f"Starting WebSocket client (server: {args.ws_url})")
+            ws_client = start_ws_client(server_url=args.ws_url, outbox_path=args.outbox_path,
+                                        device_id=args.device_id, asset_sync=asset_sync,
+                                        definition_sync=DefinitionSync())
+        
+        while not server.started and server_thread.is_alive():
+            time.sleep(0.001)
+    
+    def stop_serving():
+        """Stop taking commands, so the state can no longer change."""
+        server.should_exit = True
+        server_thread.join()
+        if ws_client is not None:
+            ws_client.stop()
+            ws_client.thread.join()
+        run_history.stop()
+    
+    def resume_serving():
+        run_history.start()
+        start_serving()
+    
+    def export_state():
+        return {"routine": routine_state.export_state(), "targets": routine_registry.export_state(),
+                "run": run_history.export_run()}
+    
+    start_serving()
+    if predecessor is not None:
+        predecessor.serving()
+        notify(f"MAINPID={os.getpid()}")
+    notify("READY=1")
+    
+    # SIGTERM and SIGINT stop the process, SIGHUP (systemctl reload) replaces it
+    stop_requested = threading.Event()
+    handover_requested = threading.Event()
+    signal.signal(signal.SIGINT, lambda sig, frame: stop_requested.set())
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop_requested.set())
+    signal.signal(signal.SIGHUP, lambda sig, frame: handover_requested.set())
+    
+    handed_over = False
+    while not stop_requested.wait(0.1):
+        if handover_requested.is_set():
+            handover_requested.clear()
+            logger.info("Handing over to a new process...")
+            notify("RELOADING=1")
+            if replace_process(listener, export_state, stop_serving, resume_serving):
+                handed_over = True
+                break
+            notify("READY=1")
+    
+    logger.info("Shutting down...")
+    if not handed_over:
+        notify("STOPPING=1")
+        stop_serving()
+        save_state(args.state_file, export_state())
+    routine_registry.remove_listener(event_dispatcher.on_transition)
+    event_dispatcher.stop()
+    if asset_sync is not None:
+        asset_sync.stop()
+    if display_supervisor is not None:
+        display_supervisor.stop()
+    listener.close()
+    shutdown_logging()
     
     return 0
 
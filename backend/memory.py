@@ -0,0 +1,279 @@
+"""
+memory.py
+
+This module provides memory instrumentation and budget enforcement for the
+device process.
+
+Subsystems holding caches (icon metadata, icon SVGs, trace and log rings,
+...) register with the process-wide memory_monitor, giving a function that
+estimates their size and optionally one that evicts their caches. The
+monitor reports a per-subsystem breakdown, takes tracemalloc snapshots on
+demand, and, when the resident set size crosses the configured budget,
+evicts the caches, runs the garbage collector and returns freed memory to
+the operating system before the OOM killer has to step in.
+"""
+
+import ctypes
+import ctypes.util
+import gc
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import resident_memory, registry
+
+logger = logging.getLogger(__name__)
+
+EVICTIONS = registry.counter("memory_evictions_total", "Cache evictions triggered by the memory budget.")
+BUDGET = registry.gauge("memory_budget_bytes", "Resident memory budget of the process (0 if disabled).")
+
+def approximate_size(obj: Any, max_objects: int = 200000) -> int:
+    """
+    Estimate the memory used by an object and everything it references
+    through containers and instance dictionaries, in bytes.
+
+    Shared objects are counted once; the walk stops after max_objects.
+    """
+    seen = set()
+    pending = [obj]
+    total = 0
+    while pending and len(seen) < max_objects:
+        current = pending.pop()
+        if id(current) in seen or isinstance(current, type):
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current, 0)
+        if isinstance(current, dict):
+            pending.extend(current.keys())
+            pending.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            pending.extend(current)
+        else:
+            if hasattr(current, "__dict__"):
+                pending.append(vars(current))
+            for cls in type(current).__mro__:
+                for slot in getattr(cls, "__slots__", ()):
+                    value = getattr(current, slot, None)
+                    if value is not None:
+                        pending.append(value)
+    return total
+
+def _load_malloc_trim() -> Optional[Callable[[int], int]]:
+    """Get glibc's malloc_trim, which returns freed heap memory to the OS, if available."""
+    name = ctypes.util.find_library("c")
+    if not name:
+        return None
+    try:
+        return ctypes.CDLL(name).malloc_trim
+    except (OSError, AttributeError):
+        return None
+
+_malloc_trim = _load_malloc_trim()
+
+class Subsystem:
+    """A registered memory consumer."""
+
+    __slots__ = ("name", "size", "evict", "priority")
+
+    def __init__(self, name: str, size: Callable[[], int], evict: Optional[Callable[[], None]], priority: int):
+        self.name = name
+        self.size = size
+        self.evict = evict
+        self.priority = priority
+
+class MemoryMonitor:
+    """Tracks subsystem memory use and enforces a resident memory budget."""
+
+    def __init__(self, budget: int = 0, check_interval: float = 30,
+                 rss: Callable[[], float] = resident_memory):
+        """
+        Args:
+            budget: Resident set size in bytes that triggers eviction (0 disables it)
+            check_interval: Seconds between budget checks
+            rss: Function returning the current resident set size in bytes
+        """
+        self.budget = budget
+        self.check_interval = check_interval
+        self.rss = rss
+        self.evictions = 0
+        self.last_eviction: Optional[Dict[str, Any]] = None
+        self._subsystems: Dict[str, Subsystem] = {}
+        self._lock = threading.Lock()
+        self._previous_snapshot: Optional[tracemalloc.Snapshot] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        BUDGET.set_function(lambda: self.budget)
+
+    def register(self, name: str, size: Callable[[], int], evict: Optional[Callable[[], None]] = None,
+                 priority: int = 100):
+        """
+        Register a subsystem.
+
+        Args:
+            name: Shown in the breakdown, e.g. "icon_metadata"
+            size: Returns the estimated size of the subsystem's caches in bytes
+            evict: Drops the caches; they must be rebuilt on demand afterwards
+            priority: Lower priorities are evicted first
+        """
+        with self._lock:
+            self._subsystems[name] = Subsystem(name, size, evict, priority)
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._subsystems.pop(name, None)
+
+    def _sorted_subsystems(self) -> List[Subsystem]:
+        with self._lock:
+            return sorted(self._subsystems.values(), key=lambda subsystem: (subsystem.priority, subsystem.name))
+
+    def breakdown(self) -> Dict[str, Any]:
+        """Get the resident set size, the budget and the estimated size of every subsystem."""
+        subsystems = {}
+        for subsystem in self._sorted_subsystems():
+            try:
+                size = subsystem.size()
+            except Exception as e:
+                logger.error(f"Could not size memory subsystem {subsystem.name}: {e}")
+                size = None
+            subsystems[subsystem.name] = {"bytes": size, "evictable": subsystem.evict is not None}
+        return {
+            "rss_bytes": self.rss(),
+            "budget_bytes": self.budget,
+            "evictions": self.evictions,
+            "last_eviction": self.last_eviction,
+            "tracemalloc": tracemalloc.is_tracing(),
+            "subsystems": subsystems,
+        }
+
+    def evict(self, target: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Evict subsystem caches, lowest priority first, and give the memory back.
+
+        Args:
+            target: Stop once the resident set size is at or below this many
+                bytes (None evicts every subsystem)
+        """
+        rss_before = self.rss()
+        evicted = []
+        for subsystem in self._sorted_subsystems():
+            if subsystem.evict is None:
+                continue
+            try:
+                subsystem.evict()
+                evicted.append(subsystem.name)
+            except Exception as e:
+                logger.error(f"Evicting memory subsystem {subsystem.name} failed: {e}")
+            self._release()
+            if target is not None and self.rss() <= target:
+                break
+        if not evicted:
+            self._release()
+
+        self.evictions += 1
+        EVICTIONS.inc()
+        self.last_eviction = {
+            "timestamp": time.time(),
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": self.rss(),
+            "subsystems": evicted,
+        }
+        return self.last_eviction
+
+    @staticmethod
+    def _release():
+        """Free unreachable objects and return free heap pages to the OS."""
+        gc.collect()
+        if _malloc_trim is not None:
+            _malloc_trim(0)
+
+    def check(self) -> bool:
+        """Evict caches if the resident set size exceeds the budget. Returns True if it did."""
+        if not self.budget:
+            return False
+        rss = self.rss()
+        if rss <= self.budget:
+            return False
+        logger.warning(f"Resident memory {rss / 2**20:.1f} MiB exceeds the budget of "
+                       f"{self.budget / 2**20:.1f} MiB, evicting caches")
+        # Aim below the budget, so the next check does not evict again right away
+        result = self.evict(self.budget * 0.9)
+        logger.warning(f"Resident memory after eviction: {result['rss_after_bytes'] / 2**20:.1f} MiB")
+        return True
+
+    def start(self):
+        """Check the budget periodically in a background thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="memory-monitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Memory budget check failed: {e}")
+
+    def snapshot(self, limit: int = 20, key_type: str = "lineno", frames: int = 1) -> Dict[str, Any]:
+        """
+        Take a tracemalloc snapshot and get the top allocation sites.
+
+        Tracing is started by the first call (it slows allocations down, so
+        it is off until needed); later calls also report the growth since the
+        previous snapshot.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._previous_snapshot = None
+            return {"tracing": True, "started": True, "top": [], "growth": []}
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "tracing": True,
+            "started": False,
+            "traced_bytes": current,
+            "peak_traced_bytes": peak,
+            "top": [self._stat_to_dict(stat) for stat in snapshot.statistics(key_type)[:limit]],
+            "growth": [],
+        }
+        if self._previous_snapshot is not None:
+            result["growth"] = [
+                self._stat_to_dict(stat)
+                for stat in snapshot.compare_to(self._previous_snapshot, key_type)[:limit]
+                if stat.size_diff > 0
+            ]
+        self._previous_snapshot = snapshot
+        return result
+
+    def stop_tracing(self):
+        """Stop tracemalloc and drop its snapshots."""
+        tracemalloc.stop()
+        self._previous_snapshot = None
+
+    @staticmethod
+    def _stat_to_dict(stat) -> Dict[str, Any]:
+        entry = {
+            "where": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+            "bytes": stat.size,
+            "count": stat.count,
+        }
+        if hasattr(stat, "size_diff"):
+            entry["bytes_diff"] = stat.size_diff
+            entry["count_diff"] = stat.count_diff
+        return entry
+
+# Process-wide monitor
+memory_monitor = MemoryMonitor()
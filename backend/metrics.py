@@ -0,0 +1,321 @@
+"""
+metrics.py
+
+This module provides a small, low-overhead metrics registry with counters,
+gauges and fixed-bucket histograms, rendered in the Prometheus text format
+by the /metrics endpoint.
+
+Recording is a lock-protected increment (plus a bisect for histograms), so
+it can stay enabled on a Raspberry Pi Zero. Process RSS and CPU time are
+read from /proc only when the metrics are scraped.
+"""
+
+import bisect
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Default buckets in seconds for request and command latencies
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Buckets in seconds for lock wait and hold times
+LOCK_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+def _format_value(value: float) -> str:
+    """Format a sample value the way Prometheus expects."""
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """Format a label set, e.g. {route="/status",method="GET"}."""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    """Escape a label value."""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Counter:
+    """A value that only goes up, or is read from a monotonic source when scraped."""
+
+    __slots__ = ("_lock", "value", "function")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1.0):
+        """Increase the counter."""
+        with self._lock:
+            self.value += amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the counter with a function each time the metrics are scraped."""
+        self.function = function
+
+    def get(self) -> float:
+        """Get the current value."""
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self, name: str, label_names: Sequence[str], label_values: Sequence[str]) -> Iterator[str]:
+        yield f"{name}{_format_labels(label_names, label_values)} {_format_value(self.get())}"
+
+class Gauge:
+    """A value that can go up and down, or is computed when scraped."""
+
+    __slots__ = ("_lock", "value", "function")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        """Set the gauge."""
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        """Increase the gauge."""
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        """Decrease the gauge."""
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Compute the gauge with a function each time the metrics are scraped."""
+        self.function = function
+
+    def get(self) -> float:
+        """Get the current value."""
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self, name: str, label_names: Sequence[str], label_values: Sequence[str]) -> Iterator[str]:
+        yield f"{name}{_format_labels(label_names, label_values)} {_format_value(self.get())}"
+
+class Histogram:
+    """Counts observations in fixed buckets, plus their sum and count."""
+
+    __slots__ = ("_lock", "buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Record one observation."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> "_Timer":
+        """Time a block: with histogram.time(): ..."""
+        return _Timer(self)
+
+    def state(self) -> Tuple[List[int], float, int]:
+        """Get the bucket counts (not cumulative), sum and count."""
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def merge(self, counts: Sequence[int], total: float, count: int):
+        """Add observations counted elsewhere, e.g. in another process, with the same buckets."""
+        if len(counts) != len(self.counts):
+            raise ValueError("Histogram buckets do not match")
+        with self._lock:
+            for index, bucket_count in enumerate(counts):
+                self.counts[index] += bucket_count
+            self.sum += total
+            self.count += count
+
+    def samples(self, name: str, label_names: Sequence[str], label_values: Sequence[str]) -> Iterator[str]:
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(bound)}"'
+            yield f"{name}_bucket{_format_labels(label_names, label_values, le)} {cumulative}"
+        labels = _format_labels(label_names, label_values)
+        yield f"{name}_sum{labels} {_format_value(total)}"
+        yield f"{name}_count{labels} {count}"
+
+class _Timer:
+    """Context manager observing the time spent in a block."""
+
+    __slots__ = ("histogram", "started_at")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at)
+
+class MetricFamily:
+    """A named metric with a fixed set of label names and one child per label set."""
+
+    def __init__(self, name: str, help: str, kind: str, factory: Callable[[], object],
+                 label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self._factory = factory
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._children[()] = factory()
+
+    def labels(self, *values: str):
+        """Get the child for a label set, creating it on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects labels {self.label_names}")
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def children(self) -> List[Tuple[Tuple[str, ...], object]]:
+        """Get the (label values, child) pairs created so far."""
+        return list(self._children.items())
+
+    def __getattr__(self, attribute):
+        # Unlabelled families forward inc/set/observe/... to their only child
+        if attribute.startswith("_") or self.label_names:
+            raise AttributeError(attribute)
+        return getattr(self._children[()], attribute)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self.children():
+            yield from child.samples(self.name, self.label_names, values)
+
+class MetricsRegistry:
+    """Holds the metric families of the process and renders them."""
+
+    def __init__(self):
+        self._families: Dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, name: str, help: str, kind: str, factory: Callable[[], object],
+                  labels: Sequence[str]) -> MetricFamily:
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = MetricFamily(name, help, kind, factory, labels)
+                self._families[name] = family
+            elif family.kind != kind or family.label_names != tuple(labels):
+                raise ValueError(f"Metric {name} is already registered differently")
+            return family
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> MetricFamily:
+        """Get or create a counter."""
+        return self._register(name, help, "counter", Counter, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> MetricFamily:
+        """Get or create a gauge."""
+        return self._register(name, help, "gauge", Gauge, labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> MetricFamily:
+        """Get or create a histogram with fixed buckets."""
+        return self._register(name, help, "histogram", lambda: Histogram(buckets), labels)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            families = list(self._families.values())
+        lines: List[str] = []
+        for family in families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+class TimedLock:
+    """
+    A reentrant lock recording how long threads wait for it and hold it.
+
+    Only contended acquires are timed for the wait histogram, and only the
+    outermost acquire of a thread counts towards the hold histogram, so the
+    uncontended path costs two clock reads and one observation.
+    """
+
+    __slots__ = ("_lock", "_wait", "_hold", "_depth", "_acquired_at")
+
+    def __init__(self, wait: Histogram, hold: Histogram):
+        self._lock = threading.RLock()
+        self._wait = wait
+        self._hold = hold
+        self._depth = 0  # Only changed by the thread holding the lock
+        self._acquired_at = 0.0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if not self._lock.acquire(False):
+            if not blocking:
+                return False
+            started_at = time.perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            self._wait.observe(time.perf_counter() - started_at)
+        self._depth += 1
+        if self._depth == 1:
+            self._acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._hold.observe(time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+# Process-wide registry used by the /metrics endpoint
+registry = MetricsRegistry()
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def resident_memory() -> float:
+    """Get the resident set size of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+def _cpu_seconds() -> float:
+    """Get the user and system CPU time of the process in seconds."""
+    times = os.times()
+    return times.user + times.system
+
+_START_TIME = time.time()
+
+registry.gauge("process_resident_memory_bytes", "Resident memory size in bytes.").set_function(resident_memory)
+registry.counter("process_cpu_seconds_total", "Total user and system CPU time spent in seconds.").set_function(_cpu_seconds)
+registry.gauge("process_start_time_seconds", "Start time of the process since the epoch in seconds.").set(_START_TIME)
@@ -0,0 +1,60 @@
+"""Initial schema (as previously created by Base.metadata.create_all)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "tasks",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("icon_name", sa.String(), nullable=False),
+        sa.Column("sound", sa.String(), nullable=False),
+        sa.Column("duration", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_tasks_id", "tasks", ["id"])
+
+    op.create_table(
+        "routines",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("description", sa.String(), nullable=True),
+        sa.Column("is_active", sa.Boolean(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_routines_id", "routines", ["id"])
+
+    op.create_table(
+        "routine_tasks",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("routine_id", sa.Integer(), sa.ForeignKey("routines.id"), nullable=False),
+        sa.Column("task_id", sa.Integer(), sa.ForeignKey("tasks.id"), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_routine_tasks_id", "routine_tasks", ["id"])
+
+
+def downgrade():
+    op.drop_index("ix_routine_tasks_id", table_name="routine_tasks")
+    op.drop_table("routine_tasks")
+    op.drop_index("ix_routines_id", table_name="routines")
+    op.drop_table("routines")
+    op.drop_index("ix_tasks_id", table_name="tasks")
+    op.drop_table("tasks")
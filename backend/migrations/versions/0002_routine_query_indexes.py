@@ -0,0 +1,45 @@
+"""Indexes for the routine ordering, active routine and task name lookups
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+Hot queries covered:
+  - ordered tasks of a routine:  routine_tasks WHERE routine_id = ? ORDER BY position
+  - the active routine:          routines WHERE is_active IS 1
+  - routines/tasks by name:      routines / tasks WHERE name = ?
+  - routine_tasks of a task:     routine_tasks WHERE task_id = ? (relationship loads, cascades)
+
+The (routine_id, position) index is unique, so a routine can no longer hold
+two tasks at the same position.
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_routine_tasks_routine_id_position",
+        "routine_tasks",
+        ["routine_id", "position"],
+        unique=True,
+    )
+    op.create_index("ix_routine_tasks_task_id", "routine_tasks", ["task_id"])
+    op.create_index("ix_routines_is_active", "routines", ["is_active"])
+    op.create_index("ix_routines_name", "routines", ["name"])
+    op.create_index("ix_tasks_name", "tasks", ["name"])
+
+
+def downgrade():
+    op.drop_index("ix_tasks_name", table_name="tasks")
+    op.drop_index("ix_routines_name", table_name="routines")
+    op.drop_index("ix_routines_is_active", table_name="routines")
+    op.drop_index("ix_routine_tasks_task_id", table_name="routine_tasks")
+    op.drop_index("ix_routine_tasks_routine_id_position", table_name="routine_tasks")
@@ -0,0 +1,56 @@
+"""Run history events and per-task duration rollups
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "run_events",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("run_id", sa.Integer(), nullable=False),
+        sa.Column("routine_id", sa.Integer(), nullable=True),
+        sa.Column("task_id", sa.Integer(), nullable=True),
+        sa.Column("kind", sa.String(), nullable=False),
+        sa.Column("timestamp", sa.Float(), nullable=False),
+        sa.Column("duration", sa.Float(), nullable=True),
+        sa.Column("completed", sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_run_events_run_id", "run_events", ["run_id"])
+    op.create_index("ix_run_events_timestamp", "run_events", ["timestamp"])
+
+    op.create_table(
+        "task_stats",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("routine_id", sa.Integer(), nullable=True),
+        sa.Column("task_id", sa.Integer(), nullable=True),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.Column("total_duration", sa.Float(), nullable=False),
+        sa.Column("min_duration", sa.Float(), nullable=True),
+        sa.Column("max_duration", sa.Float(), nullable=True),
+        sa.Column("histogram", sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_task_stats_routine_id_task_id", "task_stats", ["routine_id", "task_id"])
+
+
+def downgrade():
+    op.drop_index("ix_task_stats_routine_id_task_id", table_name="task_stats")
+    op.drop_table("task_stats")
+    op.drop_index("ix_run_events_timestamp", table_name="run_events")
+    op.drop_index("ix_run_events_run_id", table_name="run_events")
+    op.drop_table("run_events")
@@ -0,0 +1,30 @@
+"""Last applied revision of the cloud change feeds
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "sync_revisions",
+        sa.Column("feed", sa.String(), nullable=False),
+        sa.Column("revision", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint("feed"),
+    )
+
+
+def downgrade():
+    op.drop_table("sync_revisions")
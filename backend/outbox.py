@@ -0,0 +1,139 @@
+"""
+outbox.py
+
+This module provides a small persistent outbox for device-to-cloud messages.
+
+Messages are appended to an SQLite table before they are sent and deleted
+once the server has acknowledged them, so messages produced while offline
+are delivered after reconnecting. Messages sharing a collapse key supersede
+each other: only the newest unacknowledged one is kept (e.g. status). The
+table is bounded; the oldest messages are dropped when it is full.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Outbox:
+    """
+    An append-only, bounded, persistent queue of unacknowledged messages.
+    """
+
+    def __init__(self, path: str = ":memory:", max_messages: int = 500):
+        """
+        Initialize the outbox.
+
+        Args:
+            path: SQLite database file (":memory:" for a non-persistent outbox)
+            max_messages: Maximum number of unacknowledged messages kept
+        """
+        self.path = path
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # An fsync per commit would wear the SD card; WAL with NORMAL
+        # sync can lose the last commits on power loss, but not corrupt.
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " collapse_key TEXT,"
+            " body TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_outbox_collapse_key ON outbox (collapse_key)")
+        self._db.commit()
+
+    def append(self, message: Dict[str, Any], collapse_key: Optional[str] = None) -> int:
+        """
+        Store a message until it is acknowledged.
+
+        Args:
+            message: Message to store (must be JSON serializable)
+            collapse_key: Messages with the same key replace each other
+
+        Returns:
+            The id of the stored message
+        """
+        with self._lock, self._db:
+            if collapse_key is not None:
+                self._db.execute("DELETE FROM outbox WHERE collapse_key = ?", (collapse_key,))
+            cursor = self._db.execute(
+                "INSERT INTO outbox (collapse_key, body, created_at) VALUES (?, ?, ?)",
+                (collapse_key, json.dumps(message), time.time())
+            )
+            message_id = cursor.lastrowid
+            self._trim()
+            return message_id
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any]]]:
+        """Get the unacknowledged messages as (id, message) pairs, oldest first."""
+        with self._lock:
+            rows = self._db.execute("SELECT id, body FROM outbox ORDER BY id").fetchall()
+        return [(message_id, json.loads(body)) for message_id, body in rows]
+
+    def ack(self, message_ids: Iterable[int]):
+        """Delete acknowledged messages."""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in message_ids])
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _trim(self):
+        """Drop the oldest messages beyond max_messages. Must be called in a transaction."""
+        cursor = self._db.execute(
+            "DELETE FROM outbox WHERE id <= (SELECT id FROM outbox ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (self.max_messages,)
+        )
+        if cursor.rowcount > 0:
+            logger.warning(f"Outbox full, dropped {cursor.rowcount} undelivered messages")
+
+class MemoryOutbox:
+    """
+    Non-persistent outbox with the same interface as Outbox, for devices
+    that do not need to survive restarts (e.g. simulated devices).
+    """
+
+    def __init__(self, max_messages: int = 500):
+        self.max_messages = max_messages
+        self._messages: Dict[int, Tuple[Optional[str], Dict[str, Any]]] = {}
+        self._next_id = 1
+
+    def append(self, message: Dict[str, Any], collapse_key: Optional[str] = None) -> int:
+        if collapse_key is not None:
+            for message_id in [i for i, (key, _) in self._messages.items() if key == collapse_key]:
+                del self._messages[message_id]
+        message_id = self._next_id
+        self._next_id += 1
+        self._messages[message_id] = (collapse_key, message)
+        while len(self._messages) > self.max_messages:
+            del self._messages[next(iter(self._messages))]
+        return message_id
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any]]]:
+        return [(message_id, message) for message_id, (_, message) in self._messages.items()]
+
+    def ack(self, message_ids: Iterable[int]):
+        for message_id in message_ids:
+            self._messages.pop(message_id, None)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def close(self):
+        pass
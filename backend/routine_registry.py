@@ -0,0 +1,191 @@
+"""
+routine_registry.py
+
+This module provides independent routine runtimes keyed by target id (a
+child or a screen), so one device can run a routine per child and the hub
+can host the routines of many devices in one process.
+
+Each runtime is a RoutineState of its own (RoutineState.standalone), with
+its own lock, task list and listeners: commands for one child never wait
+for another child's lock. The process-wide routine_state is the default
+runtime, used when a command names no target.
+
+Runtimes load the active routine unless created for a specific one, and
+changing the routine of one runtime does not affect the others. An idle
+runtime takes a few hundred bytes.
+"""
+
+import logging
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from clock import Clock
+from memory import approximate_size, memory_monitor
+from metrics import registry
+from routine_state import RoutineState, Transition, routine_state
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGET = "default"  # Target id of the process-wide routine_state
+
+RUNTIMES = registry.gauge("routine_runtimes", "Routine runtimes in the registry, including the default one.")
+
+class RoutineRegistry:
+    """Routine runtimes by target id, created on request."""
+
+    def __init__(self, default: Optional[RoutineState] = None, clock: Optional[Clock] = None,
+                 max_runtimes: int = 10000):
+        """
+        Args:
+            default: Runtime used without a target id (the process-wide state by default)
+            clock: Clock of the runtimes created here (defaults to the system clock)
+            max_runtimes: Maximum number of runtimes besides the default one
+        """
+        self.default = default if default is not None else routine_state
+        self.clock = clock
+        self.max_runtimes = max_runtimes
+        self._runtimes: Dict[str, RoutineState] = {}
+        self._listeners: List[Callable[[Transition], None]] = []
+        self._lock = threading.Lock()  # Guards the dict and listener list, not the runtimes
+
+    def get(self, target_id: Optional[str] = None) -> Optional[RoutineState]:
+        """Get the runtime of a target (the default one for None), or None if there is none."""
+        if target_id is None or target_id == DEFAULT_TARGET:
+            return self.default
+        return self._runtimes.get(target_id)
+
+    def create(self, target_id: str, routine_id: Optional[int] = None, load: bool = True) -> RoutineState:
+        """
+        Get the runtime of a target, creating it if needed.
+
+        Args:
+            target_id: Child or device id
+            routine_id: Routine to load into a new runtime (defaults to the active routine)
+            load: Load the routine from the database (otherwise the default tasks are used)
+
+        Raises:
+            KeyError: If routine_id names no stored routine
+            ValueError: If the id is empty or the registry is full
+        """
+        existing = self.get(target_id)
+        if existing is not None:
+            return existing
+        if not target_id:
+            raise ValueError("Empty target id")
+
+        state = RoutineState.standalone(self.clock, target_id)
+        # Outside the registry lock: loading queries the database
+        if load and not state.load_from_db(routine_id) and routine_id is not None:
+            state.close()
+            raise KeyError(routine_id)
+        with self._lock:
+            existing = self._runtimes.get(target_id)
+            if existing is not None:
+                state.close()
+                return existing
+            if len(self._runtimes) >= self.max_runtimes:
+                state.close()
+                raise ValueError(f"Too many routine runtimes ({self.max_runtimes})")
+            for callback in self._listeners:
+                state.add_listener(callback)
+            self._runtimes[target_id] = state
+        logger.info(f"Created routine runtime {target_id}")
+        return state
+
+    def remove(self, target_id: str) -> bool:
+        """
+        Discard the runtime of a target. The default runtime cannot be removed.
+
+        Returns:
+            True if there was one
+        """
+        with self._lock:
+            state = self._runtimes.pop(target_id, None)
+        if state is None:
+            return False
+        state.close()
+        logger.info(f"Removed routine runtime {target_id}")
+        return True
+
+    def ids(self) -> List[str]:
+        """Get the target ids of the runtimes besides the default one."""
+        return list(self._runtimes)
+
+    def snapshots(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the snapshot of every runtime besides the default one.
+
+        Each snapshot is consistent on its own; they are taken one after the
+        other, without stopping the other runtimes.
+        """
+        return {target_id: state.snapshot() for target_id, state in list(self._runtimes.items())}
+
+    def export_state(self) -> Dict[str, Dict[str, Any]]:
+        """Get the progress of every runtime besides the default one, to carry over to a new process."""
+        return {target_id: state.export_state() for target_id, state in list(self._runtimes.items())}
+
+    def restore_state(self, states: Dict[str, Dict[str, Any]]) -> int:
+        """
+        Recreate the runtimes exported by another process and continue their progress.
+
+        Returns:
+            The number of runtimes whose progress was restored
+        """
+        restored = 0
+        for target_id, state in states.items():
+            try:
+                runtime = self.create(target_id, state["routine_id"])
+            except (KeyError, ValueError) as e:
+                logger.warning(f"Could not restore routine runtime {target_id}: {e!r}")
+                continue
+            restored += runtime.restore_state(state)
+        return restored
+
+    def add_listener(self, callback: Callable[[Transition], None]):
+        """
+        Register a callback with every runtime, including the default one and
+        those created later. Transitions carry the target_id of their runtime.
+        """
+        with self._lock:
+            if callback in self._listeners:
+                return
+            self._listeners.append(callback)
+            runtimes = list(self._runtimes.values())
+        self.default.add_listener(callback)
+        for state in runtimes:
+            state.add_listener(callback)
+
+    def remove_listener(self, callback: Callable[[Transition], None]):
+        """Unregister a callback added with add_listener."""
+        with self._lock:
+            if callback not in self._listeners:
+                return
+            self._listeners.remove(callback)
+            runtimes = list(self._runtimes.values())
+        self.default.remove_listener(callback)
+        for state in runtimes:
+            state.remove_listener(callback)
+
+    def memory_size(self) -> int:
+        """
+        Estimate the memory of the runtimes besides the default one, in bytes.
+
+        Counts the states, their locks and task lists, but not what their
+        listeners reference.
+        """
+        runtimes = list(self._runtimes.values())
+        own = sum(sys.getsizeof(state) + sys.getsizeof(state._state_lock) for state in runtimes)
+        return sys.getsizeof(self._runtimes) + own + approximate_size([state._tasks for state in runtimes])
+
+    def __len__(self) -> int:
+        return len(self._runtimes)
+
+    def __contains__(self, target_id: str) -> bool:
+        return self.get(target_id) is not None
+
+# Create a global instance that can be imported
+routine_registry = RoutineRegistry()
+
+RUNTIMES.set_function(lambda: len(routine_registry) + 1)
+memory_monitor.register("routine_runtimes", routine_registry.memory_size)
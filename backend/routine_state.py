@@ -3,10 +3,52 @@ routine_state.py
 
 This module provides a thread-safe singleton state for managing the child's bedtime routine.
 It tracks the current task, sound to play, and overall routine state.
+
+The routine definition is loaded from the database (entity.Routine and
+entity.RoutineTask) and cached in memory. Reads never touch the database;
+the cache is refreshed when the entity layer reports a committed change.
 """
 
+import logging
 import threading
-from typing import List, Dict, Optional, Any
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Dict, Optional, Any
+
+from clock import Clock, system_clock
+from metrics import LOCK_BUCKETS, TimedLock, registry
+from sound_library import sound_library
+from tracing import Trace, current_trace
+
+logger = logging.getLogger(__name__)
+
+# Tasks used until a routine has been loaded from the database
+DEFAULT_TASKS = [
+    {"id": 1, "name": "Brush Teeth", "icon_name": "tooth", "sound": "brush_teeth.mp3", "duration": 120},
+    {"id": 2, "name": "Put on Pajamas", "icon_name": "shirt", "sound": "pajamas.mp3", "duration": 180},
+    {"id": 3, "name": "Read a Book", "icon_name": "book-open", "sound": "book.mp3", "duration": 300},
+    {"id": 4, "name": "Go to Sleep", "icon_name": "bed", "sound": "sleep.mp3", "duration": 60}
+]
+_DEFAULT_TASK_LIST = [task.copy() for task in DEFAULT_TASKS]
+
+# Contention on the state lock, shared by all RoutineState instances
+LOCK_WAIT = registry.histogram("routine_state_lock_wait_seconds",
+                               "Time spent waiting for the routine state lock.", buckets=LOCK_BUCKETS)
+LOCK_HOLD = registry.histogram("routine_state_lock_hold_seconds",
+                               "Time the routine state lock was held.", buckets=LOCK_BUCKETS)
+TRANSITIONS = registry.counter("routine_state_transitions_total",
+                               "Routine state changes by event.", labels=("event",))
+
+@dataclass(frozen=True)
+class Transition:
+    """A change of the routine state, as passed to RoutineState listeners."""
+    event: str  # "start_routine", "next_task", "stop_routine", "play_sound", "restore" or "refresh"
+    previous_task: Optional[Dict[str, Any]]  # Task active before the change
+    current_task: Optional[Dict[str, Any]]  # Task active after the change
+    routine_id: Optional[int]
+    timestamp: float  # Wall clock time of the change (clock.time() of the state)
+    trace: Optional[Trace] = None  # Trace of the command causing the change, if sampled
+    target_id: Optional[str] = None  # Runtime in the routine_registry, None for the process-wide state
 
 class RoutineState:
     """
@@ -15,6 +57,10 @@ class RoutineState:
     _instance = None
     _lock = threading.Lock()
     
+    # Keeps idle states small, a hub may host thousands (see routine_registry)
+    __slots__ = ("clock", "target_id", "_state_lock", "_tasks", "_routine_id", "_routine_name",
+                 "_current_task_index", "_is_routine_active", "_current_sound", "_listening", "_listeners")
+    
     def __new__(cls):
         with cls._lock:
             if cls._instance is None:
@@ -22,24 +68,174 @@ class RoutineState:
                 cls._instance._initialize()
             return cls._instance
     
-    def _initialize(self):
+    @classmethod
+    def standalone(cls, clock: Optional[Clock] = None, target_id: Optional[str] = None) -> "RoutineState":
+        """
+        Create an independent state that is not the process-wide singleton,
+        e.g. for simulated devices or the runtimes of a routine_registry.
+        
+        Args:
+            clock: Clock timestamping the transitions (defaults to the system clock)
+            target_id: Child or device the state belongs to, passed on in transitions
+        """
+        instance = super(RoutineState, cls).__new__(cls)
+        instance._initialize(clock, target_id)
+        return instance
+    
+    def _initialize(self, clock: Optional[Clock] = None, target_id: Optional[str] = None):
         """Initialize the state with default values."""
-        self._state_lock = threading.RLock()
-        self._tasks = [
-            {"id": 1, "name": "Brush Teeth", "sound": "brush_teeth.mp3", "duration": 120},
-            {"id": 2, "name": "Put on Pajamas", "sound": "pajamas.mp3", "duration": 180},
-            {"id": 3, "name": "Read a Book", "sound": "book.mp3", "duration": 300},
-            {"id": 4, "name": "Go to Sleep", "sound": "sleep.mp3", "duration": 60}
-        ]
+        self.clock = clock or system_clock
+        self.target_id = target_id
+        self._state_lock = TimedLock(LOCK_WAIT.labels(), LOCK_HOLD.labels())
+        # Shared by all states until a routine is loaded: the task list is
+        # only ever replaced, and tasks are copied when handed out
+        self._tasks = _DEFAULT_TASK_LIST
+        self._routine_id = None  # Database id of the loaded routine, None for the defaults
+        self._routine_name = None
         self._current_task_index = -1  # No task active initially
         self._is_routine_active = False
         self._current_sound = None
+        self._listening = False
+        self._listeners: List[Callable[[Transition], None]] = []
+    
+    @property
+    def routine_id(self) -> Optional[int]:
+        """Get the database id of the loaded routine, or None if the defaults are used."""
+        with self._state_lock:
+            return self._routine_id
+    
+    @property
+    def routine_name(self) -> Optional[str]:
+        """Get the name of the loaded routine."""
+        with self._state_lock:
+            return self._routine_name
+    
+    def load_from_db(self, routine_id: Optional[int] = None) -> bool:
+        """
+        Load a routine definition from the database into memory.
+        
+        Also subscribes to entity change notifications, so later edits to the
+        loaded routine refresh the cache without re-querying on reads.
+        
+        Args:
+            routine_id: Routine to load (defaults to the active routine)
+            
+        Returns:
+            True if a routine was loaded, False if none was found
+        """
+        from entity import Routine, RoutineTask, add_change_listener
+        from entity.base import SessionLocal
+        
+        if not self._listening:
+            add_change_listener(self._on_definitions_changed)
+            self._listening = True
+        
+        session = SessionLocal()
+        try:
+            if routine_id is None:
+                routine = Routine.get_active(session)
+            else:
+                routine = session.get(Routine, routine_id)
+            if routine is None:
+                logger.warning(f"No routine found to load (routine_id={routine_id})")
+                return False
+            
+            tasks = [task.to_dict() for task in RoutineTask.ordered_tasks_query(routine.id, session)]
+            self._apply_routine(routine.id, routine.name, tasks)
+            logger.info(f"Loaded routine '{routine.name}' with {len(tasks)} tasks")
+            return True
+        finally:
+            session.close()
+    
+    def select_routine(self, routine_id: int) -> bool:
+        """
+        Make a routine the active one in the database and load it.
+        
+        A running routine is stopped, since its task list is replaced. For a
+        runtime of the routine_registry (target_id set) the routine is only
+        loaded: the active routine in the database belongs to the
+        process-wide state.
+        
+        Returns:
+            True if the routine exists and was loaded
+        """
+        from entity import Routine
+        from entity.base import SessionLocal
+        
+        session = SessionLocal()
+        try:
+            if session.get(Routine, routine_id) is None:
+                return False
+            if self.target_id is not None:
+                self.stop_routine()
+                return self.load_from_db(routine_id)
+            for routine in session.query(Routine).filter(
+                    (Routine.id == routine_id) | Routine.is_active.is_(True)):
+                routine.is_active = routine.id == routine_id
+            self.stop_routine()
+            session.commit()  # Change listeners reload the new active routine
+        finally:
+            session.close()
+        
+        if self.routine_id != routine_id:
+            return self.load_from_db(routine_id)
+        return True
+    
+    def _apply_routine(self, routine_id: int, routine_name: str, tasks: List[Dict[str, Any]]):
+        """
+        Swap in a new task list.
+        
+        A running routine keeps its current task, found by id, and the
+        listeners see the edit as a "refresh" transition. If another routine
+        was swapped in or the current task was removed, the run is stopped.
+        """
+        with self._state_lock:
+            current = self.current_task
+            same_routine = routine_id == self._routine_id
+            self._routine_id = routine_id
+            self._routine_name = routine_name
+            self._tasks = tasks
+            
+            if not self._is_routine_active:
+                return
+            index = next((i for i, task in enumerate(tasks) if current and task["id"] == current["id"]), None)
+            if not same_routine or index is None:
+                reason = f"routine {routine_id} replaced it" if not same_routine else "its current task was removed"
+                logger.info(f"Stopping the running routine: {reason}")
+                self._is_routine_active = False
+                self._current_task_index = -1
+                self._current_sound = None
+                self._notify("stop_routine", current)
+                return
+            self._current_task_index = index
+            if tasks[index] != current:
+                if self._current_sound == current["sound"]:  # Not a sound played on request
+                    self._current_sound = tasks[index]["sound"]
+                self._notify("refresh", current)
+    
+    def _on_definitions_changed(self, change):
+        """Refresh the cached routine when a committed change touches it."""
+        with self._state_lock:
+            routine_id = self._routine_id
+            task_ids = {task["id"] for task in self._tasks}
+        
+        if change.active_changed and self.target_id is None:
+            self.load_from_db()
+        elif routine_id in change.routine_ids or task_ids & change.task_ids:
+            self.load_from_db(routine_id)
+    
+    def close(self):
+        """Stop following changes of the routine definition (for states that are discarded)."""
+        if self._listening:
+            from entity import remove_change_listener
+            remove_change_listener(self._on_definitions_changed)
+            self._listening = False
     
     @property
     def tasks(self) -> List[Dict[str, Any]]:
         """Get the list of tasks in the routine."""
         with self._state_lock:
-            return self._tasks.copy()
+            return [task.copy() for task in self._tasks]
     
     @property
     def current_task(self) -> Optional[Dict[str, Any]]:
@@ -61,13 +257,109 @@ class RoutineState:
         with self._state_lock:
             return self._current_sound
     
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get is_active, current_task and current_sound read under one lock
+        acquisition, so they always belong to the same state.
+        """
+        with self._state_lock:
+            return {
+                "is_active": self._is_routine_active,
+                "current_task": self.current_task,
+                "current_sound": self._current_sound
+            }
+    
+    def export_state(self) -> Dict[str, Any]:
+        """Get the progress of the routine, to carry over to a new process (see handoff)."""
+        with self._state_lock:
+            current_task = self.current_task
+            return {
+                "routine_id": self._routine_id,
+                "is_active": self._is_routine_active,
+                "current_task_id": current_task["id"] if current_task else None,
+                "current_task_index": self._current_task_index,
+                "current_sound": self._current_sound
+            }
+    
+    def restore_state(self, state: Dict[str, Any]) -> bool:
+        """
+        Continue the progress exported by another process.
+        
+        The routine definition must have been loaded already; the progress
+        is dropped if the exported routine is not the loaded one.
+        
+        Returns:
+            True if the state was restored
+        """
+        with self._state_lock:
+            if state["routine_id"] != self._routine_id:
+                logger.warning(f"Not restoring the progress of routine {state['routine_id']}, "
+                               f"routine {self._routine_id} is loaded")
+                return False
+            previous_task = self.current_task
+            index = -1
+            if state["is_active"]:
+                index = next((i for i, task in enumerate(self._tasks) if task["id"] == state["current_task_id"]),
+                             min(state["current_task_index"], len(self._tasks) - 1))
+            self._is_routine_active = index >= 0
+            self._current_task_index = index
+            self._current_sound = state["current_sound"]
+            self._notify("restore", previous_task)
+            return True
+    
+    def add_listener(self, callback: Callable[["Transition"], None]) -> None:
+        """
+        Register a callback invoked with a Transition after every state change.
+        
+        Callbacks run while the state lock is held, so they see transitions in
+        order; they must only record or enqueue work, never block.
+        """
+        with self._state_lock:
+            if callback not in self._listeners:
+                self._listeners.append(callback)
+    
+    def remove_listener(self, callback: Callable[["Transition"], None]) -> None:
+        """Unregister a callback added with add_listener."""
+        with self._state_lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+    
+    def _notify(self, event: str, previous_task: Optional[Dict[str, Any]]) -> None:
+        """Tell the listeners about a transition. Must be called with the state lock held."""
+        TRANSITIONS.labels(event).inc()
+        trace = current_trace()
+        if not self._listeners and trace is None:
+            return
+        
+        started_at = time.perf_counter()
+        transition = Transition(
+            event=event,
+            previous_task=previous_task,
+            current_task=self.current_task,
+            routine_id=self._routine_id,
+            timestamp=self.clock.time(),
+            trace=trace,
+            target_id=self.target_id
+        )
+        for callback in self._listeners:
+            try:
+                callback(transition)
+            except Exception as e:
+                logger.error(f"Routine state listener failed: {e}")
+        if trace is not None:
+            trace.add_span("state.transition", started_at, event=event)
+    
     def start_routine(self) -> Dict[str, Any]:
         """Start the routine from the beginning."""
         with self._state_lock:
+            if not self._tasks:
+                raise ValueError("The loaded routine has no tasks")
+            previous_task = self.current_task
             self._is_routine_active = True
             self._current_task_index = 0
             current_task = self._tasks[self._current_task_index]
             self._current_sound = current_task["sound"]
+            self._notify("start_routine", previous_task)
             return current_task.copy()
     
     def next_task(self) -> Optional[Dict[str, Any]]:
@@ -78,7 +370,8 @@ class RoutineState:
         with self._state_lock:
             if not self._is_routine_active:
                 return None
-                
+            
+            previous_task = self.current_task
             self._current_task_index += 1
             
             # Check if we've reached the end of the routine
@@ -86,28 +379,36 @@ class RoutineState:
                 self._is_routine_active = False
                 self._current_task_index = -1
                 self._current_sound = None
+                self._notify("next_task", previous_task)
                 return None
             
             # Set the current sound to the new task's sound
             current_task = self._tasks[self._current_task_index]
             self._current_sound = current_task["sound"]
+            self._notify("next_task", previous_task)
             return current_task.copy()
     
     def play_sound(self, sound_name: str) -> bool:
         """
         Set a specific sound to play.
-        Returns True if the sound was set successfully.
+        Returns True if the sound was set successfully, False if there is
+        no such sound in the sound_library.
         """
+        if sound_name not in sound_library:
+            return False
         with self._state_lock:
             self._current_sound = sound_name
+            self._notify("play_sound", self.current_task)
             return True
     
     def stop_routine(self) -> None:
         """Stop the current routine."""
         with self._state_lock:
+            previous_task = self.current_task
             self._is_routine_active = False
             self._current_task_index = -1
             self._current_sound = None
+            self._notify("stop_routine", previous_task)
 
 # Create a global instance that can be imported
 routine_state = RoutineState()
\ No newline at end of file
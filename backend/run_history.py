@@ -0,0 +1,423 @@
+"""
+run_history.py
+
+This module records the history of routine runs: when each run and each task
+starts and ends. Events are buffered in memory and written to the database
+in batches by a background thread.
+
+Per-task and per-routine duration rollups (count, mean, p50/p90) are
+maintained incrementally as tasks and runs finish, so reading statistics
+never scans the raw history. Raw events are downsampled and trimmed to stay
+under a configurable budget. Run ids are never reused, even once every event
+of a run has been trimmed: the last issued id is kept in sync_revisions.
+"""
+
+import logging
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from routine_state import RoutineState, Transition, routine_state
+
+logger = logging.getLogger(__name__)
+
+# sync_revisions row holding the last issued run id
+RUN_ID_COUNTER = "run_ids"
+
+# Durations are counted in log-spaced histogram buckets: bucket i holds
+# durations up to HISTOGRAM_MIN * HISTOGRAM_GROWTH ** i seconds, so
+# percentiles are accurate to within 5%.
+HISTOGRAM_MIN = 1.0
+HISTOGRAM_GROWTH = 1.05
+
+def bucket_index(duration: float) -> int:
+    """Get the histogram bucket for a duration in seconds."""
+    if duration <= HISTOGRAM_MIN:
+        return 0
+    return math.ceil(math.log(duration / HISTOGRAM_MIN) / math.log(HISTOGRAM_GROWTH))
+
+def bucket_upper_bound(index: int) -> float:
+    """Get the largest duration in seconds counted in a histogram bucket."""
+    return HISTOGRAM_MIN * HISTOGRAM_GROWTH ** index
+
+class DurationStats:
+    """Incrementally maintained duration rollup of one task or routine."""
+
+    __slots__ = ("stats_id", "name", "count", "total", "min", "max", "histogram", "dirty")
+
+    def __init__(self, name: Optional[str] = None):
+        self.stats_id: Optional[int] = None  # TaskStats row id once persisted
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self.histogram: Dict[int, int] = {}
+        self.dirty = False
+
+    def add(self, duration: float):
+        """Add one finished duration in seconds."""
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+        index = bucket_index(duration)
+        self.histogram[index] = self.histogram.get(index, 0) + 1
+        self.dirty = True
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Estimate a percentile (0 < fraction <= 1) from the histogram."""
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index in sorted(self.histogram):
+            seen += self.histogram[index]
+            if seen >= rank:
+                return min(max(bucket_upper_bound(index), self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the rollup to a dictionary."""
+        return {
+            "name": self.name,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "min": self.min,
+            "max": self.max
+        }
+
+class RunHistory:
+    """
+    Records routine runs from RoutineState transitions and maintains
+    duration rollups per task and per routine.
+    """
+
+    def __init__(self, state: RoutineState = routine_state, flush_interval: float = 5.0,
+                 batch_size: int = 50, max_events: int = 20000, full_resolution_runs: int = 30,
+                 session_factory: Optional[Callable] = None):
+        """
+        Initialize the run history.
+
+        Args:
+            state: Routine state to record
+            flush_interval: Maximum seconds between batched writes
+            batch_size: Number of buffered events that triggers an early write
+            max_events: Budget of raw events kept in the database
+            full_resolution_runs: Number of most recent runs whose start events
+                are kept; older runs keep only their end events (which carry
+                the duration) until they are trimmed by the budget
+            session_factory: Creates the database sessions (defaults to SessionLocal)
+        """
+        self.state = state
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_events = max_events
+        self.full_resolution_runs = full_resolution_runs
+        self._session_factory = session_factory
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self._stats: Dict[Tuple[Optional[int], Optional[int]], DurationStats] = {}
+        self._event_count = 0
+        self._next_run_id = 1
+        self._stored_run_id = 0  # Last run id recorded in the database
+        self.events_dropped = 0
+
+        # The run in progress
+        self._run_id: Optional[int] = None
+        self._run_routine_id: Optional[int] = None
+        self._run_routine_name: Optional[str] = None
+        self._run_started_at: Optional[float] = None
+        self._task: Optional[Dict[str, Any]] = None
+        self._task_started_at: Optional[float] = None
+
+        self._wake = threading.Event()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Load the stored rollups and start recording."""
+        self._load()
+        self._running = True
+        self._thread = threading.Thread(target=self._writer_loop, name="run-history", daemon=True)
+        self._thread.start()
+        self.state.add_listener(self._on_transition)
+
+    def stop(self):
+        """Stop recording and write the remaining events."""
+        self.state.remove_listener(self._on_transition)
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def export_run(self) -> Optional[Dict[str, Any]]:
+        """Get the run in progress, to carry over to a new process (see handoff)."""
+        with self._lock:
+            if self._run_id is None:
+                return None
+            return {
+                "run_id": self._run_id,
+                "routine_id": self._run_routine_id,
+                "routine_name": self._run_routine_name,
+                "started_at": self._run_started_at,
+                "task": self._task,
+                "task_started_at": self._task_started_at
+            }
+
+    def restore_run(self, run: Optional[Dict[str, Any]]):
+        """Continue recording a run exported by another process (after start())."""
+        if run is None:
+            return
+        with self._lock:
+            self._run_id = run["run_id"]
+            self._next_run_id = max(self._next_run_id, run["run_id"] + 1)
+            self._run_routine_id = run["routine_id"]
+            self._run_routine_name = run.get("routine_name")
+            self._run_started_at = run["started_at"]
+            self._task = run["task"]
+            self._task_started_at = run["task_started_at"]
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Get the duration rollups of all tasks and routines.
+
+        Served from memory; task_id is None for whole-run statistics.
+        """
+        with self._lock:
+            return [
+                dict(routine_id=routine_id, task_id=task_id, **stats.to_dict())
+                for (routine_id, task_id), stats in self._stats.items()
+            ]
+
+    def _session(self):
+        if self._session_factory is None:
+            from entity.base import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+    def _load(self):
+        """Load the rollups and the event counters from the database."""
+        from sqlalchemy import func
+        from entity import RunEvent, SyncRevision, TaskStats
+
+        session = self._session()
+        try:
+            with self._lock:
+                for row in session.query(TaskStats):
+                    stats = DurationStats(row.name)
+                    stats.stats_id = row.id
+                    stats.count = row.count
+                    stats.total = row.total_duration
+                    stats.min = row.min_duration
+                    stats.max = row.max_duration
+                    stats.histogram = row.get_histogram()
+                    self._stats[(row.routine_id, row.task_id)] = stats
+                self._event_count = session.query(func.count(RunEvent.id)).scalar() or 0
+                counter = session.get(SyncRevision, RUN_ID_COUNTER)
+                self._stored_run_id = counter.revision if counter is not None else 0
+                last_run_id = max(session.query(func.max(RunEvent.run_id)).scalar() or 0, self._stored_run_id)
+                self._next_run_id = max(self._next_run_id, last_run_id + 1)
+        finally:
+            session.close()
+
+    def _on_transition(self, transition: Transition):
+        """Turn a state transition into run and task events (called under the state lock)."""
+        if transition.event == "play_sound":
+            return
+
+        timestamp = transition.timestamp
+        with self._lock:
+            if transition.event == "start_routine":
+                if self._run_id is not None:
+                    self._end_run(timestamp, completed=False)
+                self._begin_run(transition.routine_id, timestamp)
+                self._begin_task(transition.current_task, timestamp)
+            elif transition.event == "next_task":
+                if self._run_id is None:
+                    return
+                self._end_task(timestamp, completed=True)
+                if transition.current_task is not None:
+                    self._begin_task(transition.current_task, timestamp)
+                else:
+                    self._end_run(timestamp, completed=True)
+            elif transition.event == "stop_routine":
+                if self._run_id is not None:
+                    self._end_run(timestamp, completed=False)
+            pending = len(self._pending)
+            over_budget = self._event_count + pending > self.max_events
+
+        # Write, and so trim, as soon as the budget is exceeded
+        if pending >= self.batch_size or over_budget:
+            self._wake.set()
+
+    def _record(self, kind: str, timestamp: float, task_id: Optional[int] = None,
+                duration: Optional[float] = None, completed: Optional[bool] = None):
+        """Buffer one event of the run in progress, within the budget if writes keep failing."""
+        if self._pending and len(self._pending) >= max(self.max_events, self.batch_size):
+            self._pending.pop(0)
+            self.events_dropped += 1
+            if self.events_dropped == 1:
+                logger.warning("Run history events are not being written, dropping the oldest")
+        self._pending.append({
+            "run_id": self._run_id,
+            "routine_id": self._run_routine_id,
+            "task_id": task_id,
+            "kind": kind,
+            "timestamp": timestamp,
+            "duration": duration,
+            "completed": completed
+        })
+
+    def _rollup(self, task_id: Optional[int], name: Optional[str]) -> DurationStats:
+        """Get the rollup of a task (or of the routine when task_id is None)."""
+        key = (self._run_routine_id, task_id)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = DurationStats(name)
+        elif name and stats.name != name:
+            stats.name = name
+            stats.dirty = True
+        return stats
+
+    def _begin_run(self, routine_id: Optional[int], timestamp: float):
+        self._run_id = self._next_run_id
+        self._next_run_id += 1
+        self._run_routine_id = routine_id
+        self._run_routine_name = self.state.routine_name  # Called under the state lock
+        self._run_started_at = timestamp
+        self._record("run_start", timestamp)
+
+    def _begin_task(self, task: Optional[Dict[str, Any]], timestamp: float):
+        self._task = task
+        self._task_started_at = timestamp
+        if task is not None:
+            self._record("task_start", timestamp, task_id=task["id"])
+
+    def _end_task(self, timestamp: float, completed: bool):
+        if self._task is None:
+            return
+        duration = timestamp - self._task_started_at
+        self._record("task_end", timestamp, task_id=self._task["id"], duration=duration, completed=completed)
+        # Only tasks that were finished count towards the duration statistics
+        if completed:
+            self._rollup(self._task["id"], self._task["name"]).add(duration)
+        self._task = None
+        self._task_started_at = None
+
+    def _end_run(self, timestamp: float, completed: bool):
+        self._end_task(timestamp, completed=False)
+        duration = timestamp - self._run_started_at
+        self._record("run_end", timestamp, duration=duration, completed=completed)
+        if completed:
+            self._rollup(None, self._run_routine_name).add(duration)
+        self._run_id = None
+        self._run_routine_id = None
+        self._run_routine_name = None
+        self._run_started_at = None
+
+    def _writer_loop(self):
+        """Write buffered events every flush_interval or when a batch is full."""
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to write run history: {e}")
+
+    def flush(self):
+        """Write buffered events and changed rollups in one transaction."""
+        from entity import RunEvent, SyncRevision, TaskStats
+
+        with self._write_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+                last_run_id = self._next_run_id - 1
+                dirty = [(key, stats) for key, stats in self._stats.items() if stats.dirty]
+                snapshots = []
+                for key, stats in dirty:
+                    stats.dirty = False
+                    snapshots.append((key, stats, {
+                        "name": stats.name,
+                        "count": stats.count,
+                        "total_duration": stats.total,
+                        "min_duration": stats.min,
+                        "max_duration": stats.max,
+                        "histogram": dict(stats.histogram)
+                    }))
+
+            if not events and not snapshots and last_run_id <= self._stored_run_id:
+                return
+
+            event_count = self._event_count  # Restored if the transaction fails
+            session = self._session()
+            try:
+                if events:
+                    session.bulk_insert_mappings(RunEvent, events)
+                if last_run_id > self._stored_run_id:
+                    counter = session.get(SyncRevision, RUN_ID_COUNTER)
+                    if counter is None:
+                        counter = SyncRevision(feed=RUN_ID_COUNTER)
+                        session.add(counter)
+                    counter.revision = last_run_id
+                    counter.updated_at = time.time()
+                for (routine_id, task_id), stats, values in snapshots:
+                    row = session.get(TaskStats, stats.stats_id) if stats.stats_id is not None else None
+                    if row is None:
+                        row = TaskStats(routine_id=routine_id, task_id=task_id)
+                        session.add(row)
+                    histogram = values.pop("histogram")
+                    for name, value in values.items():
+                        setattr(row, name, value)
+                    row.set_histogram(histogram)
+                    session.flush()
+                    stats.stats_id = row.id
+                self._event_count += len(events)
+                if self._event_count > self.max_events:
+                    self._enforce_budget(session)
+                session.commit()
+                self._stored_run_id = max(self._stored_run_id, last_run_id)
+            except Exception:
+                session.rollback()
+                with self._lock:
+                    self._pending[:0] = events
+                    for _, stats, _ in snapshots:
+                        stats.dirty = True
+                self._event_count = event_count
+                raise
+            finally:
+                session.close()
+
+    def _enforce_budget(self, session):
+        """Downsample, then trim, raw events to stay within max_events."""
+        from entity import RunEvent
+
+        # Downsample: runs past the full resolution window keep only their
+        # end events, which carry the durations.
+        cutoff_run_id = self._next_run_id - self.full_resolution_runs
+        removed = (
+            session.query(RunEvent)
+            .filter(RunEvent.run_id < cutoff_run_id, RunEvent.kind.in_(("run_start", "task_start")))
+            .delete(synchronize_session=False)
+        )
+        self._event_count -= removed
+
+        # Trim: drop the oldest events beyond the budget
+        excess = self._event_count - self.max_events
+        if excess > 0:
+            last_id = session.query(RunEvent.id).order_by(RunEvent.id).offset(excess - 1).limit(1).scalar()
+            if last_id is not None:
+                removed = session.query(RunEvent).filter(RunEvent.id <= last_id).delete(synchronize_session=False)
+                self._event_count -= removed
+        logger.info(f"Run history trimmed to {self._event_count} events")
+
+# Create a global instance that can be imported
+run_history = RunHistory()
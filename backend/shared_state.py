@@ -0,0 +1,155 @@
+"""
+shared_state.py
+
+This module provides a shared-memory copy of the routine state for the
+display process. The main process writes RoutineState snapshots into a
+fixed-size segment; the display process reads them without locks or
+system calls.
+
+Consistency is kept with a seqlock: the writer makes the sequence number
+odd, writes the payload and makes it even again. A reader copies the
+payload and retries if the sequence number was odd or changed meanwhile,
+so it never sees a half-written snapshot and never blocks the writer.
+
+After each write, the writer also puts a byte into a wakeup pipe, so the
+display can sleep in its event loop instead of polling the segment.
+Wakeups coalesce: when the pipe is full, the reader will see the latest
+snapshot anyway.
+
+Segment layout (native byte order):
+    0   uint64  sequence number (odd while a write is in progress)
+    8   uint32  payload length
+    16  bytes   payload (a JSON document)
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional, Tuple
+
+SEQUENCE = struct.Struct("=Q")  # At offset 0
+LENGTH = struct.Struct("=I")  # At offset 8
+HEADER_SIZE = 16
+DEFAULT_CAPACITY = 64 * 1024  # Bytes of payload
+
+class SnapshotTooLarge(ValueError):
+    """The encoded snapshot does not fit into the segment."""
+
+class SharedStateWriter:
+    """Owns the shared-memory segment and publishes snapshots into it."""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, name: Optional[str] = None):
+        """
+        Args:
+            capacity: Maximum payload size in bytes
+            name: Name of the segment (generated if None)
+        """
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE + capacity)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._wakeup_fd: Optional[int] = None
+        SEQUENCE.pack_into(self._shm.buf, 0, 0)
+        LENGTH.pack_into(self._shm.buf, 8, 0)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def sequence(self) -> int:
+        return self._sequence
+
+    def set_wakeup_fd(self, fd: Optional[int]):
+        """Write a byte to this (non-blocking) file descriptor after every publish."""
+        if fd is not None:
+            os.set_blocking(fd, False)
+        self._wakeup_fd = fd
+
+    def publish(self, snapshot: Dict[str, Any]) -> int:
+        """Write a snapshot into the segment and wake the reader. Returns the new sequence number."""
+        payload = json.dumps(snapshot, separators=(",", ":")).encode()
+        if len(payload) > self.capacity:
+            raise SnapshotTooLarge(f"Snapshot of {len(payload)} bytes exceeds {self.capacity} bytes")
+        with self._lock:
+            buf = self._shm.buf
+            SEQUENCE.pack_into(buf, 0, self._sequence + 1)
+            buf[HEADER_SIZE:HEADER_SIZE + len(payload)] = payload
+            LENGTH.pack_into(buf, 8, len(payload))
+            # The sequence number goes last: a reader that sees it even and
+            # unchanged after copying has read this length and payload
+            self._sequence += 2
+            SEQUENCE.pack_into(buf, 0, self._sequence)
+            sequence = self._sequence
+        self.wake()
+        return sequence
+
+    def wake(self):
+        """Wake the reader without publishing."""
+        if self._wakeup_fd is None:
+            return
+        try:
+            os.write(self._wakeup_fd, b"\0")
+        except (BlockingIOError, BrokenPipeError):
+            pass  # The reader has wakeups pending already, or is gone
+
+    def close(self):
+        """Release and remove the segment."""
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+class SharedStateReader:
+    """Reads consistent snapshots from a segment created by SharedStateWriter."""
+
+    def __init__(self, name: str):
+        self._shm = shared_memory.SharedMemory(name=name)
+        self.capacity = self._shm.size - HEADER_SIZE
+        self.retries = 0
+        self._last_sequence = -1
+        self._last_snapshot: Optional[Dict[str, Any]] = None
+
+    @property
+    def sequence(self) -> int:
+        """Sequence number of the last snapshot read (-1 before the first read)."""
+        return self._last_sequence
+
+    def read_raw(self, timeout: float = 0.1) -> Tuple[int, bytes]:
+        """
+        Get the sequence number and payload of the latest complete write.
+
+        Raises TimeoutError if no consistent copy could be taken in time,
+        which only happens if the writer died halfway through a write.
+        """
+        buf = self._shm.buf
+        deadline = None
+        while True:
+            before, = SEQUENCE.unpack_from(buf, 0)
+            length, = LENGTH.unpack_from(buf, 8)
+            if not before & 1 and length <= self.capacity:
+                payload = bytes(buf[HEADER_SIZE:HEADER_SIZE + length])
+                after, = SEQUENCE.unpack_from(buf, 0)
+                if after == before:
+                    return before, payload
+            self.retries += 1
+            if deadline is None:
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError("No consistent snapshot in the shared state segment")
+            time.sleep(0)
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        """Get the latest snapshot (None if nothing was published yet)."""
+        sequence, payload = self.read_raw()
+        if sequence != self._last_sequence:
+            self._last_snapshot = json.loads(payload) if sequence else None
+            self._last_sequence = sequence
+        return self._last_snapshot
+
+    def close(self):
+        self._shm.close()
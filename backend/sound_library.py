@@ -0,0 +1,77 @@
+"""
+sound_library.py
+
+This module provides the names of the sounds available on the device, so
+play_sound commands can be checked before they change the routine state.
+
+Sound names are plain file names in the sound directory: no path
+separators, no hidden files. Without a directory (tests, tools) any such
+name is accepted. The names are listed once and listed again when the
+directory changes, which asset_sync reports after installing new sounds.
+"""
+
+import logging
+import os
+import threading
+from typing import FrozenSet, Optional
+
+logger = logging.getLogger(__name__)
+
+SOUND_EXTENSIONS = (".mp3", ".wav", ".ogg", ".flac")
+
+def valid_sound_name(name: str) -> bool:
+    """Check that a name can only refer to a sound file directly in the sound directory."""
+    return (bool(name) and name == os.path.basename(name) and "/" not in name and "\\" not in name
+            and not name.startswith(".") and name.lower().endswith(SOUND_EXTENSIONS))
+
+class SoundLibrary:
+    """The sound files of a directory."""
+
+    def __init__(self, directory: Optional[str] = None):
+        """
+        Args:
+            directory: Sound directory (None accepts every valid name)
+        """
+        self._directory = directory
+        self._names: Optional[FrozenSet[str]] = None
+        self._listed_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self) -> Optional[str]:
+        return self._directory
+
+    @directory.setter
+    def directory(self, directory: Optional[str]):
+        self._directory = directory
+        self.refresh()
+
+    def refresh(self):
+        """Forget the listed names, so they are listed again on the next lookup."""
+        with self._lock:
+            self._names = None
+            self._listed_mtime = None
+
+    def names(self) -> FrozenSet[str]:
+        """Get the names of the available sounds (empty without a directory)."""
+        if self._directory is None:
+            return frozenset()
+        try:
+            mtime = os.stat(self._directory).st_mtime
+        except OSError:
+            return frozenset()
+        with self._lock:
+            # Adding, removing or replacing a file changes the directory's mtime
+            if self._names is None or mtime != self._listed_mtime:
+                self._names = frozenset(entry.name for entry in os.scandir(self._directory)
+                                        if entry.is_file() and valid_sound_name(entry.name))
+                self._listed_mtime = mtime
+            return self._names
+
+    def __contains__(self, name: str) -> bool:
+        if not valid_sound_name(name):
+            return False
+        return self._directory is None or name in self.names()
+
+# Create a global instance that can be imported
+sound_library = SoundLibrary()
@@ -0,0 +1,36 @@
+"""
+test_api_bench.py
+
+A tiny in-process run of tools.api_bench: it must measure every request and
+flag a run that is slower than the stored baseline.
+"""
+
+import asyncio
+import json
+import sys
+
+from tools import api_bench
+
+def test_slower_run_than_the_baseline_is_flagged(tmp_path, monkeypatch, capsys):
+    results = asyncio.run(api_bench.run(["status"], 20, [1, 4], warmup=5))
+    for level in results["scenarios"]["status"].values():
+        assert level["count"] == 20 and level["errors"] == 0
+        assert level["statuses"] == {"200": 20}
+    assert api_bench.compare(results, results, 0.2) == []
+
+    # A baseline ten times faster than this machine can be
+    baseline = json.loads(json.dumps(results))
+    for level in baseline["scenarios"]["status"].values():
+        for key in api_bench.LATENCY_KEYS:
+            level[key] /= 10
+        level["throughput_rps"] *= 10
+    regressions = api_bench.compare(baseline, results, 0.2)
+    assert len(regressions) == 2 * (len(api_bench.LATENCY_KEYS) + 1)
+    assert regressions[0].startswith("status c=1: p50_ms")
+
+    baseline_path = tmp_path / "baseline.json"
+    baseline_path.write_text(json.dumps(baseline))
+    monkeypatch.setattr(sys, "argv", ["api_bench", "--scenario", "status", "--requests", "20",
+                                      "--concurrency", "1", "--baseline", str(baseline_path)])
+    assert api_bench.main() == 1
+    assert "REGRESSION status c=1: throughput_rps" in capsys.readouterr().out
@@ -0,0 +1,100 @@
+"""
+test_app_logging.py
+
+Logging must never block: records beyond the queue are dropped, records
+beyond the rate limit are kept in memory but not written, and every
+suppressed record is accounted for in a summary line, even at the end of
+a burst or when logging stops.
+"""
+
+import io
+import logging
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app_logging
+import fastapi_server
+from app_logging import LOG_DROPPED, LogPipeline
+
+class FakeMonotonic:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def monotonic(monkeypatch):
+    fake = FakeMonotonic()
+    monkeypatch.setattr(app_logging.time, "monotonic", fake)
+    return fake
+
+def record(message, level=logging.INFO, name="routine_state"):
+    return logging.LogRecord(name, level, __file__, 1, message, None, None)
+
+def written(pipeline):
+    return pipeline.stream.getvalue().splitlines()
+
+def test_records_are_dropped_when_the_queue_is_full():
+    pipeline = LogPipeline(io.StringIO(), queue_size=2)  # Writer not started
+    dropped = LOG_DROPPED.labels("queue_full").get()
+    for i in range(5):
+        pipeline.handler.handle(record(f"record {i}"))
+    assert pipeline.queue.qsize() == 2
+    assert LOG_DROPPED.labels("queue_full").get() == dropped + 3
+
+def test_rate_limit_writes_a_burst_then_summarizes(monotonic):
+    pipeline = LogPipeline(io.StringIO(), rate_limit=10, burst=3)
+    pipeline._write([record(f"info {i}") for i in range(3)] + [record("disk full", logging.ERROR)]
+                    + [record(f"info {i}") for i in range(3, 8)])
+    lines = written(pipeline)
+    # Warnings and errors are written regardless
+    assert [line.split(": ", 1)[1] for line in lines] == ["info 0", "info 1", "info 2", "disk full"]
+    assert len(pipeline.ring) == 9  # Kept in memory all the same
+
+    # The end of the burst is reported once the bucket refills
+    monotonic.now += 0.05
+    pipeline._write([])
+    assert len(written(pipeline)) == 4
+    monotonic.now += 0.1
+    pipeline._write([])
+    assert written(pipeline)[-1] == "... 5 log records suppressed by rate limit"
+
+    monotonic.now += 1
+    pipeline._write([record("info 9")])
+    assert written(pipeline)[-1].endswith("info 9")
+
+def test_suppressed_records_are_reported_when_logging_stops():
+    pipeline = LogPipeline(io.StringIO(), rate_limit=0.001, burst=1, flush_interval=60)
+    pipeline.start()
+    for i in range(4):
+        pipeline.handler.handle(record(f"info {i}"))
+    pipeline.stop()
+    lines = written(pipeline)
+    assert lines[0].endswith("info 0")
+    assert lines[-1] == "... 3 log records suppressed by rate limit"
+
+def test_ring_buffer_filters_by_level_and_logger():
+    pipeline = LogPipeline(io.StringIO(), ring_size=4, rate_limit=0)
+    pipeline._write([record("old"), record("connected", name="ws_client"),
+                     record("retrying", logging.WARNING, "ws_client.outbox"),
+                     record("lookalike", logging.ERROR, "ws_clientx"),
+                     record("failed", logging.ERROR, "ws_client")])
+    assert [r["message"] for r in pipeline.records()] == ["connected", "retrying", "lookalike", "failed"]
+    assert [r["message"] for r in pipeline.records(logger_name="ws_client")] == ["connected", "retrying", "failed"]
+    assert [r["message"] for r in pipeline.records(level="warning", logger_name="ws_client")] == ["retrying", "failed"]
+    assert [r["message"] for r in pipeline.records(limit=1)] == ["failed"]
+    with pytest.raises(ValueError):
+        pipeline.records(level="LOUD")
+
+def test_debug_logs_endpoint(monkeypatch):
+    pipeline = LogPipeline(io.StringIO(), rate_limit=0)
+    pipeline._write([record("started"), record("lost connection", logging.WARNING, "ws_client")])
+    monkeypatch.setattr(app_logging, "pipeline", pipeline)
+    client = TestClient(fastapi_server.app)
+
+    response = client.get("/debug/logs", params={"level": "WARNING"})
+    assert response.status_code == 200
+    assert [(r["logger"], r["message"]) for r in response.json()] == [("ws_client", "lost connection")]
+    assert client.get("/debug/logs", params={"level": "LOUD"}).status_code == 400
@@ -0,0 +1,149 @@
+"""
+test_asset_sync.py
+
+Assets synced from the hub's REST facade must be downloaded once per
+content, only when missing, resume after an interrupted transfer and never
+be installed half-way. play_sound must only accept sounds the device has.
+"""
+
+import asyncio
+import os
+
+import httpx
+import pytest
+
+from asset_sync import AssetSync, AssetSyncError
+from hub import AssetCatalog, Hub, create_app
+from routine_state import RoutineState
+from sound_library import sound_library
+
+CHUNK = 64 * 1024
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Serves the hub app, records the blob requests and fails the ones told to."""
+
+    def __init__(self, app):
+        self.inner = httpx.ASGITransport(app=app)
+        self.blob_ranges = []
+        self.fail_requests = set()  # Indexes of blob requests to fail
+        self.error_statuses = {}  # Index of a blob request -> HTTP status to answer it with
+
+    async def handle_async_request(self, request):
+        if request.url.path.startswith("/assets/blobs/"):
+            self.blob_ranges.append(request.headers.get("range"))
+            index = len(self.blob_ranges) - 1
+            if index in self.fail_requests:
+                raise httpx.ReadError("connection reset", request=request)
+            if index in self.error_statuses:
+                return httpx.Response(self.error_statuses[index], request=request)
+        return await self.inner.handle_async_request(request)
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@pytest.fixture
+def hub_assets(tmp_path):
+    book = os.urandom(5 * CHUNK + 100)
+    write(tmp_path / "hub" / "sounds" / "book.mp3", book)
+    write(tmp_path / "hub" / "sounds" / "book-copy.mp3", book)
+    write(tmp_path / "hub" / "icons" / "fa" / "svgs" / "moon.svg", b"<svg>moon</svg>")
+    catalog = AssetCatalog({"sounds": str(tmp_path / "hub" / "sounds"), "icons": str(tmp_path / "hub" / "icons")})
+    return catalog, RecordingTransport(create_app(Hub(), catalog))
+
+def device(tmp_path, transport, **kwargs):
+    roots = {"sounds": str(tmp_path / "device" / "sounds"), "icons": str(tmp_path / "device" / "icons")}
+    return AssetSync("http://hub", roots, str(tmp_path / "device" / "store"), chunk_size=CHUNK,
+                     retry_base=0.001, retry_cap=0.01, transport=transport, **kwargs)
+
+def test_sync_downloads_each_content_once_and_only_changes(tmp_path, hub_assets):
+    catalog, transport = hub_assets
+    write(tmp_path / "device" / "sounds" / "own.mp3", b"recorded on the device")
+    syncer = device(tmp_path, transport)
+
+    result = asyncio.run(syncer.sync())
+    assert result["downloaded"] == 2 and result["installed"] == 3
+    assert len(transport.blob_ranges) == 6 + 1  # The copy shares the book's blob
+    sounds = tmp_path / "device" / "sounds"
+    assert read(sounds / "book-copy.mp3") == read(tmp_path / "hub" / "sounds" / "book.mp3")
+    assert read(tmp_path / "device" / "icons" / "fa" / "svgs" / "moon.svg") == b"<svg>moon</svg>"
+
+    # Unchanged manifest: one conditional request
+    transport.blob_ranges.clear()
+    assert asyncio.run(syncer.sync())["revision"] == catalog.manifest["revision"]
+    assert transport.blob_ranges == []
+
+    write(tmp_path / "hub" / "icons" / "fa" / "svgs" / "moon.svg", b"<svg>new moon</svg>")
+    os.unlink(tmp_path / "hub" / "sounds" / "book-copy.mp3")
+    assert catalog.rescan()
+    result = asyncio.run(syncer.sync())
+    assert (result["downloaded"], result["installed"], result["removed"]) == (1, 1, 1)
+    assert read(tmp_path / "device" / "icons" / "fa" / "svgs" / "moon.svg") == b"<svg>new moon</svg>"
+    assert sorted(os.listdir(sounds)) == ["book.mp3", "own.mp3"]  # Files the hub never listed stay
+    assert len(syncer.store.digests()) == 2
+
+def test_interrupted_download_resumes_and_installs_nothing_before(tmp_path, hub_assets):
+    catalog, transport = hub_assets
+    transport.fail_requests = {2}
+    with pytest.raises(AssetSyncError):
+        asyncio.run(device(tmp_path, transport, concurrency=1, max_attempts=1).sync())
+    assert not os.path.exists(tmp_path / "device" / "sounds" / "book.mp3")
+
+    # A new process continues where the first one stopped, and retries failed chunks
+    transport.blob_ranges.clear()
+    transport.fail_requests = {1}
+    result = asyncio.run(device(tmp_path, transport, concurrency=1).sync())
+    book = read(tmp_path / "hub" / "sounds" / "book.mp3")
+    assert result["bytes"] == len(book) - 2 * CHUNK + len(b"<svg>moon</svg>")
+    assert f"bytes={2 * CHUNK}-{3 * CHUNK - 1}" in transport.blob_ranges
+    assert f"bytes=0-{CHUNK - 1}" not in transport.blob_ranges
+    assert read(tmp_path / "device" / "sounds" / "book.mp3") == book
+
+def test_server_errors_are_retried_and_client_errors_are_not(tmp_path, hub_assets):
+    catalog, transport = hub_assets
+    transport.error_statuses = {0: 503, 1: 429}
+    result = asyncio.run(device(tmp_path, transport, concurrency=1).sync())
+    assert result["installed"] == 3
+    assert transport.blob_ranges[0] == transport.blob_ranges[1] == transport.blob_ranges[2]
+
+    write(tmp_path / "hub" / "icons" / "fa" / "svgs" / "moon.svg", b"<svg>new moon</svg>")
+    catalog.rescan()
+    transport.blob_ranges.clear()
+    transport.error_statuses = {0: 404}
+    with pytest.raises(AssetSyncError):
+        asyncio.run(device(tmp_path, transport).sync())
+    assert len(transport.blob_ranges) == 1
+
+def test_oversized_partial_download_starts_over(tmp_path, hub_assets):
+    catalog, transport = hub_assets
+    syncer = device(tmp_path, transport)
+    moon = catalog.manifest["files"]["icons/fa/svgs/moon.svg"]["digest"]
+    write(syncer.store.partial_path(moon), b"x" * 100)
+    asyncio.run(syncer.sync())
+    assert read(tmp_path / "device" / "icons" / "fa" / "svgs" / "moon.svg") == b"<svg>moon</svg>"
+
+def test_corrupt_blob_is_rejected(tmp_path, hub_assets):
+    catalog, transport = hub_assets
+    write(tmp_path / "hub" / "icons" / "fa" / "svgs" / "moon.svg", b"<svg>tampered</svg>")  # Not rescanned
+    with pytest.raises(AssetSyncError):
+        asyncio.run(device(tmp_path, transport).sync())
+    assert not os.path.exists(tmp_path / "device" / "icons")
+
+def test_play_sound_only_accepts_available_sounds(tmp_path):
+    write(tmp_path / "sounds" / "book.mp3", b"")
+    state = RoutineState.standalone()
+    try:
+        sound_library.directory = str(tmp_path / "sounds")
+        assert state.play_sound("book.mp3")
+        assert not state.play_sound("missing.mp3")
+        assert not state.play_sound("../sounds/book.mp3")
+        assert state.current_sound == "book.mp3"
+        write(tmp_path / "sounds" / "new.mp3", b"")
+        assert state.play_sound("new.mp3")
+    finally:
+        sound_library.directory = None
@@ -0,0 +1,112 @@
+"""
+test_command_lanes.py
+
+Commands must run high lane first, a priority command must discard the
+normal commands queued before it, and every command that will not run,
+because the device is busy, it was preempted or it cannot be run, must be
+nacked.
+"""
+
+import asyncio
+import time
+
+from hub import Hub
+from routine_registry import RoutineRegistry
+from routine_state import RoutineState
+from ws_client import WebSocketClient
+
+def record_nacks(client):
+    """Record the (reason, command) of the nacks the client sends."""
+    nacks = []
+    send_message = client._send_message
+
+    async def recording_send(message, outbox_ids=None):
+        if message["type"] == "nack":
+            nacks.append((message["reason"], message["command"]))
+        return await send_message(message, outbox_ids)
+    client._send_message = recording_send
+    return nacks
+
+async def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def test_priority_command_preempts_and_full_lane_rejects():
+    async def scenario():
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        client = WebSocketClient(hub.url, device_id="child-1", state=RoutineState.standalone(),
+                                 command_queue_size=2)
+
+        # The first command holds the only worker until the gate opens
+        gate = asyncio.Event()
+        ran = []
+
+        def recording(command):
+            async def handle(data):
+                ran.append((command, data.get("n")))
+                await gate.wait()
+            return handle
+        for command in ("next_task", "stop_routine"):
+            client.command_handlers[command] = recording(command)
+
+        nacks = record_nacks(client)
+        running = asyncio.create_task(client.run())
+        try:
+            await wait_until(lambda: "child-1" in hub.connections)
+            await hub.send_command("child-1", "next_task", {"n": 0})
+            await wait_until(lambda: ran)
+
+            for n in range(1, 4):
+                await hub.send_command("child-1", "next_task", {"n": n})
+            await wait_until(lambda: nacks)
+            assert nacks == [("busy", "next_task")]  # n=3 did not fit the lane
+            assert client.queue_depth == {"high": 0, "normal": 2}
+
+            await hub.send_command("child-1", "stop_routine")
+            await hub.send_command("child-1", "next_task", {"n": 4})
+            await wait_until(lambda: len(nacks) == 3)
+            assert nacks[1:] == [("preempted", "next_task")] * 2
+            assert client.commands_preempted == 2 and client.commands_rejected == 1
+
+            gate.set()
+            await wait_until(lambda: len(ran) == 3)
+            assert ran == [("next_task", 0), ("stop_routine", None), ("next_task", 4)]
+            await wait_until(lambda: hub.nacks_received == 3)
+        finally:
+            gate.set()
+            client.stop()
+            await running
+            await hub.stop()
+
+    asyncio.run(scenario())
+
+def test_commands_that_cannot_run_are_nacked():
+    async def scenario():
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        registry = RoutineRegistry(default=RoutineState.standalone())
+        anna = registry.create("anna", load=False)
+        client = WebSocketClient(hub.url, device_id="child-1", state=registry.default, registry=registry)
+        nacks = record_nacks(client)
+        running = asyncio.create_task(client.run())
+        try:
+            await wait_until(lambda: "child-1" in hub.connections)
+            await hub.send_command("child-1", "start_routine", {"target_id": "ben"})
+            await hub.send_command("child-1", "start_routine", {"target_id": "anna"})
+            await wait_until(lambda: anna.is_routine_active)
+            assert nacks == [("unknown_target", "start_routine")]
+
+            await hub.send_command("child-1", "play_sound", {"target_id": "anna", "sound_name": "../secret.mp3"})
+            await wait_until(lambda: len(nacks) == 2)
+            assert nacks[1] == ("unknown_sound", "play_sound")
+            assert anna.current_sound == anna.tasks[0]["sound"]
+            await wait_until(lambda: hub.nacks_received == 2)
+        finally:
+            client.stop()
+            await running
+            await hub.stop()
+
+    asyncio.run(scenario())
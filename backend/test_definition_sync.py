@@ -0,0 +1,154 @@
+"""
+test_definition_sync.py
+
+Routine definitions edited in the cloud must reach the device as changes
+since its last revision, applied in one transaction that notifies the
+caches, with a full download only when the hub no longer has the changes.
+"""
+
+import asyncio
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from definition_sync import DefinitionSync, DefinitionSyncError
+from entity import Routine, RoutineTask, Task, add_change_listener, init_db, remove_change_listener
+from hub import DefinitionStore, Hub
+from routine_state import RoutineState
+from ws_client import WebSocketClient
+
+def task(task_id, name):
+    return {"table": "tasks", "id": task_id,
+            "row": {"name": name, "icon_name": "star", "sound": "book.mp3", "duration": 60}}
+
+def routine_task(row_id, task_id, position, routine_id=10):
+    return {"table": "routine_tasks", "id": row_id,
+            "row": {"routine_id": routine_id, "task_id": task_id, "position": position}}
+
+CLOUD_ROUTINE = [
+    {"table": "routines", "id": 10, "row": {"name": "Cloud Routine", "description": None, "is_active": True}},
+    task(1, "Bath"), task(2, "Brush Teeth"), task(3, "Story"),
+    routine_task(100, 1, 0), routine_task(101, 2, 1), routine_task(102, 3, 2),
+]
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'device.db'}")
+    init_db(bind=engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+def ordered_task_names(session_factory, routine_id=10):
+    session = session_factory()
+    try:
+        return [t.name for t in RoutineTask.ordered_tasks_query(routine_id, session)]
+    finally:
+        session.close()
+
+def test_changes_are_applied_in_order_and_notify_caches(session_factory):
+    store = DefinitionStore()
+    device = DefinitionSync(session_factory)
+    changes = []
+    add_change_listener(changes.append)
+    try:
+        store.apply(CLOUD_ROUTINE)
+        assert device.apply(store.changes_since(device.revision))
+        assert ordered_task_names(session_factory) == ["Bath", "Brush Teeth", "Story"]
+
+        # Reorder and rename: only the touched rows are sent
+        store.apply([routine_task(100, 1, 2), routine_task(102, 3, 0), task(2, "Teeth")])
+        message = store.changes_since(device.revision)
+        assert not message["full"] and len(message["changes"]) == 3
+        assert device.apply(message)
+        assert ordered_task_names(session_factory) == ["Story", "Teeth", "Bath"]
+        assert changes[-1].routine_ids == {10} and 2 in changes[-1].task_ids
+    finally:
+        remove_change_listener(changes.append)
+
+    # A missed revision is not applied over; the changes since are requested
+    store.apply([task(3, "Song")])
+    missed = store.changes_since(store.revision)
+    store.apply([{"table": "routine_tasks", "id": 101, "deleted": True}])
+    assert not device.apply(store.changes_since(missed["revision"]))
+    assert device.revision == 2
+    assert device.request()["revision"] == 2
+    assert device.apply(store.changes_since(2))
+    assert ordered_task_names(session_factory) == ["Song", "Bath"]
+    assert device.apply(missed)  # Late duplicate
+    assert store.full_downloads == 1
+    assert DefinitionSync(session_factory).revision == 4  # Survives a restart
+
+def test_invalid_changes_leave_the_database_unchanged(session_factory):
+    store = DefinitionStore()
+    device = DefinitionSync(session_factory)
+    store.apply(CLOUD_ROUTINE)
+    device.apply(store.changes_since(0))
+    with pytest.raises(DefinitionSyncError):
+        device.apply({"base": 1, "revision": 2, "changes": [
+            task(1, "Renamed"), {"table": "tasks", "id": 4, "row": {"name": "No icon"}}]})
+    assert device.revision == 1
+    assert ordered_task_names(session_factory) == ["Bath", "Brush Teeth", "Story"]
+
+def test_device_behind_the_log_gets_everything_once(session_factory):
+    store = DefinitionStore(max_log=3)
+    device = DefinitionSync(session_factory)
+    session = session_factory()
+    session.add(Routine(id=1, name="Local Routine", is_active=False))
+    session.commit()
+    session.close()
+
+    store.apply(CLOUD_ROUTINE)
+    store.apply([task(2, "Teeth")])
+    message = store.changes_since(device.revision)
+    assert message["full"]
+    device.apply(message)
+    session = session_factory()
+    try:
+        # The full download replaces the rows the cloud does not have
+        assert [r.name for r in session.query(Routine)] == ["Cloud Routine"]
+        assert session.get(Task, 2).name == "Teeth"
+    finally:
+        session.close()
+
+def test_device_catches_up_over_the_hub_after_reconnecting(session_factory):
+    async def scenario():
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        device = DefinitionSync(session_factory)
+        hub.publish_definitions(CLOUD_ROUTINE)
+
+        async def connected_client():
+            client = WebSocketClient(hub.url, device_id="device-1", state=RoutineState.standalone(),
+                                     definition_sync=device)
+            task_ = asyncio.create_task(client.run())
+            return client, task_
+
+        async def wait_until(condition, timeout=10.0):
+            deadline = time.monotonic() + timeout
+            while not condition():
+                assert time.monotonic() < deadline, "timed out"
+                await asyncio.sleep(0.01)
+
+        try:
+            client, running = await connected_client()
+            await wait_until(lambda: device.revision == 1)
+            hub.publish_definitions([task(1, "Shower")])  # Pushed
+            await wait_until(lambda: device.revision == 2)
+            client.stop()
+            await running
+
+            # Missed while offline
+            hub.publish_definitions([task(3, "Song")])
+            hub.publish_definitions([routine_task(101, 2, 3)])
+            client, running = await connected_client()
+            await wait_until(lambda: device.revision == 4)
+            client.stop()
+            await running
+        finally:
+            await hub.stop()
+        return hub.definitions.full_downloads
+
+    assert asyncio.run(scenario()) == 1
+    assert ordered_task_names(session_factory) == ["Shower", "Song", "Brush Teeth"]
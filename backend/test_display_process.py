@@ -0,0 +1,155 @@
+"""
+test_display_process.py
+
+The display process must only ever see complete routine state snapshots in
+shared memory, the supervisor must restart it after a crash, and what the
+display reports about its updates must reach the metrics, traces and memory
+breakdown of the main process. Stand-ins for the Qt display record what they
+read, so no display server is needed.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+
+from backoff import DecorrelatedJitterBackoff
+from display.telemetry import DISPLAY_UPDATE, TelemetrySender
+from display_supervisor import DisplaySupervisor
+from memory import memory_monitor
+from metrics import registry
+from routine_state import RoutineState
+from shared_state import SharedStateReader, SharedStateWriter
+from tracing import Tracer, activate
+
+PUBLISHES = 20000
+
+
+def make_snapshot(n):
+    # The padding changes the payload length with every write
+    return {"n": n, "check": n * 7, "pad": "x" * (n % 500)}
+
+
+def read_snapshots(shm_name, results):
+    reader = SharedStateReader(shm_name)
+    reads = torn = 0
+    last = -1
+    while last < PUBLISHES - 1:
+        snapshot = reader.read()
+        if snapshot is None:
+            continue
+        n = snapshot["n"]
+        if snapshot != make_snapshot(n) or n < last:
+            torn += 1
+        last = n
+        reads += 1
+    results.put({"reads": reads, "torn": torn, "retries": reader.retries})
+    reader.close()
+
+
+def test_reader_process_never_sees_a_torn_snapshot():
+    context = multiprocessing.get_context("spawn")
+    writer = SharedStateWriter(capacity=1024)
+    results = context.Queue()
+    process = context.Process(target=read_snapshots, args=(writer.name, results))
+    process.start()
+    try:
+        for n in range(PUBLISHES):
+            writer.publish(make_snapshot(n))
+        # Keep the last snapshot published until the reader has seen it
+        result = results.get(timeout=30)
+        process.join(10)
+    finally:
+        writer.close()
+    assert process.exitcode == 0
+    assert result["torn"] == 0, result
+
+
+def fake_display(shm_name, wakeup, reports, screen_size, log_level):
+    """Record every snapshot read; the first instance crashes right away."""
+    path = os.path.join(os.environ["FAKE_DISPLAY_DIR"], "snapshots.jsonl")
+    reader = SharedStateReader(shm_name)
+    with open(path, "a") as f:
+        f.write(json.dumps(reader.read()) + "\n")
+    with open(path) as f:
+        if len(f.readlines()) == 1:
+            os._exit(3)
+    while os.read(wakeup.fileno(), 4096):
+        with open(path, "a") as f:
+            f.write(json.dumps(reader.read()) + "\n")
+    reader.close()
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_supervisor_restarts_a_crashed_display_and_feeds_it_transitions(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_DISPLAY_DIR", str(tmp_path))
+    path = tmp_path / "snapshots.jsonl"
+
+    def snapshots():
+        return [json.loads(line) for line in path.read_text().splitlines()] if path.exists() else []
+
+    state = RoutineState.standalone()
+    supervisor = DisplaySupervisor(state=state, target=fake_display,
+                                   backoff=DecorrelatedJitterBackoff(base=0.05, cap=0.1))
+    supervisor.start()
+    try:
+        wait_for(lambda: supervisor.restarts == 1 and len(snapshots()) >= 2)
+        assert snapshots()[1]["is_active"] is False
+
+        task = state.start_routine()
+        wait_for(lambda: snapshots()[-1]["is_active"])
+        assert snapshots()[-1]["current_task"] == task
+
+        process = supervisor.process
+    finally:
+        supervisor.stop()
+    # Closing the wakeup pipe let the display exit on its own
+    assert process.exitcode == 0
+    assert supervisor.restarts == 1
+
+
+def reporting_display(shm_name, wakeup, reports, screen_size, log_level):
+    """Time every read as a window update and report it like the Qt display."""
+    reader = SharedStateReader(shm_name)
+    telemetry = TelemetrySender(reports, caches=lambda: {"icon_svgs": 4096})
+
+    def update():
+        with DISPLAY_UPDATE.labels("window").time():
+            reader.read()
+    telemetry.update(update, lambda: reader.sequence)
+    while os.read(wakeup.fileno(), 4096):
+        telemetry.update(update, lambda: reader.sequence)
+        telemetry.send(include_caches=True)
+    reader.close()
+
+
+def test_display_reports_reach_the_main_process():
+    window_updates = DISPLAY_UPDATE.labels("window")
+    updates_before = window_updates.count
+    state = RoutineState.standalone()
+    supervisor = DisplaySupervisor(state=state, target=reporting_display)
+    supervisor.start()
+    try:
+        trace = Tracer().start_trace("start_routine", "rest")
+        with activate(trace):
+            state.start_routine()
+        wait_for(lambda: any(span.name == "display.update" for span in trace.spans))
+        spans = {span.name: span for span in trace.spans}
+        assert list(spans) == ["state.transition", "display.queue", "display.update"]
+        assert spans["display.queue"].end == spans["display.update"].start
+        assert spans["state.transition"].start <= spans["display.queue"].start <= spans["display.queue"].end
+
+        wait_for(lambda: "display.icon_svgs" in memory_monitor.breakdown()["subsystems"])
+        assert memory_monitor.breakdown()["subsystems"]["display.icon_svgs"] == {"bytes": 4096, "evictable": False}
+        # The startup update and the one showing the routine
+        assert window_updates.count >= updates_before + 2
+        assert f'display_update_seconds_count{{widget="window"}} {window_updates.count}' in registry.render()
+    finally:
+        supervisor.stop()
+    assert "display.icon_svgs" not in memory_monitor.breakdown()["subsystems"]
@@ -0,0 +1,121 @@
+"""
+test_event_dispatcher.py
+
+Routine events must reach webhooks and local topics without slowing down
+the routine: a slow sink gets the latest state (changes coalesce), failed
+webhook deliveries are retried with backoff and rejected ones dropped.
+"""
+
+import asyncio
+import time
+
+import httpx
+
+from event_dispatcher import EventDispatcher, TopicBus, TopicSink, WebhookSink, topic_matches
+from routine_registry import RoutineRegistry
+from routine_state import RoutineState
+
+
+class SlowSink:
+    name = "slow"
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.started = 0
+        self.events = []
+
+    async def deliver(self, event):
+        self.started += 1
+        await asyncio.sleep(self.delay)
+        self.events.append(event)
+
+    async def close(self):
+        pass
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_slow_sink_does_not_delay_the_routine_and_gets_the_latest_state():
+    state = RoutineState.standalone()
+    sink = SlowSink(0.5)
+    dispatcher = EventDispatcher([sink])
+    dispatcher.start()
+    state.add_listener(dispatcher.on_transition)
+    try:
+        started_at = time.perf_counter()
+        first = state.start_routine()
+        elapsed = time.perf_counter() - started_at
+        wait_for(lambda: sink.started == 1)
+        started_at = time.perf_counter()
+        for _ in range(3):
+            state.next_task()
+        elapsed += time.perf_counter() - started_at
+        wait_for(lambda: len(sink.events) == 2)
+    finally:
+        state.remove_listener(dispatcher.on_transition)
+        dispatcher.stop()
+    assert elapsed < 0.1, f"4 transitions in {elapsed * 1000:.2f} ms"
+
+    started, latest = sink.events
+    assert started["event"] == "start_routine" and started["task"] == first
+    # The three next_task changes arrived while the first delivery was running
+    assert latest["coalesced"] == 2
+    assert latest["previous_task"] == first
+    assert latest["task"]["name"] == "Go to Sleep"
+
+
+def test_webhook_retries_failures_and_drops_rejected_events():
+    requests = []
+    responses = iter([503, 503, 200, 400])
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(next(responses))
+
+    sink = WebhookSink("http://lights.local/hook", transport=httpx.MockTransport(handler))
+    dispatcher = EventDispatcher([sink], retry_base=0.01, retry_cap=0.05)
+    dispatcher.start()
+    try:
+        registry = RoutineRegistry(default=RoutineState.standalone())
+        registry.add_listener(dispatcher.on_transition)
+        registry.create("anna", load=False).start_routine()
+        wait_for(lambda: len(requests) == 3 and not dispatcher.pending()["webhook:lights.local"])
+        registry.default.start_routine()
+        wait_for(lambda: len(requests) == 4)
+        time.sleep(0.1)
+    finally:
+        dispatcher.stop()
+    assert len(requests) == 4  # The rejected event was not retried
+    assert httpx.Response(200, content=requests[2].content).json()["target_id"] == "anna"
+
+
+def test_topics_and_queue_bound():
+    bus = TopicBus()
+    received = []
+    bus.subscribe("bedtime/+/next_task", lambda topic, payload: received.append(topic))
+    registry = RoutineRegistry(default=RoutineState.standalone())
+    slow = SlowSink(0.3)
+    dispatcher = EventDispatcher([TopicSink(bus), slow], max_pending=2)
+    dispatcher.start()
+    registry.add_listener(dispatcher.on_transition)
+    try:
+        registry.create("a", load=False).start_routine()
+        wait_for(lambda: slow.started == 1)
+        for target in ("b", "c", "d"):
+            registry.create(target, load=False).start_routine()
+        registry.get("d").next_task()
+        wait_for(lambda: received and len(slow.events) == 3)
+    finally:
+        dispatcher.stop()
+    assert received == ["bedtime/d/next_task"]
+    assert bus.retained("bedtime/+/state")["bedtime/d/state"]["task"]["id"] == 2
+    # "a" was being delivered, "b" was dropped for "c" and "d"
+    assert [event["target_id"] for event in slow.events] == ["a", "c", "d"]
+
+    assert topic_matches("bedtime/#", "bedtime/a/state")
+    assert not topic_matches("bedtime/+", "bedtime/a/state")
@@ -0,0 +1,22 @@
+"""
+test_fleet_sim.py
+
+A short run of tools.fleet_sim with a few devices: every device must
+connect, commands must reach the devices and come back acknowledged, and
+dropped connections must be re-established.
+"""
+
+import asyncio
+
+from tools.fleet_sim import FleetSimulator
+
+def test_small_fleet_smoke():
+    report = asyncio.run(FleetSimulator(5, disconnect_rate=0.5, ramp_up=0.2, seed=2).run(3.0))
+
+    assert report["connected_after_ramp_up"] == 5
+    assert report["command_latency"]["count"] > 0
+    assert report["command_round_trip"]["count"] > 0
+    assert report["device_messages_sent_per_s"] > 0
+    assert report["reconnects"] > 0
+    assert report["hub"]["known_devices"] == 5
+    assert report["hub"]["nacks_received"] == 0
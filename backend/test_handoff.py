@@ -0,0 +1,139 @@
+"""
+test_handoff.py
+
+Zero-downtime restarts: the device process is started the way systemd
+socket activation starts it, replaced with SIGHUP while a client keeps
+polling /status, then stopped and started again. No request may fail, and
+the running routine must survive both.
+"""
+
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from handoff import load_state, save_state
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HANDOVER_BUDGET_MS = 200
+CI_TOLERANCE = 2
+
+# Moves the listener to fd 3 and sets LISTEN_PID to the pid main.py will have
+SD_LAUNCHER = (
+    "import os, sys; os.dup2(int(sys.argv[1]), 3); os.environ['LISTEN_PID'] = str(os.getpid()); "
+    "os.execv(sys.executable, [sys.executable] + sys.argv[2:])"
+)
+
+
+def start_device(listener, tmp_path):
+    """Start main.py with the listener as systemd would pass it (fd 3, LISTEN_FDS=1)."""
+    env = dict(os.environ, ROUTINECLOUD_DATABASE_URL=f"sqlite:///{tmp_path}/device.db", LISTEN_FDS="1")
+    command = [
+        sys.executable, "-c", SD_LAUNCHER, str(listener.fileno()),
+        os.path.join(BACKEND_DIR, "main.py"), "--no-display", "--no-ws",
+        "--state-file", str(tmp_path / "state.json"), "--log-file", str(tmp_path / "device.log"),
+    ]
+    return subprocess.Popen(command, env=env, cwd=tmp_path, pass_fds=(listener.fileno(),),
+                            stdout=subprocess.DEVNULL)
+
+
+def wait_until_serving(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return httpx.get(f"{url}/status", timeout=5).json()
+        except httpx.HTTPError:
+            assert time.monotonic() < deadline, "device did not start"
+            time.sleep(0.05)
+
+
+def test_reload_and_restart_keep_serving_and_keep_the_routine(tmp_path):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+    url = f"http://127.0.0.1:{listener.getsockname()[1]}"
+    log_path = tmp_path / "device.log"
+    processes = [start_device(listener, tmp_path)]
+    try:
+        wait_until_serving(url)
+        httpx.post(f"{url}/routine/start")
+        task = httpx.post(f"{url}/routine/next").json()
+
+        # Poll with a new connection per request, like the parent app does
+        results = []
+        polling = True
+
+        def poll():
+            while polling:
+                started_at = time.perf_counter()
+                try:
+                    outcome = httpx.get(f"{url}/status", timeout=10).status_code
+                except httpx.HTTPError as e:
+                    outcome = repr(e)
+                results.append((time.perf_counter() - started_at, outcome))
+
+        poller = threading.Thread(target=poll)
+        poller.start()
+        time.sleep(0.3)
+        processes[0].send_signal(signal.SIGHUP)
+        assert processes[0].wait(60) == 0
+        time.sleep(0.3)
+        polling = False
+        poller.join()
+
+        failures = [outcome for _, outcome in results if outcome != 200]
+        assert not failures
+        # The target is a 200 ms gap; shared CI machines get twice that
+        slowest = max(latency for latency, _ in results) * 1000
+        held = int(re.search(r"requests were held for (\d+) ms", log_path.read_text()).group(1))
+        assert held < HANDOVER_BUDGET_MS * CI_TOLERANCE, f"requests were held for {held} ms"
+        assert slowest < HANDOVER_BUDGET_MS * CI_TOLERANCE, f"slowest request took {slowest:.0f} ms"
+        status = httpx.get(f"{url}/status").json()
+        assert status["is_active"] and status["current_task"] == task
+
+        # Stopping saves the progress, the next process picks it up
+        successor = int(re.search(r"Handed over to process (\d+)", log_path.read_text()).group(1))
+        os.kill(successor, signal.SIGTERM)
+        deadline = time.monotonic() + 30
+        while not (tmp_path / "state.json").exists():
+            assert time.monotonic() < deadline, "state was not saved"
+            time.sleep(0.05)
+        time.sleep(0.5)
+
+        processes.append(start_device(listener, tmp_path))
+        status = wait_until_serving(url)
+        assert status["is_active"] and status["current_task"] == task
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait(30)
+        for match in re.finditer(r"Handed over to process (\d+)", log_path.read_text() if log_path.exists() else ""):
+            try:
+                os.kill(int(match.group(1)), signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        listener.close()
+
+
+def test_stale_saved_state_is_ignored(tmp_path):
+    path = str(tmp_path / "state.json")
+    save_state(path, {"routine": None})
+    assert load_state(path, max_age=60) == {"routine": None}
+    assert load_state(path) is None  # Consumed by the first load
+
+    save_state(path, {"routine": None})
+    with open(path) as f:
+        saved = json.load(f)
+    saved["saved_at"] -= 3600
+    with open(path, "w") as f:
+        json.dump(saved, f)
+    assert load_state(path, max_age=60) is None
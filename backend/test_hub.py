@@ -0,0 +1,78 @@
+"""
+test_hub.py
+
+The hub must remember which outbox messages of a device it has processed
+across connections, so the batch a device replays after reconnecting is
+not applied again, while its sequence numbers still move on.
+"""
+
+import asyncio
+
+import websockets
+
+import ws_protocol
+from hub import Hub
+
+async def connect(url):
+    websocket = await websockets.connect(url, subprotocols=ws_protocol.supported_subprotocols() or None)
+    return websocket, ws_protocol.codec_for_subprotocol(websocket.subprotocol)
+
+def test_batch_replayed_after_reconnecting_is_not_applied_again():
+    async def scenario():
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        url = f"{hub.url}?device_id=child-1"
+        batch = {"type": "batch", "seq": 1,
+                 "messages": [{"type": "status", "id": 1, "data": {"current_task_index": 0}}]}
+        try:
+            websocket, codec = await connect(url)
+            async with websocket:
+                await websocket.send(codec.encode(batch))
+                assert codec.decode(await websocket.recv()) == {"type": "ack", "seq": 1}
+                await websocket.send(codec.encode({"type": "status", "seq": 2, "id": 2,
+                                                    "data": {"current_task_index": 1}}))
+                assert codec.decode(await websocket.recv()) == {"type": "ack", "seq": 2}
+            while "child-1" in hub.connections:
+                await asyncio.sleep(0.01)
+
+            # The ack of the first batch was lost: the device replays it
+            websocket, codec = await connect(url)
+            async with websocket:
+                await websocket.send(codec.encode(batch))
+                assert codec.decode(await websocket.recv()) == {"type": "ack", "seq": 1}
+                assert hub.statuses["child-1"] == {"current_task_index": 1}
+
+                await websocket.send(codec.encode(dict(batch, seq=2, messages=[
+                    {"type": "status", "id": 3, "data": {"current_task_index": 2}}])))
+                await websocket.recv()
+                assert hub.statuses["child-1"] == {"current_task_index": 2}
+        finally:
+            await hub.stop()
+
+    asyncio.run(scenario())
+
+
+def test_duplicate_status_moves_the_sequence_on():
+    async def scenario():
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        status = {"type": "status", "seq": 1, "id": 1, "data": {"current_task_index": 0}}
+        try:
+            websocket, codec = await connect(f"{hub.url}?device_id=child-1")
+            async with websocket:
+                await websocket.send(codec.encode(status))
+                assert codec.decode(await websocket.recv()) == {"type": "ack", "seq": 1}
+
+                # The ack was lost: the device sends the status again
+                await websocket.send(codec.encode(dict(status, seq=2)))
+                assert codec.decode(await websocket.recv()) == {"type": "ack", "seq": 2}
+
+                await websocket.send(codec.encode({"type": "status_delta", "seq": 3, "base": 2,
+                                                    "data": {"current_task_index": 1}}))
+                assert codec.decode(await websocket.recv()) == {"type": "ack", "seq": 3}
+                assert hub.statuses["child-1"] == {"current_task_index": 1}
+                assert hub.resyncs_requested == 0
+        finally:
+            await hub.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,92 @@
+"""
+test_memory.py
+
+Memory tests: the resident set size must stay flat over a scripted,
+time-compressed night of use, and crossing the budget must evict caches.
+"""
+
+import asyncio
+import gc
+import io
+import logging
+
+import httpx
+
+from app_logging import LogPipeline
+from memory import MemoryMonitor
+from metrics import resident_memory
+
+# One simulated night: the parent app polls the status every minute from
+# 19:00 to 07:00 and the bedtime routine is run three times.
+POLLS_PER_NIGHT = 12 * 60
+ROUTINE_RUNS_PER_NIGHT = 3
+NIGHTS = 4
+ALLOWED_GROWTH = 2 * 2**20  # Bytes of RSS growth after the first night
+
+
+async def simulate_night(client: httpx.AsyncClient):
+    runs_at = {POLLS_PER_NIGHT * (i + 1) // (ROUTINE_RUNS_PER_NIGHT + 1) for i in range(ROUTINE_RUNS_PER_NIGHT)}
+    for minute in range(POLLS_PER_NIGHT):
+        response = await client.get("/status")
+        assert response.status_code == 200
+        if minute in runs_at:
+            await client.post("/routine/start")
+            await client.post("/sound/play/lullaby.mp3")
+            while (await client.post("/routine/next")).json() is not None:
+                await client.get("/tasks")
+            await client.get("/debug/traces")
+            await client.get("/metrics")
+
+
+def test_rss_is_steady_over_a_simulated_night():
+    from fastapi_server import app
+
+    # Log like the device does, without touching the root logger pytest uses
+    pipeline = LogPipeline(io.StringIO(), json_output=True, flush_interval=0.05)
+    pipeline.start()
+    log = logging.getLogger("ws_client")
+    log.addHandler(pipeline.handler)
+    log.setLevel(logging.INFO)
+
+    async def run():
+        rss = []
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://device") as client:
+            for night in range(NIGHTS):
+                await simulate_night(client)
+                log.info(f"night {night} done", extra={"night": night})
+                gc.collect()
+                rss.append(resident_memory())
+        return rss
+
+    try:
+        rss = asyncio.run(run())
+    finally:
+        log.removeHandler(pipeline.handler)
+        pipeline.stop()
+
+    growth = max(rss[1:]) - rss[0]
+    assert growth <= ALLOWED_GROWTH, \
+        f"RSS per night (MiB): {[round(value / 2**20, 1) for value in rss]}, growth {growth / 2**10:.0f} KiB"
+
+
+def test_crossing_the_budget_evicts_caches_in_priority_order():
+    rss = [500]
+    evicted = []
+
+    def evict(name, freed):
+        def run():
+            evicted.append(name)
+            rss[0] -= freed
+        return run
+
+    monitor = MemoryMonitor(budget=400, rss=lambda: rss[0])
+    monitor.register("metadata", lambda: 150, evict("metadata", 150), priority=30)
+    monitor.register("traces", lambda: 50, evict("traces", 50), priority=10)
+    monitor.register("orm", lambda: 10)
+
+    assert monitor.check()
+    # Traces alone leave 450 > 360 (90% of the budget), so metadata goes too
+    assert evicted == ["traces", "metadata"]
+    assert monitor.last_eviction["rss_after_bytes"] == 300
+    assert not monitor.check()
+    assert monitor.breakdown()["subsystems"]["orm"] == {"bytes": 10, "evictable": False}
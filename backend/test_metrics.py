@@ -0,0 +1,89 @@
+"""
+test_metrics.py
+
+The metrics registry must render the Prometheus text format with cumulative
+histogram buckets, refuse to register a name twice with a different shape,
+and TimedLock must time contended waits and outermost holds only.
+"""
+
+import threading
+
+import pytest
+
+from metrics import Histogram, MetricsRegistry, TimedLock
+
+def test_render_format():
+    registry = MetricsRegistry()
+    registry.counter("commands_total", "Commands handled.", labels=("command",)).labels("next_task").inc(2)
+    registry.gauge("queue_depth", "Queued commands.").set(1.5)
+    registry.gauge("cache_bytes", "Cache size.").set_function(lambda: 2048)
+    registry.counter("route_total", "Requests.", labels=("route",)).labels('/a"b\\').inc()
+
+    assert registry.render() == "\n".join([
+        "# HELP commands_total Commands handled.",
+        "# TYPE commands_total counter",
+        'commands_total{command="next_task"} 2',
+        "# HELP queue_depth Queued commands.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 1.5",
+        "# HELP cache_bytes Cache size.",
+        "# TYPE cache_bytes gauge",
+        "cache_bytes 2048",
+        "# HELP route_total Requests.",
+        "# TYPE route_total counter",
+        'route_total{route="/a\\"b\\\\"} 1',
+    ]) + "\n"
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("update_seconds", "Updates.", labels=("widget",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.labels("time").observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'update_seconds_bucket{widget="time",le="0.1"} 2',  # A bucket includes its bound
+        'update_seconds_bucket{widget="time",le="1"} 3',
+        'update_seconds_bucket{widget="time",le="+Inf"} 4',
+        'update_seconds_sum{widget="time"} 3.65',
+        'update_seconds_count{widget="time"} 4',
+    ]
+
+def test_registering_a_name_again():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("update_seconds", "Updates.", labels=("widget",))
+    assert registry.histogram("update_seconds", "Updates.", labels=("widget",)) is histogram
+    with pytest.raises(ValueError):
+        registry.counter("update_seconds", "Updates.", labels=("widget",))
+    with pytest.raises(ValueError):
+        registry.histogram("update_seconds", "Updates.")
+    with pytest.raises(ValueError):
+        histogram.labels("time", "extra")
+
+def test_timed_lock_times_contended_waits_and_outermost_holds():
+    wait, hold = Histogram((0.01, 1.0)), Histogram((0.01, 1.0))
+    lock = TimedLock(wait, hold)
+
+    with lock:
+        with lock:  # Reentrant: only the outermost hold counts
+            pass
+    assert (wait.count, hold.count) == (0, 1)
+
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with lock:
+            held.set()
+            release.wait()
+    thread = threading.Thread(target=holder)
+    thread.start()
+    held.wait()
+    assert not lock.acquire(blocking=False)
+    threading.Timer(0.05, release.set).start()
+    with lock:
+        pass
+    thread.join()
+
+    assert wait.count == 1 and wait.sum >= 0.04
+    assert hold.count == 3
+    assert hold.counts[-2] >= 1  # The holder kept it for longer than 10 ms
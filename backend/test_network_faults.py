@@ -0,0 +1,173 @@
+"""
+test_network_faults.py
+
+Scenario tests running the WebSocket client, the reference hub and the REST
+API through tools.fault_proxy. They measure time-to-detect-disconnect,
+time-to-resync and lost or duplicated commands against bounds, so changes
+to reconnect and delivery logic are judged by numbers; a failed assertion
+reports the measurement.
+"""
+
+import asyncio
+import time
+
+import httpx
+import uvicorn
+
+from hub import Hub
+from routine_state import RoutineState
+from tools.fault_proxy import FaultConfig, FaultProxy
+from ws_client import WebSocketClient
+
+HEARTBEAT_INTERVAL = 0.5
+HEARTBEAT_TIMEOUT = 0.5
+MAX_RECONNECT_INTERVAL = 0.5
+RESETS_AT = (20, 40)  # Commands before which every connection is reset
+
+
+async def wait_until(condition, timeout=10.0, interval=0.01):
+    """Wait until condition() is true and return the seconds it took."""
+    started = time.monotonic()
+    while not condition():
+        if time.monotonic() - started > timeout:
+            raise AssertionError(f"Condition not met within {timeout}s")
+        await asyncio.sleep(interval)
+    return time.monotonic() - started
+
+
+class Scenario:
+    """A hub, a fault proxy in front of it and one device connected through the proxy."""
+
+    def __init__(self, config=None):
+        self.config = config or FaultConfig()
+        self.handled = []
+
+    async def __aenter__(self):
+        self.hub = Hub("127.0.0.1", 0)
+        await self.hub.start()
+        self.proxy = FaultProxy("127.0.0.1", self.hub.port, config=self.config, seed=7)
+        await self.proxy.start()
+
+        self.state = RoutineState.standalone()
+        self.client = WebSocketClient(
+            f"ws://{self.proxy.address}/ws", device_id="device-1", state=self.state,
+            reconnect_interval=0.1, max_reconnect_interval=MAX_RECONNECT_INTERVAL,
+            heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+            coalesce_window=0.01
+        )
+        play_sound = self.client.command_handlers["play_sound"]
+
+        async def recording_play_sound(data):
+            self.handled.append(data["sound_name"])
+            await play_sound(data)
+
+        self.client.command_handlers["play_sound"] = recording_play_sound
+        self.task = asyncio.create_task(self.client.run())
+        await wait_until(lambda: "device-1" in self.hub.connections)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.client.stop()
+        await asyncio.wait_for(self.task, 10)
+        await self.proxy.stop()
+        await self.hub.stop()
+
+    def hub_in_sync(self):
+        """Check whether the hub holds the device's current status over a live connection."""
+        expected = {
+            "is_active": self.state.is_routine_active,
+            "current_task": self.state.current_task,
+            "current_sound": self.state.current_sound,
+        }
+        return "device-1" in self.hub.connections and self.hub.statuses.get("device-1") == expected
+
+
+def test_half_open_link_is_detected_within_heartbeat_deadline():
+    async def scenario():
+        async with Scenario() as s:
+            s.proxy.set_blackhole(True)
+            detect = await wait_until(lambda: not s.client.connected)
+            s.proxy.set_blackhole(False)
+            return detect
+
+    detect = asyncio.run(scenario())
+    assert detect <= HEARTBEAT_INTERVAL + HEARTBEAT_TIMEOUT + 0.5, \
+        f"half-open link detected after {detect * 1000:.0f} ms"
+
+
+def test_offline_changes_resync_after_reset():
+    async def scenario():
+        async with Scenario() as s:
+            s.proxy.reset_all()
+            await wait_until(lambda: not s.client.connected)
+            # Changed while offline, e.g. through the local REST API
+            s.state.start_routine()
+            s.state.next_task()
+            resync = await wait_until(s.hub_in_sync)
+            return resync, s.client.reconnects
+
+    resync, reconnects = asyncio.run(scenario())
+    assert resync <= MAX_RECONNECT_INTERVAL + 1.0, f"resynced after {resync * 1000:.0f} ms ({reconnects} reconnects)"
+
+
+def test_commands_over_lossy_link_are_never_duplicated():
+    config = FaultConfig(latency=0.02, jitter=0.01, stall_rate=0.02, stall_duration=0.2)
+
+    async def scenario():
+        async with Scenario(config) as s:
+            accepted = []
+            for i in range(60):
+                if i in RESETS_AT:
+                    s.proxy.reset_all()
+                name = f"sound-{i}.mp3"
+                if await s.hub.send_command("device-1", "play_sound", {"sound_name": name}):
+                    accepted.append(name)
+                await asyncio.sleep(0.02)
+            await wait_until(s.hub_in_sync)
+            await asyncio.sleep(0.3)
+            return accepted, list(s.handled)
+
+    accepted, handled = asyncio.run(scenario())
+    duplicates = len(handled) - len(set(handled))
+    lost = len(set(accepted) - set(handled))
+    summary = f"accepted by hub: {len(accepted)}, handled: {len(handled)}, lost: {lost}, duplicated: {duplicates}"
+    assert duplicates == 0, summary
+    assert set(handled) <= set(accepted), summary
+    # Commands are delivered at most once: only those in flight when the link is reset are lost
+    assert lost <= 5 * len(RESETS_AT), summary
+
+
+def test_rest_api_over_slow_link():
+    from fastapi_server import app
+
+    async def scenario():
+        config = uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning")
+        server = uvicorn.Server(config)
+        serve_task = asyncio.create_task(server.serve())
+        await wait_until(lambda: server.started)
+        port = server.servers[0].sockets[0].getsockname()[1]
+
+        proxy = FaultProxy("127.0.0.1", port, config=FaultConfig(latency=0.05, bandwidth=50000), seed=7)
+        await proxy.start()
+        try:
+            async with httpx.AsyncClient(base_url=f"http://{proxy.address}", timeout=5) as client:
+                started = time.monotonic()
+                response = await client.get("/status")
+                slow = time.monotonic() - started
+
+                proxy.config.reset_rate = 1.0
+                try:
+                    await client.get("/tasks")
+                    reset_failed = False
+                except httpx.TransportError:
+                    reset_failed = True
+            return response, slow, reset_failed
+        finally:
+            await proxy.stop()
+            server.should_exit = True
+            await serve_task
+
+    response, slow, reset_failed = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert slow >= 0.1, f"GET /status over 50 ms link took {slow * 1000:.0f} ms"
+    assert reset_failed
@@ -0,0 +1,119 @@
+"""
+test_outbox.py
+
+Undelivered messages must be kept until acknowledged, newest first per
+collapse key and within the bound, and a client that was offline must
+replay them after reconnecting without writing the outbox on its event loop.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import ws_protocol
+from hub import Hub
+from outbox import MemoryOutbox, Outbox
+from routine_state import RoutineState
+from ws_client import WebSocketClient
+
+@pytest.fixture(params=["sqlite", "memory"])
+def make_outbox(request, tmp_path):
+    outboxes = []
+
+    def make(max_messages=500):
+        if request.param == "sqlite":
+            outbox = Outbox(str(tmp_path / "outbox.db"), max_messages=max_messages)
+        else:
+            outbox = MemoryOutbox(max_messages=max_messages)
+        outboxes.append(outbox)
+        return outbox
+    yield make
+    for outbox in outboxes:
+        outbox.close()
+
+def test_collapse_key_keeps_only_the_newest_message(make_outbox):
+    outbox = make_outbox()
+    outbox.append({"type": "status", "data": {"n": 1}}, collapse_key="status")
+    event_id = outbox.append({"type": "event"})
+    status_id = outbox.append({"type": "status", "data": {"n": 2}}, collapse_key="status")
+    assert outbox.pending() == [(event_id, {"type": "event"}), (status_id, {"type": "status", "data": {"n": 2}})]
+    assert status_id > event_id
+
+def test_oldest_messages_are_dropped_beyond_the_bound(make_outbox):
+    outbox = make_outbox(max_messages=3)
+    ids = [outbox.append({"n": n}) for n in range(5)]
+    assert [message_id for message_id, _ in outbox.pending()] == ids[2:]
+    assert len(outbox) == 3
+
+def test_acknowledged_messages_are_deleted(make_outbox):
+    outbox = make_outbox()
+    ids = [outbox.append({"n": n}) for n in range(3)]
+    outbox.ack([ids[0], ids[2]])
+    outbox.ack([])
+    assert outbox.pending() == [(ids[1], {"n": 1})]
+
+def test_sqlite_outbox_survives_a_restart(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    first = outbox.append({"n": 1})
+    outbox.close()
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    try:
+        assert outbox.pending() == [(first, {"n": 1})]
+        assert outbox.append({"n": 2}) > first  # Ids are never reused
+    finally:
+        outbox.close()
+
+def test_client_replays_offline_statuses_and_deletes_them_once_acked(tmp_path):
+    class ThreadRecordingOutbox(Outbox):
+        def append(self, message, collapse_key=None):
+            writer_threads.add(threading.get_ident())
+            return super().append(message, collapse_key)
+
+    async def wait_until(condition, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline, "timed out"
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        port = hub.port
+        await hub.stop()
+
+        state = RoutineState.standalone()
+        client = WebSocketClient(hub.url, reconnect_interval=0.05, max_reconnect_interval=0.1,
+                                 device_id="child-1", state=state, outbox=outbox)
+        running = asyncio.create_task(client.run())
+        await asyncio.sleep(0)  # Subscribed to the state
+        try:
+            # Offline: the statuses collapse into one outbox message
+            state.start_routine()
+            state.next_task()
+            await wait_until(lambda: len(outbox) == 1)
+            assert outbox.pending()[0][1]["data"] == ws_protocol.status_snapshot(state)
+
+            hub = Hub("127.0.0.1", port)
+            await hub.start()
+            try:
+                await wait_until(lambda: hub.statuses.get("child-1") == ws_protocol.status_snapshot(state))
+                await wait_until(lambda: len(outbox) == 0)
+                state.next_task()
+                await wait_until(lambda: hub.statuses["child-1"] == ws_protocol.status_snapshot(state))
+                await wait_until(lambda: len(outbox) == 0)
+            finally:
+                await hub.stop()
+        finally:
+            client.stop()
+            await running
+        return threading.get_ident()
+
+    writer_threads = set()
+    outbox = ThreadRecordingOutbox(str(tmp_path / "outbox.db"))
+    try:
+        loop_thread = asyncio.run(scenario())
+    finally:
+        outbox.close()
+    assert writer_threads and loop_thread not in writer_threads
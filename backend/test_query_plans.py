@@ -0,0 +1,129 @@
+"""
+test_query_plans.py
+
+Checks that the hot routine queries are served by indexes on a database
+migrated with Alembic, so schema changes cannot silently regress them to
+table scans or temporary sorts.
+
+Run with: python -m pytest test_query_plans.py
+"""
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.exc import IntegrityError
+
+from alembic import command
+from alembic.script import ScriptDirectory
+
+from entity import Routine, RoutineTask, RunEvent, Task, init_db
+from entity.base import LEGACY_SCHEMA_REVISION, get_alembic_config
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A fresh SQLite database migrated to the latest revision."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'plans.db'}")
+    init_db(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+def head_revision():
+    """Get the latest revision of the migration history."""
+    return ScriptDirectory.from_config(get_alembic_config()).get_current_head()
+
+
+def query_plan(engine, query):
+    """Run EXPLAIN QUERY PLAN for an ORM query and return the plan details."""
+    sql = query.statement.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    with engine.connect() as connection:
+        rows = connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+    return [row[-1] for row in rows]
+
+
+def assert_no_scan(plan, table):
+    """Assert that the plan neither scans the table nor sorts with a temporary b-tree."""
+    for detail in plan:
+        assert not detail.startswith(f"SCAN {table}"), plan
+        assert "USE TEMP B-TREE" not in detail, plan
+
+
+def test_migrations_reach_head(engine):
+    with engine.connect() as connection:
+        version = connection.execute(text("SELECT version_num FROM alembic_version")).scalar()
+    assert version == head_revision()
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("routine_tasks")}
+    assert "ix_routine_tasks_routine_id_position" in indexes
+
+
+def test_legacy_database_is_stamped_and_upgraded(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    # The schema create_all used to build: the baseline revision, without a revision table
+    config = get_alembic_config()
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, LEGACY_SCHEMA_REVISION)
+        connection.execute(text("DROP TABLE alembic_version"))
+
+    init_db(bind=engine)
+
+    with engine.connect() as connection:
+        version = connection.execute(text("SELECT version_num FROM alembic_version")).scalar()
+    assert version == head_revision()
+    indexes = {index["name"] for index in inspect(engine).get_indexes("routine_tasks")}
+    assert "ix_routine_tasks_routine_id_position" in indexes
+    assert "run_events" in inspect(engine).get_table_names()
+    engine.dispose()
+
+
+def test_ordered_tasks_of_routine_use_position_index(engine):
+    plan = query_plan(engine, RoutineTask.ordered_tasks_query(1))
+    assert any("ix_routine_tasks_routine_id_position" in detail for detail in plan), plan
+    assert_no_scan(plan, "routine_tasks")
+    assert_no_scan(plan, "tasks")
+
+
+def test_active_routine_uses_index(engine):
+    plan = query_plan(engine, Routine.query.filter(Routine.is_active.is_(True)))
+    assert any("ix_routines_is_active" in detail for detail in plan), plan
+    assert_no_scan(plan, "routines")
+
+
+def test_routine_by_name_uses_index(engine):
+    plan = query_plan(engine, Routine.query.filter(Routine.name == "Bedtime Routine"))
+    assert any("ix_routines_name" in detail for detail in plan), plan
+    assert_no_scan(plan, "routines")
+
+
+def test_task_by_name_uses_index(engine):
+    plan = query_plan(engine, Task.query.filter(Task.name == "Brush Teeth"))
+    assert any("ix_tasks_name" in detail for detail in plan), plan
+    assert_no_scan(plan, "tasks")
+
+
+def test_routine_tasks_of_task_use_index(engine):
+    plan = query_plan(engine, RoutineTask.query.filter(RoutineTask.task_id == 1))
+    assert any("ix_routine_tasks_task_id" in detail for detail in plan), plan
+    assert_no_scan(plan, "routine_tasks")
+
+
+def test_run_history_downsampling_uses_run_index(engine):
+    query = RunEvent.query.filter(RunEvent.run_id < 10, RunEvent.kind.in_(("run_start", "task_start")))
+    plan = query_plan(engine, query)
+    assert any("ix_run_events_run_id" in detail for detail in plan), plan
+    assert_no_scan(plan, "run_events")
+
+
+def test_position_is_unique_per_routine(engine):
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO routines (id, name) VALUES (1, 'r')"))
+        connection.execute(text(
+            "INSERT INTO tasks (id, name, icon_name, sound, duration) VALUES (1, 't', 'i', 's', 1)"
+        ))
+        connection.execute(text("INSERT INTO routine_tasks (routine_id, task_id, position) VALUES (1, 1, 0)"))
+
+    with pytest.raises(IntegrityError):
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO routine_tasks (routine_id, task_id, position) VALUES (1, 1, 0)"))
@@ -0,0 +1,143 @@
+"""
+test_routine_refresh.py
+
+The cached routine of a RoutineState must follow committed edits of its
+tasks, their order and the active routine, and ignore rolled-back ones. A
+running routine keeps its task through edits and is stopped when its task
+or the routine itself goes away, and listeners see either change.
+"""
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from entity import Routine, RoutineTask, Task, add_change_listener, init_db, remove_change_listener
+from routine_state import RoutineState
+
+@pytest.fixture
+def session_factory(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'routines.db'}")
+    init_db(bind=engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr("entity.base.SessionLocal", factory)
+
+    session = factory()
+    session.add_all([
+        Routine(id=1, name="School Night", is_active=True),
+        Routine(id=2, name="Weekend", is_active=False),
+        Task(id=1, name="Bath", icon_name="bath", sound="bath.mp3", duration=600),
+        Task(id=2, name="Brush Teeth", icon_name="tooth", sound="teeth.mp3", duration=120),
+        Task(id=3, name="Story", icon_name="book", sound="book.mp3", duration=900),
+        RoutineTask(id=1, routine_id=1, task_id=1, position=0),
+        RoutineTask(id=2, routine_id=1, task_id=2, position=1),
+        RoutineTask(id=3, routine_id=2, task_id=3, position=0),
+    ])
+    session.commit()
+    session.close()
+    yield factory
+    engine.dispose()
+
+@pytest.fixture
+def state(session_factory):
+    state = RoutineState.standalone()
+    assert state.load_from_db()
+    yield state
+    state.close()
+
+def names(state):
+    return [task["name"] for task in state.tasks]
+
+@pytest.fixture
+def transitions(state):
+    transitions = []
+    state.add_listener(transitions.append)
+    return transitions
+
+def test_committed_task_edits_refresh_the_cache(session_factory, state):
+    assert names(state) == ["Bath", "Brush Teeth"]
+    session = session_factory()
+    try:
+        session.get(Task, 2).name = "Teeth"
+        session.commit()
+        assert names(state) == ["Bath", "Teeth"]
+
+        # Reorder within the unique (routine_id, position) index
+        session.get(RoutineTask, 1).position = 2
+        session.flush()
+        session.get(RoutineTask, 2).position = 0
+        session.commit()
+        assert names(state) == ["Teeth", "Bath"]
+    finally:
+        session.close()
+
+def test_rolled_back_edits_are_ignored(session_factory, state):
+    changes = []
+    add_change_listener(changes.append)
+    session = session_factory()
+    try:
+        session.get(Task, 1).name = "Shower"
+        session.flush()  # Seen by the listener, then discarded
+        session.rollback()
+        assert changes == []
+        session.add(Task(id=4, name="Unrelated", icon_name="star", sound="book.mp3", duration=60))
+        session.commit()
+    finally:
+        session.close()
+        remove_change_listener(changes.append)
+    # The next commit does not carry the rolled-back edit
+    assert [change.task_ids for change in changes] == [{4}]
+    assert names(state) == ["Bath", "Brush Teeth"]
+
+def test_edits_keep_the_running_task_and_are_notified(session_factory, state, transitions):
+    state.start_routine()
+    state.next_task()
+    session = session_factory()
+    try:
+        # Moved, renamed and given a new sound: still the current task
+        session.get(RoutineTask, 1).position = 2
+        session.flush()
+        session.get(RoutineTask, 2).position = 0
+        task = session.get(Task, 2)
+        task.name, task.sound = "Teeth", "teeth2.mp3"
+        session.commit()
+    finally:
+        session.close()
+    assert state.is_routine_active and state.current_task["name"] == "Teeth"
+    assert state.current_sound == "teeth2.mp3"
+    assert transitions[-1].event == "refresh"
+    assert transitions[-1].previous_task["name"] == "Brush Teeth"
+    assert transitions[-1].current_task["name"] == "Teeth"
+
+    count = len(transitions)
+    session = session_factory()
+    try:
+        session.get(Task, 1).duration = 300  # Not the current task
+        session.commit()
+    finally:
+        session.close()
+    assert len(transitions) == count
+
+def test_removing_the_running_task_stops_the_routine(session_factory, state, transitions):
+    state.start_routine()
+    session = session_factory()
+    try:
+        session.delete(session.get(RoutineTask, 1))
+        session.commit()
+    finally:
+        session.close()
+    assert names(state) == ["Brush Teeth"]
+    assert not state.is_routine_active and state.current_sound is None
+    assert transitions[-1].event == "stop_routine" and transitions[-1].previous_task["name"] == "Bath"
+
+def test_changing_the_active_routine_stops_the_run_and_loads_it(session_factory, state, transitions):
+    state.start_routine()
+    session = session_factory()
+    try:
+        session.get(Routine, 1).is_active = False
+        session.get(Routine, 2).is_active = True
+        session.commit()
+    finally:
+        session.close()
+    assert state.routine_id == 2 and names(state) == ["Story"]
+    assert not state.is_routine_active and state.current_task is None
+    assert transitions[-1].event == "stop_routine" and transitions[-1].previous_task["name"] == "Bath"
@@ -0,0 +1,103 @@
+"""
+test_routine_registry.py
+
+Routine runtimes of different targets must be independent: their own
+progress, their own lock and transitions tagged with their target. The
+REST routes address them with the target query parameter.
+"""
+
+import threading
+import tracemalloc
+
+import pytest
+from fastapi.testclient import TestClient
+
+from fastapi_server import app
+from routine_registry import RoutineRegistry, routine_registry
+from routine_state import RoutineState
+
+
+@pytest.fixture
+def registry():
+    return RoutineRegistry(default=RoutineState.standalone())
+
+
+def test_runtimes_are_independent(registry):
+    anna = registry.create("anna", load=False)
+    ben = registry.create("ben", load=False)
+    assert registry.create("anna", load=False) is anna
+    assert registry.get(None) is registry.default
+
+    anna.start_routine()
+    anna.next_task()
+    ben.start_routine()
+    assert anna.current_task["id"] == 2
+    assert ben.current_task["id"] == 1
+    assert not registry.default.is_routine_active
+    assert set(registry.snapshots()) == {"anna", "ben"}
+
+    # Holding one runtime's lock does not block another runtime
+    with anna._state_lock:
+        worker = threading.Thread(target=ben.next_task)
+        worker.start()
+        worker.join(5)
+        assert not worker.is_alive()
+    assert ben.current_task["id"] == 2
+
+    # Tasks handed out are copies, the shared default tasks stay intact
+    ben.tasks[0]["name"] = "changed"
+    assert anna.tasks[0]["name"] == "Brush Teeth"
+
+
+def test_listeners_follow_every_runtime_with_its_target(registry):
+    transitions = []
+    registry.create("anna", load=False)
+    registry.add_listener(transitions.append)
+    registry.create("ben", load=False).start_routine()
+    registry.get("anna").start_routine()
+    registry.default.start_routine()
+    assert [t.target_id for t in transitions] == ["ben", "anna", None]
+
+    assert registry.remove("ben")
+    assert not registry.remove("ben")
+    assert registry.ids() == ["anna"]
+
+
+def test_export_and_restore_progress(registry):
+    registry.create("anna", load=False).start_routine()
+    registry.get("anna").next_task()
+    exported = registry.export_state()
+
+    successor = RoutineRegistry(default=RoutineState.standalone())
+    successor.create("anna", load=False)  # The routine loaded from the database
+    assert successor.restore_state(exported) == 1
+    assert successor.get("anna").current_task["id"] == 2
+
+
+def test_idle_runtimes_are_small():
+    registry = RoutineRegistry(default=RoutineState.standalone(), max_runtimes=5000)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(5000):
+            registry.create(f"child-{i}", load=False)
+        per_runtime = (tracemalloc.get_traced_memory()[0] - before) / 5000
+    finally:
+        tracemalloc.stop()
+    assert per_runtime < 1024, f"{per_runtime:.0f} bytes per idle runtime"
+    with pytest.raises(ValueError):
+        registry.create("one-too-many", load=False)
+
+
+def test_rest_routes_take_a_target():
+    client = TestClient(app)
+    routine_registry.create("rest-test", load=False)
+    try:
+        assert client.post("/routine/start", params={"target": "rest-test"}).json()["id"] == 1
+        assert client.get("/status", params={"target": "rest-test"}).json()["is_active"]
+        assert client.get("/targets").json()["rest-test"]["is_active"]
+        assert client.post("/routine/next", params={"target": "unknown"}).status_code == 404
+        assert client.delete("/targets/rest-test").status_code == 200
+        assert client.get("/status", params={"target": "rest-test"}).status_code == 404
+    finally:
+        routine_registry.remove("rest-test")
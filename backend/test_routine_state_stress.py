@@ -0,0 +1,26 @@
+"""
+test_routine_state_stress.py
+
+Short runs of tools.state_stress: concurrent reads and writes of RoutineState
+must never raise and snapshot() must always be consistent.
+"""
+
+import pytest
+
+from tools.state_stress import check_snapshot, run
+
+
+@pytest.mark.parametrize("write_ratio", [0.05, 0.5])
+def test_concurrent_access_keeps_invariants(write_ratio):
+    result = run(threads=4, tasks=4, duration=1.0, write_ratio=write_ratio)
+    assert result["operations"] > 0
+    assert result["errors"] == 0, result["messages"]
+    assert result["violations"] == 0, result["messages"]
+
+
+def test_check_snapshot_detects_inconsistent_status():
+    task = {"id": 1, "name": "Brush Teeth"}
+    assert check_snapshot({"is_active": True, "current_task": task, "current_sound": None}) is None
+    assert check_snapshot({"is_active": False, "current_task": None, "current_sound": "x.mp3"}) is None
+    assert check_snapshot({"is_active": True, "current_task": None, "current_sound": None})
+    assert check_snapshot({"is_active": False, "current_task": task, "current_sound": None})
@@ -0,0 +1,180 @@
+"""
+test_run_history.py
+
+Duration rollups must estimate percentiles within the histogram accuracy
+and belong to the routine a run started with, the raw events must be
+downsampled and trimmed to the budget as they arrive, also across failed
+writes, and run ids must never be reused, even once trimmed away.
+"""
+
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import fastapi_server
+from clock import SystemClock
+from entity import RunEvent, init_db
+from routine_state import RoutineState
+from run_history import DurationStats, RunHistory
+
+class SteppingClock(SystemClock):
+    """Wall clock time that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1767290400.0
+
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'history.db'}")
+    init_db(bind=engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+@pytest.fixture
+def make_history(session_factory):
+    histories = []
+
+    def make(**kwargs):
+        clock = SteppingClock()
+        history = RunHistory(RoutineState.standalone(clock), flush_interval=60, batch_size=1000,
+                             session_factory=session_factory, **kwargs)
+        history.start()
+        histories.append(history)
+        return history, clock
+    yield make
+    for history in histories:
+        history.stop()
+
+def play_routine(history, clock, task_seconds=60.0):
+    """Run the routine of the history's state to completion, each task taking task_seconds."""
+    history.state.start_routine()
+    while True:
+        clock.now += task_seconds
+        if history.state.next_task() is None:
+            return
+
+def events(session_factory):
+    session = session_factory()
+    try:
+        return [(e.run_id, e.kind) for e in session.query(RunEvent).order_by(RunEvent.id)]
+    finally:
+        session.close()
+
+def test_percentiles_are_within_the_histogram_accuracy():
+    stats = DurationStats("Bath")
+    assert stats.percentile(0.5) is None
+    for duration in range(1, 101):
+        stats.add(float(duration))
+    summary = stats.to_dict()
+    assert summary["count"] == 100 and summary["mean"] == pytest.approx(50.5)
+    assert summary["p50"] == pytest.approx(50, rel=0.05)
+    assert summary["p90"] == pytest.approx(90, rel=0.05)
+    assert (summary["min"], summary["max"]) == (1.0, 100.0)
+    # Percentiles never leave the observed range
+    single = DurationStats()
+    single.add(42.0)
+    assert single.percentile(0.5) == single.percentile(0.9) == 42.0
+
+def test_rollups_survive_a_restart(make_history):
+    history, clock = make_history()
+    play_routine(history, clock, task_seconds=30)
+    play_routine(history, clock, task_seconds=90)
+    history.flush()
+    tasks = len(history.state.tasks)
+
+    restarted, _ = make_history()
+    rollups = {row["task_id"]: row for row in restarted.stats()}
+    assert rollups[None]["count"] == 2
+    assert rollups[None]["min"] == 30 * tasks and rollups[None]["max"] == 90 * tasks
+    first_task = history.state.tasks[0]["id"]
+    assert rollups[first_task]["count"] == 2 and rollups[first_task]["mean"] == 60
+
+def test_run_rollup_keeps_the_routine_it_started_with(make_history):
+    history, clock = make_history()
+    tasks = history.state.tasks
+    history.state._apply_routine(1, "School Night", tasks)
+    history.state.start_routine()
+    history.state._apply_routine(1, "Bedtime", tasks)  # Renamed mid-run
+    while history.state.next_task() is not None:
+        clock.now += 60
+    run = next(row for row in history.stats() if row["task_id"] is None)
+    assert (run["routine_id"], run["name"], run["count"]) == (1, "School Night", 1)
+
+def test_old_runs_are_downsampled_then_trimmed(make_history, session_factory):
+    history, clock = make_history(full_resolution_runs=1)
+    events_per_run = 2 * len(history.state.tasks) + 2
+    history.max_events = 2 * events_per_run
+    for _ in range(3):
+        play_routine(history, clock)
+        history.flush()
+
+    stored = events(session_factory)
+    assert len(stored) <= history.max_events
+    # Runs before the last keep only their end events
+    assert all(kind.endswith("_end") for run_id, kind in stored if run_id < 3)
+    assert {kind for run_id, kind in stored if run_id == 3} == {"run_start", "task_start", "task_end", "run_end"}
+    # The rollups are unaffected
+    assert next(row for row in history.stats() if row["task_id"] is None)["count"] == 3
+
+def test_budget_is_enforced_as_events_arrive(make_history, session_factory):
+    history, clock = make_history(full_resolution_runs=1)
+    history.max_events = len(history.state.tasks) + 1
+    play_routine(history, clock)  # No explicit flush: the writer is woken
+    deadline = time.monotonic() + 5
+    while len(events(session_factory)) == 0 or len(events(session_factory)) > history.max_events:
+        assert time.monotonic() < deadline, "budget not enforced"
+        time.sleep(0.01)
+
+def test_failed_write_keeps_the_event_count(make_history, session_factory):
+    history, clock = make_history(full_resolution_runs=1)
+    history.max_events = len(history.state.tasks) + 1
+    play_routine(history, clock)
+    history.flush()
+    stored = len(events(session_factory))
+
+    def fail():
+        raise RuntimeError("disk full")
+
+    def failing_session():
+        session = session_factory()
+        session.commit = fail
+        return session
+    history._session_factory = failing_session
+    play_routine(history, clock)  # Trimmed within the failed transaction
+    with pytest.raises(RuntimeError):
+        history.flush()
+    assert history._event_count == stored
+
+    history._session_factory = session_factory
+    history.flush()
+    assert history._event_count == len(events(session_factory)) <= history.max_events
+
+def test_run_ids_are_not_reused_after_trimming_everything(make_history, session_factory):
+    history, clock = make_history(max_events=0)
+    play_routine(history, clock)
+    play_routine(history, clock)
+    history.flush()
+    assert events(session_factory) == []
+
+    restarted, clock = make_history()
+    play_routine(restarted, clock)
+    restarted.flush()
+    assert {run_id for run_id, _ in events(session_factory)} == {3}
+
+def test_stats_endpoint_serves_the_rollups(make_history, monkeypatch):
+    history, clock = make_history()
+    play_routine(history, clock, task_seconds=45)
+    monkeypatch.setattr(fastapi_server, "run_history", history)
+
+    response = TestClient(fastapi_server.app).get("/stats")
+    assert response.status_code == 200
+    rows = {row["task_id"]: row for row in response.json()}
+    assert len(rows) == len(history.state.tasks) + 1
+    assert rows[None]["count"] == 1 and rows[None]["p50"] == pytest.approx(45 * len(history.state.tasks), rel=0.05)
+    assert all(row["mean"] == 45 for task_id, row in rows.items() if task_id is not None)
@@ -0,0 +1,82 @@
+"""
+test_time_sync.py
+
+Devices must estimate the hub's clock despite their own being off, run
+commands carrying an execute_at time at that hub time, and let a priority
+command cancel the scheduled commands sent before it.
+"""
+
+import asyncio
+import time
+
+from hub import Hub
+from routine_state import RoutineState
+from time_sync import TimeSync
+from tools.skew_bench import SkewedClock
+from ws_client import WebSocketClient
+
+def test_offset_comes_from_the_fastest_exchanges():
+    sync = TimeSync(window=4)
+    assert sync.offset is None and sync.to_local(100.0) == 100.0
+
+    # Server 10s ahead; the second exchange was delayed on the way back only
+    for t0, delay_up, delay_down in ((0.0, 0.02, 0.02), (1.0, 0.02, 0.5), (2.0, 0.03, 0.01)):
+        answer = TimeSync.answer(TimeSync.probe(t0), t0 + 10 + delay_up, t0 + 10 + delay_up + 0.001)
+        assert sync.add(answer, t0 + delay_up + 0.001 + delay_down)
+    assert abs(sync.offset - 10.0) < 0.01
+    assert abs(sync.rtt - 0.04) < 1e-9
+    assert abs(sync.to_local(110.0) - 100.0) < 0.01
+
+    assert not sync.add({"t0": 5.0, "t1": 15.0, "t2": 16.0}, 5.5)  # Negative RTT
+    assert not sync.add({"t0": 5.0}, 5.5)
+    assert len(sync.samples) == 3
+
+def test_devices_with_skewed_clocks_run_commands_together():
+    async def scenario():
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        ran_at = {}
+        clients, tasks = [], []
+        for device_id, clock_offset in (("child-1", 2.0), ("child-2", -3.0)):
+            state = RoutineState.standalone()
+            state.add_listener(lambda transition, device_id=device_id:
+                               ran_at.setdefault(device_id, []).append(time.time()))
+            client = WebSocketClient(hub.url, device_id=device_id, state=state,
+                                     clock=SkewedClock(clock_offset), time_sync_burst_interval=0.02)
+            clients.append(client)
+            tasks.append(asyncio.create_task(client.run()))
+            hub.add_to_group("siblings", device_id)
+
+        async def wait_until(condition, timeout=10.0):
+            deadline = time.monotonic() + timeout
+            while not condition():
+                assert time.monotonic() < deadline, "timed out"
+                await asyncio.sleep(0.01)
+
+        try:
+            await wait_until(lambda: all(len(c.time_sync.samples) >= 4 for c in clients))
+            for client in clients:
+                assert abs(client.time_sync.offset + client.clock.offset) < 0.05
+
+            execute_at = time.time() + 0.3
+            assert hub.send_group_command("siblings", "start_routine", execute_at=execute_at) == 2
+            await wait_until(lambda: len(ran_at) == 2)
+            times = [ran_at[device_id][0] for device_id in ("child-1", "child-2")]
+            assert max(times) - min(times) < 0.05
+            assert min(times) > execute_at - 0.05
+
+            # A stop sent on receipt cancels the switch scheduled before it
+            ran_at.clear()
+            hub.send_group_command("siblings", "next_task", execute_at=time.time() + 0.3)
+            await asyncio.sleep(0.05)
+            hub.send_group_command("siblings", "stop_routine")
+            await asyncio.sleep(0.5)
+            assert all(len(ran_at[device_id]) == 1 for device_id in ("child-1", "child-2"))
+            assert all(not c.state.is_routine_active and c.commands_preempted == 1 for c in clients)
+        finally:
+            for client in clients:
+                client.stop()
+            await asyncio.gather(*tasks)
+            await hub.stop()
+
+    asyncio.run(scenario())
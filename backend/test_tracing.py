@@ -0,0 +1,69 @@
+"""
+test_tracing.py
+
+The tracer must trace the sampled fraction of commands, keep only the most
+recent traces, summarize the stages in the order commands pass them, and
+serve them from /debug/traces.
+"""
+
+import random
+
+from fastapi.testclient import TestClient
+
+import fastapi_server
+from tracing import Tracer
+
+def test_sampling():
+    assert Tracer(sample_rate=0).start_trace("next_task", "ws") is None
+    assert Tracer(sample_rate=1).start_trace("next_task", "ws", trace_id="abc").trace_id == "abc"
+
+    tracer = Tracer(capacity=1000, sample_rate=0.25, rng=random.Random(7))
+    sampled = [tracer.start_trace("next_task", "ws") for _ in range(1000)]
+    traced = [trace for trace in sampled if trace is not None]
+    assert 200 <= len(traced) <= 300
+    assert len(tracer.traces()) == len(traced)
+    assert len({trace.trace_id for trace in traced}) == len(traced)
+
+def test_ring_buffer_keeps_the_most_recent_traces():
+    tracer = Tracer(capacity=3)
+    for n in range(5):
+        tracer.start_trace(f"command-{n}", "ws")
+    assert [trace.name for trace in tracer.traces()] == ["command-4", "command-3", "command-2"]
+    assert [trace["name"] for trace in tracer.export(limit=2)] == ["command-4", "command-3"]
+
+    tracer.capacity = 2
+    assert [trace.name for trace in tracer.traces()] == ["command-4", "command-3"]
+
+def test_stage_latencies():
+    tracer = Tracer()
+    for duration in (0.001, 0.002, 0.003):
+        trace = tracer.start_trace("next_task", "ws", started_at=0.0)
+        trace.add_span("display.update", 1.0, 1.0 + duration)
+        trace.add_span("custom", 0.0, 0.001)
+        trace.add_span("ws.queue", 0.0, duration * 2)
+
+    stages = tracer.stage_latencies()
+    assert list(stages) == ["ws.queue", "display.update", "custom"]  # Known stages first, in order
+    display = stages["display.update"]
+    assert display["count"] == 3
+    assert round(display["mean_ms"], 6) == 2.0
+    assert round(display["p50_ms"], 6) == 2.0 and round(display["max_ms"], 6) == 3.0
+    assert tracer.stage_latencies(limit=1)["ws.queue"]["count"] == 1
+
+def test_debug_traces_endpoint(monkeypatch):
+    tracer = Tracer()
+    monkeypatch.setattr(fastapi_server, "tracer", tracer)
+    client = TestClient(fastapi_server.app)
+
+    response = client.post("/debug/memory/evict", headers={"X-Trace-Id": "cloud-1"})
+    assert response.headers["X-Trace-Id"] == "cloud-1"
+    client.get("/debug/traces")  # GET requests are not traced
+
+    body = client.get("/debug/traces", params={"limit": 5}).json()
+    assert body["sample_rate"] == 1.0
+    assert list(body["stages"]) == ["rest.handler"]
+    [trace] = body["traces"]
+    assert trace["trace_id"] == "cloud-1"
+    assert trace["name"] == "POST /debug/memory/evict" and trace["source"] == "rest"
+    assert [span["name"] for span in trace["spans"]] == ["rest.handler"]
+    assert trace["spans"][0]["attributes"] == {"status": 200}
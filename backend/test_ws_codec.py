@@ -0,0 +1,54 @@
+"""
+test_ws_codec.py
+
+The MessagePack codec must send known field names, message types and
+commands as their fixed ids, unknown names as strings, and decode every
+message back to what was encoded.
+"""
+
+import pytest
+
+import ws_protocol
+from ws_protocol import COMMAND_IDS, FIELD_IDS, MESSAGE_TYPE_IDS, JsonCodec, MsgpackCodec
+
+msgpack = pytest.importorskip("msgpack")
+
+def unpack(frame):
+    """Decode a frame without expanding the ids."""
+    return msgpack.unpackb(frame, raw=False, strict_map_key=False)
+
+def test_every_field_round_trips_with_its_id():
+    codec = MsgpackCodec()
+    data = {key: f"value-{key}" for key in FIELD_IDS if key not in ("type", "command")}
+    data["targets"] = {"anna": {"is_active": True, "current_task": {"id": 1, "name": "Bath"}}}
+    data["nickname"] = "unknown keys are sent as strings"
+    message = {"type": ws_protocol.STATUS_DELTA, "seq": 8, "data": data}
+
+    frame = codec.encode(message)
+    assert codec.decode(frame) == message
+
+    raw = unpack(frame)
+    assert raw[0] == MESSAGE_TYPE_IDS[ws_protocol.STATUS_DELTA] and raw[1] == 8
+    assert raw[3][19] == {"anna": {5: True, 6: {8: 1, 9: "Bath"}}}  # "targets", target ids stay strings
+    assert sorted(key for key in raw[3] if isinstance(key, int)) == \
+        sorted(FIELD_IDS[key] for key in data if key in FIELD_IDS)
+    assert raw[3]["nickname"] == data["nickname"]
+
+def test_every_message_type_and_command_round_trips():
+    codec = MsgpackCodec()
+    for message_type, type_id in MESSAGE_TYPE_IDS.items():
+        assert unpack(codec.encode({"type": message_type}))[0] == type_id
+        assert codec.decode(codec.encode({"type": message_type})) == {"type": message_type}
+    for command, command_id in COMMAND_IDS.items():
+        message = {"type": ws_protocol.COMMAND, "command": command, "data": {}}
+        assert unpack(codec.encode(message))[2] == command_id
+        assert codec.decode(codec.encode(message)) == message
+
+    unknown = {"type": "hello", "command": "dance"}
+    assert codec.decode(codec.encode(unknown)) == unknown
+
+def test_text_frames_and_invalid_frames():
+    codec = MsgpackCodec()
+    assert codec.decode(JsonCodec().encode({"type": "ack", "seq": 3})) == {"type": "ack", "seq": 3}
+    with pytest.raises(ValueError):
+        codec.decode(b"\xc1")
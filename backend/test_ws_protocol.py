@@ -0,0 +1,99 @@
+"""
+test_ws_protocol.py
+
+The hub must rebuild a device's status from snapshots and deltas, ask for
+a resync when a message was missed, and process replayed or duplicate
+messages only once.
+"""
+
+from ws_protocol import STATUS, STATUS_DELTA, StatusTracker, apply_status_delta, diff_status
+
+def status(seq, data, message_id=None):
+    message = {"type": STATUS, "seq": seq, "data": data}
+    if message_id is not None:
+        message["id"] = message_id
+    return message
+
+def delta(seq, base, data):
+    return {"type": STATUS_DELTA, "seq": seq, "base": base, "data": data}
+
+def test_diff_and_apply_round_trip():
+    base = {"is_active": False, "current_task": None, "current_sound": None}
+    current = {"is_active": True, "current_task": {"id": 1}, "current_sound": None}
+    changes = diff_status(base, current)
+    assert changes == {"is_active": True, "current_task": {"id": 1}}
+    assert apply_status_delta(base, changes) == current
+    assert base["is_active"] is False  # The base is not modified
+
+def test_targets_are_diffed_per_target():
+    anna = {"is_active": False, "current_task": None, "current_sound": None}
+    ben = {"is_active": True, "current_task": {"id": 2}, "current_sound": "bath.mp3"}
+    base = {"is_active": False, "targets": {"anna": anna, "ben": ben}}
+    current = {"is_active": False, "targets": {"anna": dict(anna, is_active=True),
+                                               "cleo": dict(anna)}}
+    changes = diff_status(base, current)
+    assert changes == {"targets": {"anna": {"is_active": True}, "ben": None, "cleo": anna}}
+    assert apply_status_delta(base, changes) == current
+    assert diff_status(current, current) == {}
+
+    # Removing the last target removes the field
+    without_targets = {"is_active": False}
+    assert diff_status(current, without_targets) == {"targets": {"anna": None, "cleo": None}}
+    assert apply_status_delta(current, diff_status(current, without_targets)) == without_targets
+
+def test_in_order_delta_is_applied():
+    tracker = StatusTracker()
+    assert tracker.apply(status(1, {"is_active": False, "current_task": None}))
+    assert tracker.apply(delta(2, 1, {"is_active": True}))
+    # Relative to the last acknowledged status, not the last received one
+    assert tracker.apply(delta(3, 1, {"current_task": {"id": 1}}))
+    assert tracker.status == {"is_active": False, "current_task": {"id": 1}}
+    assert tracker.last_seq == 3
+
+def test_gap_requires_a_resync():
+    tracker = StatusTracker()
+    tracker.apply(status(1, {"is_active": False}))
+    assert not tracker.apply(delta(3, 1, {"is_active": True}))  # seq 2 was lost
+    assert tracker.status == {"is_active": False}
+    assert not tracker.apply(delta(4, 99, {"is_active": True}))  # Unknown base
+    # The full snapshot the device sends on resync restores it
+    assert tracker.apply(status(5, {"is_active": True}))
+    assert tracker.apply(delta(6, 5, {"current_sound": "book.mp3"}))
+    assert tracker.status == {"is_active": True, "current_sound": "book.mp3"}
+
+def test_gap_in_other_messages_requires_a_resync():
+    tracker = StatusTracker()
+    tracker.apply(status(1, {"is_active": False}))
+    assert tracker.observe(2)
+    assert not tracker.observe(4)
+    assert tracker.observe(None)
+
+def test_duplicates_are_not_applied_again():
+    tracker = StatusTracker()
+    tracker.apply(status(1, {"current_task_index": 0}))
+    assert tracker.apply(delta(2, 1, {"current_task_index": 1}))
+    assert tracker.apply(delta(2, 1, {"current_task_index": 5}))  # Same seq again
+    assert tracker.status == {"current_task_index": 1}
+
+    assert not tracker.is_duplicate({"id": 7})
+    assert tracker.is_duplicate({"id": 7})
+    assert tracker.is_duplicate({"id": 3})
+    assert not tracker.is_duplicate({"type": STATUS})  # Without an outbox id
+
+def test_batch_applies_its_latest_new_snapshot():
+    tracker = StatusTracker(last_id=2)
+    fresh = tracker.apply_batch({"type": "batch", "seq": 10, "messages": [
+        status(None, {"current_task_index": 0}, message_id=2),  # Processed on an earlier connection
+        {"type": "event", "id": 3},
+        status(None, {"current_task_index": 4}, message_id=4),
+    ]})
+    assert [m["id"] for m in fresh] == [3, 4]
+    assert tracker.status == {"current_task_index": 4}
+    assert tracker.last_seq == 10 and tracker.last_id == 4
+    # Deltas continue from the batch
+    assert tracker.apply(delta(11, 10, {"current_task_index": 5}))
+    assert tracker.status == {"current_task_index": 5}
+
+    # A batch with nothing new only advances the sequence
+    assert tracker.apply_batch({"type": "batch", "seq": 12, "messages": [status(None, {}, message_id=4)]}) == []
+    assert tracker.status == {"current_task_index": 5} and tracker.last_seq == 12
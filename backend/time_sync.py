@@ -0,0 +1,81 @@
+"""
+time_sync.py
+
+This module estimates the offset between the hub's clock and the device's
+clock over the WebSocket connection, NTP-style, so commands carrying an
+"execute_at" time can run at the same moment on every device.
+
+A probe records the device time t0 when it is sent; the hub answers with
+the time t1 it received the probe and the time t2 it sent the answer; the
+device notes the time t3 the answer arrived. Assuming the delay is the same
+both ways:
+
+    offset = ((t1 - t0) + (t2 - t3)) / 2    (hub clock - device clock)
+    rtt    = (t3 - t0) - (t2 - t1)
+
+The error of a sample is at most rtt / 2, and samples delayed by queueing
+have the larger RTTs. Like NTP's clock filter, only the recent samples with
+the lowest RTTs are used: the offset is the mean of the better half of
+them, which also averages out jitter that delays both directions alike.
+"""
+
+from collections import deque
+from typing import Any, Dict, Optional
+
+import ws_protocol
+
+class TimeSync:
+    """Offset of the server clock from the device clock, from recent probe exchanges."""
+
+    def __init__(self, window: int = 8):
+        """
+        Args:
+            window: Recent samples kept; the offset is the mean of the half
+                with the lowest RTTs. A short window follows clock drift and
+                route changes sooner
+        """
+        self.samples: deque = deque(maxlen=window)  # (rtt, offset)
+
+    @staticmethod
+    def probe(now: float) -> Dict[str, Any]:
+        """Get a probe message, sent at device time now."""
+        return {"type": ws_protocol.TIME_SYNC, "t0": now}
+
+    @staticmethod
+    def answer(probe: Dict[str, Any], received_at: float, now: float) -> Dict[str, Any]:
+        """Get the server's answer to a probe received at received_at and answered at now (server times)."""
+        return {"type": ws_protocol.TIME_SYNC, "t0": probe.get("t0"), "t1": received_at, "t2": now}
+
+    def add(self, answer: Dict[str, Any], received_at: float) -> bool:
+        """
+        Add the sample of a probe answer received at device time received_at.
+
+        Returns:
+            False if the answer is malformed or impossible (a negative RTT)
+        """
+        try:
+            t0, t1, t2 = float(answer["t0"]), float(answer["t1"]), float(answer["t2"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        rtt = (received_at - t0) - (t2 - t1)
+        if rtt < 0:
+            return False
+        self.samples.append((rtt, ((t1 - t0) + (t2 - received_at)) / 2))
+        return True
+
+    @property
+    def offset(self) -> Optional[float]:
+        """Server clock minus device clock in seconds, or None before the first sample."""
+        if not self.samples:
+            return None
+        best = sorted(self.samples)[:(len(self.samples) + 1) // 2]
+        return sum(offset for _, offset in best) / len(best)
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """Lowest round-trip time of the recent samples."""
+        return min(self.samples)[0] if self.samples else None
+
+    def to_local(self, server_time: float) -> float:
+        """Convert a server time to device time (unchanged before the first sample)."""
+        return server_time - (self.offset or 0.0)
@@ -0,0 +1,6 @@
+"""
+Development tools for the RoutineCloud backend: benchmarks, simulators and
+test harnesses. Run them as modules from the backend directory, e.g.
+
+    python -m tools.codec_bench
+"""
@@ -0,0 +1,238 @@
+"""
+api_bench.py
+
+Load and latency benchmark of the REST API. By default it drives the FastAPI
+app in-process through httpx's ASGI transport, so no server is needed and the
+numbers show the cost of the handlers themselves. --socket runs the app under
+uvicorn on a local port instead (in a separate thread), and --url targets an
+already running server.
+
+Each scenario is run with a number of concurrent clients and reports
+throughput and p50/p90/p99 latency. Results can be written as JSON and
+compared against an earlier run; latency or throughput changes beyond a
+threshold are flagged as regressions (and make the exit code non-zero).
+
+Usage:
+    python -m tools.api_bench [--requests N] [--concurrency 1,8,32] [--scenario status ...]
+                              [--socket | --url URL] [--json results.json]
+                              [--baseline old.json] [--threshold 0.2]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from tools.stats import summarize
+
+# Requests issued by each scenario, cycled until the request budget is spent
+SCENARIOS: Dict[str, List[Tuple[str, str]]] = {
+    "status": [("GET", "/status")],
+    "tasks": [("GET", "/tasks")],
+    "routine": [
+        ("POST", "/routine/start"),
+        ("POST", "/routine/next"),
+        ("POST", "/sound/play/book.mp3"),
+        ("POST", "/routine/next"),
+        ("POST", "/routine/stop"),
+    ],
+    # Mostly reads, as when the app polls while a parent taps through the routine
+    "mixed": [("GET", "/status")] * 6 + [("GET", "/tasks")] * 2 + [
+        ("POST", "/routine/start"), ("POST", "/routine/next")],
+}
+
+# Relative changes against the baseline that count as regressions
+LATENCY_KEYS = ("p50_ms", "p99_ms")
+
+async def run_scenario(client: httpx.AsyncClient, requests: Sequence[Tuple[str, str]],
+                       total: int, concurrency: int) -> Dict[str, Any]:
+    """
+    Issue total requests from concurrency workers and measure them.
+
+    Responses with a 5xx status or a transport error count as errors;
+    4xx responses (e.g. /routine/next without an active routine) are valid
+    answers of the API.
+    """
+    cycle = itertools.cycle(requests)
+    remaining = total
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, path = next(cycle)
+            started_at = time.perf_counter()
+            try:
+                response = await client.request(method, path)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started_at)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            if response.status_code >= 500:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        **summarize(latencies),
+    }
+
+class SocketServer:
+    """Runs the app under uvicorn on a free local port, in its own thread and event loop."""
+
+    def __init__(self, app, host: str = "127.0.0.1"):
+        import uvicorn
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=0, log_level="warning"))
+        self.host = host
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f"http://{self.host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("uvicorn failed to start")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.should_exit = True
+        self.thread.join()
+
+def make_client(mode: str, base_url: Optional[str] = None) -> httpx.AsyncClient:
+    """Create the HTTP client for a benchmark mode ("asgi" or a server URL)."""
+    limits = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+    if mode == "asgi":
+        from fastapi_server import app
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=30)
+    return httpx.AsyncClient(base_url=base_url, timeout=30, limits=limits)
+
+async def run(scenarios: Sequence[str], total: int, concurrencies: Sequence[int],
+              mode: str = "asgi", base_url: Optional[str] = None, warmup: int = 50) -> Dict[str, Any]:
+    """Run every scenario at every concurrency level."""
+    results: Dict[str, Any] = {
+        "mode": mode,
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "scenarios": {},
+    }
+    async with make_client(mode, base_url) as client:
+        for name in scenarios:
+            requests = SCENARIOS[name]
+            await run_scenario(client, requests, warmup, 1)
+            results["scenarios"][name] = {
+                str(concurrency): await run_scenario(client, requests, total, concurrency)
+                for concurrency in concurrencies
+            }
+    return results
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Compare a run with a baseline run.
+
+    Returns:
+        One message per regression: a latency percentile grew, or throughput
+        dropped, by more than threshold (a fraction, e.g. 0.2 for 20%)
+    """
+    regressions = []
+    for name, levels in results["scenarios"].items():
+        for concurrency, current in levels.items():
+            old = baseline.get("scenarios", {}).get(name, {}).get(concurrency)
+            if old is None:
+                continue
+            for key in LATENCY_KEYS:
+                if old.get(key) and current.get(key) and current[key] > old[key] * (1 + threshold):
+                    regressions.append(f"{name} c={concurrency}: {key} {old[key]} -> {current[key]}")
+            if old.get("throughput_rps") and current.get("throughput_rps") and \
+                    current["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+                regressions.append(f"{name} c={concurrency}: throughput_rps "
+                                   f"{old['throughput_rps']} -> {current['throughput_rps']}")
+            if current["errors"] > old.get("errors", 0):
+                regressions.append(f"{name} c={concurrency}: errors {old.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+def print_table(results: Dict[str, Any]):
+    """Print the results as a table."""
+    header = f"{'scenario':<10} {'conc':>5} {'req/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}"
+    print(f"mode: {results['mode']}")
+    print(header)
+    print("-" * len(header))
+    for name, levels in results["scenarios"].items():
+        for concurrency, r in levels.items():
+            cells = [r[key] if r[key] is not None else "-"
+                     for key in ("throughput_rps", "p50_ms", "p90_ms", "p99_ms", "max_ms")]
+            print(f"{name:<10} {concurrency:>5} {cells[0]:>9} {cells[1]:>8} {cells[2]:>8} "
+                  f"{cells[3]:>8} {cells[4]:>8} {r['errors']:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the REST API")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="Requests per scenario and concurrency level (default: 2000)")
+    parser.add_argument("--concurrency", default="1,8,32",
+                        help="Comma-separated numbers of concurrent clients (default: 1,8,32)")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run, may be repeated (default: all)")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--socket", action="store_true",
+                        help="Serve the app with uvicorn on a local port instead of in-process")
+    target.add_argument("--url", help="Benchmark an already running server, e.g. http://raspberrypi:8000")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file")
+    parser.add_argument("--baseline", help="Earlier JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative change counted as a regression (default: 0.2)")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+
+    if args.url:
+        results = asyncio.run(run(scenarios, args.requests, concurrencies, "url", args.url))
+    elif args.socket:
+        from fastapi_server import app
+        with SocketServer(app) as server:
+            results = asyncio.run(run(scenarios, args.requests, concurrencies, "socket", server.url))
+    else:
+        results = asyncio.run(run(scenarios, args.requests, concurrencies))
+
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("mode") != results["mode"]:
+            print(f"Note: baseline was run in {baseline.get('mode')} mode, this run in {results['mode']} mode")
+        regressions = compare(baseline, results, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
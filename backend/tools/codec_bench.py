@@ -0,0 +1,118 @@
+"""
+codec_bench.py
+
+Benchmark of the WebSocket wire codecs: bytes on the wire (raw and with
+permessage-deflate as negotiated by ws_client) and encode/decode time for
+each message type of the device protocol.
+
+Usage:
+    python -m tools.codec_bench [--iterations N] [--json results.json]
+"""
+
+import argparse
+import json
+import sys
+import timeit
+import zlib
+from typing import Any, Dict, List
+
+import ws_protocol
+
+TASK = {"id": 2, "name": "Put on Pajamas", "icon_name": "shirt", "sound": "pajamas.mp3", "duration": 180}
+
+SAMPLE_MESSAGES = {
+    "command.start_routine": {"type": "command", "command": "start_routine", "data": {}},
+    "command.next_task": {"type": "command", "command": "next_task", "data": {}},
+    "command.stop_routine": {"type": "command", "command": "stop_routine", "data": {}},
+    "command.play_sound": {"type": "command", "command": "play_sound", "data": {"sound_name": "book.mp3"}},
+    "command.select_routine": {"type": "command", "command": "select_routine", "data": {"routine_id": 3}},
+    "status": {"type": "status", "seq": 1041, "data": {
+        "is_active": True, "current_task": TASK, "current_sound": "pajamas.mp3"}},
+    "status_delta": {"type": "status_delta", "seq": 1042, "base": 1041, "data": {
+        "current_task": TASK, "current_sound": "pajamas.mp3"}},
+    "ack": {"type": "ack", "seq": 1042},
+    "resync": {"type": "resync"},
+}
+
+# Matches WebSocketClient._deflate_extension
+DEFLATE_WINDOW_BITS = 11
+DEFLATE_MEM_LEVEL = 4
+
+def encode_bytes(codec, message: Dict[str, Any]) -> bytes:
+    frame = codec.encode(message)
+    return frame.encode("utf-8") if isinstance(frame, str) else frame
+
+def deflated_sizes(codec, message: Dict[str, Any], repetitions: int) -> List[int]:
+    """
+    Sizes of a message sent repeatedly through one permessage-deflate stream
+    with context takeover (the trailing 00 00 ff ff is not sent). Sequence
+    numbers advance between repetitions, as they do on a real connection.
+    """
+    compressor = zlib.compressobj(wbits=-DEFLATE_WINDOW_BITS, memLevel=DEFLATE_MEM_LEVEL)
+    sizes = []
+    for i in range(repetitions):
+        repeated = dict(message)
+        if "seq" in repeated:
+            repeated["seq"] += i
+        frame = encode_bytes(codec, repeated)
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        sizes.append(len(data) - 4)
+    return sizes
+
+def benchmark_codec(codec, message: Dict[str, Any], iterations: int) -> Dict[str, Any]:
+    """Measure one codec on one message."""
+    frame = codec.encode(message)
+    frame_bytes = encode_bytes(codec, message)
+    assert codec.decode(frame) == message, "codec round trip changed the message"
+
+    sizes = deflated_sizes(codec, message, 20)
+    encode_time = min(timeit.repeat(lambda: codec.encode(message), number=iterations, repeat=3))
+    decode_time = min(timeit.repeat(lambda: codec.decode(frame), number=iterations, repeat=3))
+    return {
+        "bytes": len(frame_bytes),
+        "deflate_first_bytes": sizes[0],
+        "deflate_steady_bytes": sum(sizes[1:]) / (len(sizes) - 1),
+        "encode_us": encode_time / iterations * 1e6,
+        "decode_us": decode_time / iterations * 1e6,
+    }
+
+def run(iterations: int) -> Dict[str, Dict[str, Any]]:
+    """Benchmark every available codec on every sample message."""
+    results = {}
+    for codec in ws_protocol.available_codecs():
+        name = codec.subprotocol or "json"
+        results[name] = {
+            message_type: benchmark_codec(codec, message, iterations)
+            for message_type, message in SAMPLE_MESSAGES.items()
+        }
+    return results
+
+def print_table(results: Dict[str, Dict[str, Any]]):
+    """Print the results as a table."""
+    header = f"{'codec':<20} {'message':<24} {'bytes':>6} {'defl.1st':>9} {'defl.avg':>9} {'enc us':>8} {'dec us':>8}"
+    print(header)
+    print("-" * len(header))
+    for codec_name, messages in results.items():
+        for message_type, r in messages.items():
+            print(f"{codec_name:<20} {message_type:<24} {r['bytes']:>6} {r['deflate_first_bytes']:>9} "
+                  f"{r['deflate_steady_bytes']:>9.1f} {r['encode_us']:>8.2f} {r['decode_us']:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the WebSocket wire codecs")
+    parser.add_argument("--iterations", type=int, default=20000,
+                        help="Encode/decode calls per measurement (default: 20000)")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if ws_protocol.msgpack is None:
+        print("msgpack is not installed, only the JSON codec is benchmarked", file=sys.stderr)
+
+    results = run(args.iterations)
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
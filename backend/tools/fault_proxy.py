@@ -0,0 +1,227 @@
+"""
+fault_proxy.py
+
+Network fault-injection proxy for testing the device WebSocket client, the
+hub and the REST API over a bad link.
+
+The proxy forwards TCP connections to a target and injects configurable
+latency, jitter, bandwidth caps, stalls, abrupt resets and blackholes (a
+link that silently stops delivering, leaving both sockets half-open). Faults
+can be changed while connections are open.
+
+Usage:
+    python -m tools.fault_proxy --listen 127.0.0.1:9000 --target 127.0.0.1:3000 \\
+        --latency 0.2 --jitter 0.05 --bandwidth 20000 --stall-rate 0.01 --reset-rate 0.001
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 16384
+
+@dataclass
+class FaultConfig:
+    """Faults applied to every chunk forwarded in either direction."""
+    latency: float = 0.0  # Seconds added to every chunk
+    jitter: float = 0.0  # Seconds, uniformly distributed +/- around the latency
+    bandwidth: Optional[float] = None  # Bytes per second per direction, None for unlimited
+    stall_rate: float = 0.0  # Probability per chunk of a stall
+    stall_duration: float = 1.0  # Seconds a stall holds back the link
+    reset_rate: float = 0.0  # Probability per chunk of an abrupt reset
+    blackhole: bool = False  # Silently drop everything
+
+class _Link:
+    """One proxied connection: a client socket and the matching target socket."""
+
+    def __init__(self, proxy: "FaultProxy", client: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                 target: Tuple[asyncio.StreamReader, asyncio.StreamWriter]):
+        self.proxy = proxy
+        self.client_reader, self.client_writer = client
+        self.target_reader, self.target_writer = target
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        for reader, writer in ((self.client_reader, self.target_writer), (self.target_reader, self.client_writer)):
+            queue: asyncio.Queue = asyncio.Queue()
+            self.tasks.append(asyncio.create_task(self._read(reader, queue)))
+            self.tasks.append(asyncio.create_task(self._write(writer, queue)))
+
+    def reset(self):
+        """Abort both sockets without a TCP FIN, like a dropped link."""
+        for writer in (self.client_writer, self.target_writer):
+            writer.transport.abort()
+        for task in self.tasks:
+            task.cancel()
+
+    async def _read(self, reader: asyncio.StreamReader, queue: asyncio.Queue):
+        config = self.proxy.config
+        rng = self.proxy.rng
+        deliver_at = 0.0
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    await queue.put((0.0, None))
+                    return
+                if config.blackhole:
+                    continue
+                if config.reset_rate and rng.random() < config.reset_rate:
+                    self.proxy.resets += 1
+                    self.reset()
+                    return
+
+                now = time.monotonic()
+                delay = max(0.0, config.latency + rng.uniform(-config.jitter, config.jitter))
+                if config.stall_rate and rng.random() < config.stall_rate:
+                    self.proxy.stalls += 1
+                    delay += config.stall_duration
+                # Keep the byte stream in order and apply the bandwidth cap
+                deliver_at = max(deliver_at, now + delay)
+                if config.bandwidth:
+                    deliver_at += len(data) / config.bandwidth
+                await queue.put((deliver_at, data))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def _write(self, writer: asyncio.StreamWriter, queue: asyncio.Queue):
+        try:
+            while True:
+                deliver_at, data = await queue.get()
+                if data is None:
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    else:
+                        writer.close()
+                    return
+                delay = deliver_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.proxy.config.blackhole:
+                    continue
+                writer.write(data)
+                self.proxy.bytes_forwarded += len(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+class FaultProxy:
+    """
+    TCP proxy injecting network faults between clients and a target server.
+    """
+
+    def __init__(self, target_host: str, target_port: int, listen_host: str = "127.0.0.1",
+                 listen_port: int = 0, config: Optional[FaultConfig] = None, seed: Optional[int] = None):
+        """
+        Initialize the proxy.
+
+        Args:
+            target_host: Host to forward connections to
+            target_port: Port to forward connections to
+            listen_host: Interface to listen on
+            listen_port: Port to listen on (0 picks a free port)
+            config: Faults to inject (can be replaced or modified at any time)
+            seed: Seed for the random fault decisions
+        """
+        self.target_host = target_host
+        self.target_port = target_port
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.config = config or FaultConfig()
+        self.rng = random.Random(seed)
+        self.links: Set[_Link] = set()
+        self.connections = 0
+        self.resets = 0
+        self.stalls = 0
+        self.bytes_forwarded = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        """Start accepting connections."""
+        self._server = await asyncio.start_server(self._handle_client, self.listen_host, self.listen_port)
+        self.listen_port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Fault proxy {self.listen_host}:{self.listen_port} -> {self.target_host}:{self.target_port}")
+
+    async def stop(self):
+        """Stop accepting connections and reset the open ones."""
+        self.reset_all()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def address(self) -> str:
+        return f"{self.listen_host}:{self.listen_port}"
+
+    def reset_all(self):
+        """Abruptly reset every open connection."""
+        for link in list(self.links):
+            link.reset()
+        self.resets += len(self.links)
+        self.links.clear()
+
+    def set_blackhole(self, enabled: bool):
+        """Start or stop silently dropping all traffic of open and new connections."""
+        self.config.blackhole = enabled
+
+    async def _handle_client(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        try:
+            target = await asyncio.open_connection(self.target_host, self.target_port)
+        except OSError as e:
+            logger.warning(f"Cannot reach target: {e}")
+            client_writer.transport.abort()
+            return
+
+        self.connections += 1
+        link = _Link(self, (client_reader, client_writer), target)
+        self.links.add(link)
+        link.start()
+        await asyncio.gather(*link.tasks, return_exceptions=True)
+        self.links.discard(link)
+        for writer in (client_writer, target[1]):
+            writer.close()
+
+def parse_address(value: str) -> Tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description="TCP proxy injecting network faults")
+    parser.add_argument("--listen", default="127.0.0.1:9000", help="host:port to listen on (default: 127.0.0.1:9000)")
+    parser.add_argument("--target", required=True, help="host:port to forward to")
+    parser.add_argument("--latency", type=float, default=0.0, help="Added latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency jitter in seconds")
+    parser.add_argument("--bandwidth", type=float, help="Bandwidth cap in bytes per second per direction")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Probability per chunk of a stall")
+    parser.add_argument("--stall-duration", type=float, default=1.0, help="Stall duration in seconds")
+    parser.add_argument("--reset-rate", type=float, default=0.0, help="Probability per chunk of a reset")
+    parser.add_argument("--seed", type=int, help="Random seed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    listen_host, listen_port = parse_address(args.listen)
+    target_host, target_port = parse_address(args.target)
+    config = FaultConfig(args.latency, args.jitter, args.bandwidth, args.stall_rate,
+                         args.stall_duration, args.reset_rate)
+
+    async def run():
+        proxy = FaultProxy(target_host, target_port, listen_host, listen_port, config, args.seed)
+        await proxy.start()
+        await asyncio.Future()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+fleet_sim.py
+
+Fleet simulator and load generator for the device WebSocket protocol.
+
+Runs many virtual devices (WebSocketClient instances with their own
+RoutineState) in one process, drives them through scripted routines and
+randomly drops their connections. It reports command round-trip latency,
+reconnect times and message rates.
+
+By default an in-process reference hub is started; pass --hub-url and
+--api-url to load any hub that offers the hub REST facade.
+
+Usage:
+    python -m tools.fleet_sim --devices 1000 --duration 60
+    python -m tools.fleet_sim --hub-url ws://hub:3000/ws --api-url http://hub:8080
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+from outbox import MemoryOutbox
+from routine_state import RoutineState
+from tools.stats import summarize
+from ws_client import WebSocketClient
+
+# A routine as the driver plays it: command and pause before the next one
+ROUTINE_SCRIPT = [("start_routine", 1.0), ("next_task", 1.0), ("next_task", 1.0),
+                  ("play_sound", 0.5), ("next_task", 1.0), ("next_task", 1.0)]
+
+class FleetMetrics:
+    """Measurements shared by all virtual devices."""
+
+    def __init__(self):
+        self.command_sent_at: Dict[str, float] = {}  # Device id -> send time of the pending command
+        self.command_rtts: List[float] = []  # Command sent -> status acknowledged
+        self.command_latencies: List[float] = []  # Command sent -> handled on the device
+        self.reconnect_times: List[float] = []
+        self.messages_sent = 0
+        self.messages_received = 0
+
+class VirtualDevice(WebSocketClient):
+    """
+    A WebSocketClient with its own in-memory state and outbox that records
+    latency and reconnect measurements.
+    """
+
+    def __init__(self, server_url: str, device_id: str, metrics: FleetMetrics, **kwargs):
+        super().__init__(server_url, device_id=device_id, state=RoutineState.standalone(),
+                         outbox=MemoryOutbox(max_messages=16), **kwargs)
+        self.metrics = metrics
+        self._handled_at: Optional[float] = None
+        self._dropped_at: Optional[float] = None
+        for command, handler in list(self.command_handlers.items()):
+            self.command_handlers[command] = self._measured(handler)
+
+    def _measured(self, handler):
+        async def measured_handler(data):
+            await handler(data)
+            sent_at = self.metrics.command_sent_at.pop(self.device_id, None)
+            if sent_at is not None:
+                self.metrics.command_latencies.append(time.perf_counter() - sent_at)
+                self._handled_at = sent_at
+        return measured_handler
+
+    async def connect(self):
+        connected = await super().connect()
+        if connected and self._dropped_at is not None:
+            self.metrics.reconnect_times.append(time.perf_counter() - self._dropped_at)
+            self._dropped_at = None
+        return connected
+
+    async def _send_message(self, message, outbox_ids=None):
+        sent = await super()._send_message(message, outbox_ids)
+        if sent:
+            self.metrics.messages_sent += 1
+        return sent
+
+    async def _handle_message(self, message_str):
+        self.metrics.messages_received += 1
+        await super()._handle_message(message_str)
+
+    def _handle_ack(self, seq: int):
+        super()._handle_ack(seq)
+        # The first ack after a command covers the status it produced
+        if self._handled_at is not None and not self._status_flush:
+            self.metrics.command_rtts.append(time.perf_counter() - self._handled_at)
+            self._handled_at = None
+
+    def drop_connection(self):
+        """Abort the connection abruptly, as a Wi-Fi dropout would."""
+        if self.websocket is not None and self.connected:
+            self._dropped_at = time.perf_counter()
+            self.websocket.transport.abort()
+
+class FleetSimulator:
+    """Runs virtual devices against a hub and drives them with routines."""
+
+    def __init__(self, devices: int, hub_url: Optional[str] = None, api_url: Optional[str] = None,
+                 disconnect_rate: float = 0.01, ramp_up: float = 5.0, seed: int = 1,
+                 heartbeat_interval: float = 3, coalesce_window: float = 0.05):
+        """
+        Initialize the simulator.
+
+        Args:
+            devices: Number of virtual devices
+            hub_url: WebSocket URL of the hub (None starts an in-process hub)
+            api_url: REST URL of the hub, used to send commands to a remote hub
+            disconnect_rate: Probability per device and second of a dropped connection
+            ramp_up: Seconds over which the devices connect
+            seed: Seed of the random disconnect and scheduling decisions
+            heartbeat_interval: Heartbeat interval of the devices
+            coalesce_window: Status coalescing window of the devices
+        """
+        self.device_count = devices
+        self.hub_url = hub_url
+        self.api_url = api_url
+        self.disconnect_rate = disconnect_rate
+        self.ramp_up = ramp_up
+        self.rng = random.Random(seed)
+        self.heartbeat_interval = heartbeat_interval
+        self.coalesce_window = coalesce_window
+        self.metrics = FleetMetrics()
+        self.devices: List[VirtualDevice] = []
+        self.hub = None
+        self._http = None
+
+    async def run(self, duration: float) -> Dict[str, object]:
+        """Run the simulation and return the report."""
+        if self.hub_url is None:
+            from hub import Hub
+            self.hub = Hub("127.0.0.1", 0)
+            await self.hub.start()
+            self.hub_url = self.hub.url
+        elif self.api_url is not None:
+            import httpx
+            self._http = httpx.AsyncClient(base_url=self.api_url, timeout=10)
+
+        tasks = []
+        try:
+            for i in range(self.device_count):
+                device = VirtualDevice(self.hub_url, f"sim-{i:05d}", self.metrics,
+                                       heartbeat_interval=self.heartbeat_interval,
+                                       coalesce_window=self.coalesce_window)
+                self.devices.append(device)
+                tasks.append(asyncio.create_task(device.run()))
+                await asyncio.sleep(self.ramp_up / self.device_count)
+
+            connect_deadline = time.perf_counter() + 10
+            while sum(d.connected for d in self.devices) < self.device_count and time.perf_counter() < connect_deadline:
+                await asyncio.sleep(0.1)
+            connected = sum(d.connected for d in self.devices)
+
+            self.metrics.messages_sent = self.metrics.messages_received = 0
+            started = time.perf_counter()
+            drivers = [asyncio.create_task(self._drive(device, started + duration)) for device in self.devices]
+            chaos = asyncio.create_task(self._chaos(started + duration))
+            await asyncio.gather(*drivers, chaos)
+            elapsed = time.perf_counter() - started
+        finally:
+            for device in self.devices:
+                device.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self._http is not None:
+                await self._http.aclose()
+            if self.hub is not None:
+                await self.hub.stop()
+
+        metrics = self.metrics
+        return {
+            "devices": self.device_count,
+            "connected_after_ramp_up": connected,
+            "duration_s": round(elapsed, 2),
+            "device_messages_sent_per_s": round(metrics.messages_sent / elapsed, 1),
+            "device_messages_received_per_s": round(metrics.messages_received / elapsed, 1),
+            "command_latency": summarize(metrics.command_latencies),
+            "command_round_trip": summarize(metrics.command_rtts),
+            "reconnect_time": summarize(metrics.reconnect_times),
+            "reconnects": sum(d.reconnects for d in self.devices),
+            "hub": self.hub.stats() if self.hub is not None else None,
+        }
+
+    async def _send(self, device: VirtualDevice, command: str, data: Dict[str, object]):
+        self.metrics.command_sent_at[device.device_id] = time.perf_counter()
+        if self.hub is not None:
+            sent = await self.hub.send_command(device.device_id, command, data)
+        else:
+            response = await self._http.post(f"/devices/{device.device_id}/commands/{command}", json=data)
+            sent = response.status_code == 200
+        if not sent:
+            self.metrics.command_sent_at.pop(device.device_id, None)
+
+    async def _drive(self, device: VirtualDevice, deadline: float):
+        """Play the routine script on one device until the deadline."""
+        await asyncio.sleep(self.rng.uniform(0, ROUTINE_SCRIPT[0][1]))
+        while time.perf_counter() < deadline:
+            for command, pause in ROUTINE_SCRIPT:
+                if time.perf_counter() >= deadline:
+                    return
+                data = {"sound_name": "book.mp3"} if command == "play_sound" else {}
+                await self._send(device, command, data)
+                await asyncio.sleep(pause * self.rng.uniform(0.5, 1.5))
+
+    async def _chaos(self, deadline: float):
+        """Drop random connections at disconnect_rate per device and second."""
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(1)
+            for device in self.devices:
+                if self.rng.random() < self.disconnect_rate:
+                    device.drop_connection()
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of devices against a hub")
+    parser.add_argument("--devices", type=int, default=200, help="Number of virtual devices (default: 200)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to drive routines (default: 30)")
+    parser.add_argument("--hub-url", help="WebSocket URL of the hub (default: start an in-process hub)")
+    parser.add_argument("--api-url", help="REST URL of the hub, required with --hub-url")
+    parser.add_argument("--disconnect-rate", type=float, default=0.01,
+                        help="Dropped connections per device and second (default: 0.01)")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds to connect all devices (default: 5)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--json", dest="json_path", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    if args.hub_url and not args.api_url:
+        parser.error("--api-url is required with --hub-url")
+
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        from hub.__main__ import raise_file_limit
+        raise_file_limit()
+    except (ImportError, ValueError, OSError):
+        pass
+
+    simulator = FleetSimulator(args.devices, args.hub_url, args.api_url, args.disconnect_rate,
+                               args.ramp_up, args.seed)
+    report = asyncio.run(simulator.run(args.duration))
+    print(json.dumps(report, indent=2))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,386 @@
+"""
+simulate.py
+
+Deterministic, accelerated simulation of bedtime routines.
+
+Runs virtual devices (WebSocketClient instances with their own
+RoutineState) against an in-memory hub on a VirtualClock, so a night of
+routines takes as long as the code it exercises. Every device plays
+scripted routines drawn from a seeded random generator: tasks take their
+configured duration scaled by a random factor, some routines get a sound
+played or are stopped early, and some lose the network for a while, which
+exercises the heartbeat, reconnect backoff and outbox replay.
+
+The same seed always produces the same events, summarized by the digest in
+the report. The simulation checks that:
+- every transition is timestamped with the virtual time the command
+  reached the device (code reading the real clock would break this),
+- the status the hub reconstructs converges to the device's state after
+  every routine, also after lost connections.
+
+Usage:
+    python -m tools.simulate --routines 2000 --devices 20 --seed 1
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import ws_protocol
+from clock import VirtualClock
+from outbox import MemoryOutbox
+from routine_state import RoutineState
+from ws_client import WebSocketClient
+
+class SimulatedLink:
+    """
+    One device connection to the SimulatedHub, standing in for the
+    websockets connection used by WebSocketClient.
+
+    A broken link silently drops frames and pings in both directions, like a
+    half-open TCP connection after a Wi-Fi dropout.
+    """
+
+    subprotocol = None  # JSON frames
+
+    def __init__(self, hub: "SimulatedHub", device_id: str):
+        self.hub = hub
+        self.device_id = device_id
+        self.tracker = ws_protocol.StatusTracker()
+        self.closed = False
+        self.broken = False
+        self._incoming: asyncio.Queue = asyncio.Queue()
+
+    async def send(self, frame):
+        if self.closed:
+            raise ConnectionError("Link closed")
+        if not self.broken:
+            self.hub.clock.call_later(self.hub.latency, lambda: self.hub.receive(self, frame))
+
+    async def ping(self) -> asyncio.Future:
+        if self.closed:
+            raise ConnectionError("Link closed")
+        pong = asyncio.get_running_loop().create_future()
+        if not self.broken:
+            self.hub.clock.call_later(2 * self.hub.latency, lambda: pong.done() or pong.set_result(None))
+        return pong
+
+    def deliver(self, frame, on_delivered=None) -> bool:
+        """Hand a frame from the hub to the device. Returns False if the link lost it."""
+        if self.closed or self.broken:
+            return False
+        self._incoming.put_nowait(frame)
+        if on_delivered is not None:
+            on_delivered()
+        return True
+
+    def abort(self):
+        """Close the link, ending the device's receive loop."""
+        if not self.closed:
+            self.closed = True
+            self._incoming.put_nowait(None)
+
+    async def close(self):
+        self.abort()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await self._incoming.get()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+class SimulatedHub:
+    """
+    In-memory hub: reconstructs device statuses like hub.server does, and
+    sends commands, with a fixed one-way latency in virtual time.
+    """
+
+    def __init__(self, clock: VirtualClock, latency: float = 0.02):
+        self.clock = clock
+        self.latency = latency
+        self.codec = ws_protocol.JsonCodec()
+        self.links: Dict[str, SimulatedLink] = {}
+        self.unreachable_until: Dict[str, float] = {}
+        self.deliveries: Dict[str, List[float]] = {}  # Device id -> wall time each command arrived
+        self.commands_lost = 0
+        self.resyncs_requested = 0
+
+    def connect(self, device_id: str) -> Optional[SimulatedLink]:
+        """Open a connection for a device, replacing its previous one, or None while it is cut off."""
+        if self.clock.monotonic() < self.unreachable_until.get(device_id, 0.0):
+            return None
+        previous = self.links.get(device_id)
+        if previous is not None:
+            previous.abort()
+        link = self.links[device_id] = SimulatedLink(self, device_id)
+        return link
+
+    def cut_off(self, device_id: str, outage: float):
+        """Break the device's connection and refuse new ones for outage seconds."""
+        link = self.links.get(device_id)
+        if link is not None:
+            link.broken = True
+        self.unreachable_until[device_id] = self.clock.monotonic() + outage
+
+    def status(self, device_id: str) -> Optional[Dict[str, Any]]:
+        """Get the device's status as reconstructed over its live connection."""
+        link = self.links.get(device_id)
+        if link is None or link.closed or link.broken:
+            return None
+        return link.tracker.status
+
+    def receive(self, link: SimulatedLink, frame):
+        if link.closed or link.broken:
+            return
+        message = self.codec.decode(frame)
+        tracker = link.tracker
+        message_type = message.get("type")
+        if message_type == ws_protocol.BATCH:
+            in_sync = True
+            tracker.apply_batch(message)
+        elif message_type in (ws_protocol.STATUS, ws_protocol.STATUS_DELTA):
+            in_sync = True if tracker.is_duplicate(message) else tracker.apply(message)
+        else:
+            in_sync = tracker.observe(message.get("seq"))
+        if in_sync:
+            reply = {"type": ws_protocol.ACK, "seq": message.get("seq")}
+        else:
+            self.resyncs_requested += 1
+            reply = {"type": ws_protocol.RESYNC}
+        self._send(link, reply)
+
+    def send_command(self, device_id: str, command: str, data: Optional[Dict[str, Any]] = None):
+        """Send a command to the device's current connection (lost if there is none)."""
+        link = self.links.get(device_id)
+        if link is None or link.closed:
+            self.commands_lost += 1
+            return
+        message = {"type": ws_protocol.COMMAND, "command": command, "data": data or {}}
+        deliveries = self.deliveries.setdefault(device_id, [])
+        self._send(link, message, lambda: deliveries.append(self.clock.time()))
+
+    def _send(self, link: SimulatedLink, message: Dict[str, Any], on_delivered=None):
+        frame = self.codec.encode(message)
+
+        def deliver():
+            if not link.deliver(frame, on_delivered) and message["type"] == ws_protocol.COMMAND:
+                self.commands_lost += 1
+
+        self.clock.call_later(self.latency, deliver)
+
+class SimulatedDevice(WebSocketClient):
+    """A WebSocketClient connected to a SimulatedHub instead of a server."""
+
+    def __init__(self, hub: SimulatedHub, device_id: str, clock: VirtualClock, rng: random.Random, **kwargs):
+        kwargs.setdefault("time_sync_interval", None)  # The simulated hub shares the device's clock
+        super().__init__("sim://hub", device_id=device_id, state=RoutineState.standalone(clock),
+                         outbox=MemoryOutbox(max_messages=16), clock=clock, rng=rng, **kwargs)
+        self.hub = hub
+
+    async def connect(self):
+        link = self.hub.connect(self.device_id)
+        if link is None:
+            return False
+        self.websocket = link
+        self._codec = ws_protocol.JsonCodec()
+        self._reset_status_tracking()
+        self.connected = True
+        await self._replay_outbox()
+        return True
+
+class RoutineSimulator:
+    """Plays seeded routine scripts on virtual devices in virtual time and checks the outcome."""
+
+    def __init__(self, routines: int, devices: int = 10, seed: int = 1, fault_rate: float = 0.05,
+                 stop_rate: float = 0.05, sound_rate: float = 0.3, latency: float = 0.02,
+                 heartbeat_interval: float = 30, converge_timeout: float = 600):
+        """
+        Initialize the simulator.
+
+        Args:
+            routines: Number of routines to play, spread over the devices
+            devices: Number of virtual devices playing routines concurrently
+            seed: Seed of all random decisions
+            fault_rate: Probability that a routine loses the network for a while
+            stop_rate: Probability per task that the routine is stopped during it
+            sound_rate: Probability per task that a sound is played during it
+            latency: One-way network latency in seconds
+            heartbeat_interval: Heartbeat interval of the devices (sparser
+                than the devices' 3 s by default: heartbeats are most of
+                the timers, and losses are detected either way)
+            converge_timeout: Virtual seconds the hub's view of a device may
+                take to catch up after a routine
+        """
+        self.routines = routines
+        self.device_count = devices
+        self.seed = seed
+        self.fault_rate = fault_rate
+        self.stop_rate = stop_rate
+        self.sound_rate = sound_rate
+        self.heartbeat_interval = heartbeat_interval
+        self.converge_timeout = converge_timeout
+        self.clock = VirtualClock()
+        self.hub = SimulatedHub(self.clock, latency)
+        self.devices: List[SimulatedDevice] = []
+        self.events: List[Tuple[str, str, Optional[int], float]] = []
+        self.commands = 0
+        self.completed = 0
+        self.stopped = 0
+        self.faults = 0
+        self.timing_errors = 0
+        self.unconverged = 0
+
+    def run(self) -> Dict[str, Any]:
+        """Run the simulation and return the report."""
+        started_at = time.perf_counter()
+        asyncio.run(self.clock.run(self._main()))
+        elapsed = time.perf_counter() - started_at
+        virtual = self.clock.monotonic()
+        return {
+            "seed": self.seed,
+            "devices": self.device_count,
+            "routines": self.completed + self.stopped,
+            "routines_completed": self.completed,
+            "routines_stopped": self.stopped,
+            "commands": self.commands,
+            "virtual_hours": round(virtual / 3600, 1),
+            "wall_s": round(elapsed, 2),
+            "speedup": round(virtual / elapsed) if elapsed else None,
+            "us_per_command": round(elapsed / self.commands * 1e6, 1) if self.commands else None,
+            "timers_fired": self.clock.timers_fired,
+            "us_per_timer": round(elapsed / self.clock.timers_fired * 1e6, 1) if self.clock.timers_fired else None,
+            "faults": self.faults,
+            "reconnects": sum(device.reconnects for device in self.devices),
+            "commands_lost": self.hub.commands_lost,
+            "resyncs_requested": self.hub.resyncs_requested,
+            "timing_errors": self.timing_errors,
+            "unconverged": self.unconverged,
+            "digest": self.digest(),
+        }
+
+    def digest(self) -> str:
+        """Get a hash of all transitions (device, event, task and virtual time)."""
+        h = hashlib.sha256()
+        for device_id, event, task_id, timestamp in self.events:
+            h.update(f"{device_id} {event} {task_id} {timestamp:.6f}\n".encode())
+        return h.hexdigest()[:16]
+
+    async def _main(self):
+        tasks = []
+        drivers = []
+        for i in range(self.device_count):
+            device_id = f"sim-{i:04d}"
+            device = SimulatedDevice(self.hub, device_id, self.clock, random.Random(f"{self.seed}/backoff/{i}"),
+                                     heartbeat_interval=self.heartbeat_interval)
+            device.state.add_listener(self._recorder(device_id))
+            self.devices.append(device)
+            tasks.append(asyncio.ensure_future(device.run()))
+            routines = self.routines // self.device_count + (i < self.routines % self.device_count)
+            drivers.append(self._drive(device, routines, random.Random(f"{self.seed}/script/{i}")))
+        try:
+            await asyncio.gather(*drivers)
+        finally:
+            for device in self.devices:
+                device.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _recorder(self, device_id: str):
+        def record(transition):
+            task_id = transition.current_task["id"] if transition.current_task else None
+            self.events.append((device_id, transition.event, task_id, transition.timestamp))
+        return record
+
+    def _script(self, tasks: List[Dict[str, Any]], rng: random.Random) -> List[Tuple[float, str, Dict[str, Any]]]:
+        """Draw a routine: (pause before, command, data) steps."""
+        steps = [(0.0, "start_routine", {})]
+        for task in tasks:
+            dwell = task["duration"] * rng.lognormvariate(0, 0.4)
+            if rng.random() < self.stop_rate:
+                steps.append((rng.uniform(0, dwell), "stop_routine", {}))
+                return steps
+            if rng.random() < self.sound_rate:
+                at = rng.uniform(0, dwell)
+                steps.append((at, "play_sound", {"sound_name": task["sound"]}))
+                dwell -= at
+            steps.append((dwell, "next_task", {}))
+        return steps
+
+    async def _drive(self, device: SimulatedDevice, routines: int, rng: random.Random):
+        await self.clock.sleep(rng.uniform(1, 60))
+        for _ in range(routines):
+            steps = self._script(device.state.tasks, rng)
+            fault_step = rng.randrange(len(steps)) if rng.random() < self.fault_rate else None
+            outage = rng.uniform(5, 120)
+
+            first_event = len(self.events)
+            deliveries = self.hub.deliveries[device.device_id] = []
+            for n, (pause, command, data) in enumerate(steps):
+                await self.clock.sleep(pause)
+                if n == fault_step:
+                    self.faults += 1
+                    self.hub.cut_off(device.device_id, outage)
+                self.hub.send_command(device.device_id, command, data)
+                self.commands += 1
+            if steps[-1][1] == "stop_routine":
+                self.stopped += 1
+            else:
+                self.completed += 1
+
+            await self._wait_converged(device)
+            if fault_step is None:
+                self._check_timestamps(device.device_id, first_event, deliveries)
+            await self.clock.sleep(rng.uniform(30, 120))
+
+    async def _wait_converged(self, device: SimulatedDevice):
+        """Wait until the hub's view of the device matches its state."""
+        deadline = self.clock.monotonic() + self.converge_timeout
+        while self.hub.status(device.device_id) != device.state.snapshot():
+            if self.clock.monotonic() >= deadline:
+                self.unconverged += 1
+                return
+            await self.clock.sleep(1)
+
+    def _check_timestamps(self, device_id: str, first_event: int, deliveries: List[float]):
+        """Every command must cause one transition stamped with its arrival time."""
+        stamps = [timestamp for event_device, _, _, timestamp in self.events[first_event:]
+                  if event_device == device_id]
+        if len(stamps) != len(deliveries):
+            self.timing_errors += 1
+            return
+        self.timing_errors += sum(1 for stamp, arrival in zip(stamps, deliveries) if abs(stamp - arrival) > 1e-6)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay routines on virtual devices in virtual time")
+    parser.add_argument("--routines", type=int, default=2000, help="Routines to play (default: 2000)")
+    parser.add_argument("--devices", type=int, default=20, help="Concurrent virtual devices (default: 20)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--fault-rate", type=float, default=0.05,
+                        help="Share of routines that lose the network (default: 0.05)")
+    parser.add_argument("--heartbeat-interval", type=float, default=30,
+                        help="Heartbeat interval of the devices in seconds (default: 30)")
+    parser.add_argument("--json", dest="json_path", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    # Dropped connections are expected, only report real errors
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    simulator = RoutineSimulator(args.routines, args.devices, args.seed, fault_rate=args.fault_rate,
+                                 heartbeat_interval=args.heartbeat_interval)
+    report = simulator.run()
+    print(json.dumps(report, indent=2))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["timing_errors"] or report["unconverged"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+skew_bench.py
+
+Cross-device skew benchmark for group commands.
+
+Starts the in-process reference hub and a group of virtual devices (see
+fleet_sim) behind a fault proxy adding latency and jitter. Each device
+reads a clock that is off by a random offset, as device clocks are. The
+group is sent next_task commands alternately on receipt and with an
+execute_at time a lead ahead; the skew of a command is the spread of the
+moments the devices ran it, measured on one host clock.
+
+Usage:
+    python -m tools.skew_bench --devices 20 --rounds 20 --latency 0.05 --jitter 0.04
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from typing import Dict, List
+
+from clock import SystemClock
+from tools.fault_proxy import FaultConfig, FaultProxy
+from tools.fleet_sim import FleetMetrics, VirtualDevice
+from tools.stats import summarize
+
+GROUP = "siblings"
+
+class SkewedClock(SystemClock):
+    """The system clock, off by a fixed offset in seconds."""
+
+    def __init__(self, offset: float):
+        self.offset = offset
+
+    def time(self) -> float:
+        return time.time() + self.offset
+
+class SkewBenchmark:
+    """Sends group commands to devices with skewed clocks and measures when they run."""
+
+    def __init__(self, devices: int = 20, rounds: int = 20, latency: float = 0.05, jitter: float = 0.04,
+                 clock_error: float = 0.5, lead: float = 0.5, seed: int = 1):
+        """
+        Initialize the benchmark.
+
+        Args:
+            devices: Number of devices in the group
+            rounds: Commands sent per mode
+            latency: One-way latency added by the proxy, in seconds
+            jitter: Seconds, uniformly distributed +/- around the latency
+            clock_error: Device clocks are off by up to this many seconds
+            lead: Seconds between sending a scheduled command and its execute_at
+            seed: Seed of the clock offsets and the network jitter
+        """
+        self.device_count = devices
+        self.rounds = rounds
+        self.fault_config = FaultConfig(latency=latency, jitter=jitter)
+        self.clock_error = clock_error
+        self.lead = lead
+        self.seed = seed
+        self.handled: Dict[int, List[float]] = {}  # Round -> host times the devices ran its command
+
+    def _recording(self, handler):
+        async def recording_handler(data):
+            self.handled.setdefault(data.get("round"), []).append(time.perf_counter())
+            await handler(data)
+        return recording_handler
+
+    async def run(self) -> Dict[str, object]:
+        """Run the benchmark and return the report."""
+        from hub import Hub
+        rng = random.Random(self.seed)
+        hub = Hub("127.0.0.1", 0)
+        await hub.start()
+        proxy = FaultProxy("127.0.0.1", hub.port, config=self.fault_config, seed=self.seed)
+        await proxy.start()
+
+        metrics = FleetMetrics()
+        devices: List[VirtualDevice] = []
+        tasks = []
+        try:
+            for i in range(self.device_count):
+                device_id = f"skew-{i:03d}"
+                clock = SkewedClock(rng.uniform(-self.clock_error, self.clock_error))
+                device = VirtualDevice(f"ws://{proxy.address}/ws", device_id, metrics, clock=clock)
+                device.command_handlers["next_task"] = self._recording(device.command_handlers["next_task"])
+                devices.append(device)
+                hub.add_to_group(GROUP, device_id)
+                tasks.append(asyncio.create_task(device.run()))
+
+            deadline = time.perf_counter() + 10
+            while sum(d.connected for d in devices) < self.device_count and time.perf_counter() < deadline:
+                await asyncio.sleep(0.1)
+            # Let the burst of clock probes after connecting complete
+            await asyncio.sleep(1.0)
+            hub.send_group_command(GROUP, "start_routine")
+            await asyncio.sleep(0.5)
+
+            on_receipt, scheduled = [], []
+            for i in range(self.rounds):
+                hub.send_group_command(GROUP, "next_task", {"round": 2 * i})
+                await asyncio.sleep(0.5)
+                hub.send_group_command(GROUP, "next_task", {"round": 2 * i + 1}, time.time() + self.lead)
+                await asyncio.sleep(self.lead + 0.5)
+                for round_, skews in ((2 * i, on_receipt), (2 * i + 1, scheduled)):
+                    times = self.handled.get(round_, [])
+                    if len(times) == self.device_count:
+                        skews.append(max(times) - min(times))
+        finally:
+            for device in devices:
+                device.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await proxy.stop()
+            await hub.stop()
+
+        offset_errors = [abs(d.time_sync.offset + d.clock.offset) for d in devices if d.time_sync.offset is not None]
+        return {
+            "devices": self.device_count,
+            "rounds": self.rounds,
+            "latency_s": self.fault_config.latency,
+            "jitter_s": self.fault_config.jitter,
+            "clock_error_s": self.clock_error,
+            "skew_on_receipt": summarize(on_receipt),
+            "skew_scheduled": summarize(scheduled),
+            "offset_error": summarize(offset_errors),
+            "time_sync_rtt": summarize([d.time_sync.rtt for d in devices if d.time_sync.rtt is not None]),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the skew of group commands across devices")
+    parser.add_argument("--devices", type=int, default=20, help="Devices in the group (default: 20)")
+    parser.add_argument("--rounds", type=int, default=20, help="Commands sent per mode (default: 20)")
+    parser.add_argument("--latency", type=float, default=0.05, help="One-way latency in seconds (default: 0.05)")
+    parser.add_argument("--jitter", type=float, default=0.04, help="Latency jitter in seconds (default: 0.04)")
+    parser.add_argument("--clock-error", type=float, default=0.5,
+                        help="Maximum device clock offset in seconds (default: 0.5)")
+    parser.add_argument("--lead", type=float, default=0.5,
+                        help="Seconds between sending a scheduled command and running it (default: 0.5)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--json", dest="json_path", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    benchmark = SkewBenchmark(args.devices, args.rounds, args.latency, args.jitter, args.clock_error,
+                              args.lead, args.seed)
+    report = asyncio.run(benchmark.run())
+    print(json.dumps(report, indent=2))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+state_stress.py
+
+Concurrency stress test and contention benchmark of RoutineState. Worker
+threads (standing in for the API server and the display) and asyncio tasks
+on one event loop thread (standing in for the WebSocket client) hammer a
+standalone state with a mix of reads and writes, including reloads of the
+routine definition with task lists of different lengths.
+
+Every operation is checked:
+- operations must not raise (e.g. an index out of range when stop_routine
+  or a reload races next_task),
+- snapshot() must be consistent: a current task exactly when active, and
+  the task belongs to a loaded routine,
+- reads of the separate properties are counted as torn when they do not
+  belong to the same state (informational, they are not atomic by design).
+
+Reports operations per second and the state lock's wait and hold times
+(from the metrics registry).
+
+Usage:
+    python -m tools.state_stress [--threads 4] [--tasks 8] [--duration 5]
+                                 [--write-ratio 0.05,0.5] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from routine_state import DEFAULT_TASKS, LOCK_HOLD, LOCK_WAIT, RoutineState
+
+# Alternative definitions swapped in by reload operations
+ROUTINE_VARIANTS = [
+    [task.copy() for task in DEFAULT_TASKS],
+    [task.copy() for task in DEFAULT_TASKS[:2]],
+    [task.copy() for task in DEFAULT_TASKS[1:]] + [
+        {"id": 5, "name": "Lights Out", "icon_name": "lightbulb", "sound": "lights.mp3", "duration": 30}],
+    [DEFAULT_TASKS[3].copy()],
+]
+KNOWN_TASK_IDS = {task["id"] for variant in ROUTINE_VARIANTS for task in variant}
+
+# Relative weights of the write operations
+WRITES = [("start_routine", 2), ("next_task", 6), ("stop_routine", 1), ("play_sound", 2), ("reload", 1)]
+
+class WorkerStats:
+    """Counts of one worker, merged after the run."""
+
+    __slots__ = ("reads", "writes", "errors", "violations", "torn_reads", "messages")
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self.violations = 0
+        self.torn_reads = 0
+        self.messages: List[str] = []
+
+    def fail(self, kind: str, message: str):
+        setattr(self, kind, getattr(self, kind) + 1)
+        if len(self.messages) < 5:
+            self.messages.append(message)
+
+def check_snapshot(snapshot: Dict[str, Any]) -> Optional[str]:
+    """Get a description of the broken invariant, or None if the snapshot is consistent."""
+    task = snapshot["current_task"]
+    if snapshot["is_active"] and task is None:
+        return "active routine without a current task"
+    if not snapshot["is_active"] and task is not None:
+        return f"inactive routine with current task {task['id']}"
+    if task is not None and task["id"] not in KNOWN_TASK_IDS:
+        return f"unknown current task {task['id']}"
+    return None
+
+class Worker:
+    """Issues a random mix of operations against the state."""
+
+    def __init__(self, state: RoutineState, write_ratio: float, seed: int):
+        self.state = state
+        self.write_ratio = write_ratio
+        self.rng = random.Random(seed)
+        self.stats = WorkerStats()
+        self._write_names = [name for name, _ in WRITES]
+        self._write_weights = [weight for _, weight in WRITES]
+
+    def step(self):
+        """Run one operation and check its result."""
+        try:
+            if self.rng.random() < self.write_ratio:
+                self.write(self.rng.choices(self._write_names, self._write_weights)[0])
+                self.stats.writes += 1
+            else:
+                self.read()
+                self.stats.reads += 1
+        except Exception as e:
+            self.stats.fail("errors", f"{type(e).__name__}: {e}")
+
+    def read(self):
+        state = self.state
+        if self.rng.random() < 0.5:
+            problem = check_snapshot(state.snapshot())
+            if problem:
+                self.stats.fail("violations", problem)
+        else:
+            # The way callers read before snapshot() existed
+            split = {"is_active": state.is_routine_active, "current_task": state.current_task,
+                     "current_sound": state.current_sound}
+            if check_snapshot(split):
+                self.stats.torn_reads += 1
+            state.tasks  # Copies the task list under the lock
+
+    def write(self, operation: str):
+        state = self.state
+        if operation == "start_routine":
+            task = state.start_routine()
+            if task["id"] not in KNOWN_TASK_IDS:
+                self.stats.fail("violations", f"start_routine returned unknown task {task['id']}")
+        elif operation == "next_task":
+            task = state.next_task()
+            if task is not None and task["id"] not in KNOWN_TASK_IDS:
+                self.stats.fail("violations", f"next_task returned unknown task {task['id']}")
+        elif operation == "stop_routine":
+            state.stop_routine()
+        elif operation == "play_sound":
+            state.play_sound(f"sound-{self.rng.randrange(10)}.mp3")
+        else:
+            variant = self.rng.choice(ROUTINE_VARIANTS)
+            state._apply_routine(len(variant), f"variant-{len(variant)}", [task.copy() for task in variant])
+
+def histogram_delta(before: List[int], after: List[int]) -> List[int]:
+    return [b - a for a, b in zip(before, after)]
+
+def bucket_percentile(buckets, counts: List[int], fraction: float) -> Optional[float]:
+    """Upper bound of the bucket holding a percentile, in seconds (None if above the last bucket)."""
+    total = sum(counts)
+    if total == 0:
+        return 0.0
+    seen = 0
+    for bound, count in zip(tuple(buckets) + (None,), counts):
+        seen += count
+        if seen >= fraction * total:
+            return bound
+    return None
+
+def run(threads: int, tasks: int, duration: float, write_ratio: float, seed: int = 1) -> Dict[str, Any]:
+    """Stress one standalone state and return the measurements."""
+    state = RoutineState.standalone()
+    wait, hold = LOCK_WAIT.labels(), LOCK_HOLD.labels()
+    wait_before, hold_before = (list(wait.counts), wait.sum), (list(hold.counts), hold.sum)
+
+    stop = threading.Event()
+    workers: List[Worker] = []
+
+    def thread_main(worker: Worker):
+        while not stop.is_set():
+            for _ in range(100):
+                worker.step()
+
+    async def task_main(worker: Worker):
+        while not stop.is_set():
+            for _ in range(10):
+                worker.step()
+            await asyncio.sleep(0)
+
+    def loop_main(loop_workers: List[Worker]):
+        async def run_tasks():
+            await asyncio.gather(*(task_main(worker) for worker in loop_workers))
+        asyncio.run(run_tasks())
+
+    runners = []
+    for i in range(threads):
+        worker = Worker(state, write_ratio, seed * 1000 + i)
+        workers.append(worker)
+        runners.append(threading.Thread(target=thread_main, args=(worker,)))
+    if tasks:
+        loop_workers = [Worker(state, write_ratio, seed * 1000 + threads + i) for i in range(tasks)]
+        workers.extend(loop_workers)
+        runners.append(threading.Thread(target=loop_main, args=(loop_workers,)))
+
+    started_at = time.perf_counter()
+    for runner in runners:
+        runner.start()
+    time.sleep(duration)
+    stop.set()
+    for runner in runners:
+        runner.join()
+    elapsed = time.perf_counter() - started_at
+
+    totals = WorkerStats()
+    for worker in workers:
+        for field in ("reads", "writes", "errors", "violations", "torn_reads"):
+            setattr(totals, field, getattr(totals, field) + getattr(worker.stats, field))
+        totals.messages.extend(worker.stats.messages)
+
+    wait_counts = histogram_delta(wait_before[0], wait.counts)
+    hold_counts = histogram_delta(hold_before[0], hold.counts)
+    contended = sum(wait_counts)
+    acquisitions = sum(hold_counts)
+    operations = totals.reads + totals.writes
+    return {
+        "threads": threads,
+        "tasks": tasks,
+        "write_ratio": write_ratio,
+        "seconds": round(elapsed, 3),
+        "operations": operations,
+        "ops_per_second": round(operations / elapsed),
+        "reads": totals.reads,
+        "writes": totals.writes,
+        "errors": totals.errors,
+        "violations": totals.violations,
+        "torn_split_reads": totals.torn_reads,
+        "lock": {
+            "acquisitions": acquisitions,
+            "contended": contended,
+            "contended_fraction": round(contended / acquisitions, 4) if acquisitions else 0.0,
+            "mean_wait_us": round((wait.sum - wait_before[1]) / contended * 1e6, 2) if contended else 0.0,
+            "p99_wait_us_bound": _us(bucket_percentile(wait.buckets, wait_counts, 0.99)),
+            "mean_hold_us": round((hold.sum - hold_before[1]) / acquisitions * 1e6, 2) if acquisitions else 0.0,
+            "p99_hold_us_bound": _us(bucket_percentile(hold.buckets, hold_counts, 0.99)),
+        },
+        "messages": totals.messages[:10],
+    }
+
+def _us(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1e6, 2)
+
+def print_result(result: Dict[str, Any]):
+    lock = result["lock"]
+    print(f"threads={result['threads']} tasks={result['tasks']} write_ratio={result['write_ratio']}: "
+          f"{result['ops_per_second']} ops/s ({result['reads']} reads, {result['writes']} writes)")
+    print(f"  errors={result['errors']} violations={result['violations']} "
+          f"torn split reads={result['torn_split_reads']}")
+    print(f"  lock: {lock['contended']}/{lock['acquisitions']} contended, mean wait {lock['mean_wait_us']} us, "
+          f"p99 wait <= {lock['p99_wait_us_bound']} us, mean hold {lock['mean_hold_us']} us, "
+          f"p99 hold <= {lock['p99_hold_us_bound']} us")
+    for message in result["messages"]:
+        print(f"  ! {message}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress and benchmark RoutineState under concurrency")
+    parser.add_argument("--threads", type=int, default=4, help="Worker threads (default: 4)")
+    parser.add_argument("--tasks", type=int, default=8, help="Asyncio tasks on one loop thread (default: 8)")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds per run (default: 5)")
+    parser.add_argument("--write-ratio", default="0.05,0.5",
+                        help="Comma-separated fractions of writes, one run each (default: 0.05,0.5)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for ratio in (float(r) for r in args.write_ratio.split(",")):
+        result = run(args.threads, args.tasks, args.duration, ratio, args.seed)
+        print_result(result)
+        results.append(result)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(r["errors"] or r["violations"] for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+"""
+stats.py
+
+Latency summaries shared by the benchmarks and simulators (fleet_sim,
+api_bench, skew_bench), so their reports use the same percentiles.
+"""
+
+from typing import Dict, List, Optional
+
+def percentile(samples: List[float], fraction: float) -> Optional[float]:
+    """Get a percentile of samples (nearest rank), or None without samples."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+    """Summarize latencies in seconds as milliseconds."""
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+    return {
+        "count": len(samples),
+        "p50_ms": ms(percentile(samples, 0.5)),
+        "p90_ms": ms(percentile(samples, 0.9)),
+        "p99_ms": ms(percentile(samples, 0.99)),
+        "max_ms": ms(max(samples) if samples else None),
+    }
@@ -0,0 +1,190 @@
+"""
+tracing.py
+
+This module provides lightweight end-to-end tracing of commands. A trace is
+started when a command arrives (WebSocket receive or REST handler) and
+travels with it: through the command queue, into the RoutineState transition
+(via a context variable) and on to the display (via Transition.trace),
+each stage recording a span.
+
+Traces are kept in an in-memory ring buffer of the most recent commands and
+can be exported as JSON, e.g. by GET /debug/traces. Sampling keeps the cost
+down on busy devices: unsampled commands get no trace and every recording
+call is a no-op.
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import random
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from memory import approximate_size, memory_monitor
+
+# Stages in the order a command normally passes through them
+STAGES = ("ws.receive", "ws.queue", "ws.handler", "rest.handler", "state.transition",
+          "display.queue", "display.update")
+
+class Span:
+    """One timed stage of a trace. Times are time.perf_counter() values."""
+
+    __slots__ = ("name", "start", "end", "attributes")
+
+    def __init__(self, name: str, start: float, end: float, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attributes = attributes
+
+class Trace:
+    """The spans recorded for one command."""
+
+    __slots__ = ("trace_id", "name", "source", "timestamp", "started_at", "spans")
+
+    def __init__(self, trace_id: str, name: str, source: str, started_at: Optional[float] = None):
+        self.trace_id = trace_id
+        self.name = name  # Command name or REST route
+        self.source = source  # "ws" or "rest"
+        self.timestamp = time.time()
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.spans: List[Span] = []
+
+    def add_span(self, name: str, start: float, end: Optional[float] = None, **attributes):
+        """Record a stage that ran from start to end (defaults to now)."""
+        self.spans.append(Span(name, start, time.perf_counter() if end is None else end, attributes or None))
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes) -> Iterator[None]:
+        """Record the time spent in a block as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, **attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the trace to a dictionary, with span times in milliseconds from its start."""
+        spans = sorted(self.spans, key=lambda span: span.start)
+        end = max((span.end for span in spans), default=self.started_at)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "source": self.source,
+            "timestamp": self.timestamp,
+            "duration_ms": (end - self.started_at) * 1000,
+            "spans": [
+                {
+                    "name": span.name,
+                    "start_ms": (span.start - self.started_at) * 1000,
+                    "duration_ms": (span.end - span.start) * 1000,
+                    **({"attributes": span.attributes} if span.attributes else {}),
+                }
+                for span in spans
+            ],
+        }
+
+class Tracer:
+    """Starts sampled traces and keeps the most recent ones in a ring buffer."""
+
+    def __init__(self, capacity: int = 200, sample_rate: float = 1.0, rng: Optional[random.Random] = None):
+        """
+        Args:
+            capacity: Number of recent traces to keep
+            sample_rate: Fraction of commands that are traced (0 disables tracing)
+            rng: Random number generator used for sampling and trace ids
+        """
+        self.sample_rate = sample_rate
+        self._rng = rng or random.Random()
+        self._traces = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return self._traces.maxlen
+
+    @capacity.setter
+    def capacity(self, capacity: int):
+        with self._lock:
+            self._traces = collections.deque(self._traces, maxlen=capacity)
+
+    def start_trace(self, name: str, source: str, trace_id: Optional[str] = None,
+                    started_at: Optional[float] = None) -> Optional[Trace]:
+        """
+        Start a trace for a command, or return None if it is not sampled.
+
+        Args:
+            name: Command name or REST route
+            source: Where the command came from ("ws" or "rest")
+            trace_id: Id assigned upstream (e.g. by the cloud), generated if missing
+            started_at: time.perf_counter() value the command arrived at
+        """
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and self._rng.random() >= self.sample_rate):
+            return None
+        if trace_id is None:
+            trace_id = f"{self._rng.getrandbits(64):016x}"
+        trace = Trace(trace_id, name, source, started_at)
+        with self._lock:
+            self._traces.append(trace)
+        return trace
+
+    def traces(self, limit: Optional[int] = None) -> List[Trace]:
+        """Get the most recent traces, newest first."""
+        with self._lock:
+            traces = list(self._traces)
+        traces.reverse()
+        return traces[:limit] if limit is not None else traces
+
+    def export(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Export the most recent traces as dictionaries."""
+        return [trace.to_dict() for trace in self.traces(limit)]
+
+    def to_json(self, limit: Optional[int] = None) -> str:
+        """Export the most recent traces as JSON."""
+        return json.dumps(self.export(limit))
+
+    def stage_latencies(self, limit: Optional[int] = None) -> Dict[str, Dict[str, float]]:
+        """Summarize the duration of each stage over the most recent traces, in milliseconds."""
+        durations: Dict[str, List[float]] = {}
+        for trace in self.traces(limit):
+            for span in list(trace.spans):
+                durations.setdefault(span.name, []).append((span.end - span.start) * 1000)
+
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        summary = {}
+        for name in sorted(durations, key=lambda name: (order.get(name, len(order)), name)):
+            values = sorted(durations[name])
+            summary[name] = {
+                "count": len(values),
+                "mean_ms": sum(values) / len(values),
+                "p50_ms": values[(len(values) - 1) // 2],
+                "p99_ms": values[min(len(values) - 1, int(len(values) * 0.99))],
+                "max_ms": values[-1],
+            }
+        return summary
+
+    def clear(self):
+        """Drop all recorded traces."""
+        with self._lock:
+            self._traces.clear()
+
+# Process-wide tracer
+tracer = Tracer()
+memory_monitor.register("traces", lambda: approximate_size(tracer.traces()), tracer.clear, priority=10)
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+def current_trace() -> Optional[Trace]:
+    """Get the trace of the command being handled in this context, if any."""
+    return _current_trace.get()
+
+@contextlib.contextmanager
+def activate(trace: Optional[Trace]) -> Iterator[Optional[Trace]]:
+    """Make a trace the current one for the duration of a block."""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
@@ -2,41 +2,213 @@
 ws_client.py
 
 This module provides a WebSocket client to connect to a cloud server and receive commands.
+
+A supervisor task owns the connection: it connects, runs the receive loop and
+a ping/pong heartbeat, and reconnects with jittered exponential backoff as
+soon as either of them ends. A half-open connection is detected by a missing
+pong within heartbeat_interval + heartbeat_timeout seconds.
+
+The client also estimates the offset of the server's clock (see time_sync),
+so commands carrying an "execute_at" time run at that moment on every
+device rather than when each device happens to receive them.
 """
 
 import asyncio
-import json
+import collections
+import contextvars
 import logging
+import random
 import threading
+import time
 import websockets
-from typing import Optional, Dict, Any, Callable
+from urllib.parse import urlencode
+from typing import Optional, Dict, Any, Callable, List, Set
 from websockets.exceptions import ConnectionClosed
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
 
-from routine_state import routine_state
+import ws_protocol
+from backoff import DecorrelatedJitterBackoff
+from clock import Clock
+from metrics import registry
+from tracing import activate, tracer
+from outbox import MemoryOutbox, Outbox
+from routine_registry import RoutineRegistry, routine_registry
+from routine_state import RoutineState, routine_state
+from time_sync import TimeSync
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+COMMAND_WAIT = registry.histogram("ws_command_queue_seconds",
+                                  "Time WebSocket commands waited in their lane.", labels=("command",))
+COMMAND_RUN = registry.histogram("ws_command_run_seconds",
+                                 "Time spent running WebSocket command handlers.", labels=("command",))
+COMMANDS_REJECTED = registry.counter("ws_commands_rejected_total",
+                                     "WebSocket commands rejected because their lane was full.")
+RECONNECTS = registry.counter("ws_reconnects_total", "Reconnects to the WebSocket server.")
+HEARTBEAT_RTT = registry.histogram("ws_heartbeat_rtt_seconds", "Round-trip time of heartbeat pings.")
+CONNECTED = registry.gauge("ws_connected", "Whether the device client is connected to the server.")
+QUEUE_DEPTH = registry.gauge("ws_command_queue_depth", "Queued WebSocket commands per lane.", labels=("lane",))
+OUTBOX_PENDING = registry.gauge("ws_outbox_pending_messages", "Messages not yet acknowledged by the server.")
+CLOCK_OFFSET = registry.gauge("ws_clock_offset_seconds", "Estimated server clock minus device clock.")
+TIME_SYNC_RTT = registry.histogram("ws_time_sync_rtt_seconds", "Round-trip time of clock probes.")
+SCHEDULED_COMMANDS = registry.counter("ws_scheduled_commands_total",
+                                      "Commands with an execute_at time, by outcome.", labels=("result",))
+
+class CommandRejected(Exception):
+    """Raised by a command handler that cannot run its command; the server gets a nack with the reason."""
+    
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+# Probes sent right after connecting, time_sync_burst_interval apart, so
+# scheduled commands have a good offset before the first periodic probe
+TIME_SYNC_BURST = 8
+
+class CommandTiming:
+    """Latency totals of one command type, split into queue wait and run time."""
+    
+    __slots__ = ("count", "total_wait", "total_run", "max_wait", "max_run")
+    
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+        self.max_run = 0.0
+    
+    def add(self, wait: float, run: float):
+        self.count += 1
+        self.total_wait += wait
+        self.total_run += run
+        self.max_wait = max(self.max_wait, wait)
+        self.max_run = max(self.max_run, run)
+    
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_wait": self.total_wait / self.count if self.count else 0.0,
+            "mean_run": self.total_run / self.count if self.count else 0.0,
+            "max_wait": self.max_wait,
+            "max_run": self.max_run
+        }
+
 class WebSocketClient:
     """
     A WebSocket client that connects to a cloud server and receives commands.
     """
     
-    def __init__(self, server_url: str, reconnect_interval: int = 5):
+    # Commands run before, and discard, the normal commands queued before them
+    PRIORITY_COMMANDS = {"stop_routine"}
+    
+    def __init__(self, server_url: str, reconnect_interval: float = 1, coalesce_window: float = 0.05,
+                 max_reconnect_interval: float = 60, heartbeat_interval: float = 3,
+                 heartbeat_timeout: float = 2, stable_after: float = 30,
+                 outbox: Optional[Outbox] = None, command_workers: int = 1,
+                 command_queue_size: int = 32, device_id: Optional[str] = None,
+                 state: Optional[RoutineState] = None, clock: Optional[Clock] = None,
+                 rng: Optional[random.Random] = None, registry: Optional[RoutineRegistry] = None,
+                 asset_sync=None, definition_sync=None,
+                 time_sync_interval: Optional[float] = 15, time_sync_burst_interval: float = 0.2):
         """
         Initialize the WebSocket client.
         
         Args:
             server_url: URL of the WebSocket server
-            reconnect_interval: Interval in seconds to attempt reconnection
+            reconnect_interval: Minimum delay in seconds before reconnecting
+            coalesce_window: Seconds to wait after a state change so that a
+                burst of changes is sent as one status message
+            max_reconnect_interval: Maximum delay in seconds before reconnecting
+            heartbeat_interval: Seconds between pings
+            heartbeat_timeout: Seconds to wait for a pong before the
+                connection is considered dead
+            stable_after: Seconds a connection must last before the backoff
+                is reset (so a flapping server keeps being backed off)
+            outbox: Persistent store of undelivered messages (defaults to an
+                in-memory outbox)
+            command_workers: Number of tasks running command handlers; more
+                than one lets a slow handler overlap with others, at the cost
+                of commands no longer finishing in arrival order
+            command_queue_size: Maximum number of queued commands per lane
+            device_id: Identifies the device to the hub (sent as the
+                device_id query parameter)
+            state: Routine state controlled by this client (defaults to the
+                process-wide routine_state)
+            clock: Clock for the heartbeat, reconnect delays and status
+                coalescing (defaults to the clock of the state)
+            rng: Random number generator for the reconnect jitter (for
+                deterministic simulations)
+            registry: Routine runtimes addressed by the target_id of
+                commands (defaults to the routine_registry when the state
+                is the process-wide one, none otherwise)
+            asset_sync: AssetSync woken by sync_assets commands (those are
+                ignored without one)
+            definition_sync: DefinitionSync applying the routine definitions
+                feed (not requested without one)
+            time_sync_interval: Seconds between clock probes once connected
+                (None to not probe; execute_at is then taken as device time)
+            time_sync_burst_interval: Seconds between the probes sent right
+                after connecting
         """
         self.server_url = server_url
+        self.device_id = device_id
+        self.state = state if state is not None else routine_state
+        if registry is None and self.state is routine_state:
+            registry = routine_registry
+        self.registry = registry
+        self.asset_sync = asset_sync
+        self.definition_sync = definition_sync
+        self.clock = clock if clock is not None else self.state.clock
+        self.rng = rng
         self.reconnect_interval = reconnect_interval
+        self.max_reconnect_interval = max_reconnect_interval
+        self.coalesce_window = coalesce_window
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stable_after = stable_after
         self.websocket: Optional[websockets.WebSocketClientProtocol] = None
         self.running = False
         self.connected = False
         self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._codec = ws_protocol.JsonCodec()
+        
+        # Connection health
+        self.reconnects = 0
+        self.last_rtt: Optional[float] = None  # Seconds
+        self.rtt_samples = collections.deque(maxlen=64)
+        
+        # Server clock offset, for commands scheduled at a server time
+        self.time_sync = TimeSync()
+        self.time_sync_interval = time_sync_interval
+        self.time_sync_burst_interval = time_sync_burst_interval
+        
+        # Status delta encoding (see ws_protocol)
+        self._seq = 0
+        self._acked_status_seq: Optional[int] = None  # Last status the server acknowledged
+        self._acked_status: Optional[Dict[str, Any]] = None
+        self._last_sent_status: Optional[Dict[str, Any]] = None
+        self._unacked_statuses: Dict[int, Dict[str, Any]] = {}
+        self._status_flush: Optional[asyncio.Handle] = None
+        self._status_lock: Optional[asyncio.Lock] = None  # Created in run(), on the client's loop
+        
+        # Reliable delivery (see outbox)
+        self.outbox = outbox if outbox is not None else MemoryOutbox()
+        self._inflight: Dict[int, List[int]] = {}  # Sequence number -> outbox ids
+        
+        # Command pipeline: the receive loop only decodes and queues commands
+        self.command_workers = command_workers
+        self.command_queue_size = command_queue_size
+        self._high_lane: Optional[asyncio.Queue] = None  # Created in run(), on the client's loop
+        self._normal_lane: Optional[asyncio.Queue] = None
+        self._commands_ready: Optional[asyncio.Semaphore] = None
+        self.command_timings: Dict[str, CommandTiming] = {}
+        self.commands_rejected = 0
+        self.commands_preempted = 0
+        self._commands_received = 0
+        self._scheduled: Dict[int, Any] = {}  # Receive order -> (timer, message, trace, received_at)
+        self._background: Set[asyncio.Task] = set()  # Referenced until done, so they are not collected
         
         # Command handlers
         self.command_handlers = {
@@ -44,18 +216,34 @@ class WebSocketClient:
             "next_task": self._handle_next_task,
             "stop_routine": self._handle_stop_routine,
             "play_sound": self._handle_play_sound,
+            "select_routine": self._handle_select_routine,
+            "sync_assets": self._handle_sync_assets,
         }
     
     async def connect(self):
         """Connect to the WebSocket server."""
         logger.info(f"Connecting to WebSocket server at {self.server_url}")
         try:
-            self.websocket = await websockets.connect(self.server_url)
+            self.websocket = await websockets.connect(
+                self._connect_url(),
+                subprotocols=ws_protocol.supported_subprotocols() or None,
+                compression=None,
+                extensions=[self._deflate_extension()],
+                open_timeout=self.heartbeat_interval + self.heartbeat_timeout,
+                close_timeout=self.heartbeat_timeout,
+                # Keepalive is done by our own heartbeat, which records the RTT
+                ping_interval=None
+            )
+            # Servers that do not know the binary protocol select no subprotocol
+            self._codec = ws_protocol.codec_for_subprotocol(self.websocket.subprotocol)
+            self._reset_status_tracking()
             self.connected = True
-            logger.info("Connected to WebSocket server")
+            logger.info(f"Connected to WebSocket server (protocol: {self.websocket.subprotocol or 'json'})")
             
-            # Send initial status
-            await self._send_status()
+            # Send a full status snapshot and undelivered messages on every (re)connect
+            await self._replay_outbox()
+            if self.definition_sync is not None:
+                await self._request_definitions()
             
             return True
         except Exception as e:
@@ -63,6 +251,28 @@ class WebSocketClient:
             self.connected = False
             return False
     
+    def _connect_url(self) -> str:
+        """Get the server URL including the device id."""
+        if self.device_id is None:
+            return self.server_url
+        separator = "&" if "?" in self.server_url else "?"
+        return f"{self.server_url}{separator}{urlencode({'device_id': self.device_id})}"
+    
+    @staticmethod
+    def _deflate_extension() -> ClientPerMessageDeflateFactory:
+        """
+        Offer permessage-deflate tuned for small, repetitive messages.
+        
+        Context takeover is kept so repeated field names compress well across
+        messages; small windows and memLevel keep the per-connection zlib
+        memory low on the device and on the hub.
+        """
+        return ClientPerMessageDeflateFactory(
+            server_max_window_bits=11,
+            client_max_window_bits=11,
+            compress_settings={"memLevel": 4}
+        )
+    
     async def disconnect(self):
         """Disconnect from the WebSocket server."""
         if self.websocket:
@@ -70,65 +280,385 @@ class WebSocketClient:
             self.websocket = None
             self.connected = False
             logger.info("Disconnected from WebSocket server")
+        self._reset_status_tracking()
     
-    async def _send_message(self, message: Dict[str, Any]):
+    async def _send_message(self, message: Dict[str, Any], outbox_ids: Optional[List[int]] = None) -> bool:
         """
-        Send a message to the WebSocket server.
+        Send a message to the WebSocket server, numbering it with the next sequence number.
         
         Args:
             message: Message to send
+            outbox_ids: Outbox messages delivered by this frame, deleted from
+                the outbox once the server acknowledges its sequence number
+            
+        Returns:
+            True if the message was sent
         """
         if not self.connected or not self.websocket:
             logger.warning("Cannot send message: not connected")
-            return
+            return False
         
+        self._seq += 1
+        message["seq"] = self._seq
         try:
-            await self.websocket.send(json.dumps(message))
+            await self.websocket.send(self._codec.encode(message))
         except Exception as e:
             logger.error(f"Failed to send message: {e}")
             self.connected = False
+            return False
+        
+        if outbox_ids:
+            self._inflight[message["seq"]] = outbox_ids
+        return True
     
-    async def _send_status(self):
-        """Send the current status to the WebSocket server."""
-        status = {
-            "type": "status",
-            "data": {
-                "is_active": routine_state.is_routine_active,
-                "current_task": routine_state.current_task,
-                "current_sound": routine_state.current_sound
+    async def _send_status(self, full: bool = False):
+        """
+        Send the current status to the WebSocket server.
+        
+        The status is first stored in the outbox, replacing any undelivered
+        older status, so it reaches the server even if it is sent while
+        offline. A delta against the last acknowledged status is sent unless
+        a full snapshot is requested or the server has not acknowledged one yet.
+        
+        Args:
+            full: Send a full snapshot
+        """
+        # One status at a time, so statuses are stored and sent in the same order
+        async with self._status_lock:
+            status = ws_protocol.status_snapshot(self.state, self.registry)
+            if not full and status == self._last_sent_status:
+                return
+            
+            self._last_sent_status = status
+            message_id = await self._outbox_call(self.outbox.append, {"type": ws_protocol.STATUS, "data": status},
+                                                 "status")
+            if not self.connected:
+                return
+            
+            if full or self._acked_status is None:
+                message = {"type": ws_protocol.STATUS, "id": message_id, "data": status}
+            else:
+                message = {
+                    "type": ws_protocol.STATUS_DELTA,
+                    "id": message_id,
+                    "base": self._acked_status_seq,
+                    "data": ws_protocol.diff_status(self._acked_status, status)
+                }
+            
+            if await self._send_message(message, [message_id]):
+                self._unacked_statuses[message["seq"]] = status
+    
+    async def _replay_outbox(self):
+        """
+        Send the current status and all undelivered messages as one batch.
+        
+        Called after (re)connecting. Superseded status messages were already
+        collapsed by the outbox, so the batch holds one full status snapshot
+        plus the other messages produced while offline, in order.
+        """
+        async with self._status_lock:
+            status = ws_protocol.status_snapshot(self.state, self.registry)
+            self._last_sent_status = status
+            
+            def append_status():
+                self.outbox.append({"type": ws_protocol.STATUS, "data": status}, collapse_key="status")
+                return self.outbox.pending()
+            pending = await self._outbox_call(append_status)
+            batch = {
+                "type": ws_protocol.BATCH,
+                "messages": [dict(message, id=message_id) for message_id, message in pending]
             }
-        }
-        await self._send_message(status)
+            if await self._send_message(batch, [message_id for message_id, _ in pending]):
+                self._unacked_statuses[batch["seq"]] = status
+                if len(pending) > 1:
+                    logger.info(f"Replayed {len(pending) - 1} undelivered messages")
+    
+    async def _outbox_call(self, function: Callable, *args):
+        """
+        Call an outbox method; the SQLite commit of a persistent outbox runs
+        in the default executor, so it never stalls the event loop.
+        """
+        if isinstance(self.outbox, MemoryOutbox):
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+    
+    def _schedule_status(self):
+        """Send a status message after the coalescing window, unless one is already pending."""
+        if self._status_flush is None:
+            self._status_flush = self.clock.call_later(self.coalesce_window, self._flush_status)
+    
+    def _flush_status(self):
+        self._status_flush = None
+        self._spawn(self._send_status())
+    
+    def _spawn(self, coroutine):
+        """Run a coroutine started from a timer callback in the background."""
+        task = asyncio.ensure_future(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+    
+    def _on_state_change(self, transition):
+        """Routine state listener: queue a status update (called from any thread)."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._schedule_status)
     
-    async def _handle_message(self, message_str: str):
+    def _handle_ack(self, seq: int):
+        """Record that the server has processed all messages up to seq."""
+        acked = [s for s in self._unacked_statuses if s <= seq]
+        if acked:
+            self._acked_status_seq = max(acked)
+            self._acked_status = self._unacked_statuses[self._acked_status_seq]
+            for s in acked:
+                del self._unacked_statuses[s]
+        
+        delivered = [s for s in self._inflight if s <= seq]
+        if delivered:
+            message_ids = [i for s in delivered for i in self._inflight.pop(s)]
+            if isinstance(self.outbox, MemoryOutbox):
+                self.outbox.ack(message_ids)
+            else:
+                # Acknowledged messages replayed before the delete commits are dropped by the server
+                asyncio.get_running_loop().run_in_executor(None, self.outbox.ack, message_ids)
+    
+    def _reset_status_tracking(self):
+        """Forget acknowledgements, so the next status is a full snapshot."""
+        self._acked_status_seq = None
+        self._acked_status = None
+        self._last_sent_status = None
+        self._unacked_statuses.clear()
+        # Unacknowledged messages stay in the outbox and are replayed
+        self._inflight.clear()
+    
+    async def _handle_message(self, message_str):
         """
         Handle a message received from the WebSocket server.
         
         Args:
-            message_str: JSON message string
+            message_str: Encoded message frame (str or bytes)
         """
+        received_at = time.perf_counter()
+        received_clock = self.clock.time()
         try:
-            message = json.loads(message_str)
+            message = self._codec.decode(message_str)
+            
+            message_type = message.get("type")
             
-            # Check if the message is a command
-            if "type" in message and message["type"] == "command":
+            if message_type == ws_protocol.ACK:
+                self._handle_ack(message.get("seq", 0))
+            elif message_type == ws_protocol.RESYNC:
+                await self._send_status(full=True)
+            elif message_type == ws_protocol.DEFINITIONS:
+                await self._handle_definitions(message)
+            elif message_type == ws_protocol.TIME_SYNC:
+                self._handle_time_sync(message, received_clock)
+            elif message_type == ws_protocol.COMMAND:
                 command = message.get("command")
-                data = message.get("data", {})
                 
                 if command in self.command_handlers:
-                    # Handle the command
-                    await self.command_handlers[command](data)
-                    
-                    # Send updated status after handling command
-                    await self._send_status()
+                    trace = tracer.start_trace(command, "ws", message.get("trace_id"), received_at)
+                    if trace is not None:
+                        trace.add_span("ws.receive", received_at)
+                    self._commands_received += 1
+                    if message.get("execute_at") is None or not self._schedule_command(message, trace, received_at):
+                        await self._enqueue_command(message, trace)
                 else:
                     logger.warning(f"Unknown command: {command}")
             
-        except json.JSONDecodeError:
-            logger.error(f"Failed to parse message: {message_str}")
+        except ValueError:
+            logger.error(f"Failed to parse message: {message_str!r}")
         except Exception as e:
             logger.error(f"Error handling message: {e}")
     
+    async def _request_definitions(self):
+        """Ask the server for the routine definition changes since the applied revision."""
+        loop = asyncio.get_running_loop()
+        # Reading the revision may query the database
+        await self._send_message(await loop.run_in_executor(None, self.definition_sync.request))
+    
+    async def _handle_definitions(self, message: Dict[str, Any]):
+        """
+        Apply routine definition changes from the server, asking for the
+        missed ones when a revision was skipped.
+        
+        Args:
+            message: definitions message
+        """
+        if self.definition_sync is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            # One database transaction, off the event loop
+            applied = await loop.run_in_executor(None, self.definition_sync.apply, message)
+        except Exception as e:
+            logger.error(f"Could not apply routine definitions: {e}")
+            return
+        if not applied:
+            await self._request_definitions()
+    
+    def _handle_time_sync(self, message: Dict[str, Any], received_at: float):
+        """
+        Record the answer to a clock probe.
+        
+        Args:
+            message: time_sync answer of the server
+            received_at: Device time the answer arrived
+        """
+        if not self.time_sync.add(message, received_at):
+            logger.warning(f"Ignoring invalid time_sync answer: {message!r}")
+            return
+        TIME_SYNC_RTT.observe(self.time_sync.samples[-1][0])
+    
+    def _schedule_command(self, message: Dict[str, Any], trace, received_at: float) -> bool:
+        """
+        Run a command at its execute_at time (a server time) instead of now.
+        
+        Returns:
+            False if the time has already passed, so the command must run now
+        """
+        try:
+            delay = self.time_sync.to_local(float(message["execute_at"])) - self.clock.time()
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring invalid execute_at: {message['execute_at']!r}")
+            return False
+        if delay <= 0:
+            SCHEDULED_COMMANDS.labels("late").inc()
+            logger.info(f"{message['command']} arrived {-delay:.3f}s after its execute_at time")
+            return False
+        
+        order = self._commands_received
+        timer = self.clock.call_later(delay, lambda: self._run_scheduled(order))
+        self._scheduled[order] = (timer, message, trace, received_at)
+        SCHEDULED_COMMANDS.labels("scheduled").inc()
+        return True
+    
+    def _run_scheduled(self, order: int):
+        """Queue a scheduled command whose time has come."""
+        _, message, trace, received_at = self._scheduled.pop(order)
+        if trace is not None:
+            trace.add_span("ws.scheduled", received_at)
+        self._spawn(self._enqueue_command(message, trace, order))
+    
+    def _cancel_scheduled(self, before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Cancel the scheduled normal commands received before a receive order
+        (all of them if None).
+        
+        Returns:
+            The cancelled command messages
+        """
+        cancelled = [order for order, (_, message, _, _) in self._scheduled.items()
+                     if (before is None or order < before) and message["command"] not in self.PRIORITY_COMMANDS]
+        messages = []
+        for order in cancelled:
+            timer, message, _, _ = self._scheduled.pop(order)
+            timer.cancel()
+            messages.append(message)
+        return messages
+    
+    async def _enqueue_command(self, message: Dict[str, Any], trace=None, order: Optional[int] = None):
+        """
+        Queue a command for the workers without waiting for it to run.
+        
+        Priority commands go to the high lane and discard the normal commands
+        queued or scheduled before them. When a lane is full the command is
+        rejected with a nack, so the server sees the overload instead of the
+        socket silently buffering frames; the discarded commands are nacked
+        too, so the server knows they never ran.
+        
+        Args:
+            message: command message
+            trace: Trace of the command, if sampled
+            order: Receive order of a scheduled command (None for one
+                queued on receipt, which every scheduled command precedes)
+        """
+        command = message["command"]
+        if command in self.PRIORITY_COMMANDS:
+            lane = self._high_lane
+            preempted = self._cancel_scheduled(order)
+            while not self._normal_lane.empty():
+                preempted.append(self._normal_lane.get_nowait()[1])
+            if preempted:
+                self.commands_preempted += len(preempted)
+                logger.info(f"{command} preempted {len(preempted)} queued commands")
+                for discarded in preempted:
+                    await self._send_nack(discarded, "preempted")
+        else:
+            lane = self._normal_lane
+        
+        try:
+            lane.put_nowait((time.perf_counter(), message, trace))
+        except asyncio.QueueFull:
+            self.commands_rejected += 1
+            COMMANDS_REJECTED.inc()
+            logger.warning(f"Command queue full, rejecting {command}")
+            await self._send_nack(message, "busy")
+            return
+        self._commands_ready.release()
+    
+    async def _send_nack(self, message: Dict[str, Any], reason: str):
+        """Tell the server a command will not run, and why."""
+        nack = {"type": ws_protocol.NACK, "command": message["command"], "reason": reason}
+        if "id" in message:
+            nack["id"] = message["id"]
+        await self._send_message(nack)
+    
+    async def _command_worker(self):
+        """Run queued commands, high lane first."""
+        while True:
+            await self._commands_ready.acquire()
+            if not self._high_lane.empty():
+                queued_at, message, trace = self._high_lane.get_nowait()
+            elif not self._normal_lane.empty():
+                queued_at, message, trace = self._normal_lane.get_nowait()
+            else:
+                continue  # Discarded by a priority command
+            
+            command = message["command"]
+            started_at = time.perf_counter()
+            try:
+                # The state transition picks the trace up from the context
+                with activate(trace):
+                    await self.command_handlers[command](message.get("data", {}))
+            except CommandRejected as e:
+                logger.warning(f"Rejecting {command}: {e}")
+                await self._send_nack(message, e.reason)
+            except Exception as e:
+                logger.error(f"Error handling command {command}: {e}")
+            finished_at = time.perf_counter()
+            if trace is not None:
+                trace.add_span("ws.queue", queued_at, started_at)
+                trace.add_span("ws.handler", started_at, finished_at)
+            
+            self.command_timings.setdefault(command, CommandTiming()).add(
+                started_at - queued_at, finished_at - started_at)
+            COMMAND_WAIT.labels(command).observe(started_at - queued_at)
+            COMMAND_RUN.labels(command).observe(finished_at - started_at)
+            
+            # Send updated status (coalesced with other changes)
+            self._schedule_status()
+    
+    @property
+    def queue_depth(self) -> Dict[str, int]:
+        """Get the number of queued commands per lane."""
+        if self._high_lane is None:
+            return {"high": 0, "normal": 0}
+        return {"high": self._high_lane.qsize(), "normal": self._normal_lane.qsize()}
+    
+    def _target_state(self, data: Dict[str, Any]) -> RoutineState:
+        """
+        Get the routine runtime a command addresses.
+        
+        Raises:
+            CommandRejected: if the target is unknown
+        """
+        target_id = data.get("target_id")
+        if target_id is None:
+            return self.state
+        state = self.registry.get(target_id) if self.registry is not None else None
+        if state is None:
+            raise CommandRejected("unknown_target", f"unknown target {target_id!r}")
+        return state
+    
     async def _handle_start_routine(self, data: Dict[str, Any]):
         """
         Handle the start_routine command.
@@ -137,7 +667,7 @@ class WebSocketClient:
             data: Command data
         """
         logger.info("Received command: start_routine")
-        routine_state.start_routine()
+        self._target_state(data).start_routine()
     
     async def _handle_next_task(self, data: Dict[str, Any]):
         """
@@ -147,7 +677,7 @@ class WebSocketClient:
             data: Command data
         """
         logger.info("Received command: next_task")
-        routine_state.next_task()
+        self._target_state(data).next_task()
     
     async def _handle_stop_routine(self, data: Dict[str, Any]):
         """
@@ -157,7 +687,7 @@ class WebSocketClient:
             data: Command data
         """
         logger.info("Received command: stop_routine")
-        routine_state.stop_routine()
+        self._target_state(data).stop_routine()
     
     async def _handle_play_sound(self, data: Dict[str, Any]):
         """
@@ -167,12 +697,47 @@ class WebSocketClient:
             data: Command data
         """
         sound_name = data.get("sound_name")
+        state = self._target_state(data)
         if sound_name:
             logger.info(f"Received command: play_sound {sound_name}")
-            routine_state.play_sound(sound_name)
+            if not state.play_sound(sound_name):
+                raise CommandRejected("unknown_sound", f"unknown sound {sound_name!r}")
         else:
             logger.warning("Received play_sound command without sound_name")
     
+    async def _handle_select_routine(self, data: Dict[str, Any]):
+        """
+        Handle the select_routine command.
+        
+        Args:
+            data: Command data
+        """
+        routine_id = data.get("routine_id")
+        if routine_id is None:
+            logger.warning("Received select_routine command without routine_id")
+            return
+        state = self._target_state(data)
+        
+        logger.info(f"Received command: select_routine {routine_id}")
+        # Database access must not block the event loop
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()  # Keeps the command's trace
+        if not await loop.run_in_executor(None, context.run, state.select_routine, routine_id):
+            logger.warning(f"Unknown routine: {routine_id}")
+    
+    async def _handle_sync_assets(self, data: Dict[str, Any]):
+        """
+        Handle the sync_assets command.
+        
+        Args:
+            data: Command data
+        """
+        if self.asset_sync is None:
+            logger.warning("Received sync_assets command, but asset sync is disabled")
+            return
+        logger.info("Received command: sync_assets")
+        self.asset_sync.request_sync()
+    
     async def _receive_messages(self):
         """Receive and handle messages from the WebSocket server."""
         if not self.connected or not self.websocket:
@@ -181,6 +746,8 @@ class WebSocketClient:
         try:
             async for message in self.websocket:
                 await self._handle_message(message)
+            logger.info("WebSocket connection closed by server")
+            self.connected = False
         except ConnectionClosed:
             logger.info("WebSocket connection closed")
             self.connected = False
@@ -188,50 +755,150 @@ class WebSocketClient:
             logger.error(f"Error receiving messages: {e}")
             self.connected = False
     
-    async def _reconnect_loop(self):
-        """Reconnect to the WebSocket server if disconnected."""
+    async def _heartbeat(self):
+        """
+        Ping the server periodically and record the round-trip time.
+        
+        Returns when a pong does not arrive within heartbeat_timeout, which
+        makes the supervisor drop the (possibly half-open) connection.
+        """
+        while self.connected and self.websocket:
+            await self.clock.sleep(self.heartbeat_interval)
+            try:
+                sent_at = time.perf_counter()
+                pong_waiter = await self.websocket.ping()
+                await self.clock.wait_for(pong_waiter, self.heartbeat_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"No pong within {self.heartbeat_timeout}s, dropping connection")
+                self.connected = False
+                return
+            except Exception as e:
+                logger.info(f"Heartbeat stopped: {e}")
+                self.connected = False
+                return
+            self.last_rtt = time.perf_counter() - sent_at
+            self.rtt_samples.append(self.last_rtt)
+            HEARTBEAT_RTT.observe(self.last_rtt)
+    
+    async def _probe_clock(self):
+        """
+        Send clock probes to the server: a burst after connecting, then one
+        every time_sync_interval.
+        
+        Returns when the connection is lost, like the heartbeat.
+        """
+        probes = 0
+        while self.connected and self.websocket:
+            if not await self._send_message(self.time_sync.probe(self.clock.time())):
+                return
+            probes += 1
+            await self.clock.sleep(self.time_sync_burst_interval if probes < TIME_SYNC_BURST
+                                   else self.time_sync_interval)
+    
+    async def _run_connection(self):
+        """Run the receive loop, the heartbeat and the clock probes until one ends or the client stops."""
+        tasks = {
+            asyncio.create_task(self._receive_messages()),
+            asyncio.create_task(self._heartbeat()),
+            asyncio.create_task(self._stop_event.wait()),
+        }
+        if self.time_sync_interval is not None:
+            tasks.add(asyncio.create_task(self._probe_clock()))
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.disconnect()
+    
+    async def _supervise(self):
+        """Keep a connection to the server, reconnecting with jittered exponential backoff."""
+        backoff = DecorrelatedJitterBackoff(self.reconnect_interval, self.max_reconnect_interval, self.rng)
+        
         while self.running:
-            if not self.connected:
-                success = await self.connect()
-                if success:
-                    # Start receiving messages
-                    asyncio.create_task(self._receive_messages())
+            if await self.connect():
+                connected_at = self.clock.monotonic()
+                await self._run_connection()
+                if self.clock.monotonic() - connected_at >= self.stable_after:
+                    backoff.reset()
+                if not self.running:
+                    break
+                self.reconnects += 1
+                RECONNECTS.inc()
             
-            # Wait before checking connection again
-            await asyncio.sleep(self.reconnect_interval)
+            delay = backoff.next_delay()
+            logger.info(f"Reconnecting in {delay:.1f}s (attempt {backoff.attempts})")
+            try:
+                await self.clock.wait_for(self._stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
     
     async def run(self):
         """Run the WebSocket client."""
         self.running = True
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._high_lane = asyncio.Queue(maxsize=self.command_queue_size)
+        self._normal_lane = asyncio.Queue(maxsize=self.command_queue_size)
+        self._commands_ready = asyncio.Semaphore(0)
+        self._status_lock = asyncio.Lock()
+        self._subscribe(True)
         
-        # Start the reconnect loop
-        reconnect_task = asyncio.create_task(self._reconnect_loop())
-        
-        # Wait until stopped
-        while self.running:
-            await asyncio.sleep(1)
-        
-        # Clean up
-        reconnect_task.cancel()
-        await self.disconnect()
+        workers = [asyncio.create_task(self._command_worker()) for _ in range(self.command_workers)]
+        try:
+            await self._supervise()
+        finally:
+            for task in workers + list(self._background):
+                task.cancel()
+            await asyncio.gather(*workers, *self._background, return_exceptions=True)
+            for timer, _, _, _ in self._scheduled.values():
+                timer.cancel()
+            self._scheduled.clear()
+            self._subscribe(False)
+            await self.disconnect()
+    
+    def _subscribe(self, subscribe: bool):
+        """Follow (or stop following) the state, and the other runtimes if their status is sent too."""
+        source = self.registry if self.registry is not None and self.registry.default is self.state else self.state
+        if subscribe:
+            source.add_listener(self._on_state_change)
+        else:
+            source.remove_listener(self._on_state_change)
     
     def stop(self):
-        """Stop the WebSocket client."""
+        """Stop the WebSocket client (may be called from any thread)."""
         self.running = False
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
 
 # Function to start the WebSocket client in a separate thread
-def start_ws_client(server_url: str, reconnect_interval: int = 5) -> threading.Thread:
+def start_ws_client(server_url: str, reconnect_interval: float = 1,
+                    outbox_path: str = "outbox.db", device_id: Optional[str] = None,
+                    asset_sync=None, definition_sync=None) -> WebSocketClient:
     """
     Start the WebSocket client in a separate thread.
     
     Args:
         server_url: URL of the WebSocket server
-        reconnect_interval: Interval in seconds to attempt reconnection
+        reconnect_interval: Minimum delay in seconds before reconnecting
+        outbox_path: SQLite file holding undelivered messages
+        device_id: Identifies the device to the hub
+        asset_sync: AssetSync woken by sync_assets commands
+        definition_sync: DefinitionSync applying the routine definitions feed
         
     Returns:
-        The thread running the WebSocket client
+        The client; its thread is client.thread
     """
-    client = WebSocketClient(server_url, reconnect_interval)
+    client = WebSocketClient(server_url, reconnect_interval, outbox=Outbox(outbox_path), device_id=device_id,
+                             asset_sync=asset_sync, definition_sync=definition_sync)
+    
+    # Expose the device client's health, read when the metrics are scraped
+    CONNECTED.set_function(lambda: float(client.connected))
+    QUEUE_DEPTH.labels("high").set_function(lambda: client.queue_depth["high"])
+    QUEUE_DEPTH.labels("normal").set_function(lambda: client.queue_depth["normal"])
+    OUTBOX_PENDING.set_function(lambda: len(client.outbox))
+    CLOCK_OFFSET.set_function(lambda: client.time_sync.offset or 0.0)
     
     # Create a new event loop for the thread
     def run_client():
@@ -241,19 +908,17 @@ def start_ws_client(server_url: str, reconnect_interval: int = 5) -> threading.T
         loop.close()
     
     # Start the client in a separate thread
-    thread = threading.Thread(target=run_client, daemon=True)
-    thread.start()
+    client.thread = threading.Thread(target=run_client, daemon=True)
+    client.thread.start()
     
-    return thread
+    return client
 
 if __name__ == "__main__":
     # Test the WebSocket client
-    import time
-    
     # Replace with your WebSocket server URL
     server_url = "ws://localhost:3000/ws"
     
-    thread = start_ws_client(server_url)
+    client = start_ws_client(server_url)
     
     try:
         while True:
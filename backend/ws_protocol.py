@@ -0,0 +1,357 @@
+"""
+ws_protocol.py
+
+This module defines the message format shared by the device WebSocket client
+and the cloud side.
+
+Every device message carries a sequence number ("seq"). Status is sent as a
+full snapshot on (re)connect or when the server asks for a resync, and
+otherwise as a delta against the last status the server acknowledged:
+
+    {"type": "status", "seq": 7, "data": {...full status...}}
+    {"type": "status_delta", "seq": 8, "base": 7, "data": {...changed fields...}}
+
+Commands may carry a "trace_id" assigned by the cloud; the device records
+its handling of the command under that id (see tracing). A "target_id" in
+the command data addresses the routine runtime of one child or screen (see
+routine_registry); without it the device's own routine is meant. The status
+of the other runtimes is sent in the "targets" field of the status, by
+target id. A delta holds only the changed fields of the targets that
+changed, and null for a target that was removed:
+
+    {"type": "status_delta", "seq": 9, "base": 8,
+     "data": {"targets": {"anna": {"is_active": true}, "ben": null}}}
+
+The "sync_assets" command asks the device to fetch the hub's asset manifest
+now instead of at its next periodic sync (see asset_sync).
+
+Routine definitions edited in the cloud reach the device as a change feed
+(see definition_sync). Each committed edit gets the next revision; the
+device asks for the changes since the revision it last applied, after
+connecting, and the hub pushes new revisions as they happen:
+
+    {"type": "definitions_sync", "seq": 10, "revision": 41}
+    {"type": "definitions", "base": 41, "revision": 43, "full": false,
+     "changes": [{"table": "tasks", "id": 7, "row": {"name": ..., ...}},
+                 {"table": "routine_tasks", "id": 12, "deleted": true}]}
+
+A change holds the current row (DEFINITION_FIELDS) of every row touched
+after base. A "full" message holds every row instead, and rows it does not
+list are deleted; the hub sends one when it no longer has the changes
+since the device's revision, or the device has never synced.
+
+Commands may carry an "execute_at" time in seconds since the epoch on the
+hub's clock, so devices switch at the same moment instead of on receipt.
+The device estimates the hub's clock offset from time_sync probes (see
+time_sync), answered by the hub with its receive and send times:
+
+    {"type": "time_sync", "seq": 11, "t0": 1767290400.102}
+    {"type": "time_sync", "t0": 1767290400.102, "t1": 1767290400.611, "t2": 1767290400.612}
+
+Commands the device cannot queue because it is overloaded are answered with
+{"type": "nack", "command": "next_task", "reason": "busy"}, and queued or
+scheduled commands discarded by a priority command with reason "preempted",
+commands for a target_id the device does not run with "unknown_target", and
+play_sound commands for a sound the device does not have with "unknown_sound".
+
+The server acknowledges with {"type": "ack", "seq": 8} (cumulative: every
+message up to seq 8) and requests a full snapshot with {"type": "resync"}
+when it detects a gap.
+
+Messages that must survive disconnects also carry a persistent outbox "id".
+After (re)connecting the device sends one batch holding a full status and
+every unacknowledged message, oldest first; the server drops messages whose
+id it has already processed:
+
+    {"type": "batch", "seq": 9, "messages": [{"type": "status", "id": 41, "data": {...}}]}
+
+Messages are encoded with a codec negotiated through the WebSocket
+subprotocol. The binary MessagePack codec replaces known field names, message
+types and command names with fixed integer ids; servers that select no
+subprotocol get plain JSON text frames.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # Optional dependency, JSON is used without it
+    msgpack = None
+
+# Message types
+COMMAND = "command"
+STATUS = "status"
+STATUS_DELTA = "status_delta"
+ACK = "ack"
+RESYNC = "resync"
+BATCH = "batch"
+NACK = "nack"
+DEFINITIONS = "definitions"
+DEFINITIONS_SYNC = "definitions_sync"
+TIME_SYNC = "time_sync"
+
+# Columns of the routine definition rows in the definitions feed, by table
+DEFINITION_FIELDS = {
+    "tasks": ("name", "icon_name", "sound", "duration"),
+    "routines": ("name", "description", "is_active"),
+    "routine_tasks": ("routine_id", "task_id", "position"),
+}
+
+# Fixed ids of the binary encoding. These tables are append-only: never
+# renumber or reuse an id, old devices and servers rely on them.
+FIELD_IDS = {
+    "type": 0, "seq": 1, "command": 2, "data": 3, "base": 4,
+    "is_active": 5, "current_task": 6, "current_sound": 7,
+    "id": 8, "name": 9, "icon_name": 10, "sound": 11, "duration": 12,
+    "sound_name": 13, "routine_id": 14, "messages": 15,
+    "reason": 16, "trace_id": 17, "target_id": 18, "targets": 19,
+    "revision": 20, "changes": 21, "full": 22, "table": 23, "row": 24,
+    "deleted": 25, "description": 26, "task_id": 27, "position": 28,
+    "execute_at": 29, "t0": 30, "t1": 31, "t2": 32,
+}
+MESSAGE_TYPE_IDS = {COMMAND: 0, STATUS: 1, STATUS_DELTA: 2, ACK: 3, RESYNC: 4, BATCH: 5, NACK: 6,
+                    DEFINITIONS: 7, DEFINITIONS_SYNC: 8, TIME_SYNC: 9}
+COMMAND_IDS = {
+    "start_routine": 0, "next_task": 1, "stop_routine": 2, "play_sound": 3,
+    "select_routine": 4, "sync_assets": 5,
+}
+
+class JsonCodec:
+    """Plain JSON text frames, understood by every server."""
+
+    subprotocol = None
+
+    def encode(self, message: Dict[str, Any]) -> str:
+        return json.dumps(message, separators=(",", ":"))
+
+    def decode(self, frame: Union[str, bytes]) -> Dict[str, Any]:
+        return json.loads(frame)
+
+class MsgpackCodec:
+    """
+    MessagePack binary frames with integer ids for known field names, message
+    types and commands. Unknown names are sent as strings.
+    """
+
+    subprotocol = "routine.msgpack.v1"
+
+    def __init__(self):
+        self._field_names = {v: k for k, v in FIELD_IDS.items()}
+        self._type_names = {v: k for k, v in MESSAGE_TYPE_IDS.items()}
+        self._command_names = {v: k for k, v in COMMAND_IDS.items()}
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        return msgpack.packb(self._compact(message), use_bin_type=True)
+
+    def decode(self, frame: Union[str, bytes]) -> Dict[str, Any]:
+        if isinstance(frame, str):
+            # A text frame on a binary connection is JSON
+            return json.loads(frame)
+        try:
+            message = msgpack.unpackb(frame, raw=False, strict_map_key=False)
+        except Exception as e:
+            raise ValueError(f"Invalid MessagePack frame: {e}") from e
+        return self._expand(message)
+
+    def _compact(self, value):
+        if isinstance(value, dict):
+            compact = {}
+            for key, item in value.items():
+                if key == "type":
+                    item = MESSAGE_TYPE_IDS.get(item, item)
+                elif key == "command":
+                    item = COMMAND_IDS.get(item, item)
+                else:
+                    item = self._compact(item)
+                compact[FIELD_IDS.get(key, key)] = item
+            return compact
+        if isinstance(value, list):
+            return [self._compact(item) for item in value]
+        return value
+
+    def _expand(self, value):
+        if isinstance(value, dict):
+            expanded = {}
+            for key, item in value.items():
+                key = self._field_names.get(key, key)
+                if key == "type":
+                    item = self._type_names.get(item, item)
+                elif key == "command":
+                    item = self._command_names.get(item, item)
+                else:
+                    item = self._expand(item)
+                expanded[key] = item
+            return expanded
+        if isinstance(value, list):
+            return [self._expand(item) for item in value]
+        return value
+
+def available_codecs() -> List[Any]:
+    """Get the codecs this installation supports, most preferred first."""
+    codecs = []
+    if msgpack is not None:
+        codecs.append(MsgpackCodec())
+    codecs.append(JsonCodec())
+    return codecs
+
+def codec_for_subprotocol(subprotocol: Optional[str]):
+    """Get the codec for a negotiated subprotocol (JSON if none was selected)."""
+    for codec in available_codecs():
+        if codec.subprotocol == subprotocol:
+            return codec
+    return JsonCodec()
+
+def supported_subprotocols() -> List[str]:
+    """Get the subprotocols to offer during the WebSocket handshake."""
+    return [codec.subprotocol for codec in available_codecs() if codec.subprotocol]
+
+def status_snapshot(state, registry=None) -> Dict[str, Any]:
+    """
+    Get the status of a RoutineState as sent to the server, with the status
+    of the other runtimes of a RoutineRegistry if it has any.
+    """
+    status = state.snapshot()
+    if registry is not None and len(registry):
+        status["targets"] = registry.snapshots()
+    return status
+
+def diff_status(base: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Get the fields of current that differ from base.
+
+    "targets" is diffed per target: it holds the changed fields of every
+    target that changed, and None for every target that was removed.
+    """
+    changes = {key: value for key, value in current.items() if key != "targets" and base.get(key) != value}
+    base_targets = base.get("targets") or {}
+    targets = current.get("targets") or {}
+    target_changes = {target_id: None for target_id in base_targets if target_id not in targets}
+    for target_id, target in targets.items():
+        target_diff = diff_status(base_targets[target_id], target) if target_id in base_targets else target
+        if target_diff:
+            target_changes[target_id] = target_diff
+    if target_changes:
+        changes["targets"] = target_changes
+    return changes
+
+def apply_status_delta(base: Dict[str, Any], changes: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the status resulting from applying a delta to base."""
+    status = dict(base)
+    status.update({key: value for key, value in changes.items() if key != "targets"})
+    if "targets" in changes:
+        targets = dict(base.get("targets") or {})
+        for target_id, target_changes in changes["targets"].items():
+            if target_changes is None:
+                targets.pop(target_id, None)
+            else:
+                targets[target_id] = apply_status_delta(targets.get(target_id, {}), target_changes)
+        if targets:
+            status["targets"] = targets
+        else:
+            # The last target was removed, so the snapshot has no targets either
+            status.pop("targets", None)
+    return status
+
+class StatusTracker:
+    """
+    Server-side reconstruction of one device's status from snapshots and deltas.
+
+    Keeps the statuses of the most recent sequence numbers, because a delta
+    is relative to the last status the server acknowledged, which may be
+    older than the last status it received.
+    """
+
+    def __init__(self, history: int = 16, last_id: int = 0):
+        """
+        Args:
+            history: Statuses kept as delta bases
+            last_id: Highest outbox id processed on earlier connections of
+                the device, so a replayed batch is not applied again
+        """
+        self.history = history
+        self.status: Optional[Dict[str, Any]] = None
+        self.last_seq: Optional[int] = None
+        self.last_id = last_id  # Highest outbox id processed
+        self._statuses: Dict[int, Dict[str, Any]] = {}
+
+    def is_duplicate(self, message: Dict[str, Any]) -> bool:
+        """
+        Check whether a message with an outbox id was already processed, and
+        record its id otherwise.
+        """
+        message_id = message.get("id")
+        if message_id is None:
+            return False
+        if message_id <= self.last_id:
+            return True
+        self.last_id = message_id
+        return False
+
+    def apply_batch(self, message: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Apply a batch replayed after a reconnect.
+
+        Returns:
+            The messages of the batch not processed before, in order
+        """
+        seq = message.get("seq")
+        fresh = [m for m in message.get("messages", []) if not self.is_duplicate(m)]
+        statuses = [m for m in fresh if m.get("type") == STATUS]
+        if statuses:
+            self.apply(dict(statuses[-1], seq=seq))
+        else:
+            self.observe(seq)
+        return fresh
+
+    def apply(self, message: Dict[str, Any]) -> bool:
+        """
+        Apply a status or status_delta message.
+
+        Returns:
+            True if the status is up to date, False if a resync is needed
+        """
+        seq = message.get("seq")
+        if message.get("type") == STATUS:
+            self._statuses.clear()
+            self._store(seq, message.get("data") or {})
+            return True
+
+        if self.last_seq is None or seq is None or seq <= self.last_seq:
+            # Duplicate or out-of-order delta: nothing to apply
+            return self.last_seq is not None and seq is not None
+
+        base = self._statuses.get(message.get("base"))
+        if base is None or self._has_gap(seq):
+            return False
+
+        self._store(seq, apply_status_delta(base, message.get("data") or {}))
+        return True
+
+    def observe(self, seq: Optional[int]) -> bool:
+        """
+        Note the sequence number of a non-status message.
+
+        Returns:
+            True if no message was missed before it
+        """
+        if seq is None or self.last_seq is None:
+            return True
+        if seq <= self.last_seq:
+            return True
+        in_order = not self._has_gap(seq)
+        self.last_seq = seq
+        if self.status is not None:
+            self._statuses[seq] = self.status
+        return in_order
+
+    def _has_gap(self, seq: int) -> bool:
+        return self.last_seq is not None and seq != self.last_seq + 1
+
+    def _store(self, seq: Optional[int], status: Dict[str, Any]):
+        self.status = status
+        self.last_seq = seq
+        if seq is not None:
+            self._statuses[seq] = status
+            for old in [s for s in self._statuses if s <= seq - self.history]:
+                del self._statuses[old]